@@ -1,7 +1,6 @@
 import WRF_Hydro_forcing as whf
 import logging
 import os
-from ConfigParser import SafeConfigParser
 
 """Analysis_Assimilation_Forcing
 Performs the regridding and downscaling 
@@ -15,8 +14,9 @@ parameter/configuration file.
 #----------------------------------------------
 
 if __name__ == "__main__":
-    parser = SafeConfigParser()
-    parser.read('wrf_hydro_forcing.parm')
+    args = whf.forcing_arguments(
+        'Analysis and Assimilation forcing configuration', watch=True)
+    parser = whf.read_parm(args)
 
     ncl_exec = parser.get('exe', 'ncl_exe')
     ncarg_root = parser.get('default_env_vars', 'ncarg_root')
@@ -54,29 +54,27 @@ if __name__ == "__main__":
     # bias_correction("HRRR")
     # bias_correction("RAP")
 
-    # Regrid the MRMS, RAP, and HRRR data.
-    MRMS_regrids = whf.regrid_data("MRMS",parser)     
-    RAP_regrids = whf.regrid_data("RAP", parser)
-    HRRR_regrids = whf.regrid_data("HRRR", parser)
-    
-    # Downscale the RAP and HRRR data; the MRMS data does not require
-    # downscaling. 
-    RAP_downscalings = whf.downscale_data("RAP",parser)
-    HRRR_downscalings = whf.downscale_data("HRRR", parser)
-
-    # Layering the HRRR (primary) and RAP (secondary) data.
-    Analysis_Assimilation_Layering = whf.layer_data(parser, "HRRR","RAP")
-   
-    # Generate the metrics for regridding, downscaling and layering. 
-    # Write to the logfile, which by default is saved to the directory 
-    # from which this application is run.
-    # 
-    whf.create_benchmark("MRMS","Regridding", MRMS_regrids)
-    whf.create_benchmark("MRMS","Downscaling", MRMS_downscalings)
-    whf.create_benchmark("RAP","Regridding", RAP_regrids)
-    whf.create_benchmark("RAP","Downscaling", RAP_downscalings)
-    whf.create_benchmark("HRRR","Regridding", HRRR_regrids)
-    whf.create_benchmark("HRRR","Downscaling", HRRR_downscalings)
-    whf.create_benchmark_summary("HRRR_RAP","Layering", HRRR_RAP_layering)
-
+    if args.watch:
+        # Regrid, downscale and layer each forecast hour as soon as
+        # its files have arrived.
+        job_metrics = whf.watch_data(parser, ["MRMS", "HRRR", "RAP"],
+                                     layering=("HRRR", "RAP"))
+        whf.create_benchmark(job_metrics)
+    else:
+        # Regrid the MRMS, HRRR and RAP data, downscale the HRRR and
+        # RAP data (the MRMS data does not require downscaling) and
+        # layer the HRRR (primary) and RAP (secondary) data.  Each
+        # forecast hour is downscaled as soon as it is regridded and
+        # layered as soon as both products are downscaled.  If the
+        # fused pipeline is enabled, the HRRR and RAP data are instead
+        # regridded, downscaled and layered in memory, one forecast
+        # hour at a time.
+        job_metrics = whf.run_forcing_graph(parser, ["MRMS", "HRRR", "RAP"],
+                                            layering=("HRRR", "RAP"))
 
+        # Generate the metrics for regridding, downscaling and layering. 
+        # Write to the logfile, which by default is saved to the directory 
+        # from which this application is run, and to the _metrics.csv and
+        # _metrics.jsonl files next to it.
+        # 
+        whf.create_benchmark(job_metrics)
@@ -0,0 +1,544 @@
+import WRF_Hydro_downscale
+import WRF_Hydro_layering
+import WRF_Hydro_netcdf
+import WRF_Hydro_regrid
+import WRF_Hydro_shortwave
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from collections import OrderedDict
+from netCDF4 import Dataset
+
+
+
+# -----------------------------------------------------
+#             Benchmark_Kernels.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Benchmark of the numeric kernels of the Python engines
+#  (regridding, downscaling, shortwave adjustment, layering and the
+#  NetCDF I/O) on synthetic inputs, so that their throughput can be
+#  measured on any Linux host, without the HRRR/RAP data and the
+#  weight files of the test host and without network access.  For
+#  each grid scale (a fraction of the size, along each axis, of the
+#  HRRR source grid and of the CONUS 1 km destination grid; 1 is
+#  the real size) the following are generated in the work
+#  directory, and reused by the next runs with the same work
+#  directory:
+#     an ESMF bilinear weight file (row, col, S) from the source to
+#     the destination grid,
+#     a geo_dst file (HGT_M, XLAT_M, XLONG_M, COSALPHA, SINALPHA),
+#     the height file of the source data on the destination grid
+#     (HGT) and a lapse rate file (lapse),
+#  along with HRRR-shaped source fields, in memory.  Each kernel is
+#  timed in this process (median of --repeat runs), then a whole
+#  forecast hour (regridding, downscaling and shortwave adjustment
+#  of a primary and a secondary product, layering, writing) is run
+#  for --hours forecast hours by each of the --workers pool sizes,
+#  giving the time per forecast hour.  The writing and reading of
+#  the regridded fields are timed with each of the OUTPUT_PRESETS
+#  (format, compression and packing of the [output] section of the
+#  wrf_hydro_forcing.parm file), whose throughput and compression
+#  ratio are reported.
+#
+#  The results can be saved as a baseline (--save-baseline) and
+#  compared with a baseline saved earlier on the same host
+#  (--baseline): a timing more than --tolerance slower than its
+#  baseline is a regression, and the exit status is then 1.
+#
+#  Usage:
+#     python Benchmark_Kernels.py --scales 0.125,0.25 --workers 1,4 \
+#         --baseline kernels_baseline.json
+
+
+# The (south_north, west_east) shapes of the HRRR grid and of the
+# CONUS 1 km WRF-Hydro grid.
+HRRR_SHAPE = (1059, 1799)
+CONUS_SHAPE = (3840, 4608)
+
+# The smallest size of a synthetic grid along each axis.
+MIN_GRID_SIZE = 16
+
+# The fields of the synthetic HRRR files, as regridded.
+SOURCE_FIELDS = ('T2D', 'Q2D', 'U2D', 'V2D', 'PSFC', 'RAINRATE', 'SWDOWN',
+                 'LWDOWN')
+
+# The output options compared (see WRF_Hydro_netcdf), the
+# quantization keeping the precision the forcing data needs.
+LEAST_SIGNIFICANT_DIGITS = {'T2D': 2, 'Q2D': 5, 'U2D': 2, 'V2D': 2, 'PSFC': 0,
+                            'RAINRATE': 7, 'SWDOWN': 1, 'LWDOWN': 1}
+OUTPUT_PRESETS = OrderedDict([
+    ('netcdf3', None),
+    ('netcdf4', {'format': 'NETCDF4_CLASSIC'}),
+    ('zlib1', {'format': 'NETCDF4_CLASSIC', 'complevel': 1}),
+    ('zlib4', {'format': 'NETCDF4_CLASSIC', 'complevel': 4}),
+    ('zlib4_lsd', {'format': 'NETCDF4_CLASSIC', 'complevel': 4,
+                   'least_significant_digit': LEAST_SIGNIFICANT_DIGITS}),
+    ('zlib4_int16', {'format': 'NETCDF4_CLASSIC', 'complevel': 4,
+                     'pack_int16': SOURCE_FIELDS}),
+    ])
+
+# The valid time of the synthetic fields, at which the sun is up
+# over the whole CONUS domain.
+VALID_TIME = datetime.datetime(2015, 7, 1, 18)
+
+# The inputs and the fields of the forecast hours, loaded once by
+# each worker process (see init_worker).
+_worker = {}
+
+
+
+def grid_shapes(scale):
+    """Returns the source (HRRR) and destination (CONUS 1 km) grid
+    shapes at a scale.
+    """
+    def scaled(shape):
+        return tuple(max(int(round(size * scale)), MIN_GRID_SIZE)
+                     for size in shape)
+    return (scaled(HRRR_SHAPE), scaled(CONUS_SHAPE))
+
+
+
+def smooth_field(shape, seed, low, high, waves=3.):
+    """Returns a smooth float32 field between low and high, with a
+    little noise, for a grid of the given shape.
+    """
+    rng = np.random.RandomState(seed)
+    (ny, nx) = shape
+    phase = rng.uniform(0., 2. * np.pi, 2)
+    rows = np.sin(np.linspace(0., waves * np.pi, ny) + phase[0])
+    cols = np.cos(np.linspace(0., waves * np.pi, nx) + phase[1])
+    field = (np.outer(rows, cols) + 1.) / 2.
+    field += rng.uniform(-0.02, 0.02, shape)
+    field = low + (high - low) * np.clip(field, 0., 1.)
+    return field.astype(np.float32)
+
+
+
+def write_weight_file(wgt_file, src_shape, dst_shape):
+    """Writes an ESMF bilinear weight file from a source grid to a
+    destination grid covering the same area: each destination cell
+    gets the weights of the four source cells around it.
+    """
+    (src_ny, src_nx) = src_shape
+    (dst_ny, dst_nx) = dst_shape
+    y = np.linspace(0., src_ny - 1., dst_ny)
+    x = np.linspace(0., src_nx - 1., dst_nx)
+    y0 = np.minimum(np.floor(y).astype(np.int64), src_ny - 2)
+    x0 = np.minimum(np.floor(x).astype(np.int64), src_nx - 2)
+    fy = (y - y0)[:, np.newaxis]
+    fx = (x - x0)[np.newaxis, :]
+
+    rows = []
+    cols = []
+    weights = []
+    dst_index = np.arange(dst_ny * dst_nx, dtype=np.int32).reshape(dst_shape)
+    for (dy, dx, weight) in ((0, 0, (1. - fy) * (1. - fx)),
+                             (0, 1, (1. - fy) * fx),
+                             (1, 0, fy * (1. - fx)),
+                             (1, 1, fy * fx)):
+        src_index = (y0 + dy)[:, np.newaxis] * src_nx + (x0 + dx)[np.newaxis, :]
+        rows.append(dst_index.ravel() + 1)
+        cols.append(src_index.astype(np.int32).ravel() + 1)
+        weights.append(weight.ravel())
+
+    tmp_file = wgt_file + ".tmp"
+    with Dataset(tmp_file, 'w', format='NETCDF3_64BIT') as nc:
+        nc.createDimension('n_a', src_ny * src_nx)
+        nc.createDimension('n_b', dst_ny * dst_nx)
+        nc.createDimension('n_s', 4 * dst_ny * dst_nx)
+        nc.createDimension('src_grid_rank', 2)
+        nc.createDimension('dst_grid_rank', 2)
+        # ESMF stores the grid dimensions in Fortran order.
+        nc.createVariable('src_grid_dims', 'i4', ('src_grid_rank',))[:] = \
+            [src_nx, src_ny]
+        nc.createVariable('dst_grid_dims', 'i4', ('dst_grid_rank',))[:] = \
+            [dst_nx, dst_ny]
+        nc.createVariable('row', 'i4', ('n_s',))[:] = np.concatenate(rows)
+        nc.createVariable('col', 'i4', ('n_s',))[:] = np.concatenate(cols)
+        nc.createVariable('S', 'f8', ('n_s',))[:] = np.concatenate(weights)
+    os.rename(tmp_file, wgt_file)
+
+
+
+def write_static_file(out_file, fields, attributes=None):
+    """Writes static fields, with a Time dimension of size 1 as in
+    the geo_dst files.
+    """
+    tmp_file = out_file + ".tmp"
+    with Dataset(tmp_file, 'w', format='NETCDF3_64BIT') as nc:
+        shape = list(fields.values())[0].shape
+        nc.createDimension('Time', 1)
+        nc.createDimension('south_north', shape[0])
+        nc.createDimension('west_east', shape[1])
+        for name, field in fields.items():
+            nc.createVariable(name, 'f4',
+                              ('Time', 'south_north', 'west_east'))[0] = field
+        for (name, value) in (attributes or {}).items():
+            nc.setncattr(name, value)
+    os.rename(tmp_file, out_file)
+
+
+
+def make_inputs(work_dir, scale):
+    """Creates the synthetic static inputs of a grid scale in the
+    work directory, unless they already exist.
+
+    Returns:
+        inputs (dict):  The src_shape, dst_shape and the paths of the
+                        wgt_file, geo_file, hgt_file and lapse_file.
+
+    """
+    (src_shape, dst_shape) = grid_shapes(scale)
+    name = "%dx%d_%dx%d" % (src_shape + dst_shape)
+    inputs = {'src_shape': src_shape,
+              'dst_shape': dst_shape,
+              'wgt_file': os.path.join(work_dir, "wgt_bilinear_%s.nc" % name),
+              'geo_file': os.path.join(work_dir, "geo_dst_%s.nc" % name),
+              'hgt_file': os.path.join(work_dir, "hgt_%s.nc" % name),
+              'lapse_file': os.path.join(work_dir, "lapse_%s.nc" % name)}
+
+    if not os.path.isfile(inputs['wgt_file']):
+        logging.info("Creating the weight file %s", inputs['wgt_file'])
+        write_weight_file(inputs['wgt_file'], src_shape, dst_shape)
+    if not os.path.isfile(inputs['geo_file']):
+        logging.info("Creating the geo file %s", inputs['geo_file'])
+        (ny, nx) = dst_shape
+        lat = np.linspace(21., 53., ny).astype(np.float32)
+        lon = np.linspace(-125., -67., nx).astype(np.float32)
+        write_static_file(inputs['geo_file'], OrderedDict([
+            ('HGT_M', smooth_field(dst_shape, 1, 0., 3500., waves=9.)),
+            ('XLAT_M', np.repeat(lat[:, np.newaxis], nx, axis=1)),
+            ('XLONG_M', np.repeat(lon[np.newaxis, :], ny, axis=0)),
+            ('COSALPHA', np.ones(dst_shape, dtype=np.float32)),
+            ('SINALPHA', np.zeros(dst_shape, dtype=np.float32))]),
+            {'DX': 1000. / scale, 'DY': 1000. / scale})
+    if not os.path.isfile(inputs['hgt_file']):
+        logging.info("Creating the height file %s", inputs['hgt_file'])
+        write_static_file(inputs['hgt_file'], {
+            'HGT': smooth_field(dst_shape, 1, 0., 3500., waves=9.) +
+                   smooth_field(dst_shape, 2, -150., 150.)})
+    if not os.path.isfile(inputs['lapse_file']):
+        logging.info("Creating the lapse rate file %s", inputs['lapse_file'])
+        write_static_file(inputs['lapse_file'], {
+            'lapse': smooth_field(dst_shape, 3, 4.5, 8.5)})
+    return inputs
+
+
+
+def source_fields(src_shape, seed, margin=0.):
+    """Returns HRRR-shaped source fields (float32, in the units of
+    the regridded files), keyed by variable name.  The cells within
+    margin (a fraction of the grid size) of the borders are missing,
+    e.g. for a primary product not covering the whole domain.
+    """
+    ranges = {'T2D': (260., 310.), 'Q2D': (0.001, 0.02), 'U2D': (-15., 15.),
+              'V2D': (-15., 15.), 'PSFC': (70000., 102000.),
+              'RAINRATE': (0., 0.005), 'SWDOWN': (0., 1000.),
+              'LWDOWN': (200., 450.)}
+    fields = OrderedDict()
+    for (offset, name) in enumerate(SOURCE_FIELDS):
+        fields[name] = smooth_field(src_shape, seed * 100 + offset,
+                                    *ranges[name])
+    if margin > 0.:
+        (ny, nx) = src_shape
+        (my, mx) = (int(ny * margin), int(nx * margin))
+        missing = np.ones(src_shape, dtype=bool)
+        missing[my:ny - my, mx:nx - mx] = False
+        fields['T2D'][missing] = np.nan
+    return fields
+
+
+
+def time_kernel(kernel, repeat, setup=None):
+    """Returns the median time (in seconds) of repeat runs of a
+    kernel, called with the arguments returned by setup (untimed).
+    """
+    times = []
+    for i in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.time()
+        kernel(*args)
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+
+def benchmark_kernels(inputs, repeat, out_dir):
+    """Times each kernel on the synthetic inputs of a grid scale.
+
+    Returns:
+        timings (OrderedDict):  The median time in seconds of each
+                                kernel, keyed by kernel name.
+
+    """
+    timings = OrderedDict()
+    src = source_fields(inputs['src_shape'], 0)
+    src_list = list(src.values())
+
+    timings['read_weights'] = time_kernel(
+        WRF_Hydro_regrid.read_weights, repeat, lambda: (inputs['wgt_file'],))
+    weights = WRF_Hydro_regrid.read_weights(inputs['wgt_file'])
+    timings['regrid'] = time_kernel(weights.apply, repeat, lambda: (src_list,))
+    regridded = OrderedDict(zip(src, weights.apply(src_list)))
+
+    static_files = (inputs['hgt_file'], inputs['geo_file'],
+                    inputs['lapse_file'])
+    def load_static():
+        WRF_Hydro_downscale._static_cache.clear()
+        return WRF_Hydro_downscale.load_static_fields(*static_files)
+    timings['downscale_static'] = time_kernel(load_static, repeat)
+    static = load_static()
+    timings['downscale'] = time_kernel(
+        WRF_Hydro_downscale.downscale_fields, repeat,
+        lambda: (dict((name, field.copy())
+                      for name, field in regridded.items()), static))
+
+    def load_geometry():
+        WRF_Hydro_shortwave._geometry_cache.clear()
+        return WRF_Hydro_shortwave.load_terrain_geometry(inputs['geo_file'])
+    timings['shortwave_geometry'] = time_kernel(load_geometry, repeat)
+    geometry = load_geometry()
+    timings['shortwave'] = time_kernel(
+        WRF_Hydro_shortwave.adjust_shortwave, repeat,
+        lambda: (regridded['SWDOWN'].copy(), geometry, VALID_TIME))
+
+    primary = OrderedDict(zip(src, weights.apply(
+        list(source_fields(inputs['src_shape'], 1, margin=0.1).values()))))
+    missing = WRF_Hydro_layering.missing_index(primary['T2D'])
+    timings['layering'] = time_kernel(
+        WRF_Hydro_layering.layer_fields, repeat,
+        lambda: (OrderedDict((name, (field.copy(), {}))
+                             for name, field in primary.items()),
+                 OrderedDict((name, (field, {}))
+                             for name, field in regridded.items()),
+                 missing))
+
+    return timings
+
+
+
+def benchmark_output(inputs, repeat, out_dir):
+    """Times the writing and reading of the regridded fields of a
+    grid scale with each of the OUTPUT_PRESETS.
+
+    Returns:
+        (timings, sizes) (tuple):  The median times in seconds, keyed
+                                   by write_<preset> and read_<preset>,
+                                   and the size in bytes of the file
+                                   written with each preset.
+
+    """
+    weights = WRF_Hydro_regrid.read_weights(inputs['wgt_file'])
+    src = source_fields(inputs['src_shape'], 0)
+    fields = OrderedDict((name, (field, {})) for name, field in
+                         zip(src, weights.apply(list(src.values()))))
+    out_file = os.path.join(out_dir, "benchmark_fields.nc")
+    timings = OrderedDict()
+    sizes = OrderedDict()
+    for preset, options in OUTPUT_PRESETS.items():
+        timings['write_' + preset] = time_kernel(
+            WRF_Hydro_netcdf.write_fields, repeat,
+            lambda: (out_file, fields, options))
+        timings['read_' + preset] = time_kernel(
+            WRF_Hydro_netcdf.read_fields, repeat,
+            lambda: (out_file, SOURCE_FIELDS))
+        sizes[preset] = os.path.getsize(out_file)
+        os.remove(out_file)
+    return (timings, sizes)
+
+
+
+def init_worker(inputs, out_dir):
+    """Loads the inputs of a grid scale in a worker process."""
+    _worker['inputs'] = inputs
+    _worker['out_dir'] = out_dir
+    _worker['primary'] = source_fields(inputs['src_shape'], 1, margin=0.1)
+    _worker['secondary'] = source_fields(inputs['src_shape'], 2)
+    WRF_Hydro_regrid.load_weights(inputs['wgt_file'])
+    WRF_Hydro_downscale.load_static_fields(inputs['hgt_file'],
+                                           inputs['geo_file'],
+                                           inputs['lapse_file'])
+    WRF_Hydro_shortwave.load_terrain_geometry(inputs['geo_file'])
+
+
+
+def run_forecast_hour(hour):
+    """Regrids, downscales (with the shortwave adjustment) and
+    layers the synthetic fields of a forecast hour, then writes the
+    layered file, in a worker process (see init_worker).  This must
+    remain a module-level function.
+    """
+    inputs = _worker['inputs']
+    weights = WRF_Hydro_regrid.load_weights(inputs['wgt_file'])
+    products = []
+    for src in (_worker['primary'], _worker['secondary']):
+        fields = OrderedDict((name, (field, {})) for name, field in
+                             zip(src, weights.apply(list(src.values()))))
+        WRF_Hydro_downscale.downscale_in_memory(
+            fields, inputs['hgt_file'], inputs['geo_file'],
+            inputs['lapse_file'], True, None, VALID_TIME)
+        products.append(fields)
+    layered = WRF_Hydro_layering.layer_fields(products[0], products[1])
+    out_file = os.path.join(_worker['out_dir'],
+                            "layered_f%03d_%d.nc" % (hour, os.getpid()))
+    WRF_Hydro_netcdf.write_fields(out_file, layered)
+    os.remove(out_file)
+
+
+
+def benchmark_workers(inputs, num_workers, hours, out_dir):
+    """Runs forecast hours (see run_forecast_hour) with a pool of
+    worker processes.
+
+    Returns:
+        seconds (float):  The wall clock time per forecast hour.
+
+    """
+    pool = multiprocessing.Pool(num_workers, init_worker, (inputs, out_dir))
+    try:
+        # Warm up every worker, which loads the inputs once.
+        pool.map(run_forecast_hour, range(num_workers), chunksize=1)
+        start = time.time()
+        pool.map(run_forecast_hour, range(hours), chunksize=1)
+        return (time.time() - start) / hours
+    finally:
+        pool.close()
+        pool.join()
+
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Compares the timings with those of a baseline.
+
+    Returns:
+        regressions (list):  The (name, baseline, current) tuples of
+                             the timings more than tolerance (a
+                             fraction) slower than their baseline.
+
+    """
+    regressions = []
+    for name, seconds in results.items():
+        if name in baseline and seconds > baseline[name] * (1. + tolerance):
+            regressions.append((name, baseline[name], seconds))
+    return regressions
+
+
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(",") if item.strip()]
+
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark of the numeric kernels on synthetic data')
+    arg_parser.add_argument('--scales', default='0.125,0.25',
+                            help='comma-separated grid scales, 1 being the '
+                                 'HRRR and CONUS 1 km grids (default: '
+                                 '%(default)s)')
+    arg_parser.add_argument('--workers', default='1,2,4',
+                            help='comma-separated numbers of worker '
+                                 'processes (default: %(default)s)')
+    arg_parser.add_argument('--hours', type=int, default=8,
+                            help='forecast hours run for each number of '
+                                 'workers (default: %(default)s)')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='runs of each kernel (default: %(default)s)')
+    arg_parser.add_argument('--work-dir',
+                            help='directory of the synthetic inputs, kept '
+                                 'and reused (default: a temporary '
+                                 'directory)')
+    arg_parser.add_argument('--baseline',
+                            help='JSON file of the baseline timings to '
+                                 'compare with')
+    arg_parser.add_argument('--save-baseline',
+                            help='JSON file to save the timings to, as a '
+                                 'baseline')
+    arg_parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='slowdown (fraction) over the baseline '
+                                 'reported as a regression (default: '
+                                 '%(default)s)')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="wrf_hydro_benchmark_")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    results = OrderedDict()
+    output_sizes = OrderedDict()
+    try:
+        for scale in parse_list(args.scales, float):
+            inputs = make_inputs(work_dir, scale)
+            logging.info("Scale %s: source grid %s, destination grid %s",
+                         scale, inputs['src_shape'], inputs['dst_shape'])
+            for kernel, seconds in benchmark_kernels(inputs, args.repeat,
+                                                     work_dir).items():
+                results["scale=%s %s" % (scale, kernel)] = seconds
+            (timings, sizes) = benchmark_output(inputs, args.repeat, work_dir)
+            for kernel, seconds in timings.items():
+                results["scale=%s %s" % (scale, kernel)] = seconds
+            output_sizes[scale] = sizes
+            for num_workers in parse_list(args.workers, int):
+                results["scale=%s forecast_hour workers=%d" %
+                        (scale, num_workers)] = \
+                    benchmark_workers(inputs, num_workers, args.hours, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['timings']
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    regressed = set(name for (name, base, seconds) in regressions)
+
+    print("%-45s %12s %12s %8s" % ("kernel", "seconds", "baseline", "ratio"))
+    for name, seconds in results.items():
+        if name in baseline:
+            print("%-45s %12.4f %12.4f %8.2f%s" %
+                  (name, seconds, baseline[name], seconds / baseline[name],
+                   "  REGRESSION" if name in regressed else ""))
+        else:
+            print("%-45s %12.4f %12s %8s" % (name, seconds, "-", "-"))
+
+    # The throughput is that of the uncompressed (float32) fields.
+    print("")
+    print("%-12s %-12s %10s %8s %14s %14s" % ("scale", "output", "size (MB)",
+                                              "ratio", "write (MB/s)",
+                                              "read (MB/s)"))
+    for scale, sizes in output_sizes.items():
+        (src_shape, dst_shape) = grid_shapes(scale)
+        data_size = 4. * dst_shape[0] * dst_shape[1] * len(SOURCE_FIELDS)
+        for preset, size in sizes.items():
+            print("%-12s %-12s %10.2f %8.2f %14.1f %14.1f" %
+                  (scale, preset, size / 2.**20, sizes['netcdf3'] / float(size),
+                   data_size / 2.**20 / results["scale=%s write_%s" %
+                                                (scale, preset)],
+                   data_size / 2.**20 / results["scale=%s read_%s" %
+                                                (scale, preset)]))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(OrderedDict([('host', platform.node()),
+                                   ('created', time.strftime(
+                                       "%Y-%m-%dT%H:%M:%S")),
+                                   ('timings', results)]), f, indent=2)
+        logging.info("Baseline saved to %s", args.save_baseline)
+
+    if regressions:
+        logging.error("ERROR: %s timings regressed by more than %d%%",
+                      len(regressions), 100 * args.tolerance)
+        sys.exit(1)
@@ -0,0 +1,377 @@
+import WRF_Hydro_forcing as whf
+import argparse
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from ConfigParser import SafeConfigParser
+
+
+
+# -----------------------------------------------------
+#             Benchmark_Orchestration.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Benchmark of the Python orchestration of the forcing engine: the
+#  listing of the data directories and the parsing of the file names
+#  (WRF_Hydro_catalog), the creation of the output directories
+#  (mkdir_p), the building of the NCL commands and the pairing of
+#  the files to layer (find_layering_files), as opposed to the time
+#  spent in NCL.
+#  For each size (the number of forecast hours, i.e. of raw files
+#  per product), a synthetic tree of empty HRRR and RAP files is
+#  created in the work directory along with a parm/config file whose
+#  ncl_exe is a stub: a shell script which sleeps (--stub-sleep)
+#  and/or loops (--stub-work), then creates the expected output
+#  file.  It also handles the NCL batch mode and the index pass of
+#  combine.ncl.  Another stub can be given with --stub, it is then
+#  called with the same arguments as ncl.
+#
+#  The regridding, downscaling and layering of the tree are run with
+#  regrid_data, downscale_data and layer_data.  For each stage, the
+#  time taken to build the jobs alone (regrid_jobs, downscale_jobs,
+#  layer_jobs) and the time taken by the whole stage are reported,
+#  along with the time spent in the stub processes and the rest, the
+#  orchestration overhead, per file.  With --build-only the stub
+#  isn't run, the expected output files are created directly, so
+#  that the orchestration of large trees (10^5 files) can be measured
+#  quickly.
+#
+#  Usage:
+#     python Benchmark_Orchestration.py --sizes 1000,10000,100000 \
+#         --build-only --output orchestration.json
+
+
+# The products of the synthetic tree, layered as primary and
+# secondary products.
+PRODUCTS = ('HRRR', 'RAP')
+
+# The forecast hours of a cycle.
+FORECAST_HOURS = 19
+
+# The stub NCL executable, a POSIX shell script.
+STUB_SCRIPT = """#!/bin/sh
+# Stub of the NCL executable created by Benchmark_Orchestration.py:
+# creates the output file(s) named by the arguments.
+sleep_seconds=@SLEEP@
+work=@WORK@
+out=
+outdir=
+index_flag=
+out_list=
+for arg in "$@"; do
+    value=${arg#*=}
+    value=${value#\\"}
+    value=${value%\\"}
+    case "$arg" in
+        outFile=*) out=$value ;;
+        outdir=*) outdir=$value ;;
+        indexFlag=*) index_flag=$value ;;
+        outFileList=*) out_list=$value ;;
+    esac
+done
+
+process() {
+    if [ "$sleep_seconds" != "0" ]; then
+        sleep $sleep_seconds
+    fi
+    i=0
+    while [ $i -lt $work ]; do
+        i=$((i + 1))
+    done
+    echo stub > "$1"
+}
+
+# First pass of combine.ncl, which only writes index.nc.
+if [ "$index_flag" = "false" ]; then
+    echo stub > index.nc
+    exit 0
+fi
+
+# Batch mode.
+if [ -n "$out_list" ]; then
+    while read out_file; do
+        process "$out_file"
+        echo "WRF_HYDRO_FILE_DONE $out_file"
+    done < "$out_list"
+    exit 0
+fi
+
+case "$out" in
+    /*) ;;
+    *) out=$outdir/$out ;;
+esac
+process "$out"
+"""
+
+
+
+def write_stub(stub_file, sleep_seconds, work):
+    """Writes the stub NCL executable."""
+    with open(stub_file, 'w') as f:
+        f.write(STUB_SCRIPT.replace('@SLEEP@', str(sleep_seconds))
+                           .replace('@WORK@', str(int(work))))
+    os.chmod(stub_file, os.stat(stub_file).st_mode | stat.S_IXUSR |
+                        stat.S_IXGRP | stat.S_IXOTH)
+
+
+
+def raw_file_name(product, index):
+    """Returns the path, relative to the product's data directory,
+    of the index-th raw file of a product: one subdirectory per day,
+    24 cycles per day and FORECAST_HOURS forecast hours per cycle.
+    """
+    cycle = index // FORECAST_HOURS
+    day = time.strftime("%Y%m%d", time.gmtime(86400 * (16436 + cycle // 24)))
+    return "%s/%s_i%02d_f%03d_%s.grb2" % (day, day, cycle % 24,
+                                         index % FORECAST_HOURS, product)
+
+
+
+def make_tree(tree_dir, size, stub_file, num_workers, ncl_batch_size):
+    """Creates the synthetic data tree of a size and its parm/config
+    file.
+
+    Returns:
+        parser (SafeConfigParser):  The parser to the parm/config
+                                    file, read back from the tree.
+
+    """
+    for product in PRODUCTS:
+        data_dir = os.path.join(tree_dir, "data", product)
+        for index in range(size):
+            raw_file = os.path.join(data_dir, raw_file_name(product, index))
+            if index % FORECAST_HOURS == 0:
+                whf.mkdir_p(os.path.dirname(raw_file))
+            open(raw_file, 'w').close()
+
+    # The static files and scripts are only passed to the stub.
+    static_dir = os.path.join(tree_dir, "static")
+    config = SafeConfigParser()
+    config.optionxform = str
+    sections = OrderedDict([
+        ('exe', [('ncl_exe', stub_file),
+                 ('Analysis_Assimilation_layering',
+                  os.path.join(static_dir, "combine.ncl"))]),
+        ('data_dir', []),
+        ('regridding', [('dst_grid_name', os.path.join(static_dir,
+                                                       "geo_dst.nc"))]),
+        ('downscaling', [('lapse_rate_file', os.path.join(static_dir,
+                                                          "lapse.nc"))]),
+        ('layering', [('analysis_assimilation_primary',
+                       os.path.join(tree_dir, "downscaled", PRODUCTS[0])),
+                      ('analysis_assimilation_secondary',
+                       os.path.join(tree_dir, "downscaled", PRODUCTS[1])),
+                      ('output_dir', os.path.join(tree_dir, "layered"))]),
+        ('parallel', [('num_workers', str(num_workers)),
+                      ('ncl_batch_size', str(ncl_batch_size))]),
+        ])
+    for product in PRODUCTS:
+        sections['exe'] += [
+            (product + '_regridding_exe',
+             os.path.join(static_dir, product + "-2-WRF_Hydro_ESMF_forcing.ncl")),
+            (product + '_downscaling_exe',
+             os.path.join(static_dir, "All_WRF_Hydro_downscale.ncl"))]
+        sections['data_dir'].append((product + '_data',
+                                     os.path.join(tree_dir, "data", product)))
+        sections['regridding'] += [
+            (product + '_wgt_bilinear',
+             os.path.join(static_dir, product + "2HYDRO_weight_bilinear.nc")),
+            (product + '_output_dir',
+             os.path.join(tree_dir, "regridded", product))]
+        sections['downscaling'] += [
+            (product + '_data_to_downscale',
+             os.path.join(tree_dir, "regridded", product)),
+            (product + '_hgt_data',
+             os.path.join(static_dir, product + "_hgt.nc")),
+            (product + '_geo_data', os.path.join(static_dir, "geo_dst.nc")),
+            (product + '_downscale_output_dir',
+             os.path.join(tree_dir, "downscaled", product))]
+    for section, options in sections.items():
+        config.add_section(section)
+        for (option, value) in options:
+            config.set(section, option, value)
+
+    parm_file = os.path.join(tree_dir, "wrf_hydro_forcing.parm")
+    with open(parm_file, 'w') as f:
+        config.write(f)
+    parser = SafeConfigParser()
+    parser.read(parm_file)
+    return parser
+
+
+
+def benchmark_stage(stage, build, run, build_only):
+    """Times a stage of the processing of a tree.
+
+    Args:
+        stage (string):  The name of the stage.
+        build (function):  Builds the jobs of the stage, returning
+                           the list of jobs.
+        run (function):  Runs the stage, returning the elapsed
+                         times of its jobs.
+        build_only (boolean):  True to create the output files of
+                               the jobs instead of running the stage.
+    Returns:
+        timing (OrderedDict):  The number of files, the time (in
+                               seconds) taken to build the jobs and
+                               to run the stage, the time spent in
+                               the jobs and the orchestration time.
+
+    """
+    start = time.time()
+    jobs = build()
+    build_seconds = time.time() - start
+
+    start = time.time()
+    if build_only:
+        for job in jobs:
+            open(job[0], 'w').close()
+        job_seconds = 0.
+        num_files = len(jobs)
+    else:
+        elapsed_times = run()
+        job_seconds = sum(elapsed_times)
+        num_files = len(elapsed_times)
+    run_seconds = time.time() - start
+    if build_only:
+        run_seconds = build_seconds
+
+    logging.info("%s: %s files", stage, num_files)
+    return OrderedDict([('files', num_files),
+                        ('build_seconds', build_seconds),
+                        ('run_seconds', run_seconds),
+                        ('job_seconds', job_seconds)])
+
+
+
+def benchmark_tree(parser, build_only):
+    """Regrids, downscales and layers a synthetic tree.
+
+    Returns:
+        timings (OrderedDict):  The timings (see benchmark_stage)
+                                keyed by stage.
+
+    """
+    timings = OrderedDict()
+    for product in PRODUCTS:
+        timings[product + " regridding"] = benchmark_stage(
+            product + " regridding",
+            lambda: whf.regrid_jobs(product, parser)[0],
+            lambda: whf.regrid_data(product, parser), build_only)
+    for product in PRODUCTS:
+        timings[product + " downscaling"] = benchmark_stage(
+            product + " downscaling",
+            lambda: whf.downscale_jobs(product, parser)[0],
+            lambda: whf.downscale_data(product, parser), build_only)
+    timings["layering"] = benchmark_stage(
+        "layering",
+        lambda: whf.layer_jobs(parser, PRODUCTS[0], PRODUCTS[1])[0],
+        lambda: whf.layer_data(parser, PRODUCTS[0], PRODUCTS[1]), build_only)
+    return timings
+
+
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(",") if item.strip()]
+
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark of the orchestration with a stub NCL')
+    arg_parser.add_argument('--sizes', default='1000,10000',
+                            help='comma-separated numbers of raw files per '
+                                 'product (default: %(default)s)')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='num_workers of the [parallel] section '
+                                 '(default: %(default)s)')
+    arg_parser.add_argument('--ncl-batch-size', type=int, default=1,
+                            help='ncl_batch_size of the [parallel] section '
+                                 '(default: %(default)s)')
+    arg_parser.add_argument('--stub',
+                            help='executable run instead of ncl, by default '
+                                 'a generated shell script')
+    arg_parser.add_argument('--stub-sleep', type=float, default=0.,
+                            help='seconds the generated stub sleeps per file '
+                                 '(default: %(default)s)')
+    arg_parser.add_argument('--stub-work', type=int, default=0,
+                            help='iterations of the busy loop of the '
+                                 'generated stub per file (default: '
+                                 '%(default)s)')
+    arg_parser.add_argument('--build-only', action='store_true',
+                            help="only build the jobs, don't run the stub")
+    arg_parser.add_argument('--work-dir',
+                            help='directory of the synthetic trees, kept '
+                                 '(default: a temporary directory)')
+    arg_parser.add_argument('--output',
+                            help='JSON file to save the timings to')
+    arg_parser.add_argument('--log-level', default='INFO',
+                            help='level of the log of the forcing engine, '
+                                 'written to the work directory (default: '
+                                 '%(default)s)')
+    args = arg_parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="wrf_hydro_benchmark_")
+    whf.mkdir_p(work_dir)
+    logging.basicConfig(format='%(asctime)s %(message)s',
+                        filename=os.path.join(work_dir, "orchestration.log"),
+                        level=getattr(logging, args.log_level.upper()))
+    stub_file = args.stub
+    if not stub_file:
+        stub_file = os.path.join(work_dir, "ncl_stub")
+        write_stub(stub_file, args.stub_sleep, args.stub_work)
+
+    results = OrderedDict()
+    try:
+        for size in parse_list(args.sizes, int):
+            tree_dir = os.path.join(work_dir, "tree_%d" % size)
+            if os.path.isdir(tree_dir):
+                shutil.rmtree(tree_dir)
+            start = time.time()
+            parser = make_tree(tree_dir, size, os.path.abspath(stub_file),
+                               args.workers, args.ncl_batch_size)
+            sys.stderr.write("Created %d raw files in %.1f s\n" %
+                             (size * len(PRODUCTS), time.time() - start))
+            results[size] = benchmark_tree(parser, args.build_only)
+            if not args.work_dir:
+                shutil.rmtree(tree_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    # The orchestration time is the time of a stage not spent in
+    # the jobs, which run concurrently when there are several
+    # workers.
+    print("%8s %-18s %8s %12s %12s %12s %12s %14s" %
+          ("size", "stage", "files", "build (s)", "build (f/s)", "run (s)",
+           "run (f/s)", "orch. (ms/f)"))
+    for size, timings in results.items():
+        for stage, timing in timings.items():
+            num_files = max(timing['files'], 1)
+            orchestration = timing['run_seconds'] - \
+                            timing['job_seconds'] / max(args.workers, 1)
+            timing['orchestration_seconds'] = max(orchestration, 0.)
+            print("%8d %-18s %8d %12.3f %12.0f %12.3f %12.0f %14.3f" %
+                  (size, stage, timing['files'], timing['build_seconds'],
+                   num_files / max(timing['build_seconds'], 1e-9),
+                   timing['run_seconds'],
+                   num_files / max(timing['run_seconds'], 1e-9),
+                   1000. * timing['orchestration_seconds'] / num_files))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([
+                ('workers', args.workers),
+                ('ncl_batch_size', args.ncl_batch_size),
+                ('stub', args.stub or "sleep=%s work=%s" % (args.stub_sleep,
+                                                            args.stub_work)),
+                ('build_only', args.build_only),
+                ('timings', OrderedDict((str(size), timings) for size, timings
+                                        in results.items()))]), f, indent=2)
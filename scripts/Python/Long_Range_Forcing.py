@@ -1,13 +1,13 @@
-import WRF-Hydro_forcing as whf
+import WRF_Hydro_forcing as whf
 import logging
 import os
-from ConfigParser import SafeConfigParser
+import sys
 
 #----------------------------------------------
 
 if __name__ == "__main__":
-    parser = SafeConfigParser()
-    parser.read('wrf_hydro_forcing.parm')
+    args = whf.forcing_arguments('Long Range forcing configuration')
+    parser = whf.read_parm(args)
 
     ncl_exec = parser.get('exe', 'ncl_exe')
     ncarg_root = parser.get('default_env_vars', 'ncarg_root')
@@ -41,14 +41,18 @@ if __name__ == "__main__":
     # TO BE IMPLEMENTED 
     # CFS_bias_corrections = whf.bias_corr("CFS", parser)
 
-    # Regrid the CFS data.
-    CFS_regrids = whf.regrid_data("CFS",parser)     
-    
-    # Downscale the CFS data.
-    CFS_downscalings = whr.downscale_data("CFS", parser)
+    # Regrid and downscale the CFS data, each file being downscaled
+    # as soon as it is regridded.
+    # TO BE IMPLEMENTED: there is no CFS regridding script nor weight
+    # file yet, so the product is rejected before anything is run.
+    try:
+        job_metrics = whf.run_forcing_graph(parser, ["CFS"])
+    except ValueError as exc:
+        logging.error("ERROR: %s", exc)
+        sys.exit(1)
    
     # Generate the metrics for regridding and downscaling and write to the
     # logfile, which by default is saved to the directory from which this
-    # script in invoked.
-    whf.create_benchmark("CFS","Regridding", CFS_regrids)
-    whf.create_benchmark("CFS","Downscaling", CFS_downscalings)
+    # script in invoked, and to the _metrics.csv and _metrics.jsonl files
+    # next to it.
+    whf.create_benchmark(job_metrics)
@@ -1,13 +1,12 @@
-import WRF-Hydro_forcing as whf
+import WRF_Hydro_forcing as whf
 import logging
 import os
-from ConfigParser import SafeConfigParser
 
 #----------------------------------------------
 
 if __name__ == "__main__":
-    parser = SafeConfigParser()
-    parser.read('wrf_hydro_forcing.parm')
+    args = whf.forcing_arguments('Medium Range forcing configuration')
+    parser = whf.read_parm(args)
 
     ncl_exec = parser.get('exe', 'ncl_exe')
     ncarg_root = parser.get('default_env_vars', 'ncarg_root')
@@ -43,14 +42,12 @@ if __name__ == "__main__":
 
 
 
-    # Regrid the GFS data.
-    GFS_regrids = whf.regrid_data("GFS",parser)     
-    
-    # Downscale the GFS data.
-    GFS_downscalings = whr.downscale_data("GFS", parser)
+    # Regrid and downscale the GFS data, each file being downscaled
+    # as soon as it is regridded.
+    job_metrics = whf.run_forcing_graph(parser, ["GFS"])
    
     # Generate the metrics for regridding and downscaling and write to the
     # logfile, which by default is saved to the directory from which this
-    # script in invoked.
-    whf.create_benchmark("GFS","Regridding", GFS_regrids)
-    whf.create_benchmark("GFS","Downscaling", GFS_downscalings)
+    # script in invoked, and to the _metrics.csv and _metrics.jsonl files
+    # next to it.
+    whf.create_benchmark(job_metrics)
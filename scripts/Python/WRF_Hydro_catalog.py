@@ -0,0 +1,363 @@
+import os
+import datetime
+import errno
+import json
+import logging
+import re
+import time
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_catalog.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Catalog of the input files of the forcing engine: the raw data
+#  directories and the regridded and downscaled directories, indexed
+#  by the date (YYYYMMDD), model run (ihh) and forecast hour of each
+#  file.  Each directory tree is listed with scandir (os.scandir, or
+#  the scandir package on Python 2, else os.listdir), and the names
+#  of its files are parsed once, with the precompiled pattern of the
+#  product (see name_pattern), so that the stages look up the file of
+#  a forecast hour in a dict instead of parsing paths and testing the
+#  existence of files.
+#
+#  The catalog is persisted as JSON in the catalog_file of the
+#  [catalog] section of the wrf_hydro_forcing.parm file, with the
+#  modification time of each directory: on the next run, only the
+#  directories whose modification time changed (files added,
+#  removed or renamed) are listed again, the others cost one stat.
+#  A directory modified less than MTIME_SLACK seconds before it was
+#  listed is listed again on the next scan, as files may have been
+#  added within the resolution of its modification time.  The file
+#  is only a cache: it may be removed at any time, and concurrent
+#  runs writing it at once only cause directories to be listed
+#  again.
+
+
+# Version of the catalog file format, increase it when the content
+# of the file changes.
+CATALOG_VERSION = 1
+
+# Seconds within which a directory's modification time may not
+# reflect the files added to it.
+MTIME_SLACK = 2.
+
+# The names of the raw files: the date, model run and forecast hour
+# of a model (e.g. 20150723_i23_f010_HRRR.grb2), the date and hour of
+# the MRMS observations.
+_MODEL_PATTERN = re.compile(r'.*([0-9]{8})_(i[0-9]{2})_f([0-9]{2,4})')
+_MRMS_PATTERN = re.compile(r'.*([0-9]{8})_([0-9]{2})')
+
+# The pattern of the raw files of each product.
+RAW_PATTERNS = {
+    'HRRR': _MODEL_PATTERN,
+    'NAM': _MODEL_PATTERN,
+    'GFS': _MODEL_PATTERN,
+    'RAP': _MODEL_PATTERN,
+    'MRMS': _MRMS_PATTERN,
+    }
+
+# The products of observations, which have no forecast: the file of
+# an observation product matching a forecast is the one valid at its
+# time (see valid_fields).
+OBSERVATION_PRODUCTS = ('MRMS',)
+
+# The names of the regridded, downscaled and layered files, which
+# follow the RAL standard YYYYMMDD_ihh_fnnn_<product>.nc.
+HYDRO_PATTERN = re.compile(r'([0-9]{8})_(i[0-9]{2})_f([0-9]{2,4})_.*\.nc$')
+
+
+
+def name_pattern(product, processed=False):
+    """Returns the pattern of the file names of a product.
+
+    Args:
+        product (string): The product name: HRRR, MRMS, NAM, etc.
+        processed (boolean): True for the regridded and downscaled
+                             files, False for the raw data files.
+    Returns:
+        pattern (re.RegexObject): The pattern.
+    Raises:
+        ValueError: If the product isn't supported.
+
+    """
+    if processed:
+        return HYDRO_PATTERN
+    try:
+        return RAW_PATTERNS[product.upper()]
+    except KeyError:
+        raise ValueError("unsupported product: %s" % product.upper())
+
+
+
+def parse_name(pattern, name):
+    """Parses a file name (or path) with a pattern of name_pattern.
+
+    Returns:
+        fields (tuple): The date (YYYYMMDD), the model run (ihh) and
+                        the forecast hour (digits, 000 for MRMS) of
+                        the file, or None if the name doesn't match.
+
+    """
+    match = pattern.match(name)
+    if not match:
+        return None
+    if pattern is _MRMS_PATTERN:
+        # Radar data- not a model, therefore no forecast
+        return (match.group(1), "i" + match.group(2), "000")
+    return match.groups()
+
+
+
+def fields_key(fields):
+    """Returns the key of the fields of a file in a TreeIndex:
+    (YYYYMMDD, ihh, forecast hour as an int).
+    """
+    return (fields[0], fields[1], int(fields[2]))
+
+
+
+def valid_fields(fields):
+    """Returns the fields (see parse_name) of the observations valid
+    at the time of a forecast: (YYYYMMDD, ihh, 000) of the date and
+    hour of its model run plus its forecast hour.
+    """
+    valid = datetime.datetime.strptime(fields[0], "%Y%m%d") + \
+            datetime.timedelta(hours=int(fields[1][1:]) + int(fields[2]))
+    return (valid.strftime("%Y%m%d"), "i%02d" % valid.hour, "000")
+
+
+
+def ignored(name):
+    """Determines if a file is left out of the catalog: hidden files
+    and the temporary files being written.
+    """
+    return name.startswith('.') or name.endswith('.tmp')
+
+
+
+def list_directory(path):
+    """Lists a directory, as os.walk does: the subdirectories (not
+    the symbolic links to directories, which aren't followed) and
+    the other entries.
+
+    Returns:
+        (subdirectories, files) (tuple): The sorted names.
+
+    """
+    subdirectories = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+            elif not entry.is_symlink():
+                subdirectories.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            if not os.path.isdir(entry_path):
+                files.append(name)
+            elif not os.path.islink(entry_path):
+                subdirectories.append(name)
+    return (sorted(subdirectories), sorted(files))
+
+
+
+class TreeIndex(object):
+    """The files of a directory tree, indexed by date, model run and
+    forecast hour.
+
+    Args:
+        top (string): The top directory of the tree.
+        pattern (re.RegexObject): The pattern of the file names.
+        entries (list): The (path, fields) of the files of the tree
+                        (see parse_name), sorted by path.
+
+    """
+
+    def __init__(self, top, pattern, entries):
+        self.top = top
+        self.pattern = pattern
+        self.entries = entries
+        self.paths = {}
+        for (path, fields) in entries:
+            if fields is not None:
+                self.paths.setdefault(fields_key(fields), path)
+
+    def files(self):
+        """Returns the paths of the files, sorted."""
+        return [path for (path, fields) in self.entries]
+
+    def lookup(self, date, init_hr, fcst_hr):
+        """Returns the path of the file of a date (YYYYMMDD), model
+        run (ihh) and forecast hour (int or digits), None if there is
+        none.
+        """
+        return self.paths.get((date, init_hr, int(fcst_hr)))
+
+    def add(self, paths):
+        """Adds files which don't exist yet but will be created, e.g.
+        by earlier tasks of a task graph.  The files of other
+        directories and those already indexed are ignored.
+        """
+        indexed = set(self.files())
+        for path in paths:
+            if not path.startswith(os.path.join(self.top, "")) or \
+               path in indexed:
+                continue
+            fields = parse_name(self.pattern, os.path.basename(path))
+            self.entries.append((path, fields))
+            indexed.add(path)
+            if fields is not None:
+                self.paths.setdefault(fields_key(fields), path)
+        self.entries.sort()
+
+
+
+class Catalog(object):
+    """The catalog of the directory trees scanned.
+
+    Args:
+        catalog_file (string): The JSON file the catalog is loaded
+                               from, if it exists, and saved to, or
+                               None to not persist it.
+
+    """
+
+    def __init__(self, catalog_file=None):
+        self.catalog_file = catalog_file
+        # The trees scanned, keyed by top directory: the pattern of
+        # their file names and, keyed by path relative to the top,
+        # the [mtime, subdirectories, files] of their directories,
+        # files being lists of the name and fields of each file.
+        self.trees = {}
+        self.changed = False
+        if catalog_file and os.path.isfile(catalog_file):
+            try:
+                with open(catalog_file) as f:
+                    content = json.load(f)
+                if content.get('version') == CATALOG_VERSION:
+                    self.trees = content['trees']
+            except (IOError, ValueError, KeyError) as exc:
+                logging.warning("WARNING: the catalog %s can't be read, "
+                                "the directories are listed again: %s",
+                                catalog_file, exc)
+
+    def scan(self, top, pattern=None):
+        """Updates the catalog of a directory tree, listing only the
+        directories which changed since the last scan.
+
+        Args:
+            top (string): The top directory of the tree.
+            pattern (re.RegexObject): The pattern of the file names
+                                      (see name_pattern), None to
+                                      not parse them.
+        Returns:
+            index (TreeIndex): The files of the tree.  A tree which
+                               doesn't exist has none.
+
+        """
+        source = pattern.pattern if pattern is not None else None
+        tree = self.trees.get(top)
+        if tree is None or tree['pattern'] != source:
+            tree = {'pattern': source, 'directories': {}}
+        recorded = tree['directories']
+        directories = {}
+        scan_start = time.time()
+        pending = [""]
+        while pending:
+            relative_dir = pending.pop()
+            path = os.path.join(top, relative_dir) if relative_dir else top
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            record = recorded.get(relative_dir)
+            if record is None or record[0] != mtime:
+                try:
+                    (subdirectories, names) = list_directory(path)
+                except OSError as exc:
+                    if exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        logging.warning("WARNING: can't list %s: %s",
+                                        path, exc)
+                    continue
+                files = []
+                for name in names:
+                    if ignored(name):
+                        continue
+                    fields = parse_name(pattern, name) \
+                             if pattern is not None else None
+                    files.append([name] + list(fields or ()))
+                # A directory modified during the scan is listed again
+                # next time.
+                record = [mtime if mtime < scan_start - MTIME_SLACK else None,
+                          subdirectories, files]
+                self.changed = True
+            directories[relative_dir] = record
+            pending.extend(os.path.join(relative_dir, subdirectory)
+                           for subdirectory in record[1])
+        if len(directories) != len(recorded):
+            self.changed = True
+        tree['directories'] = directories
+        self.trees[top] = tree
+
+        entries = []
+        for relative_dir, (mtime, subdirectories, files) in directories.items():
+            path = os.path.join(top, relative_dir) if relative_dir else top
+            for file_entry in files:
+                entries.append((os.path.join(path, file_entry[0]),
+                                tuple(file_entry[1:]) or None))
+        entries.sort()
+        return TreeIndex(top, pattern, entries)
+
+    def save(self):
+        """Saves the catalog to its file, if it changed, under a
+        temporary name renamed when complete.
+        """
+        if not self.catalog_file or not self.changed:
+            return
+        tmp_file = "%s.%d.tmp" % (self.catalog_file, os.getpid())
+        try:
+            catalog_dir = os.path.dirname(self.catalog_file)
+            if catalog_dir and not os.path.isdir(catalog_dir):
+                os.makedirs(catalog_dir)
+            with open(tmp_file, 'w') as f:
+                json.dump({'version': CATALOG_VERSION, 'trees': self.trees}, f,
+                          separators=(',', ':'))
+            os.rename(tmp_file, self.catalog_file)
+            self.changed = False
+        except (IOError, OSError) as exc:
+            logging.warning("WARNING: the catalog %s can't be saved: %s",
+                            self.catalog_file, exc)
+
+
+
+# The catalogs of this process, keyed by catalog file (None for the
+# catalog which isn't persisted).
+_catalogs = {}
+
+
+
+def open_catalog(catalog_file=None):
+    """Returns the catalog of this process for a catalog file,
+    loading it on first use.
+    """
+    catalog = _catalogs.get(catalog_file)
+    if catalog is None:
+        catalog = Catalog(catalog_file)
+        _catalogs[catalog_file] = catalog
+    return catalog
@@ -0,0 +1,272 @@
+import os
+import fcntl
+import json
+import re
+import time
+import numpy as np
+import WRF_Hydro_netcdf
+import WRF_Hydro_util
+from collections import OrderedDict
+from contextlib import contextmanager
+from netCDF4 import Dataset
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_cube.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Consolidated per-cycle forcing cubes.  Besides its file per
+#  forecast hour (YYYYMMDD/iHH/YYYYMMDD_iHH_fNNN_<product>.nc), each
+#  processed forecast hour of a cycle is appended, as soon as it is
+#  done, to a single NetCDF4 file per cycle and product, in the
+#  cube_dir of the [output] section of the wrf_hydro_forcing.parm
+#  file:
+#     cube_dir/YYYYMMDD/iHH/YYYYMMDD_iHH_<product>.nc
+#  whose variables have an unlimited time dimension in front of the
+#  grid dimensions and are chunked one forecast hour per chunk, so
+#  that an hour is read (or rewritten) as a single chunk.  The
+#  variables are compressed as requested by the output options
+#  (see WRF_Hydro_netcdf), except for the 16-bit integer packing,
+#  whose scale would depend on the first hour appended.
+#
+#  The forecast hours are appended in the order they are done, which
+#  isn't the order of the forecast hours when they are processed
+#  concurrently; a forecast hour processed again replaces its slot.
+#  Appends, from the workers of a host or from several hosts sharing
+#  the cube directory, are serialized by an exclusive lock (flock) on
+#  the <cube>.lock file.  After each append the <cube>.index.json
+#  file is rewritten: it maps each forecast hour to its index along
+#  the time dimension, so that read_hour reads a single hour without
+#  scanning the time variable.
+
+
+# The time dimension and variable of the cubes.
+TIME = 'time'
+
+# The name of a forecast hour file: YYYYMMDD, iHH, forecast hour,
+# product.
+HOUR_FILE_RE = r'([0-9]{8})_(i[0-9]{2})_f([0-9]{2,4})_(.+)\.nc$'
+
+
+
+def cube_file_name(cube_dir, hour_file):
+    """Returns the cube of the cycle and product of a forecast hour
+    file.
+
+    Args:
+        cube_dir (string): The directory of the cubes.
+        hour_file (string): The full path of a forecast hour file,
+                            named YYYYMMDD_iHH_fNNN_<product>.nc.
+    Returns:
+        (cube_file, forecast_hour) (tuple): The full path of the
+                            cube, YYYYMMDD/iHH/YYYYMMDD_iHH_<product>.nc
+                            in the cube directory, and the forecast
+                            hour as an int.
+
+    """
+    match = re.match(HOUR_FILE_RE, os.path.basename(hour_file))
+    if match is None:
+        raise ValueError("unexpected forecast hour file name: %s" % hour_file)
+    (date, init_hr, fcst_hr, product) = match.groups()
+    cube_file = os.path.join(cube_dir, date, init_hr,
+                             "%s_%s_%s.nc" % (date, init_hr, product))
+    return (cube_file, int(fcst_hr))
+
+
+
+def index_file_name(cube_file):
+    """Returns the index file of a cube."""
+    return cube_file + ".index.json"
+
+
+
+@contextmanager
+def locked(cube_file, exclusive=True):
+    """Holds the lock of a cube: exclusive to append to it, shared
+    to read it.
+    """
+    with open(cube_file + ".lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+
+def read_index(cube_file):
+    """Reads the index of a cube.
+
+    Returns:
+        index (dict): The cycle, the grid dimensions, the
+                      variables, the chunk shape and the time index
+                      of each forecast hour (keyed by the forecast
+                      hour as a string, as in the JSON file) of the
+                      cube, or None if there is no index.
+
+    """
+    try:
+        with open(index_file_name(cube_file)) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except IOError:
+        return None
+
+
+
+def write_index(cube_file, index):
+    """Writes the index of a cube, under a temporary name renamed
+    when complete so readers never see a partial index.
+    """
+    index_file = index_file_name(cube_file)
+    with open(index_file + ".tmp", 'w') as f:
+        json.dump(index, f, indent=1)
+    os.rename(index_file + ".tmp", index_file)
+
+
+
+def cube_options(options=None):
+    """Returns the output options of the cubes: those of the
+    forecast hour files in a NetCDF4 format, without the 16-bit
+    integer packing.
+    """
+    options = WRF_Hydro_netcdf.output_options(options)
+    if not options['format'].startswith('NETCDF4'):
+        options['format'] = 'NETCDF4_CLASSIC'
+    options['pack_int16'] = ()
+    return options
+
+
+
+def read_hour_file(hour_file):
+    """Reads the fields of a forecast hour file: its float variables
+    with (at least) two dimensions, leading dimensions of size 1
+    (e.g. Time) being removed.
+
+    Returns:
+        (grid_dimensions, fields) (tuple): The names and sizes of the
+                          grid dimensions (OrderedDict) and the
+                          (field, attributes) tuples keyed by variable
+                          name (see WRF_Hydro_netcdf.read_fields).
+
+    """
+    with Dataset(hour_file, 'r') as nc:
+        names = [name for name, var in nc.variables.items()
+                 if var.dtype.kind == 'f' and len(var.dimensions) >= 2]
+        if not names:
+            raise ValueError("%s has no gridded variable" % hour_file)
+        var = nc.variables[names[0]]
+        grid_dimensions = OrderedDict(zip(var.dimensions[-2:], var.shape[-2:]))
+    return (grid_dimensions, WRF_Hydro_netcdf.read_fields(hour_file, names))
+
+
+
+def create_cube(cube_file, cycle, grid_dimensions, options):
+    """Creates an empty cube, under a temporary name renamed when
+    complete.
+    """
+    tmp_file = cube_file + ".tmp"
+    with Dataset(tmp_file, 'w', format=options['format']) as nc:
+        nc.createDimension(TIME, None)
+        for name, size in grid_dimensions.items():
+            nc.createDimension(name, size)
+        var = nc.createVariable(TIME, 'i4', (TIME,))
+        var.long_name = "forecast hour"
+        var.units = "hours since %s-%s-%s %s:00:00" % (
+            cycle[0:4], cycle[4:6], cycle[6:8], cycle[10:12])
+        nc.cycle = cycle
+    os.rename(tmp_file, cube_file)
+
+
+
+def append_file(cube_dir, hour_file, options=None):
+    """Appends a forecast hour file to the cube of its cycle and
+    product, creating the cube if needed.  A forecast hour already
+    in the cube is replaced.
+
+    Args:
+        cube_dir (string): The directory of the cubes.
+        hour_file (string): The full path of the forecast hour file.
+        options (dict): The output options of the forecast hour
+                        files (see cube_options).
+    Returns:
+        cube_file (string): The full path of the cube.
+
+    """
+    (cube_file, forecast_hour) = cube_file_name(cube_dir, hour_file)
+    (grid_dimensions, fields) = read_hour_file(hour_file)
+    options = cube_options(options)
+    cycle = "_".join(os.path.basename(cube_file).split("_")[:2])
+    WRF_Hydro_util.mkdir_p(os.path.dirname(cube_file))
+
+    with locked(cube_file):
+        if not os.path.isfile(cube_file):
+            create_cube(cube_file, cycle, grid_dimensions, options)
+        index = read_index(cube_file) or OrderedDict(
+            [('cycle', cycle), ('time_dimension', TIME),
+             ('dimensions', grid_dimensions), ('variables', []),
+             ('chunk_shape', [1] + list(grid_dimensions.values())),
+             ('forecast_hours', OrderedDict())])
+
+        with Dataset(cube_file, 'a') as nc:
+            if list(nc.dimensions.keys())[1:] != list(grid_dimensions.keys()) \
+               or [len(nc.dimensions[name]) for name in grid_dimensions] != \
+               list(grid_dimensions.values()):
+                raise ValueError("the grid of %s doesn't match that of %s" %
+                                 (hour_file, cube_file))
+            # An hour is appended after the last one written, which
+            # may not be in the index if an append was interrupted.
+            time_index = index['forecast_hours'].get(
+                str(forecast_hour), len(nc.dimensions[TIME]))
+            nc.variables[TIME][time_index] = forecast_hour
+            for name, (field, attributes) in fields.items():
+                if name not in nc.variables:
+                    var = WRF_Hydro_netcdf.create_variable(
+                        nc, name, (TIME,) + tuple(grid_dimensions.keys()),
+                        field, options)
+                    var.setncatts(attributes)
+                    index['variables'].append(name)
+                nc.variables[name][time_index] = \
+                    WRF_Hydro_netcdf.masked_field(field)
+
+        index['forecast_hours'][str(forecast_hour)] = time_index
+        index['updated'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        write_index(cube_file, index)
+    return cube_file
+
+
+
+def read_hour(cube_file, forecast_hour, names=None):
+    """Reads a forecast hour of a cube, located with the cube's
+    index.
+
+    Args:
+        cube_file (string): The full path of the cube.
+        forecast_hour (int): The forecast hour.
+        names (list): The names of the variables to read, by default
+                      all of them.
+    Returns:
+        fields (OrderedDict): (field, attributes) tuples keyed by
+                              variable name (see
+                              WRF_Hydro_netcdf.read_fields), for the
+                              variables present in the cube.
+
+    """
+    with locked(cube_file, exclusive=False):
+        index = read_index(cube_file)
+        if index is None or str(forecast_hour) not in index['forecast_hours']:
+            raise KeyError("forecast hour %s is not in %s" %
+                           (forecast_hour, cube_file))
+        time_index = index['forecast_hours'][str(forecast_hour)]
+        fields = OrderedDict()
+        with Dataset(cube_file, 'r') as nc:
+            for name in names or index['variables']:
+                if name not in nc.variables:
+                    continue
+                var = nc.variables[name]
+                field = np.ma.filled(np.ma.asarray(var[time_index],
+                                                   dtype=np.float32), np.nan)
+                fields[name] = (field,
+                                WRF_Hydro_netcdf.variable_attributes(var))
+    return fields
@@ -0,0 +1,347 @@
+import os
+import logging
+import numpy as np
+from collections import OrderedDict
+from netCDF4 import Dataset
+import WRF_Hydro_netcdf
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_downscale.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Python downscaling engine for the WRF-Hydro forcing engine.
+#  This is an in-process alternative to All_WRF_Hydro_downscale.ncl,
+#  selected with the downscaling_engine option in the [downscaling]
+#  section of the wrf_hydro_forcing.parm file.  It performs the same
+#  height correction:
+#     - the lapse rate adjustment of the temperature, T2D
+#     - the hypsometric adjustment of the surface pressure, PSFC
+#     - the specific humidity, Q2D, recomputed from the relative
+#       humidity (NCL relhum) at the original height with the
+#       adjusted temperature and pressure (NCL mixhum_ptrh).
+#  The static height difference and lapse rate fields are read once
+#  per process and product (or, with a static_store_dir, once per
+#  host, see WRF_Hydro_static_store), and the fields of each file are processed
+#  in float32, mostly in place: whole, or by blocks of rows with
+#  tile_rows set in the [parallel] section.
+#
+#  Tolerance against the NCL output:  T2D and PSFC match to float32
+#  rounding (relative difference < 1e-6).  NCL's relhum uses a table
+#  of saturation vapor pressures whereas this engine uses the same
+#  Tetens formula as mixhum_ptrh for both conversions, so Q2D differs
+#  by less than 1% (relative).  All other variables are copied
+#  unchanged.
+
+
+# Lapse rate (K/km) used when no lapse rate file is available.
+DEFAULT_LAPSE_RATE = 6.49
+
+# Gas constant for dry air (J/kg/K) and gravity (m/s^2), as used in
+# All_WRF_Hydro_downscale.ncl.
+RD = 287.05
+GRAVITY = 9.8
+
+# Constants of the mixhum_ptrh saturation vapor pressure formula.
+T0 = 273.15
+EP = 0.622
+ONEMEP = 0.378
+ES0 = 6.11
+ES_A = 17.269
+ES_B = 35.86
+
+# Variables of the regridded files, in the order they're written.
+DOWNSCALE_VARIABLES = ('T2D', 'Q2D', 'U2D', 'V2D', 'PSFC', 'RAINRATE',
+                       'SWDOWN', 'LWDOWN')
+
+# The static fields are read once per process and set of files.
+_static_cache = {}
+
+
+
+def load_static_fields(hgt_file, geo_file, lapse_file, store_dir=None):
+    """Returns the static fields needed for downscaling, reading
+    the files only the first time they are requested by this
+    process.
+
+    Args:
+        hgt_file (string): The file with the height (HGT) of the
+                           source data on the destination grid.
+        geo_file (string): The geo file of the destination grid
+                           (HGT_M).
+        lapse_file (string): The lapse rate file (lapse, K/km).
+                             If the file doesn't exist, a
+                             constant lapse rate is used.
+        store_dir (string): The node-wide static field store (see
+                            WRF_Hydro_static_store), or None to
+                            keep the fields in this process only.
+    Returns:
+        static (dict): float32 fields:
+                       'dhgt'       height difference (m),
+                                    source - destination
+                       't_adjust'   temperature adjustment (K)
+                       'p_factor'   dhgt * g / Rd
+
+    """
+    key = (hgt_file, geo_file, lapse_file)
+    if key not in _static_cache:
+        if store_dir:
+            import WRF_Hydro_static_store
+            _static_cache[key] = WRF_Hydro_static_store.load_fields(
+                store_dir, 'downscale', list(key),
+                lambda: read_static_fields(hgt_file, geo_file, lapse_file))
+        else:
+            _static_cache[key] = read_static_fields(hgt_file, geo_file,
+                                                    lapse_file)
+    return _static_cache[key]
+
+
+
+def read_static_fields(hgt_file, geo_file, lapse_file):
+    """Reads the static files and computes the static fields, see
+    load_static_fields.
+    """
+    logging.info("Reading static downscaling fields %s, %s, %s",
+                 hgt_file, geo_file, lapse_file)
+    with Dataset(hgt_file, 'r') as nc:
+        hgt_src = WRF_Hydro_netcdf.read_field(nc, 'HGT')
+    with Dataset(geo_file, 'r') as nc:
+        hgt_dst = WRF_Hydro_netcdf.read_field(nc, 'HGT_M')
+
+    if os.path.isfile(lapse_file):
+        with Dataset(lapse_file, 'r') as nc:
+            lapse = WRF_Hydro_netcdf.read_field(nc, 'lapse')
+    else:
+        logging.info("Using constant lapse rate")
+        lapse = np.float32(DEFAULT_LAPSE_RATE)
+
+    dhgt = hgt_src - hgt_dst
+    return {
+        'dhgt': dhgt,
+        't_adjust': (dhgt * lapse / np.float32(1000.)).astype(np.float32),
+        'p_factor': (dhgt * np.float32(GRAVITY / RD)).astype(np.float32),
+        }
+
+
+
+def saturation_vapor_pressure(t2d, out):
+    """Computes the saturation vapor pressure (hPa) with the
+    formula used by NCL's mixhum_ptrh.
+
+    Args:
+        t2d (ndarray): Temperature (K).
+        out (ndarray): Array the result is stored in.
+    Returns:
+        out (ndarray): The saturation vapor pressure (hPa).
+
+    """
+    np.subtract(t2d, np.float32(T0), out=out)
+    out *= np.float32(ES_A)
+    out /= t2d - np.float32(ES_B)
+    np.exp(out, out=out)
+    out *= np.float32(ES0)
+    return out
+
+
+
+def downscale_fields(fields, static, scratch=None):
+    """Performs the height correction of T2D, PSFC and Q2D, in
+    place, following All_WRF_Hydro_downscale.ncl:
+        W2D  = Q2D/(1-Q2D)
+        RH   = min(relhum(T2D,W2D,PSFC), 100)
+        T2D  = T2D + DHGT*lapse/1000
+        PSFC = PSFC + DHGT*PSFC/287.05/T2D*9.8
+        Q2D  = mixhum_ptrh(PSFC/100, T2D, RH, 2)
+
+    Args:
+        fields (dict): float32 2D arrays keyed by variable name,
+                       with at least T2D, Q2D and PSFC.
+        static (dict): The static fields from load_static_fields,
+                       or their rows matching those of the fields.
+        scratch (tuple): Two float32 arrays of the shape of the
+                         fields, used for the intermediate values,
+                         by default allocated for the call.
+    Returns:
+        None:  T2D, Q2D and PSFC are modified in place.
+
+    """
+    t2d = fields['T2D']
+    q2d = fields['Q2D']
+    psfc = fields['PSFC']
+    if scratch is None:
+        scratch = (np.empty_like(t2d), np.empty_like(t2d))
+    (es, scratch) = scratch
+
+    # Mixing ratio, stored in the Q2D array which is recomputed below.
+    np.subtract(np.float32(1.), q2d, out=scratch)
+    w2d = np.divide(q2d, scratch, out=q2d)
+
+    # Relative humidity (%) at the original height:
+    #   RH = 100 * W*(p-es) / (0.622*es)
+    saturation_vapor_pressure(t2d, es)
+    rh = np.multiply(psfc, np.float32(0.01), out=scratch)
+    rh -= es
+    rh *= w2d
+    es *= np.float32(EP)
+    rh /= es
+    rh *= np.float32(100.)
+    np.clip(rh, np.float32(0.0001), np.float32(100.), out=rh)
+
+    # Temperature and surface pressure adjustments.
+    t2d += static['t_adjust']
+    np.divide(static['p_factor'], t2d, out=es)
+    es += np.float32(1.)
+    psfc *= es
+
+    # Specific humidity from the relative humidity:
+    #   QW = RH/100 * EP*es/(p - ONEMEP*es),  Q = QW/(1+QW)
+    saturation_vapor_pressure(t2d, es)
+    q2d = np.multiply(es, np.float32(-ONEMEP), out=q2d)
+    q2d += psfc * np.float32(0.01)
+    es *= np.float32(EP)
+    np.divide(es, q2d, out=q2d)
+    rh *= np.float32(0.01)
+    q2d *= rh
+    np.add(q2d, np.float32(1.), out=scratch)
+    q2d /= scratch
+
+
+
+def downscale_in_memory(fields, hgt_file, geo_file, lapse_file,
+                        downscale_shortwave=False, terrain_cache_dir=None,
+                        valid_time=None, store_dir=None):
+    """Downscales regridded fields in memory.  If requested, the
+    topographic adjustment of the shortwave radiation is also
+    performed.
+
+    Args:
+        fields (OrderedDict): (field, attributes) tuples keyed by
+                              variable name, as returned by
+                              WRF_Hydro_netcdf.read_fields. The
+                              fields are modified in place.
+        hgt_file (string): The file with the source data height.
+        geo_file (string): The geo file of the destination grid.
+        lapse_file (string): The lapse rate file.
+        downscale_shortwave (boolean): True to also downscale SWDOWN.
+        terrain_cache_dir (string): The terrain geometry cache
+                                    directory (see WRF_Hydro_shortwave).
+        valid_time (datetime): The valid time of the fields, needed
+                               to downscale SWDOWN.
+        store_dir (string): The node-wide static field store (see
+                            WRF_Hydro_static_store), or None.
+    Returns:
+        None
+
+    """
+    for name in ('T2D', 'Q2D', 'PSFC'):
+        if name not in fields:
+            raise ValueError("%s is missing from the fields to downscale" % name)
+
+    static = load_static_fields(hgt_file, geo_file, lapse_file, store_dir)
+    downscale_fields(dict((name, field) for name, (field, attributes)
+                          in fields.items()), static)
+    if downscale_shortwave and 'SWDOWN' in fields:
+        import WRF_Hydro_shortwave
+        geometry = WRF_Hydro_shortwave.load_terrain_geometry(geo_file,
+                                                             terrain_cache_dir,
+                                                             store_dir)
+        WRF_Hydro_shortwave.adjust_shortwave(fields['SWDOWN'][0], geometry,
+                                             valid_time)
+
+
+
+def downscale_file_tiled(in_file, out_file, hgt_file, geo_file, lapse_file,
+                         downscale_shortwave=False, terrain_cache_dir=None,
+                         output_options=None, tile_rows=0, store_dir=None):
+    """Downscales a regridded file by blocks of tile_rows rows, each
+    block being read into preallocated buffers, downscaled and
+    written before the next one is read.  The arguments are those
+    of downscale_file.
+    """
+    static = load_static_fields(hgt_file, geo_file, lapse_file, store_dir)
+    if downscale_shortwave:
+        import WRF_Hydro_shortwave
+        valid_time = WRF_Hydro_shortwave.valid_time_from_filename(out_file)
+        geometry = WRF_Hydro_shortwave.load_terrain_geometry(geo_file,
+                                                             terrain_cache_dir,
+                                                             store_dir)
+
+    with Dataset(in_file, 'r') as nc:
+        names = [name for name in DOWNSCALE_VARIABLES if name in nc.variables]
+        for name in ('T2D', 'Q2D', 'PSFC'):
+            if name not in names:
+                raise ValueError("%s is missing from %s" % (name, in_file))
+        shape = nc.variables['T2D'].shape[-2:]
+        variables = OrderedDict(
+            (name, WRF_Hydro_netcdf.variable_attributes(nc.variables[name]))
+            for name in names)
+        buffers = dict((name, np.empty((tile_rows, shape[1]), dtype=np.float32))
+                       for name in names + ['es', 'scratch'])
+
+        def blocks():
+            for (start, stop) in WRF_Hydro_netcdf.row_blocks(shape[0],
+                                                             tile_rows):
+                block = WRF_Hydro_netcdf.slice_rows(buffers, 0, stop - start)
+                for name in names:
+                    WRF_Hydro_netcdf.read_rows(nc, name, start, stop,
+                                               block[name])
+                downscale_fields(block,
+                                 WRF_Hydro_netcdf.slice_rows(static, start,
+                                                             stop),
+                                 (block['es'], block['scratch']))
+                if downscale_shortwave and 'SWDOWN' in block:
+                    WRF_Hydro_shortwave.adjust_shortwave(
+                        block['SWDOWN'],
+                        WRF_Hydro_netcdf.slice_rows(geometry, start, stop),
+                        valid_time)
+                yield (start, stop, block)
+
+        WRF_Hydro_netcdf.write_tiled(out_file, shape, variables, blocks(),
+                                     tile_rows, output_options)
+
+
+
+def downscale_file(in_file, out_file, hgt_file, geo_file, lapse_file,
+                   downscale_shortwave=False, terrain_cache_dir=None,
+                   output_options=None, tile_rows=0, store_dir=None):
+    """Downscales a regridded file.  If requested, the topographic
+    adjustment of the shortwave radiation is also performed before
+    the downscaled file is written.
+
+    Args:
+        in_file (string): The full path of the regridded file.
+        out_file (string): The full path of the downscaled file.
+        hgt_file (string): The file with the source data height.
+        geo_file (string): The geo file of the destination grid.
+        lapse_file (string): The lapse rate file.
+        downscale_shortwave (boolean): True to also downscale SWDOWN.
+        terrain_cache_dir (string): The terrain geometry cache
+                                    directory (see WRF_Hydro_shortwave).
+        output_options (dict): The format and compression of the
+                               downscaled file, see WRF_Hydro_netcdf.
+        tile_rows (int): If not 0, the file is downscaled by blocks
+                         of this many rows (see downscale_file_tiled).
+        store_dir (string): The node-wide static field store (see
+                            WRF_Hydro_static_store), or None.
+    Returns:
+        None
+
+    """
+    if tile_rows > 0:
+        downscale_file_tiled(in_file, out_file, hgt_file, geo_file,
+                             lapse_file, downscale_shortwave,
+                             terrain_cache_dir, output_options, tile_rows,
+                             store_dir)
+        return
+
+    fields = WRF_Hydro_netcdf.read_fields(in_file, DOWNSCALE_VARIABLES)
+    valid_time = None
+    if downscale_shortwave:
+        import WRF_Hydro_shortwave
+        valid_time = WRF_Hydro_shortwave.valid_time_from_filename(out_file)
+    downscale_in_memory(fields, hgt_file, geo_file, lapse_file,
+                        downscale_shortwave, terrain_cache_dir, valid_time,
+                        store_dir)
+    WRF_Hydro_netcdf.write_fields(out_file, fields, output_options)
@@ -0,0 +1,371 @@
+import os
+import ctypes
+import ctypes.util
+import glob
+import logging
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import WRF_Hydro_metrics
+import WRF_Hydro_util
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_execution.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Execution backend of the external commands (NCL) of the forcing
+#  engine.  The commands are argv lists, run without a shell, each
+#  with the limits of the [execution] section of the
+#  wrf_hydro_forcing.parm file:
+#     - a wall clock timeout, after which the command and the
+#       processes it started are terminated (then killed), so a hung
+#       NCL or ESMF run fails like any other job instead of holding
+#       a worker forever,
+#     - a cap on the address space (RLIMIT_AS) of each process, so
+#       a job which runs out of memory fails on its own instead of
+#       making the node swap for all of them,
+#     - a nice level,
+#     - the standard output and error of each job appended to a log
+#       file of its own, named after its output file, instead of the
+#       terminal.
+#  With cpus_per_worker set, each worker process of the pool is
+#  pinned to a set of CPUs of its own, taken from a single NUMA node
+#  when possible and spread over the nodes, and the commands and
+#  Python engines it runs inherit its CPUs (and, through the
+#  kernel's first-touch policy, its node's memory).  The limits are
+#  also applied to the worker processes, so the Python engines run
+#  under the same memory cap and nice level.  The Python engines are
+#  not timed out.
+
+
+# The CPUs of a cpu_set_t, as used by sched_setaffinity.
+_CPU_SETSIZE = 1024
+
+# Seconds between the termination of a command which timed out and
+# its kill.
+KILL_DELAY = 10.
+
+
+
+class ExecutionLimits(object):
+    """The limits of the commands of the jobs.
+
+    Args:
+        timeout (float): The wall clock time (in seconds) after which
+                         a command is terminated, 0 for none.
+        cpus_per_worker (int): The number of CPUs each worker process
+                               is pinned to, 0 to not pin them.
+        memory_limit_mb (int): The maximum address space (in MB) of
+                               each process, 0 for no limit.
+        nice (int): The nice level of the processes.
+        log_dir (string): The directory of the log files of the jobs,
+                          None to write their output to the terminal.
+
+    """
+
+    def __init__(self, timeout=0., cpus_per_worker=0, memory_limit_mb=0,
+                 nice=0, log_dir=None):
+        self.timeout = timeout
+        self.cpus_per_worker = cpus_per_worker
+        self.memory_limit_mb = memory_limit_mb
+        self.nice = nice
+        self.log_dir = log_dir
+
+
+# The limits of this process, set by configure or init_worker.
+_limits = ExecutionLimits()
+
+
+
+def configure(limits):
+    """Sets the limits of the commands run by this process."""
+    global _limits
+    _limits = limits
+
+
+
+def get_limits():
+    """Returns the limits of the commands run by this process."""
+    return _limits
+
+
+
+def init_worker(limits, worker_count):
+    """Initializes a worker process of a pool: sets the limits of
+    its commands, applies the memory cap and nice level to the
+    worker and, with cpus_per_worker, pins it to the CPUs of its
+    slot (see cpu_slots).
+
+    Args:
+        limits (ExecutionLimits): The limits.
+        worker_count (multiprocessing.Value): The number of workers
+                                              started so far, shared
+                                              by the workers of the
+                                              pool.
+    Returns:
+        None
+
+    """
+    configure(limits)
+    apply_limits(limits)
+    if limits.cpus_per_worker <= 0:
+        return
+    with worker_count.get_lock():
+        index = worker_count.value
+        worker_count.value += 1
+    slots = cpu_slots(limits.cpus_per_worker)
+    cpus = slots[index % len(slots)]
+    try:
+        set_affinity(cpus)
+        logging.debug("Worker %d pinned to CPUs %s", os.getpid(),
+                      ",".join(str(cpu) for cpu in cpus))
+    except OSError as exc:
+        logging.warning("WARNING: can't pin worker %d to CPUs %s: %s",
+                        os.getpid(), cpus, exc)
+
+
+
+def parse_cpu_list(text):
+    """Parses a list of CPUs such as 0-3,8,10-11."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            (first, last) = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+
+def allowed_cpus():
+    """Returns the CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Cpus_allowed_list:"):
+                    return parse_cpu_list(line.split(":", 1)[1])
+    except IOError:
+        pass
+    import multiprocessing
+    return list(range(multiprocessing.cpu_count()))
+
+
+
+def numa_nodes():
+    """Returns the CPUs of each NUMA node of the host, a list of
+    lists, or a single node of all the CPUs if the topology isn't
+    known.
+    """
+    nodes = []
+    for node_dir in sorted(glob.glob("/sys/devices/system/node/node[0-9]*"),
+                           key=lambda path: int(path.rsplit("node", 1)[1])):
+        try:
+            with open(os.path.join(node_dir, "cpulist")) as f:
+                nodes.append(parse_cpu_list(f.read()))
+        except (IOError, ValueError):
+            continue
+    return nodes or [allowed_cpus()]
+
+
+
+def cpu_slots(cpus_per_worker):
+    """Divides the CPUs this process may run on into slots of
+    cpus_per_worker CPUs, one per worker.  The CPUs of a slot are
+    taken from a single NUMA node (a node with fewer CPUs forms a
+    slot of its own), and the slots alternate between the nodes, so
+    that the first workers are spread over all of them.
+
+    Returns:
+        slots (list): The lists of the CPUs of each slot.
+
+    """
+    allowed = set(allowed_cpus())
+    node_slots = []
+    for node_cpus in numa_nodes():
+        cpus = [cpu for cpu in node_cpus if cpu in allowed]
+        if not cpus:
+            continue
+        if len(cpus) < cpus_per_worker:
+            node_slots.append([cpus])
+            continue
+        node_slots.append([cpus[start:start + cpus_per_worker]
+                           for start in range(0, len(cpus) - cpus_per_worker + 1,
+                                              cpus_per_worker)])
+    slots = []
+    for index in range(max([len(node) for node in node_slots] + [0])):
+        slots.extend(node[index] for node in node_slots if index < len(node))
+    return slots or [sorted(allowed)]
+
+
+
+def set_affinity(cpus):
+    """Pins this process (and the processes it starts) to a list of
+    CPUs.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6",
+                       use_errno=True)
+    mask = (ctypes.c_ubyte * (_CPU_SETSIZE // 8))()
+    for cpu in cpus:
+        mask[cpu // 8] |= 1 << (cpu % 8)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+
+def apply_limits(limits):
+    """Applies the nice level and the memory cap of the limits to
+    this process.  The nice level is absolute: it is only raised.
+    """
+    if limits.nice > os.nice(0):
+        os.nice(limits.nice - os.nice(0))
+    if limits.memory_limit_mb > 0:
+        cap = limits.memory_limit_mb * 1024 * 1024
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            cap = min(cap, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (cap, hard))
+
+
+
+def job_log_file(output_file, log_dir):
+    """Returns the log file of the job creating an output file."""
+    return os.path.join(log_dir, os.path.basename(output_file) + ".log")
+
+
+
+def execute(argv, output_file=None, on_line=None, cwd=None):
+    """Runs a command, without a shell, with the limits of this
+    process (see configure).
+
+    Args:
+        argv (list): The command and its arguments.
+        output_file (string): The output file of the job, which
+                              names its log file.
+        on_line (function): If given, called with each line of the
+                            standard output (and error) of the
+                            command, which is also written to the log
+                            file or to the terminal.
+        cwd (string): The working directory of the command, by
+                      default that of this process.
+    Returns:
+        (status, usage, timed_out) (tuple): The exit status of the
+                             command, encoded as that of os.system,
+                             its resource usage (see
+                             WRF_Hydro_metrics.wait4), and True if it
+                             was terminated because it timed out.
+
+    """
+    limits = _limits
+
+    def preexec():
+        # The command gets a process group of its own, so that the
+        # processes it starts are terminated with it.
+        os.setpgid(0, 0)
+        apply_limits(limits)
+
+    log = None
+    if limits.log_dir and output_file:
+        WRF_Hydro_util.mkdir_p(limits.log_dir)
+        log = open(job_log_file(output_file, limits.log_dir), 'a')
+        log.write("# %s %s\n" % (time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                 " ".join(argv)))
+        log.flush()
+
+    timers = []
+    timed_out = []
+    try:
+        stdout = subprocess.PIPE if on_line is not None else log
+        process = subprocess.Popen(argv, stdout=stdout,
+                                   stderr=subprocess.STDOUT if stdout else None,
+                                   cwd=cwd, preexec_fn=preexec, close_fds=True,
+                                   universal_newlines=True)
+
+        def terminate(sig):
+            timed_out.append(sig)
+            try:
+                os.killpg(process.pid, sig)
+            except OSError:
+                try:
+                    os.kill(process.pid, sig)
+                except OSError:
+                    pass
+            if sig == signal.SIGTERM:
+                start_timer(KILL_DELAY, signal.SIGKILL)
+
+        def start_timer(delay, sig):
+            timer = threading.Timer(delay, terminate, (sig,))
+            timer.daemon = True
+            timers.append(timer)
+            timer.start()
+
+        if limits.timeout > 0:
+            start_timer(limits.timeout, signal.SIGTERM)
+        if on_line is not None:
+            out = log if log is not None else sys.stdout
+            for line in iter(process.stdout.readline, ''):
+                out.write(line)
+                on_line(line)
+            process.stdout.close()
+        (status, usage) = WRF_Hydro_metrics.wait4(process.pid)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+                             else os.WEXITSTATUS(status)
+    finally:
+        for timer in timers:
+            timer.cancel()
+        if log is not None:
+            log.close()
+    if timed_out:
+        logging.error("ERROR: %s timed out after %.0f s%s", argv[0],
+                      limits.timeout,
+                      ", killed" if signal.SIGKILL in timed_out else "")
+    return (status, usage, len(timed_out) > 0)
+
+
+
+def run_in_scratch_dir(argvs, output_file):
+    """Runs commands one after the other in a temporary working
+    directory of their own, removed afterwards, e.g. the two runs
+    of combine.ncl, which pass the index of the cells to fill
+    through the index.nc file of the current directory.  This is
+    invoked by the worker processes, so it must remain a
+    module-level function.
+
+    Args:
+        argvs (list): The commands, argv lists.
+        output_file (string): The output file of the job.
+    Returns:
+        None.  Raises a RuntimeError if a command fails.
+
+    """
+    import WRF_Hydro_failures
+
+    scratch_dir = tempfile.mkdtemp(prefix="wrf_hydro_")
+    try:
+        for argv in argvs:
+            (status, usage, timed_out) = execute(argv, output_file,
+                                                 cwd=scratch_dir)
+            if timed_out:
+                raise RuntimeError("%s timed out after %.0f s" %
+                                   (argv[0], _limits.timeout))
+            if status != 0:
+                raise RuntimeError(WRF_Hydro_failures.command_error(argv,
+                                                                    status))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
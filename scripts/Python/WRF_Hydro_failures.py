@@ -0,0 +1,158 @@
+import os
+import json
+import logging
+import socket
+import time
+import WRF_Hydro_metrics
+from collections import OrderedDict
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_failures.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Failure handling of the per-file jobs of the forcing engine.  A
+#  failed job doesn't stop the run: the other jobs keep running, and
+#  only the jobs which depend on the failed one are not run.  A
+#  failed job is retried up to max_retries times, after a delay which
+#  doubles with each retry (retry_delay, up to max_retry_delay
+#  seconds, [failures] section of the wrf_hydro_forcing.parm file),
+#  for the transient failures of e.g. an automounted file system or
+#  an input file still being written.  A job which still fails is
+#  quarantined in the processed-file manifest (see
+#  WRF_Hydro_manifest) for quarantine_hours: later runs don't try it
+#  again until one of its inputs changes or the quarantine expires.
+#
+#  At the end of each run, the jobs which failed, were quarantined or
+#  weren't run because a job they depend on failed are listed in the
+#  log file and appended, as one JSON object per run, to the
+#  <log file>_failures.jsonl file.
+
+
+
+class RetryPolicy(object):
+    """The retries of the failed jobs.
+
+    Args:
+        max_retries (int): The number of times a failed job is run
+                           again, 0 to not retry.
+        retry_delay (float): The delay (in seconds) before the first
+                             retry, doubled for each following one.
+        max_retry_delay (float): The maximum delay (in seconds).
+
+    """
+
+    def __init__(self, max_retries=0, retry_delay=30., max_retry_delay=600.):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    def should_retry(self, attempts):
+        """Determines if a job which failed attempts times is run
+        again.
+        """
+        return attempts <= self.max_retries
+
+    def delay(self, attempts):
+        """Returns the delay (in seconds) before a job which failed
+        attempts times is run again.
+        """
+        return min(self.retry_delay * 2 ** (attempts - 1),
+                   self.max_retry_delay)
+
+
+
+def command_error(cmd, status):
+    """Describes the failure of a command, a shell command string or
+    an argv list, from its exit status, encoded as that of os.system.
+    """
+    if isinstance(cmd, list):
+        name = cmd[0] if cmd else ""
+    else:
+        name = cmd.split()[0] if cmd.split() else cmd
+    if os.WIFSIGNALED(status):
+        return "%s killed by signal %d" % (name, os.WTERMSIG(status))
+    return "%s exited with %d" % (name, os.WEXITSTATUS(status))
+
+
+
+def failure_entry(label, stage, result, inputs, quarantined=False):
+    """Creates the entry of a failed job in the failure report.
+
+    Args:
+        label (tuple): The (product, activity) of the job.
+        stage (string): The processing stage.
+        result (tuple): The result of the job: (output file, elapsed
+                        time, return value, metrics).
+        inputs (list): The input files of the job.
+        quarantined (boolean): True if the job was quarantined.
+    Returns:
+        entry (OrderedDict): The entry.
+
+    """
+    (output_file, elapsed, return_value, metrics) = result
+    return OrderedDict([('product', label[0]),
+                        ('activity', label[1]),
+                        ('stage', stage),
+                        ('output_file', output_file),
+                        ('return_value', return_value),
+                        ('attempts', metrics.get('attempts', 1)),
+                        ('error', metrics.get('error', "return value of %s" %
+                                              return_value)),
+                        ('quarantined', quarantined),
+                        ('inputs', list(inputs))])
+
+
+
+def write_failure_report(failures, not_created=(), num_jobs=0, prefix=None):
+    """Logs the failed jobs of a run and appends them to
+    <prefix>_failures.jsonl.  Nothing is written if every job
+    succeeded.
+
+    Args:
+        failures (list): The entries (see failure_entry) of the jobs
+                         which failed or were quarantined.
+        not_created (list): The output files of the jobs not run
+                            because a job they depend on failed.
+        num_jobs (int): The number of jobs of the run.
+        prefix (string): The path of the file, without the _failures
+                         suffix, by default that of the log file.
+    Returns:
+        report_file (string): The path of the report, or None.
+
+    """
+    if not failures and not not_created:
+        return None
+    logging.error("ERROR: %d of %d jobs failed, %d files not created because "
+                  "a job they depend on failed", len(failures), num_jobs,
+                  len(not_created))
+    for entry in failures:
+        if entry['attempts'] == 0:
+            # Skipped: quarantined by an earlier run.
+            logging.error("ERROR: %s %s of %s skipped (%s)",
+                          entry['product'], entry['stage'],
+                          entry['output_file'], entry['error'])
+            continue
+        logging.error("ERROR: %s %s of %s failed after %d attempts (%s)%s",
+                      entry['product'], entry['stage'], entry['output_file'],
+                      entry['attempts'], entry['error'],
+                      ", quarantined" if entry['quarantined'] else "")
+
+    if prefix is None:
+        prefix = WRF_Hydro_metrics.log_file_prefix()
+    report_file = prefix + "_failures.jsonl"
+    try:
+        with open(report_file, 'a') as f:
+            f.write(json.dumps(OrderedDict(
+                [('run_end', time.strftime("%Y-%m-%dT%H:%M:%S")),
+                 ('host', socket.gethostname()),
+                 ('num_jobs', num_jobs),
+                 ('failures', failures),
+                 ('not_created', list(not_created))])) + "\n")
+    except (IOError, OSError) as exc:
+        logging.error("ERROR: the failure report could not be written: %s", exc)
+        return None
+    logging.info("Failure report appended to %s", report_file)
+    return report_file
@@ -1,10 +1,25 @@
 import os
-import errno
+import argparse
+import heapq
 import logging
+import multiprocessing
 import re
+import shlex
+import tempfile
 import time
 import numpy as np
+import WRF_Hydro_catalog
+import WRF_Hydro_execution
+import WRF_Hydro_io
+import WRF_Hydro_manifest
+import WRF_Hydro_metrics
+from WRF_Hydro_util import mkdir_p
+from collections import OrderedDict
 from ConfigParser import SafeConfigParser
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 
 
@@ -25,7 +40,7 @@ from ConfigParser import SafeConfigParser
 
 
 
-def regrid_data( product_name, parser ):
+def regrid_data( product_name, parser, data_files=None ):
     """Provides a wrapper to the regridding scripts originally
     written in NCL.  For HRRR data regridding, the
     HRRR-2-WRF_Hydro_ESMF_forcing.ncl script is invoked.
@@ -35,7 +50,12 @@ def regrid_data( product_name, parser ):
     retrieved and stored in a list. The appropriate regridding
     script is invoked for each file in the list.  The regridded
     files are stored in an output directory defined in the
-    parm/config file.
+    parm/config file.  If the regridding_engine in the 
+    [regridding] section of the parm/config file is set to
+    Python, the files are instead regridded in-process by
+    the WRF_Hydro_regrid module, using the same weight files.
+    If an ncl_batch_size greater than 1 is defined in the 
+    [parallel] section, each NCL process regrids several files.
 
     Args:
         product_name (string):  The name of the product 
@@ -43,6 +63,9 @@ def regrid_data( product_name, parser ):
         parser (ConfigParser):  The parser to the config/parm
                                 file containing all defined values
                                 necessary for running the regridding.
+        data_files (list):  The full paths of the files to regrid,
+                            by default all the files in the product's
+                            data directory.
     Returns:
         elapsed_times (numpy array):  A Numpy array containing the 
                                       elapsed time in seconds for 
@@ -50,6 +73,52 @@ def regrid_data( product_name, parser ):
 
     """
 
+    product = product_name.upper()
+    (jobs, job_inputs, version, batch) = regrid_jobs(product_name, parser,
+                                                     data_files)
+
+    # Run the NCL script for each new or changed file, concurrently
+    # if more than one worker is defined in the parm/config file.
+    # The time it takes to regrid each file is measured by the job
+    # runner.
+    elapsed_array = []
+    results = run_incremental_jobs(jobs, job_inputs, 'regridding', version,
+                                   parser, batch=batch,
+                                   label=(product, "Regridding"))
+    for (output_file, elapsed_time_sec, return_value, metrics) in results:
+        elapsed_array.append(elapsed_time_sec)
+
+        # The failed files are listed in the failure report, the
+        # others are regridded nonetheless.
+        if return_value != 0:
+            logging.error('ERROR: The regridding of %s was unsuccessful, \
+                          return value of %s', output_file, return_value)
+        
+    return elapsed_array
+
+
+
+def regrid_jobs(product_name, parser, data_files=None):
+    """Creates the jobs (see run_jobs) regridding the files of a
+    product, with the regridding script or engine defined in the
+    parm/config file (see regrid_data).
+
+    Args:
+        product_name (string):  The name of the product 
+                                e.g. HRRR, MRMS, NAM
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        data_files (list):  The full paths of the files to regrid,
+                            by default all the files in the product's
+                            data directory.
+    Returns:
+        (jobs, job_inputs, version, batch) (tuple):  The jobs, the
+                            input files of each job keyed by output
+                            file, the version of the regridding
+                            stage and the NCL batch function (or
+                            None), see run_incremental_jobs.
+
+    """
 
     # Retrieve the values from the parm/config file
     # which are needed to invoke the regridding 
@@ -57,17 +126,21 @@ def regrid_data( product_name, parser ):
     product = product_name.upper()
     dst_grid_name = parser.get('regridding','dst_grid_name')
     ncl_exec = parser.get('exe', 'ncl_exe')
-
-    # Create an array to store the elapsed times for
-    # regridding each file.
-    elapsed_array = []
+    regridding_engine = get_engine(parser, 'regridding', 'regridding_engine')
+    output_options = get_output_options(parser)
+    if regridding_engine == 'PYTHON':
+        import WRF_Hydro_regrid
+        weight_cache_dir = None
+        if parser.has_option('regridding', 'weight_cache_dir'):
+            weight_cache_dir = parser.get('regridding', 'weight_cache_dir')
+        grib_index = get_grib_index(parser)
+        tile_rows = get_tile_rows(parser, output_options)
 
     if product == 'HRRR':
        logging.info("Regridding HRRR")
        wgt_file = parser.get('regridding', 'HRRR_wgt_bilinear')
        data_dir =  parser.get('data_dir', 'HRRR_data')
        regridding_exec = parser.get('exe', 'HRRR_regridding_exe')
-       data_files_to_process = get_filepaths(data_dir)   
        #Values needed for running the regridding script
        output_dir_root = parser.get('regridding','HRRR_output_dir')
     elif product == 'MRMS':
@@ -75,7 +148,6 @@ def regrid_data( product_name, parser ):
        wgt_file = parser.get('regridding', 'MRMS_wgt_bilinear')
        data_dir =  parser.get('data_dir', 'MRMS_data')
        regridding_exec = parser.get('exe', 'MRMS_regridding_exe')
-       data_files_to_process = get_filepaths(data_dir)   
        #Values needed for running the regridding script
        output_dir_root = parser.get('regridding','MRMS_output_dir')
     elif product == 'NAM':
@@ -83,7 +155,6 @@ def regrid_data( product_name, parser ):
        wgt_file = parser.get('regridding', 'NAM_wgt_bilinear')
        data_dir =  parser.get('data_dir', 'NAM_data')
        regridding_exec = parser.get('exe', 'NAM_regridding_exe')
-       data_files_to_process = get_filepaths(data_dir)
        #Values needed for running the regridding script
        output_dir_root = parser.get('regridding','NAM_output_dir')
     elif product == 'GFS':
@@ -91,7 +162,6 @@ def regrid_data( product_name, parser ):
        wgt_file = parser.get('regridding', 'GFS_wgt_bilinear')
        data_dir =  parser.get('data_dir', 'GFS_data')
        regridding_exec = parser.get('exe', 'GFS_regridding_exe')
-       data_files_to_process = get_filepaths(data_dir)
        #Values needed for running the regridding script
        output_dir_root = parser.get('regridding','GFS_output_dir')
     elif product == 'RAP':
@@ -99,10 +169,21 @@ def regrid_data( product_name, parser ):
        wgt_file = parser.get('regridding', 'RAP_wgt_bilinear')
        data_dir =  parser.get('data_dir', 'RAP_data')
        regridding_exec = parser.get('exe', 'RAP_regridding_exe')
-       data_files_to_process = get_filepaths(data_dir)
        #Values needed for running the regridding script
        output_dir_root = parser.get('regridding','RAP_output_dir')
-
+    else:
+       raise ValueError("unsupported product: %s, can't be regridded" %
+                        product)
+
+    # The date, model run and forecast hour of the files of the data
+    # directory are taken from the input catalog, those of the files
+    # given are parsed from their names.
+    if data_files is None:
+        data_files_to_process = \
+            catalog_index(parser, data_dir,
+                          WRF_Hydro_catalog.name_pattern(product)).entries
+    else:
+        data_files_to_process = [(data_file, None) for data_file in data_files]
 
 
     # For each file in the data directory,
@@ -115,105 +196,150 @@ def regrid_data( product_name, parser ):
     #  'dstGridName="/d4/hydro-dm/IOC/data/geo_dst.nc"' 
     #  'outdir="/d4/hydro-dm/IOC/regridded/HRRR/20150723/i09"'
     #  'outFile="20150724_i09_f010_HRRR.nc"' 
-
-    for data_file_to_process in data_files_to_process:
+    # Each regridding command is stored as a job, the jobs are
+    # run once all the commands have been assembled.  The input
+    # files of each job are kept for the processed-file manifest.
+    jobs = []
+    job_inputs = {}
+    batch_entries = {}
+
+    for (data_file_to_process, fields) in data_files_to_process:
         #input_filename = data_dir + '/' + data_file_to_process
         input_filename =  data_file_to_process
-        srcfilename_param =  "'srcfilename=" + '"' + input_filename +  \
-                             '"' + "' "
+        srcfilename_param = ('srcfilename', input_filename)
        # logging.info("input data file: %s", data_file_to_process)
-        wgtFileName_in_param =  "'wgtFileName_in = " + '"' + wgt_file + \
-                                '"' + "' "
-        dstGridName_param =  "'dstGridName=" + '"' + dst_grid_name + '"' + "' "
+        wgtFileName_in_param = ('wgtFileName_in', wgt_file)
+        dstGridName_param = ('dstGridName', dst_grid_name)
 
         # Create the output filename following the RAL 
         # naming convention: 
-        (subdir_file_path,hydro_filename) = \
-            create_output_name_and_subdir(product,data_file_to_process,data_dir)
+        # A file with an unexpected name is skipped, not the others.
+        try:
+            (subdir_file_path,hydro_filename) = \
+                create_output_name_and_subdir(product,data_file_to_process,
+                                              data_dir, fields)
+        except ValueError as exc:
+            logging.error("ERROR: %s is not regridded: %s",
+                          data_file_to_process, exc)
+            continue
    
         #logging.info("hydro filename: %s", hydro_filename)
         # Create the full path to the output directory
         # and assign it to the output directory parameter
         output_file_dir = output_dir_root + "/" + subdir_file_path
-        outdir_param = "'outdir=" + '"' + output_file_dir + '"' + "' " 
+        outdir_param = ('outdir', output_file_dir)
         #logging.info("outdir_param: %s", outdir_param)
+        full_output_file = output_file_dir + "/"  + hydro_filename
 
         if product == "HRRR" or product == "NAM" \
            or product == "GFS" or product == "RAP":
-           #full_output_file = output_file_dir + "/"  + subdir_file_path
-           full_output_file = output_file_dir + "/"  
            # Create the new output file subdirectory
            mkdir_p(output_file_dir)
-           outFile_param = "'outFile=" + '"' + hydro_filename+ '"' + "' "
+           outFile_param = ('outFile', hydro_filename)
         elif product == "MRMS":
            # !!!!!!NOTE!!!!!
            # MRMS regridding script differs from the HRRR and NAM scripts in that it does not
            # accept an outdir variable.  Incorporate the output directory (outdir)
            # into the outFile variable.
-           full_output_file = output_file_dir + "/"  + hydro_filename
            mkdir_p(output_file_dir)
-           outFile_param = "'outFile=" + '"' + full_output_file + '"' + "' "
+           outFile_param = ('outFile', full_output_file)
    
-        regrid_params = srcfilename_param + wgtFileName_in_param + \
-                        dstGridName_param + outdir_param + \
-                        outFile_param
-        regrid_prod_cmd = ncl_exec + " "  + regrid_params + " " + \
-                          regridding_exec
+        regrid_params = [srcfilename_param, wgtFileName_in_param,
+                         dstGridName_param, outdir_param, outFile_param]
+        regrid_prod_cmd = ncl_command(ncl_exec, regrid_params,
+                                      regridding_exec)
         
-        logging.debug("regridding command: %s",regrid_prod_cmd)
-        # Measure how long it takes to run the NCL script for regridding.
-        start_NCL_regridding = time.time()
-        return_value = os.system(regrid_prod_cmd)
-        end_NCL_regridding = time.time()
-        elapsed_time_sec = end_NCL_regridding - start_NCL_regridding
-        elapsed_array.append(elapsed_time_sec)
-     
+        if regridding_engine == 'PYTHON':
+            logging.debug("regridding %s to %s", input_filename, full_output_file)
+            jobs.append((full_output_file,
+                         [(WRF_Hydro_regrid.regrid_file,
+                           (product, input_filename, full_output_file, wgt_file,
+                            weight_cache_dir, output_options, grib_index,
+                            tile_rows, dst_grid_name))]))
+            job_inputs[full_output_file] = [input_filename, wgt_file,
+                                            dst_grid_name]
+        else:
+            logging.debug("regridding command: %s", " ".join(regrid_prod_cmd))
+            jobs.append((full_output_file,
+                         [regrid_prod_cmd] +
+                         repack_cmds(full_output_file, output_options)))
+            job_inputs[full_output_file] = [input_filename, wgt_file,
+                                            dst_grid_name, regridding_exec]
+            batch_entries[full_output_file] = [input_filename,
+                                               full_output_file]
+
+    # In batch mode, the files to regrid are handed to the NCL
+    # script in chunks, the source and output files being listed
+    # in the srcFileList and outFileList files.
+    ncl_batch_size = get_ncl_batch_size(parser)
+    if regridding_engine != 'PYTHON' and ncl_batch_size > 1:
+        ncl_batch_cmd = ncl_command(ncl_exec, [('wgtFileName_in', wgt_file),
+                                               ('dstGridName', dst_grid_name)])
+        def batch(pending_jobs):
+            return make_ncl_batches(pending_jobs, ncl_batch_size,
+                                    get_num_workers(parser), ncl_batch_cmd,
+                                    regridding_exec,
+                                    ['srcFileList', 'outFileList'],
+                                    batch_entries)
+    else:
+        batch = None
 
-        if return_value != 0:
-            logging.info('ERROR: The regridding of %s was unsuccessful, \
-                          return value of %s', product,return_value)
-            #TO DO: Determine the proper action to take when the NCL file h
-            #fails. For now, exit.
-            exit()
-        
-    return elapsed_array
+    version = WRF_Hydro_manifest.stage_version('regridding', regridding_engine)
+    version += output_version(output_options)
+    return (jobs, job_inputs, version, batch)
 
 
 
 def get_filepaths(dir):
-    """ Generates the file names in a directory tree
-    by walking the tree either top-down or bottom-up.
-    For each directory in the tree rooted at 
-    the directory top (including top itself), it
-    produces a 3-tuple: (dirpath, dirnames, filenames).
+    """ Generates the file names in a directory tree, 
+    listed (with scandir) by the input catalog of this
+    process (WRF_Hydro_catalog), which only lists the
+    directories which changed since it last did.  Hidden
+    and temporary (.tmp) files are left out.
     
     Args:
         dir (string): The base directory from which we 
                       begin the search for filenames.
     Returns:
-        file_paths (list): A list of the full filepaths 
+        file_paths (list): A sorted list of the full filepaths 
                            of the data to be processed.
 
         
     """
 
-    # Create an empty list which will eventually store 
-    # all the full filenames
-    file_paths = []
+    return WRF_Hydro_catalog.open_catalog().scan(dir).files()
 
-    # Walk the tree
-    for root, directories, files in os.walk(dir):
-        for filename in files:
-            # Join the two strings to form the full
-            # filepath.
-            filepath = os.path.join(root,filename)
-            # add it to the list
-            file_paths.append(filepath)
-    return file_paths
 
 
+def catalog_index(parser, dir, pattern):
+    """Scans a directory tree with the input catalog
+    (WRF_Hydro_catalog) defined by catalog_file in the [catalog]
+    section of the parm/config file, and saves the catalog.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        dir (string):  The top directory of the tree.
+        pattern (re.RegexObject):  The pattern of the file names,
+                                   see WRF_Hydro_catalog.name_pattern.
+    Returns:
+        index (WRF_Hydro_catalog.TreeIndex):  The files of the tree,
+                                indexed by date, model run and
+                                forecast hour.
 
-def create_output_name_and_subdir(product, filename, input_data_file):
+    """
+    catalog_file = None
+    if parser.has_option('catalog', 'catalog_file'):
+        catalog_file = parser.get('catalog', 'catalog_file').strip() or None
+    catalog = WRF_Hydro_catalog.open_catalog(catalog_file)
+    index = catalog.scan(dir, pattern)
+    catalog.save()
+    return index
+
+
+
+def create_output_name_and_subdir(product, filename, input_data_file,
+                                  fields=None):
     """ Creates the full filename for the regridded data which follows 
     the RAL standard:  
        basedir/YYYYMMDD/i_hh/YYMMDD_ihh_fnnnn_<product>.nc
@@ -241,6 +367,11 @@ def create_output_name_and_subdir(product, filename, input_data_file):
                                   /d4/hydro-dm/IOC/regridded/<product>
                                   Used to create the full path.
 
+        fields (tuple): The date, model run and forecast hour of
+                        the file, as parsed by the input catalog
+                        (see WRF_Hydro_catalog.parse_name); parsed
+                        from the filename if not given.
+
     Returns:
         
         year_month_day_subdir (string): The subdirectory under which the 
@@ -249,6 +380,10 @@ def create_output_name_and_subdir(product, filename, input_data_file):
 
         hydro_filename (string):  The name of the processed output
                                   file.      
+
+    Raises:
+        ValueError:  If the product isn't supported or the filename
+                     doesn't follow the product's naming convention.
  
     """
 
@@ -256,32 +391,16 @@ def create_output_name_and_subdir(product, filename, input_data_file):
     # comparison.
     product_name = product.upper() 
 
-    if product == 'HRRR' or product == 'GFS' \
-       or product == "NAM" or product == 'RAP':
-        match = re.match(r'.*([0-9]{8})_(i[0-9]{2})_(f[0-9]{2,4})',filename)
-        if match:
-            year_month_day = match.group(1)
-            init_hr = match.group(2)
-            fcst_hr = match.group(3)
-            year_month_day_subdir = year_month_day + "/" + init_hr 
-        else:
-            logging.error("ERROR: %s data filename %s has an unexpected name.", \
-                           product_name,filename) 
-            exit()
-
-    elif product == 'MRMS':
-        match = re.match(r'.*([0-9]{8})_([0-9]{2}).*',filename) 
-        if match:
-           year_month_day = match.group(1)
-           init_hr = "i" + match.group(2)
-           # Radar data- not a model, therefore no forecast
-           fcst_hr = "f000"
-           year_month_day_subdir = year_month_day + "/" + init_hr 
-        else:
-           logging.error("ERROR: MRMS data filename %s \
-                          has an unexpected file name.",\
-                          filename) 
-           exit()
+    if fields is None:
+        fields = WRF_Hydro_catalog.parse_name(
+            WRF_Hydro_catalog.name_pattern(product_name), filename)
+    if fields is None:
+        raise ValueError("%s data filename %s has an unexpected name" %
+                         (product_name, filename))
+    (year_month_day, init_hr, fcst_hr) = fields
+    # The MRMS radar data have no forecast, their fcst_hr is f000
+    fcst_hr = "f" + fcst_hr
+    year_month_day_subdir = year_month_day + "/" + init_hr 
 
     # Assemble the filename and the full output directory path
     hydro_filename = year_month_day + "_" + init_hr + \
@@ -293,26 +412,8 @@ def create_output_name_and_subdir(product, filename, input_data_file):
 
 
 
-def mkdir_p(dir):
-    """Provides mkdir -p functionality.
-    
-       Args:
-          dir (string):  Full directory path to be created if it
-                         doesn't exist.
-       Returns:
-          None:  Creates nested subdirs if they don't already 
-                 exist.
-
-    """
-    try:
-       os.makedirs(dir)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(dir):
-            pass
-        else: raise            
-
-
-def downscale_data(product_name, parser, downscale_shortwave=False):
+def downscale_data(product_name, parser, downscale_shortwave=False,
+                   data_files=None):
     """
     Performs downscaling of data by calling the necessary
     NCL code (specific to the model/product).  There is an
@@ -326,6 +427,17 @@ def downscale_data(product_name, parser, downscale_shortwave=False):
     (of shortwave radiation) is requested, the adj_topo.ncl script
     will "clobber" the previously created downscaled files.
 
+    If the downscaling_engine in the [downscaling] section of the
+    parm/config file is set to Python, the height correction is
+    instead performed in-process by the WRF_Hydro_downscale module.
+    Similarly, if the shortwave_engine is set to Python the shortwave
+    radiation is adjusted in-process by the WRF_Hydro_shortwave module,
+    with the terrain geometry computed once per destination grid. 
+    When both are Python, SWDOWN is adjusted before the downscaled
+    file is written, so the file isn't rewritten.  If an
+    ncl_batch_size greater than 1 is defined in the [parallel]
+    section, each NCL process downscales several files.
+
 
     Args:
         product_name (string):  The product name: ie HRRR, NAM, GFS, etc. 
@@ -341,6 +453,11 @@ def downscale_data(product_name, parser, downscale_shortwave=False):
                                 the NCL wrapper to the Fortan
                                 code.
                                 Set to 'False' by default.
+
+        data_files (list) : The full paths of the regridded files
+                            to downscale, by default all the files
+                            in the product's data_to_downscale
+                            directory.
     Returns:
         elapsed_array (List):  A list of the elapsed time for
                                performing the downscaling. Each entry 
@@ -349,6 +466,57 @@ def downscale_data(product_name, parser, downscale_shortwave=False):
                                
                               
         
+    """
+
+    product = product_name.upper() 
+    (jobs, job_inputs, version, batch) = \
+        downscale_jobs(product_name, parser, downscale_shortwave, data_files)
+
+    # Crude measurement of performance for downscaling.
+    # Wall clock time used to determine the elapsed time
+    # for downscaling each file (including the shortwave
+    # downscaling, if requested).  Only the new or changed
+    # files are downscaled.
+    elapsed_array = []
+    results = run_incremental_jobs(jobs, job_inputs, 'downscaling', version,
+                                   parser, batch=batch,
+                                   label=(product, "Downscaling"))
+    for (output_file, elapsed, return_value, metrics) in results:
+        elapsed_array.append(elapsed)
+
+        # Check for successful or unsuccessful downscaling
+        if return_value != 0:
+            logging.error('ERROR: The downscaling of %s was unsuccessful, \
+                          return value of %s', output_file, return_value)
+
+    return elapsed_array
+
+
+
+def downscale_jobs(product_name, parser, downscale_shortwave=False,
+                   data_files=None):
+    """Creates the jobs (see run_jobs) downscaling the regridded
+    files of a product, with the scripts or engines defined in the
+    parm/config file (see downscale_data).
+
+    Args:
+        product_name (string):  The product name: ie HRRR, NAM, GFS, etc. 
+        parser (ConfigParser) : The parser to the config/parm file.
+        downscale_shortwave (boolean) : 'True' if downscaling of 
+                                shortwave radiation (SWDOWN) is 
+                                requested.
+        data_files (list) : The full paths of the regridded files
+                            to downscale, by default all the files
+                            in the product's data_to_downscale
+                            directory.  The files need not exist
+                            yet.
+    Returns:
+        (jobs, job_inputs, version, batch) (tuple):  The jobs, the
+                            input files of each job keyed by output
+                            file, the version of the downscaling
+                            stage and the NCL batch function (or
+                            None), see run_incremental_jobs.
+
     """
 
     # Read in all the relevant input parameters based on the product: 
@@ -356,12 +524,19 @@ def downscale_data(product_name, parser, downscale_shortwave=False):
     product = product_name.upper() 
     lapse_rate_file = parser.get('downscaling','lapse_rate_file')
     ncl_exec = parser.get('exe', 'ncl_exe')
+    downscaling_engine = get_engine(parser, 'downscaling', 'downscaling_engine')
+    shortwave_engine = get_engine(parser, 'downscaling', 'shortwave_engine')
+    output_options = get_output_options(parser)
+    terrain_cache_dir = None
+    if parser.has_option('downscaling', 'terrain_cache_dir'):
+        terrain_cache_dir = parser.get('downscaling', 'terrain_cache_dir')
+    static_store = get_static_store(parser)
+    if downscaling_engine == 'PYTHON':
+        import WRF_Hydro_downscale
+        tile_rows = get_tile_rows(parser, output_options)
+    if shortwave_engine == 'PYTHON':
+        import WRF_Hydro_shortwave
     
- 
-    # Create an array to store the elapsed times for
-    # downscaling each file.
-    elapsed_array = []
-
     if product  == 'HRRR':
         logging.info("Downscaling HRRR")
         data_to_downscale_dir = parser.get('downscaling','HRRR_data_to_downscale')
@@ -393,22 +568,36 @@ def downscale_data(product_name, parser, downscale_shortwave=False):
         #DEBUGXXX
         logging.info("output dir for downscaled data %s", downscale_output_dir)
         downscale_exe = parser.get('exe', 'RAP_downscaling_exe')
+    else:
+        raise ValueError("unsupported product: %s, can't be downscaled" %
+                         product)
  
     
     # Get the data to downscale, and for each file, call the 
     # corresponding downscaling script
     #logging.info("dir with downscaled data: %s", data_to_downscale_dir)
-    data_to_downscale = get_filepaths(data_to_downscale_dir)
+    # The date and model run of the files are taken from the input
+    # catalog, those of the files given are parsed from their names.
+    if data_files is None:
+        data_to_downscale = \
+            catalog_index(parser, data_to_downscale_dir,
+                          WRF_Hydro_catalog.HYDRO_PATTERN).entries
+    else:
+        data_to_downscale = [(data, WRF_Hydro_catalog.parse_name(
+                                        WRF_Hydro_catalog.HYDRO_PATTERN,
+                                        os.path.basename(data)))
+                             for data in data_files]
+    jobs = []
+    job_inputs = {}
+    batch_entries = {}
     
-    for data in data_to_downscale:
-        match = re.match(r'(.*)/(([0-9]{8})_(i[0-9]{2})_f.*)',data)
-        if match:
-            yr_month_day = match.group(3)
-            downscaled_file = match.group(2)
-            init_hr = match.group(4)
-        else:
+    for (data, fields) in data_to_downscale:
+        if fields is None:
             logging.error("ERROR: regridded file's name: %s is an unexpected format",\
                            data)
+            continue
+        (yr_month_day, init_hr, fcst_hr) = fields
+        downscaled_file = os.path.basename(data)
         
        
         full_downscaled_dir = downscale_output_dir + "/" + yr_month_day + "/"\
@@ -425,80 +614,1171 @@ def downscale_data(product_name, parser, downscale_shortwave=False):
         # Create the key-value pairs that make up the
         # input for the NCL script responsible for
         # the downscaling.
-        input_file1_param = "'inputFile1=" + '"' + hgt_data_file + '"' + "' "
-        input_file2_param = "'inputFile2=" + '"' + geo_data_file + '"' + "' "
-        input_file3_param = "'inputFile3=" + '"' + data + '"' + "' "
-        lapse_file_param =  "'lapseFile=" + '"' + lapse_rate_file + '"' + "' "
-        output_file_param = "'outFile=" + '"' + full_downscaled_file + '"' + "' "
-        downscale_params =  input_file1_param + input_file2_param + \
-                  input_file3_param + lapse_file_param +  output_file_param 
-        downscale_cmd = ncl_exec + " " + downscale_params + " " + downscale_exe
+        input_file1_param = ('inputFile1', hgt_data_file)
+        input_file2_param = ('inputFile2', geo_data_file)
+        input_file3_param = ('inputFile3', data)
+        lapse_file_param = ('lapseFile', lapse_rate_file)
+        output_file_param = ('outFile', full_downscaled_file)
+        downscale_params = [input_file1_param, input_file2_param,
+                            input_file3_param, lapse_file_param,
+                            output_file_param]
+        downscale_cmd = ncl_command(ncl_exec, downscale_params, downscale_exe)
+        job_inputs[full_downscaled_file] = [data, hgt_data_file, geo_data_file,
+                                            lapse_rate_file]
+        if downscaling_engine == 'PYTHON':
+            downscale_cmd = (WRF_Hydro_downscale.downscale_file,
+                             (data, full_downscaled_file, hgt_data_file,
+                              geo_data_file, lapse_rate_file, False,
+                              terrain_cache_dir, output_options, tile_rows,
+                              static_store))
+        else:
+            job_inputs[full_downscaled_file].append(downscale_exe)
+            batch_entries[full_downscaled_file] = [data, full_downscaled_file]
         logging.debug("Downscale command : %s", downscale_cmd)
 
         # Downscale the shortwave radiation, if requested...
         # Key-value pairs for downscaling SWDOWN, shortwave radiation.
-        if downscale_shortwave:
+        # The shortwave downscaling overwrites the file created by
+        # the first downscaling, so both commands belong to the same
+        # job and are run one after the other.
+        if downscale_shortwave and shortwave_engine == 'PYTHON':
+            logging.info("Shortwave downscaling requested...")
+            if downscaling_engine == 'PYTHON':
+                # Adjust SWDOWN in memory, before the file is written.
+                downscale_cmd = (WRF_Hydro_downscale.downscale_file,
+                                 downscale_cmd[1][:5] + (True,) +
+                                 downscale_cmd[1][6:])
+                jobs.append((full_downscaled_file, [downscale_cmd]))
+            else:
+                downscale_shortwave_cmd = \
+                    (WRF_Hydro_shortwave.adjust_shortwave_file,
+                     (full_downscaled_file, geo_data_file, terrain_cache_dir,
+                      static_store))
+                jobs.append((full_downscaled_file,
+                             [downscale_cmd, downscale_shortwave_cmd] +
+                             repack_cmds(full_downscaled_file, output_options)))
+        elif downscale_shortwave:
             logging.info("Shortwave downscaling requested...")
             downscale_swdown_exe = parser.get('exe', 'shortwave_downscaling_exe') 
-            swdown_output_file_param = "'outFile=" + '"' + \
-                                       full_downscaled_file + '"' + "' "
-
-            swdown_geo_file_param = "'inputGeo=" + '"' + geo_data_file + '"' + "' "
-            swdown_params = swdown_geo_file_param + " " + swdown_output_file_param
-            downscale_shortwave_cmd = ncl_exec + " " + swdown_params + " " \
-                                      + downscale_swdown_exe 
-            logging.info("SWDOWN downscale command: %s", downscale_shortwave_cmd)
-
-            # Crude measurement of performance for downscaling.
-            # Wall clock time used to determine the elapsed time
-            # for downscaling each file.
-            start = time.time()
-
-            #Invoke the NCL script for performing a single downscaling.
-            return_value = os.system(downscale_cmd)
-            swdown_return_value = os.system(downscale_shortwave_cmd)
-            end = time.time()
-            elapsed = end - start
-            elapsed_array.append(elapsed)
-
-            # Check for successful or unsuccessful downscaling
-            # of the required and shortwave radiation
-            if return_value != 0 or swdown_return_value != 0:
-                logging.info('ERROR: The downscaling of %s was unsuccessful, \
-                             return value of %s', product,return_value)
-                exit()
-
-        else:
+            swdown_output_file_param = ('outFile', full_downscaled_file)
+
+            swdown_geo_file_param = ('inputGeo', geo_data_file)
+            swdown_params = [swdown_geo_file_param, swdown_output_file_param]
+            downscale_shortwave_cmd = ncl_command(ncl_exec, swdown_params,
+                                                  downscale_swdown_exe)
+            job_inputs[full_downscaled_file].append(downscale_swdown_exe)
+            logging.info("SWDOWN downscale command: %s",
+                         " ".join(downscale_shortwave_cmd))
+            # The file is written as NCL writes it, then rewritten
+            # with the output options once SWDOWN is downscaled.
+            jobs.append((full_downscaled_file,
+                         [downscale_cmd, downscale_shortwave_cmd] +
+                         repack_cmds(full_downscaled_file, output_options)))
+        elif downscaling_engine == 'PYTHON':
             # Only one downscaling, no additional downscaling of
             # the short wave radiation.
+            jobs.append((full_downscaled_file, [downscale_cmd]))
+        else:
+            jobs.append((full_downscaled_file,
+                         [downscale_cmd] +
+                         repack_cmds(full_downscaled_file, output_options)))
+
+    # In batch mode, the files are handed to the NCL script in
+    # chunks, listed in the inputFileList and outFileList files.
+    # The shortwave downscaling, if requested, is still run for
+    # each file, once the batch has created it.
+    ncl_batch_size = get_ncl_batch_size(parser)
+    if downscaling_engine != 'PYTHON' and ncl_batch_size > 1:
+        ncl_batch_cmd = ncl_command(ncl_exec,
+                                    [('inputFile1', hgt_data_file),
+                                     ('inputFile2', geo_data_file),
+                                     ('lapseFile', lapse_rate_file)])
+        def batch(pending_jobs):
+            return make_ncl_batches(pending_jobs, ncl_batch_size,
+                                    get_num_workers(parser), ncl_batch_cmd,
+                                    downscale_exe,
+                                    ['inputFileList', 'outFileList'],
+                                    batch_entries)
+    else:
+        batch = None
 
-            # Crude measurement of performance for downscaling.
-            start = time.time()
+    version = WRF_Hydro_manifest.stage_version('downscaling', downscaling_engine)
+    if downscale_shortwave:
+        version += "+" + WRF_Hydro_manifest.stage_version('shortwave',
+                                                          shortwave_engine)
+    version += output_version(output_options)
+    return (jobs, job_inputs, version, batch)
 
-            #Invoke the NCL script for performing the generic downscaling.
-            return_value = os.system(downscale_cmd)
-            end = time.time()
-            elapsed = end - start
-            elapsed_array.append(elapsed)
 
-            # Check for successful or unsuccessful downscaling
-            if return_value != 0:
-                logging.info('ERROR: The downscaling of %s was unsuccessful, \
-                             return value of %s', product,return_value)
-                #TO DO: Determine the proper action to take when the NCL file 
-                #fails. For now, exit.
-                exit()
 
-    return elapsed_array
+def get_engine(parser, section, option):
+    """Retrieves the name of the engine used to perform a
+    processing step from the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        section (string):  The section of the parm/config file.
+        option (string):  The option holding the engine name.
+    Returns:
+        engine (string):  The engine name in uppercase, NCL
+                          if the option isn't defined.
+
+    """
+    if not parser.has_option(section, option):
+        return 'NCL'
+    return parser.get(section, option).strip().upper()
+
+
+
+def get_grib_index(parser):
+    """Retrieves whether the Python regridding engine reads only
+    the messages it regrids from the GRIB2 files, located with an
+    inventory of each file (see WRF_Hydro_grib_index), from the
+    [regridding] section of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        grib_index (string):  None to scan the whole files (the
+                              default), otherwise the directory
+                              where the inventories built from the
+                              files are cached, empty to not cache
+                              them.
+
+    """
+    if not parser.has_option('regridding', 'grib_index') or \
+       not parser.getboolean('regridding', 'grib_index'):
+        return None
+    if not parser.has_option('regridding', 'grib_index_dir'):
+        return ""
+    return parser.get('regridding', 'grib_index_dir').strip()
+
+
+
+def get_num_workers(parser):
+    """Retrieves the number of worker processes to use for
+    running the per-file jobs (regridding, downscaling, etc.)
+    from the [parallel] section of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        num_workers (int):  The number of worker processes. If
+                            the option isn't defined, 1 is
+                            returned (run one file at a time).
+                            A value of 0 or less means use
+                            all the available cores.
+
+    """
+    if not parser.has_option('parallel', 'num_workers'):
+        return 1
+
+    num_workers = parser.getint('parallel', 'num_workers')
+    if num_workers <= 0:
+        num_workers = multiprocessing.cpu_count()
+    return num_workers
+
+
+
+def get_ncl_batch_size(parser):
+    """Retrieves the maximum number of files handed to a single
+    NCL process (batch mode) from the [parallel] section of the
+    parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        batch_size (int):  The number of files per NCL process.
+                           If the option isn't defined, 1 is
+                           returned (one NCL process per file).
+
+    """
+    if not parser.has_option('parallel', 'ncl_batch_size'):
+        return 1
+    return max(parser.getint('parallel', 'ncl_batch_size'), 1)
+
+
+
+def get_retry_policy(parser):
+    """Retrieves the retries of the failed jobs (see
+    WRF_Hydro_failures) from the [failures] section of the
+    parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        retry (WRF_Hydro_failures.RetryPolicy):  The retry policy.
+                              The failed jobs aren't retried if
+                              max_retries isn't defined.
+
+    """
+    import WRF_Hydro_failures
+
+    def get_failure_option(option, default):
+        if parser.has_option('failures', option):
+            return parser.get('failures', option).strip() or default
+        return default
+
+    return WRF_Hydro_failures.RetryPolicy(
+        int(get_failure_option('max_retries', 0)),
+        float(get_failure_option('retry_delay', 30)),
+        float(get_failure_option('max_retry_delay', 600)))
+
+
+
+def get_quarantine_hours(parser):
+    """Retrieves how long the jobs which failed all their retries
+    are quarantined (see WRF_Hydro_failures) from the [failures]
+    section of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        quarantine_hours (float):  The duration of the quarantine in
+                                   hours, 0 (the default) to not
+                                   quarantine the failed jobs.
+
+    """
+    if not parser.has_option('failures', 'quarantine_hours'):
+        return 0.
+    return max(parser.getfloat('failures', 'quarantine_hours'), 0.)
+
+
+
+def get_execution_limits(parser):
+    """Retrieves the limits of the commands of the jobs (see
+    WRF_Hydro_execution) from the [execution] section of the
+    parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        limits (WRF_Hydro_execution.ExecutionLimits):  The limits,
+                              none for the options which aren't
+                              defined.
+
+    """
+    def get_execution_option(option, default):
+        if parser.has_option('execution', option):
+            return parser.get('execution', option).strip() or default
+        return default
+
+    log_dir = get_execution_option('job_log_dir', None)
+    return WRF_Hydro_execution.ExecutionLimits(
+        max(float(get_execution_option('timeout', 0)), 0.),
+        max(int(get_execution_option('cpus_per_worker', 0)), 0),
+        max(int(get_execution_option('memory_limit_mb', 0)), 0),
+        int(get_execution_option('nice', 0)),
+        log_dir)
+
+
+
+def configure_execution(parser):
+    """Sets the limits (see get_execution_limits) of the commands
+    run by this process and its write-behind (see
+    get_write_behind_mb), and returns the initializer of the pools
+    of worker processes which sets those of the workers and pins
+    them to their CPUs.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        (initializer, initargs) (tuple):  The initializer of the
+                                          pools and its arguments.
+
+    """
+    limits = get_execution_limits(parser)
+    write_behind_mb = get_write_behind_mb(parser)
+    WRF_Hydro_execution.configure(limits)
+    WRF_Hydro_io.configure(write_behind_mb)
+    return (init_worker,
+            (limits, multiprocessing.Value('i', 0), write_behind_mb))
+
+
+
+def init_worker(limits, worker_count, write_behind_mb):
+    """Initializes a worker process of a pool, see
+    WRF_Hydro_execution.init_worker and WRF_Hydro_io.configure.
+    This is invoked by the worker processes, so it must remain a
+    module-level function.
+    """
+    WRF_Hydro_execution.init_worker(limits, worker_count)
+    WRF_Hydro_io.configure(write_behind_mb)
+
+
+
+def get_prefetcher(parser):
+    """Retrieves the read-ahead of the input files of the jobs (see
+    WRF_Hydro_io) from the [io] section of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        prefetcher (WRF_Hydro_io.Prefetcher):  The prefetcher, or
+                              None if prefetch_files isn't defined or
+                              is 0.
+
+    """
+    if not parser.has_option('io', 'prefetch_files') or \
+       parser.getint('io', 'prefetch_files') <= 0:
+        return None
+    mode = 'fadvise'
+    if parser.has_option('io', 'prefetch_mode'):
+        mode = parser.get('io', 'prefetch_mode').strip().lower() or mode
+    if mode not in ('fadvise', 'read'):
+        raise ValueError("Invalid prefetch_mode %s in the [io] section, "
+                         "expected fadvise or read" % mode)
+    return WRF_Hydro_io.Prefetcher(parser.getint('io', 'prefetch_files'), mode)
+
+
+
+def get_write_behind_mb(parser):
+    """Retrieves the memory (in MB) of the output files written
+    behind by each process (see WRF_Hydro_io) from the [io] section
+    of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        write_behind_mb (float):  The memory of the files waiting to
+                                  be written, 0 (the default) to
+                                  write them directly.
+
+    """
+    if not parser.has_option('io', 'write_behind_mb'):
+        return 0.
+    return max(parser.getfloat('io', 'write_behind_mb'), 0.)
+
+
+
+def get_static_store(parser):
+    """Retrieves the node-wide store of the static fields of the
+    Python downscaling and shortwave engines (see
+    WRF_Hydro_static_store) from the [downscaling] section of the
+    parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        store_dir (string):  The store directory, or None if the
+                             option isn't defined or is empty, for
+                             each process to keep its own copy of
+                             the static fields.
+
+    """
+    if not parser.has_option('downscaling', 'static_store_dir'):
+        return None
+    return parser.get('downscaling', 'static_store_dir').strip() or None
+
+
+
+def get_tile_rows(parser, output_options=None):
+    """Retrieves the number of rows of the blocks by which the
+    Python engines process the fields, to bound the memory of each
+    worker, from the [parallel] section of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        output_options (dict):  The output options (see
+                                get_output_options).
+    Returns:
+        tile_rows (int):  The number of rows of the blocks, 0 (the
+                          default) to process whole fields.
+
+    """
+    if not parser.has_option('parallel', 'tile_rows'):
+        return 0
+    tile_rows = max(parser.getint('parallel', 'tile_rows'), 0)
+    if tile_rows > 0 and output_options is not None and \
+       output_options['pack_int16']:
+        raise ValueError("pack_int16 can't be used with tile_rows, the "
+                         "packing needs the whole fields")
+    return tile_rows
+
+
+
+def get_output_options(parser):
+    """Retrieves the format, compression and packing of the
+    output files from the [output] section of the parm/config
+    file (see WRF_Hydro_netcdf).
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        options (dict):  The output options, or None if the
+                         files are written as NCL writes them
+                         (uncompressed NetCDF3), which is the
+                         default.
+
+    """
+    import WRF_Hydro_netcdf
+
+    if not parser.has_section('output'):
+        return None
+    def get_output_option(option):
+        if parser.has_option('output', option):
+            return parser.get('output', option).strip()
+        return ''
+
+    options = dict(WRF_Hydro_netcdf.DEFAULT_OUTPUT_OPTIONS)
+    if get_output_option('format'):
+        options['format'] = get_output_option('format').upper()
+    if get_output_option('complevel'):
+        options['complevel'] = int(get_output_option('complevel'))
+    if get_output_option('shuffle'):
+        options['shuffle'] = parser.getboolean('output', 'shuffle')
+    if get_output_option('chunk_shape'):
+        options['chunk_shape'] = tuple(
+            int(size) for size in get_output_option('chunk_shape').split(','))
+    options['least_significant_digit'] = dict(
+        (name.strip(), int(digits)) for (name, digits) in
+        (item.split(':') for item in
+         get_output_option('least_significant_digit').split(',')
+         if item.strip()))
+    options['pack_int16'] = tuple(
+        name.strip() for name in get_output_option('pack_int16').split(',')
+        if name.strip())
+
+    if options['format'] not in ('NETCDF3_64BIT', 'NETCDF4_CLASSIC', 'NETCDF4'):
+        raise ValueError("unknown output format: %s" % options['format'])
+    if options == WRF_Hydro_netcdf.DEFAULT_OUTPUT_OPTIONS:
+        return None
+    return options
+
+
+
+def output_version(output_options):
+    """Returns the suffix of the version of a stage (see
+    WRF_Hydro_manifest.stage_version) for the output options, an
+    empty string for the default options.
+    """
+    if output_options is None:
+        return ""
+    import WRF_Hydro_netcdf
+    return "+" + WRF_Hydro_netcdf.options_version(output_options)
+
+
+
+def ncl_command(ncl_exec, params, ncl_script=None):
+    """Returns the argv list (see WRF_Hydro_execution) of an NCL
+    command.
+
+    Args:
+        ncl_exec (string):  The NCL executable, with its options.
+        params (list):  The (name, value) tuples of the parameters
+                        of the script, passed as name="value".
+        ncl_script (string):  The NCL script, or None to leave it
+                              to the caller.
+    Returns:
+        argv (list):  The command and its arguments.
+
+    """
+    argv = shlex.split(ncl_exec) + ['%s="%s"' % param for param in params]
+    if ncl_script is not None:
+        argv.append(ncl_script)
+    return argv
+
+
+
+def repack_cmds(output_file, output_options):
+    """Returns the commands (see run_jobs) rewriting a file
+    created by an NCL script with the output options, none for
+    the default options.
+    """
+    if output_options is None:
+        return []
+    import WRF_Hydro_netcdf
+    return [(WRF_Hydro_netcdf.repack_file, (output_file, output_options))]
+
+
+
+def get_cube_dir(parser):
+    """Retrieves the directory of the per-cycle forcing cubes
+    (see WRF_Hydro_cube) from the [output] section of the
+    parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        cube_dir (string):  The directory of the cubes, or None if
+                            no cubes are written, the default.
+
+    """
+    if not parser.has_option('output', 'cube_dir'):
+        return None
+    return parser.get('output', 'cube_dir').strip() or None
+
+
+
+def add_cube_cmds(jobs, version, parser):
+    """Appends the output file of each job to its per-cycle cube
+    (see WRF_Hydro_cube), once all the other steps of the job are
+    done, if a cube_dir is defined in the [output] section of the
+    parm/config file.
+
+    Args:
+        jobs (list):  A list of tuples: (output file, list of
+                      commands).
+        version (string):  The version of the jobs' stage.
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        (jobs, version) (tuple):  The jobs and the version of the
+                                  stage, which changes when the
+                                  files are appended to cubes so
+                                  that the cubes are filled from
+                                  the start.
+
+    """
+    cube_dir = get_cube_dir(parser)
+    if cube_dir is None:
+        return (jobs, version)
+    import WRF_Hydro_cube
+    output_options = get_output_options(parser)
+    jobs = [(output_file, cmds + [(WRF_Hydro_cube.append_file,
+                                   (cube_dir, output_file, output_options))])
+            for (output_file, cmds) in jobs]
+    return (jobs, version + "+cube")
+
+
+
+def run_jobs(jobs, parser, on_result=None, num_workers=None, job_inputs=None,
+             retry=None, retry_jobs=None):
+    """Runs a list of per-file jobs, one after another or
+    concurrently in a pool of worker processes, depending on
+    the number of workers defined in the parm/config file.
+    Jobs that write to the same output file are run one after
+    the other, in the order they were given, by the same worker
+    so that they never clobber each other's output.
+
+    Args:
+        jobs (list):  A list of tuples: (output file, list of
+                      commands). The commands of a job are run
+                      in order, stopping at the first failure.
+                      A command is either an argv list, run
+                      without a shell (see WRF_Hydro_execution),
+                      a shell command string or a (function, args)
+                      tuple for work done in-process by a
+                      module-level Python function.  The commands
+                      are run with the limits of the [execution]
+                      section of the parm/config file (see
+                      configure_execution).  The output of an NCL
+                      batch job (see make_ncl_batches) is a
+                      tuple of output files.
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        on_result (function):  If given, called in this process
+                               with the result of each output file
+                               as soon as it is available, e.g. to
+                               record the files that were processed.
+        num_workers (int):  If given, overrides the number of
+                            workers defined in the parm/config file.
+        job_inputs (dict):  If given, the input files of each job,
+                            keyed by output file, which are read
+                            ahead of the jobs as set in the [io]
+                            section of the parm/config file (see
+                            get_prefetcher).
+        retry (WRF_Hydro_failures.RetryPolicy):  If given, the
+                  failed jobs are run again after the delays of the
+                  policy, while the other jobs keep running.
+        retry_jobs (dict):  The jobs run again when they fail, keyed
+                            by output file, e.g. the per-file jobs of
+                            the files of an NCL batch job.  The failed
+                            jobs that are not in it aren't run again.
+    Returns:
+        results (list):  A list of tuples: (output file, elapsed
+                         time in seconds, return value, metrics), in
+                         the same order as the jobs, with one tuple
+                         per output file of a batch job.  The metrics
+                         include the number of times each file was
+                         attempted, and the results are those of the
+                         last attempt.
+
+    """
+
+    # Group the jobs by their output file.
+    jobs_by_output = OrderedDict()
+    for index, job in enumerate(jobs):
+        jobs_by_output.setdefault(job[0], []).append((index, job))
+        if len(jobs_by_output[job[0]]) == 2:
+            logging.warning("WARNING: more than one job writes to %s, \
+                            these will be run one after the other", job[0])
+    job_groups = list(jobs_by_output.values())
+
+    if num_workers is None:
+        num_workers = get_num_workers(parser)
+    num_workers = min(num_workers, len(job_groups))
+    (initializer, initargs) = configure_execution(parser)
+
+    # The groups are started in order, so while the first ones run
+    # the inputs of the next ones are read ahead.
+    prefetcher = get_prefetcher(parser) if job_inputs else None
+    def group_inputs(job_group):
+        return [input_file for (index, job) in job_group
+                for output_file in (job[0] if isinstance(job[0], tuple)
+                                    else (job[0],))
+                for input_file in job_inputs.get(output_file, ())]
+    next_prefetch = [max(num_workers, 1)]
+    def prefetch(num_done):
+        if prefetcher is None:
+            return
+        end = min(num_done + max(num_workers, 1) + prefetcher.num_files,
+                  len(job_groups))
+        while next_prefetch[0] < end:
+            prefetcher.prefetch(group_inputs(job_groups[next_prefetch[0]]))
+            next_prefetch[0] += 1
+
+    # The result of a batch job is the list of the results of
+    # its output files.  A failed file is run again on its own,
+    # the index of its job group being (job index, file position).
+    results = [None] * len(jobs)
+    num_done = [0]
+    attempts = {}
+    # The failed jobs to run again: (time, output file, job group) heap.
+    retries = []
+    def collect(group_result):
+        num_done[0] += 1
+        prefetch(num_done[0])
+        for index, result in group_result:
+            if not isinstance(result, list):
+                result = [result]
+            if isinstance(index, tuple):
+                (index, position) = index
+                results[index][position] = result[0]
+            else:
+                results[index] = result
+                position = 0
+            for offset, file_result in enumerate(result):
+                output_file = file_result[0]
+                attempts[output_file] = attempts.get(output_file, 0) + 1
+                file_result[3]['attempts'] = attempts[output_file]
+                if prefetcher is not None:
+                    file_result[3]['prefetched_bytes'] = \
+                        prefetcher.prefetched_bytes(
+                            job_inputs.get(output_file, ()))
+                if file_result[2] != 0 and retry is not None and \
+                   output_file in (retry_jobs or {}) and \
+                   retry.should_retry(attempts[output_file]):
+                    delay = retry.delay(attempts[output_file])
+                    logging.warning("WARNING: %s failed, return value of %s, "
+                                    "retrying in %.0f s", output_file,
+                                    file_result[2], delay)
+                    heapq.heappush(retries, (
+                        time.time() + delay, output_file,
+                        [((index, position + offset),
+                          retry_jobs[output_file])]))
+                    continue
+                if on_result is not None:
+                    on_result(file_result)
+    def due_retries():
+        while retries and retries[0][0] <= time.time():
+            yield heapq.heappop(retries)[2]
+
+    try:
+        prefetch(0)
+        if num_workers > 1:
+            logging.info("Running %s jobs with %s workers", len(jobs),
+                         num_workers)
+            done = Queue.Queue()
+            pool = multiprocessing.Pool(num_workers, initializer, initargs)
+            try:
+                running = 0
+                for job_group in job_groups:
+                    pool.apply_async(run_job_group, (job_group,),
+                                     callback=done.put)
+                    running += 1
+                while running or retries:
+                    for job_group in due_retries():
+                        pool.apply_async(run_job_group, (job_group,),
+                                         callback=done.put)
+                        running += 1
+                    timeout = None
+                    if retries:
+                        timeout = max(retries[0][0] - time.time(), 0.)
+                    if running == 0:
+                        time.sleep(timeout)
+                        continue
+                    try:
+                        if timeout is not None:
+                            group_result = done.get(timeout=timeout)
+                        else:
+                            group_result = done.get()
+                    except Queue.Empty:
+                        continue
+                    running -= 1
+                    collect(group_result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job_group in job_groups:
+                collect(run_job_group(job_group))
+                for retry_group in due_retries():
+                    collect(run_job_group(retry_group))
+            while retries:
+                time.sleep(max(retries[0][0] - time.time(), 0.))
+                for retry_group in due_retries():
+                    collect(run_job_group(retry_group))
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    return [file_result for result in results for file_result in result]
+
+
+
+def open_manifest(parser):
+    """Opens the processed-file manifest (WRF_Hydro_manifest)
+    defined by manifest_file in the [manifest] section of the
+    parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        manifest (WRF_Hydro_manifest.Manifest):  The manifest, or
+                  None if no manifest_file is defined, in which
+                  case every file is processed.
+
+    """
+    if not parser.has_option('manifest', 'manifest_file'):
+        return None
+    manifest_file = parser.get('manifest', 'manifest_file').strip()
+    if not manifest_file:
+        return None
+    force = parser.has_option('manifest', 'force') and \
+            parser.getboolean('manifest', 'force')
+    return WRF_Hydro_manifest.Manifest(manifest_file, force)
+
+
+
+def run_incremental_jobs(jobs, job_inputs, stage, version, parser,
+                         num_workers=None, batch=None, label=None):
+    """Runs the jobs (see run_jobs) whose output file is missing
+    or out of date according to the processed-file manifest, and
+    records the output files that were successfully created.
+    All the jobs are run if there is no manifest.  The failed jobs
+    are run again, one file at a time, once the delays of the
+    [failures] section of the parm/config file have passed, while
+    the other jobs keep running, then quarantined in the manifest
+    and listed in the failure report (see WRF_Hydro_failures); the
+    quarantined jobs are not run.
+
+    Args:
+        jobs (list):  A list of tuples: (output file, list of
+                      commands).
+        job_inputs (dict):  The full paths of the input files
+                            (data, static files, scripts) of each
+                            job, keyed by output file.
+        stage (string):  The processing stage: regridding,
+                         downscaling, layering, etc.
+        version (string):  The version of the stage, see
+                           WRF_Hydro_manifest.stage_version.
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        num_workers (int):  If given, overrides the number of
+                            workers defined in the parm/config file.
+        batch (function):  If given, called with the list of the
+                           jobs to run and returning the jobs
+                           actually run, e.g. grouped into NCL
+                           batch jobs by make_ncl_batches.
+        label (tuple):  The (product, activity) of the jobs in the
+                        failure report.
+    Returns:
+        results (list):  A list of tuples: (output file, elapsed
+                         time in seconds, return value, metrics) for
+                         the jobs that were run, the metrics including
+                         the number of times each job was run.
+
+    """
+    import WRF_Hydro_failures
+    import WRF_Hydro_scheduler
+
+    if batch is None:
+        batch = list
+    if label is None:
+        label = ("", stage)
+    retry = get_retry_policy(parser)
+    quarantine_hours = get_quarantine_hours(parser)
+    manifest = open_manifest(parser)
+    try:
+        pending_jobs = []
+        failures = []
+        for job in jobs:
+            if manifest is None:
+                pending_jobs.append(job)
+                continue
+            if manifest.is_current(stage, job[0], job_inputs[job[0]], version):
+                logging.debug("%s is up to date", job[0])
+                continue
+            error = None
+            if quarantine_hours > 0:
+                error = manifest.is_quarantined(stage, job[0],
+                                                job_inputs[job[0]], version,
+                                                quarantine_hours * 3600.)
+            if error is None:
+                pending_jobs.append(job)
+                continue
+            logging.error("ERROR: %s is not created, it is quarantined (%s)",
+                          job[0], error)
+            metrics = WRF_Hydro_metrics.empty_metrics()
+            metrics.update({'attempts': 0, 'error': "quarantined: %s" % error})
+            failures.append(WRF_Hydro_failures.failure_entry(
+                label, stage,
+                (job[0], 0., WRF_Hydro_scheduler.QUARANTINED, metrics),
+                job_inputs[job[0]], True))
+        if manifest is not None:
+            logging.info("%s: %s of %s files are up to date", stage,
+                         len(jobs) - len(pending_jobs) - len(failures),
+                         len(jobs))
+
+        def record(result):
+            (output_file, elapsed, return_value, metrics) = result
+            if return_value == 0 and manifest is not None:
+                manifest.record(stage, output_file, job_inputs[output_file],
+                                version)
+
+        results = OrderedDict(
+            (result[0], result) for result in
+            run_jobs(batch(pending_jobs), parser, on_result=record,
+                     num_workers=num_workers, job_inputs=job_inputs,
+                     retry=retry,
+                     retry_jobs=dict((job[0], job) for job in pending_jobs)))
+
+        for result in results.values():
+            (output_file, elapsed, return_value, metrics) = result
+            if return_value == 0:
+                continue
+            quarantined = manifest is not None and quarantine_hours > 0
+            if quarantined:
+                manifest.quarantine(stage, output_file, job_inputs[output_file],
+                                    version, metrics.get('error', ""))
+            failures.append(WRF_Hydro_failures.failure_entry(
+                label, stage, result, job_inputs[output_file], quarantined))
+        WRF_Hydro_failures.write_failure_report(failures,
+                                                num_jobs=len(pending_jobs))
+        return list(results.values())
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+
+
+def run_job_group(job_group):
+    """Runs the jobs that share an output file, one after the
+    other. This is invoked by the worker processes, so it must
+    remain a module-level function.
+
+    Args:
+        job_group (list):  A list of (index, job) tuples.
+    Returns:
+        group_results (list):  A list of (index, result) tuples,
+                               where result is the tuple returned
+                               by run_job.
+
+    """
+    group_results = []
+    for index, job in job_group:
+        start = time.time()
+        try:
+            group_results.append((index, run_job(job)))
+        except Exception:
+            logging.exception("ERROR: the job of %s failed", job[0])
+            elapsed = time.time() - start
+            group_results.append((index, [
+                (output_file, elapsed, 1,
+                 WRF_Hydro_metrics.empty_metrics(elapsed))
+                for output_file in (job[0] if isinstance(job[0], tuple)
+                                    else (job[0],))]))
+    return group_results
+
+
+
+def run_job(job):
+    """Runs the commands of a single job and measures the
+    wall clock time it takes, as well as the resource usage of
+    its commands (see WRF_Hydro_metrics).
+
+    Args:
+        job (tuple):  A tuple: (output file, list of commands).
+    Returns:
+        result (tuple):  A tuple: (output file, elapsed time in
+                         seconds, return value, metrics). The
+                         return value is that of the first command
+                         that failed, or 0 if all commands were
+                         successful.  A command which prints
+                         WRF_HYDRO_FILE_FAILED (see run_ncl_batch)
+                         failed, whatever its exit status.  The
+                         metrics are a dict of the
+                         WRF_Hydro_metrics.METRIC_FIELDS, with the
+                         error of the failed command, if any.  For an
+                         NCL batch job, a list of these tuples, one
+                         per output file.  The files written behind
+                         by the job are complete when it returns.
+
+    """
+    import WRF_Hydro_failures
+
+    (output_file, cmds) = job
+    return_value = 0
+    error = None
+    start = time.time()
+    if isinstance(output_file, tuple):
+        (function, args) = cmds[0]
+        try:
+            return function(*args)
+        except Exception as exc:
+            logging.exception("ERROR: %s failed for %s", 
+                              function.__name__, ", ".join(output_file))
+            elapsed = time.time() - start
+            results = [(f, elapsed, 1, WRF_Hydro_metrics.empty_metrics(elapsed))
+                       for f in output_file]
+            for result in results:
+                result[3]['error'] = "%s: %s" % (function.__name__, exc)
+            return results
+
+    usage = WRF_Hydro_metrics.JobUsage()
+    for cmd in cmds:
+        if isinstance(cmd, tuple):
+            (function, args) = cmd
+            try:
+                usage.call(function, args)
+            except Exception as exc:
+                logging.exception("ERROR: %s failed for %s", 
+                                  function.__name__, output_file)
+                return_value = 1
+                error = "%s: %s" % (function.__name__, exc)
+            # The files the function wrote behind (see WRF_Hydro_io)
+            # are complete before the next command and the result.
+            try:
+                usage.write_wait += WRF_Hydro_io.flush()
+            except IOError as exc:
+                if return_value == 0:
+                    return_value = 1
+                    error = str(exc)
+        else:
+            argv = cmd if isinstance(cmd, list) else ['/bin/sh', '-c', cmd]
+            # The NCL scripts report a file they can't create (e.g. a
+            # required field is missing) and go on, exiting with 0.
+            reported_failures = []
+            def on_line(line):
+                match = re.search(r'WRF_HYDRO_FILE_FAILED (\S+)', line)
+                if match:
+                    reported_failures.append(match.group(1))
+            (return_value, rusage, timed_out) = \
+                WRF_Hydro_execution.execute(argv, output_file, on_line)
+            usage.add(rusage)
+            if timed_out:
+                error = "%s timed out after %.0f s" % \
+                        (argv[0], WRF_Hydro_execution.get_limits().timeout)
+            elif return_value != 0:
+                error = WRF_Hydro_failures.command_error(cmd, return_value)
+            elif reported_failures:
+                return_value = 1
+                error = "%s reported %s as failed" % \
+                        (argv[0], reported_failures[0])
+        if return_value != 0:
+            break
+    elapsed = time.time() - start
+    metrics = usage.metrics(elapsed, output_file)
+    if error is not None:
+        metrics['error'] = error
+    return (output_file, elapsed, return_value, metrics)
+
+
+
+def make_ncl_batches(jobs, batch_size, num_workers, ncl_cmd, ncl_exe,
+                     list_params, list_entries):
+    """Groups per-file NCL jobs into batch jobs, each running a
+    single NCL process for several files so that the interpreter
+    startup, the library loads and the reading of the weight and
+    static files are paid once per batch instead of once per file.
+    The files of a batch are passed to the NCL script as text
+    files listing one entry per line (e.g. srcFileList and
+    outFileList for the regridding scripts).
+
+    Args:
+        jobs (list):  The per-file jobs: tuples (output file, list
+                      of commands), the first command being the
+                      per-file NCL command.  The remaining commands
+                      (e.g. the shortwave downscaling) are run for
+                      each file once the batch has created it.
+        batch_size (int):  The maximum number of files per batch,
+                           see get_ncl_batch_size.
+        num_workers (int):  The number of worker processes; the
+                            batches are made smaller if needed so
+                            that every worker has one.
+        ncl_cmd (list):  The NCL executable followed by the
+                         parameters common to all the files, an argv
+                         list (see ncl_command).
+        ncl_exe (string):  The NCL script.
+        list_params (list):  The names of the list parameters of
+                             the NCL script.
+        list_entries (dict):  The entries (one per list parameter)
+                              of each file, keyed by output file.
+    Returns:
+        batch_jobs (list):  The batch jobs: tuples (tuple of output
+                            files, [(run_ncl_batch, args)]).  A batch
+                            of a single file is left as a per-file
+                            job.
+
+    """
+    if not jobs:
+        return []
+    batch_size = min(batch_size, -(-len(jobs) // max(num_workers, 1)))
+    batch_jobs = []
+    for start in range(0, len(jobs), batch_size):
+        chunk = jobs[start:start + batch_size]
+        if len(chunk) == 1:
+            batch_jobs.append(chunk[0])
+            continue
+        output_files = tuple(job[0] for job in chunk)
+        lists = [[list_entries[output_file][i] for output_file in output_files]
+                 for i in range(len(list_params))]
+        remaining_cmds = dict((job[0], job[1][1:]) for job in chunk)
+        batch_jobs.append((output_files,
+                           [(run_ncl_batch,
+                             (ncl_cmd, ncl_exe, list_params, lists,
+                              output_files, remaining_cmds))]))
+    return batch_jobs
+
+
+
+def run_ncl_batch(ncl_cmd, ncl_exe, list_params, lists, output_files,
+                  remaining_cmds):
+    """Runs an NCL batch job (see make_ncl_batches).  The NCL
+    scripts print WRF_HYDRO_FILE_DONE <output file> once each
+    output file is written (or WRF_HYDRO_FILE_FAILED), which is
+    used to measure the time taken by each file: from the start of
+    the process, or the previous file, to the file's report.  This
+    is invoked by the worker processes, so it must remain a
+    module-level function.
+
+    Args:
+        ncl_cmd (list):  The NCL executable followed by the
+                         parameters common to all the files, an
+                         argv list (see ncl_command).
+        ncl_exe (string):  The NCL script.
+        list_params (list):  The names of the list parameters.
+        lists (list):  The entries of each list parameter, in the
+                       order of the output files.
+        output_files (tuple):  The output files of the batch.
+        remaining_cmds (dict):  The commands run for each output
+                                file after the NCL batch, keyed by
+                                output file.
+    Returns:
+        results (list):  A list of tuples: (output file, elapsed
+                         time in seconds, return value, metrics), in
+                         the order of the output files.  A file that
+                         wasn't reported by the NCL script has the
+                         return value of the NCL process, or 1.  The
+                         resource usage of the NCL process is shared
+                         by the files in proportion to their elapsed
+                         times.  The output of the NCL process goes
+                         to the log file of the first output file,
+                         if the jobs have log files.
+
+    """
+    start = time.time()
+    list_files = []
+    results = {}
+    try:
+        list_params_values = []
+        for (list_param, entries) in zip(list_params, lists):
+            (fd, list_file) = tempfile.mkstemp(prefix="ncl_batch_",
+                                               suffix=".txt")
+            list_files.append(list_file)
+            with os.fdopen(fd, 'w') as f:
+                f.write("\n".join(entries) + "\n")
+            list_params_values.append((list_param, list_file))
+        cmd = ncl_cmd + ncl_command("", list_params_values, ncl_exe)
+        logging.debug("NCL batch command: %s", " ".join(cmd))
+
+        # Forward the NCL output, to the terminal or the log file,
+        # while looking for the file reports.
+        last = [start]
+        def on_line(line):
+            match = re.search(r'WRF_HYDRO_FILE_(DONE|FAILED) (\S+)', line)
+            if match and match.group(2) in remaining_cmds:
+                now = time.time()
+                return_value = 0 if match.group(1) == 'DONE' else 1
+                results[match.group(2)] = [now - last[0], return_value]
+                last[0] = now
+        (status, rusage, timed_out) = \
+            WRF_Hydro_execution.execute(cmd, output_files[0], on_line)
+        ncl_return_value = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+                           else os.WEXITSTATUS(status)
+        last = last[0]
+    finally:
+        for list_file in list_files:
+            os.remove(list_file)
+
+    # The files the script didn't get to are failures.
+    failed_elapsed = time.time() - last
+    errors = {}
+    for output_file in output_files:
+        if output_file not in results:
+            results[output_file] = [failed_elapsed, ncl_return_value or 1]
+            failed_elapsed = 0.
+            if timed_out:
+                errors[output_file] = "NCL batch timed out after %.0f s" % \
+                    WRF_Hydro_execution.get_limits().timeout
+
+    # Share the usage of the NCL process between the files.
+    usage = WRF_Hydro_metrics.JobUsage()
+    usage.add(rusage)
+    total_elapsed = sum(results[f][0] for f in output_files) or 1.
+    for output_file in output_files:
+        share = results[output_file][0] / total_elapsed
+        metrics = usage.metrics(results[output_file][0], output_file)
+        for field in ('cpu_time', 'read_bytes', 'write_bytes'):
+            metrics[field] *= share
+        if output_file in errors:
+            metrics['error'] = errors[output_file]
+        results[output_file].append(metrics)
+
+    # Run the remaining commands of the files that were created.
+    for output_file in output_files:
+        if results[output_file][1] == 0 and remaining_cmds[output_file]:
+            (output_file, elapsed, return_value, metrics) = \
+                run_job((output_file, remaining_cmds[output_file]))
+            file_metrics = results[output_file][2]
+            for field in ('wall_time', 'cpu_time', 'read_bytes', 'write_bytes',
+                          'write_wait'):
+                file_metrics[field] += metrics[field]
+            file_metrics['max_rss'] = max(file_metrics['max_rss'],
+                                          metrics['max_rss'])
+            file_metrics['output_bytes'] = metrics['output_bytes']
+            if 'error' in metrics:
+                file_metrics['error'] = metrics['error']
+            results[output_file][0] += elapsed
+            results[output_file][1] = return_value
+
+    return [(output_file,) + tuple(results[output_file])
+            for output_file in output_files]
 
 
 
 def create_benchmark_summary(product, activity, elapsed_times):
     
-    """ Create a summary of the min, max, and mean
-        time to perform a processing activity for 
-        each data file. The information is placed 
-        in the log file.
+    """ Create a summary of the min, max, mean, median,
+        90th and 99th percentile time to perform a
+        processing activity for each data file. The
+        information is placed in the log file.
 
         Args:
            product (string):  The name of the product under
@@ -522,12 +1802,15 @@ def create_benchmark_summary(product, activity, elapsed_times):
         max_time = np.max(elapsed_array)
         avg_time = np.mean(elapsed_array)
         med_time = np.median(elapsed_array) 
+        (p90_time, p99_time) = np.percentile(elapsed_array, [90, 99])
 
         logging.info("=========================================")
         logging.info("SUMMARY for %s %s ", activity,product) 
         logging.info("=========================================")
         logging.info("Average elapsed time (sec): %s", avg_time)
         logging.info("Median elapsed time (sec): %s", med_time)
+        logging.info("90th percentile elapsed time (sec): %s", p90_time)
+        logging.info("99th percentile elapsed time (sec): %s", p99_time)
         logging.info("Min elapsed time (sec): %s ", min_time)
         logging.info("Max elapsedtime (sec): %s ", max_time)
     else:
@@ -546,13 +1829,19 @@ def bias_correction(parser):
 
 
 
-def layer_data(parser, primary_data, secondary_data):
+def layer_data(parser, primary_data, secondary_data, data_files=None):
     """ Invokes the NCL script, combine.ncl
         to layer/combine two files:  a primary and secondary
         file (with identical date/time, model run time, and
         forecast time) are found by iterating through a list
         of primary files and determining if the corresponding
-        secondary file exists.
+        secondary file exists.  Each pair is layered in its own
+        temporary directory, so that the index.nc files of
+        concurrent runs of combine.ncl don't clobber each other.
+        If the layering_engine in the [layering] section of the
+        parm/config file is set to Python, the pairs are instead
+        layered in-process by the WRF_Hydro_layering module, with
+        the coverage of the primary product computed only once.
 
 
         Args:
@@ -563,13 +1852,73 @@ def layer_data(parser, primary_data, secondary_data):
  
               secondary_data (string): The name of the secondary product
 
-        Output:
-              None:  For each primary and secondary file that is
-                     combined/layered, create a file
-                     (name and location defined in the config/parm 
-                     file).
+              data_files (list): The full paths of downscaled files
+                                 (primary or secondary); if given,
+                                 only the pairs which include one
+                                 of these files are layered.
+
+        Returns:
+              elapsed_array (List):  A list of the elapsed time for
+                                     layering each pair of files.
+                                     For each primary and secondary
+                                     file that is combined/layered,
+                                     a file is created (name and
+                                     location defined in the
+                                     config/parm file).  Only the
+                                     new or changed pairs are layered.
     """
 
+    (jobs, job_inputs, version) = layer_jobs(parser, primary_data,
+                                             secondary_data, data_files)
+    elapsed_array = []
+    results = run_incremental_jobs(jobs, job_inputs, 'layering', version,
+                                   parser, label=(primary_data.upper() + "_" +
+                                                  secondary_data.upper(),
+                                                  "Layering"))
+    for (output_file, elapsed, return_value, metrics) in results:
+        elapsed_array.append(elapsed)
+        if return_value != 0:
+            logging.error("ERROR: The layering of %s was unsuccessful, \
+                          return value of %s", output_file, return_value)
+
+    return elapsed_array
+
+
+
+def layer_jobs(parser, primary_data, secondary_data, data_files=None,
+               expected_files=None):
+    """Creates the jobs (see run_jobs) layering the pairs of
+    downscaled primary and secondary files (see layer_data), or, if
+    layering_stacks is set in the [layering] section of the
+    parm/config file, the files of each stack of products (see
+    layer_stack_jobs).
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        primary_data (string):  The name of the primary product
+        secondary_data (string): The name of the secondary product
+        data_files (list): If given, only the pairs which include
+                           one of these files are layered.
+        expected_files (list): The full paths of downscaled files
+                               which don't exist yet but will be
+                               created before the layering (e.g. by
+                               earlier tasks of a task graph); they
+                               are paired as if they existed.
+    Returns:
+        (jobs, job_inputs, version) (tuple):  The jobs, the input
+                            files of each job keyed by output file
+                            and the version of the layering stage.
+
+    """
+
+    # With layering_stacks, each variable is layered from its own
+    # stack of products instead.
+    layering_stacks = get_layering_stacks(parser, primary_data, secondary_data)
+    if layering_stacks is not None:
+        return layer_stack_jobs(parser, primary_data, secondary_data,
+                                layering_stacks[0], layering_stacks[1],
+                                data_files, expected_files)
+
     # Retrieve any necessary parameters from the wrf_hydro_forcing config/parm
     # file...
     # 1) directory where HRRR and RAP downscaled data reside
@@ -580,63 +1929,348 @@ def layer_data(parser, primary_data, secondary_data):
     downscaled_primary_dir = parser.get('layering','analysis_assimilation_primary')
     downscaled_secondary_dir = parser.get('layering','analysis_assimilation_secondary')
     layered_output_dir = parser.get('layering','output_dir')
-
-
-    # Loop through any available files in
-    # the directory that defines the first choice/priority data.
-    # Assemble the name of the corresponding secondary filename
-    # by deriving the date (YYYYMMDD), modelrun (ihh), and 
-    # forecast time (_fhhh) from the primary filename and path.
-    # Then check if this file exists, if so, then pass this pair into
-    # a list of tuples comprised of (primary file, secondary file).
-    # After a list of paired files has been completed, these files
-    # will be layered/combined by invoking the NCL script, combine.ncl.
-    primary_files = get_filepaths(downscaled_primary_dir)
+    layering_engine = get_engine(parser, 'layering', 'layering_engine')
+    output_options = get_output_options(parser)
+    if layering_engine == 'PYTHON':
+        import WRF_Hydro_layering
+        (mask_cache_dir, verify_coverage) = get_coverage_options(parser)
+        tile_rows = get_tile_rows(parser, output_options)
+        # The files which define the primary product's coverage of
+        # the destination grid.
+        static_files = layering_static_files(parser, primary_data.upper())
+
+
+    # The files of the directories of the first choice/priority data
+    # and of the secondary data are indexed by the input catalog by
+    # date (YYYYMMDD), modelrun (ihh), and forecast time (_fhhh), the
+    # files expected (e.g. created by earlier tasks of a task graph)
+    # being added to them.  Each primary file is paired with the
+    # secondary file of the same date, modelrun and forecast time,
+    # if there is one, and each pair will be layered/combined by
+    # invoking the NCL script, combine.ncl.
+    primary_index = catalog_index(parser, downscaled_primary_dir,
+                                  WRF_Hydro_catalog.HYDRO_PATTERN)
+    secondary_index = catalog_index(parser, downscaled_secondary_dir,
+                                    WRF_Hydro_catalog.HYDRO_PATTERN)
+    if expected_files is not None:
+        primary_index.add(expected_files)
+        secondary_index.add(expected_files)
     
     # Determine which primary and secondary files we can layer, based on
     # matching dates, model runs, and forecast times.
-    list_paired_files = find_layering_files(primary_files, downscaled_secondary_dir)
+    list_paired_files = find_layering_files(primary_index, secondary_index)
+    if data_files is not None:
+        data_files = set(data_files)
+        list_paired_files = [pair for pair in list_paired_files
+                             if pair[0] in data_files or pair[1] in data_files]
     
     # Now we have all the paired files to layer, create the key-value pair of
     # input needed to run the NCL layering script.
-    num_matched_pairs = len(list_paired_files)
+    mkdir_p(layered_output_dir)
+    jobs = []
+    job_inputs = {}
     for pair in list_paired_files:
-        hrrrFile_param = "'hrrrFile=" + '"' + pair[0] + '"' + "' "
-        rapFile_param =  "'rapFile="  + '"' + pair[1] + '"' + "' "
+        hrrrFile_param = ('hrrrFile', os.path.abspath(pair[0]))
+        rapFile_param = ('rapFile', os.path.abspath(pair[1]))
         full_layered_outfile = layered_output_dir + "/" + pair[2]
-        outFile_param = "'outFile=" + '"' + full_layered_outfile + '"' + "' "
-        mkdir_p(full_layered_outfile)
+        outFile_param = ('outFile', os.path.abspath(full_layered_outfile))
         init_indexFlag = "false"
         indexFlag = "true"
-        init_indexFlag_param = "'indexFlag=" + '"' +  init_indexFlag + '"' + "' "
-        indexFlag_param = "'indexFlag=" + '"' + indexFlag + '"' + "' "
-        init_layering_params = hrrrFile_param + rapFile_param + init_indexFlag_param\
-                               + outFile_param 
-        layering_params = hrrrFile_param + rapFile_param + indexFlag_param\
-                          + outFile_param
-        init_layering_cmd = ncl_exe + " " + init_layering_params + " " + \
-                            layering_exe
-        layering_cmd = ncl_exe + " " + layering_params + " " + \
-                            layering_exe
-         
-        init_return_value = os.system(init_layering_cmd)
-        return_value = os.system(layering_cmd) 
+        init_indexFlag_param = ('indexFlag', init_indexFlag)
+        indexFlag_param = ('indexFlag', indexFlag)
+        init_layering_params = [hrrrFile_param, rapFile_param,
+                                init_indexFlag_param, outFile_param]
+        layering_params = [hrrrFile_param, rapFile_param, indexFlag_param,
+                           outFile_param]
+        init_layering_cmd = ncl_command(ncl_exe, init_layering_params,
+                                        os.path.abspath(layering_exe))
+        layering_cmd = ncl_command(ncl_exe, layering_params,
+                                   os.path.abspath(layering_exe))
+
+        if layering_engine == 'PYTHON':
+            jobs.append((full_layered_outfile,
+                         [(WRF_Hydro_layering.layer_files,
+                           (pair[0], pair[1], full_layered_outfile,
+                            static_files, mask_cache_dir, verify_coverage,
+                            output_options, tile_rows))]))
+            job_inputs[full_layered_outfile] = [pair[0], pair[1]]
+        else:
+            # combine.ncl passes the index of the cells to fill from
+            # one run to the next through the index.nc file in the
+            # current directory, so run both in a temporary directory
+            # of their own.
+            layering_cmd = (WRF_Hydro_execution.run_in_scratch_dir,
+                            ([init_layering_cmd, layering_cmd],
+                             full_layered_outfile))
+            jobs.append((full_layered_outfile,
+                         [layering_cmd] +
+                         repack_cmds(full_layered_outfile, output_options)))
+            job_inputs[full_layered_outfile] = [pair[0], pair[1], layering_exe]
+
+    version = WRF_Hydro_manifest.stage_version('layering', layering_engine)
+    version += output_version(output_options)
+    return (jobs, job_inputs, version)
     
     
-def find_layering_files(primary_files,downscaled_secondary_dir):
-    """Given a list of the primary files (full path + filename),
+def get_coverage_options(parser):
+    """Retrieves the coverage cache directory and verify_coverage
+    option of the Python layering engine from the [layering]
+    section of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+    Returns:
+        (mask_cache_dir, verify_coverage) (tuple):  The directory of
+                             the coverage sidecars, or None to keep
+                             the coverage in memory only, and True to
+                             check the coverage against every file.
+
+    """
+    mask_cache_dir = None
+    if parser.has_option('layering', 'mask_cache_dir'):
+        mask_cache_dir = parser.get('layering', 'mask_cache_dir').strip() \
+                         or None
+    verify_coverage = parser.has_option('layering', 'verify_coverage') and \
+                      parser.getboolean('layering', 'verify_coverage')
+    return (mask_cache_dir, verify_coverage)
+
+
+
+def layering_static_files(parser, product):
+    """Returns the static files which define a product's coverage of
+    the destination grid (weight, height and geo files), those
+    defined in the parm/config file.
+    """
+    return [parser.get(section, product + option)
+            for (section, option) in
+            (('regridding', '_wgt_bilinear'),
+             ('downscaling', '_hgt_data'),
+             ('downscaling', '_geo_data'))
+            if parser.has_option(section, product + option)]
+
+
+
+def get_layering_stacks(parser, primary_data, secondary_data):
+    """Retrieves the product stacks of the N-way layering from
+    layering_stacks in the [layering] section of the parm/config
+    file: one VARIABLE: PRODUCT > PRODUCT > ... line per variable,
+    by decreasing priority, e.g. RAINRATE: MRMS > HRRR > RAP.  The
+    variables not listed are layered from the stack of *, by default
+    the primary product then the secondary product, except LWDOWN,
+    taken from the last product of that stack only, as combine.ncl
+    does.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        primary_data (string):  The name of the primary product
+        secondary_data (string): The name of the secondary product
+    Returns:
+        (stacks, default_stack) (tuple):  The products of each
+                            variable of the layered files, keyed by
+                            variable name, and the stack of *, whose
+                            products are required for a forecast hour
+                            to be layered.  None if layering_stacks
+                            isn't defined or is empty, for the
+                            two-way layering of the primary and
+                            secondary products.
+    Raises:
+        ValueError:  If a line isn't a variable and its products, the
+                     variable isn't one of the layered variables, a
+                     stack has none of the products of the * stack or
+                     the layering_engine isn't Python.
+
+    """
+    if not parser.has_option('layering', 'layering_stacks'):
+        return None
+    text = parser.get('layering', 'layering_stacks').strip()
+    if not text:
+        return None
+    if get_engine(parser, 'layering', 'layering_engine') != 'PYTHON':
+        raise ValueError("layering_stacks requires the Python layering_engine")
+    import WRF_Hydro_layering
+
+    listed = OrderedDict()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        (name, separator, products) = line.partition(':')
+        name = name.strip().upper()
+        stack = [product.strip().upper() for product in products.split('>')]
+        if not separator or not all(stack) or len(set(stack)) != len(stack):
+            raise ValueError("layering_stacks: %s is not VARIABLE: PRODUCT > "
+                             "PRODUCT > ..." % line)
+        if name != '*' and name not in WRF_Hydro_layering.LAYERED_VARIABLES:
+            raise ValueError("layering_stacks: unknown variable %s, expected "
+                             "one of %s or *" %
+                             (name, ", ".join(WRF_Hydro_layering.LAYERED_VARIABLES)))
+        listed[name] = stack
+
+    default_stack = listed.pop('*', [primary_data.upper(),
+                                     secondary_data.upper()])
+    stacks = OrderedDict()
+    for name in WRF_Hydro_layering.LAYERED_VARIABLES:
+        if name in listed:
+            stacks[name] = listed[name]
+        elif name in WRF_Hydro_layering.SECONDARY_ONLY_VARIABLES:
+            stacks[name] = default_stack[-1:]
+        else:
+            stacks[name] = list(default_stack)
+        if not set(stacks[name]) & set(default_stack):
+            raise ValueError("layering_stacks: the stack of %s must include "
+                             "one of %s" % (name, " > ".join(default_stack)))
+    return (stacks, default_stack)
+
+
+
+def layering_dir(parser, product, primary_data, secondary_data):
+    """Returns the directory of the files of a product to layer: the
+    analysis_assimilation_primary or _secondary directory of the
+    [layering] section of the parm/config file for the primary and
+    secondary products, else the product's downscale_output_dir of
+    the [downscaling] section or, for the products which aren't
+    downscaled (e.g. MRMS), its output_dir of the [regridding]
+    section.
+    """
+    if product == primary_data.upper():
+        return parser.get('layering', 'analysis_assimilation_primary')
+    if product == secondary_data.upper():
+        return parser.get('layering', 'analysis_assimilation_secondary')
+    if parser.has_option('downscaling', product + '_downscale_output_dir'):
+        return parser.get('downscaling', product + '_downscale_output_dir')
+    return parser.get('regridding', product + '_output_dir')
+
+
+
+def layer_stack_jobs(parser, primary_data, secondary_data, stacks,
+                     default_stack, data_files=None, expected_files=None):
+    """Creates the jobs of the N-way layering, each variable being
+    layered from its own stack of products (see get_layering_stacks
+    and WRF_Hydro_layering.layer_stack_files).  There is one job per
+    forecast hour of the first product of the * stack for which the
+    files of all the products of that stack exist; the files of the
+    other products are matched by date, model run and forecast hour,
+    or by valid time for the observation products (MRMS), and
+    layered if they exist when the job is run.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        primary_data (string):  The name of the primary product
+        secondary_data (string): The name of the secondary product
+        stacks (OrderedDict): The products of each variable.
+        default_stack (list): The products of the * stack.
+        data_files (list): If given, only the forecast hours which
+                           include one of these files are layered.
+        expected_files (list): The full paths of files which don't
+                               exist yet but will be created before
+                               the layering (see layer_jobs).
+    Returns:
+        (jobs, job_inputs, version) (tuple):  The jobs, the input
+                            files of each job keyed by output file
+                            and the version of the layering stage.
+
+    """
+    import WRF_Hydro_layering
+
+    layered_output_dir = parser.get('layering', 'output_dir')
+    output_options = get_output_options(parser)
+    (mask_cache_dir, verify_coverage) = get_coverage_options(parser)
+    tile_rows = get_tile_rows(parser, output_options)
+
+    products = []
+    for stack in [default_stack] + list(stacks.values()):
+        products += [product for product in stack if product not in products]
+    optional_products = [product for product in products
+                         if product not in default_stack]
+    static_files = dict((product, layering_static_files(parser, product))
+                        for product in products)
+
+    # The files of each product, indexed by the input catalog, with
+    # the files expected.
+    indexes = OrderedDict()
+    for product in products:
+        indexes[product] = catalog_index(parser,
+                                         layering_dir(parser, product,
+                                                      primary_data,
+                                                      secondary_data),
+                                         WRF_Hydro_catalog.HYDRO_PATTERN)
+        if expected_files is not None:
+            indexes[product].add(expected_files)
+    if data_files is not None:
+        data_files = set(data_files)
+
+    mkdir_p(layered_output_dir)
+    jobs = []
+    job_inputs = {}
+    base_product = default_stack[0]
+    for (base_file, fields) in indexes[base_product].entries:
+        if fields is None:
+            logging.error('ERROR: filename structure of %s is not what was '
+                          'expected', base_file)
+            continue
+        product_files = OrderedDict()
+        for product in products:
+            if product == base_product:
+                product_files[product] = base_file
+                continue
+            product_fields = fields
+            if product in WRF_Hydro_catalog.OBSERVATION_PRODUCTS:
+                product_fields = WRF_Hydro_catalog.valid_fields(fields)
+            product_file = indexes[product].lookup(*product_fields)
+            if product_file is None and product in optional_products:
+                # Layered if it exists by the time the job is run.
+                (subdir_file_path, hydro_filename) = \
+                    create_output_name_and_subdir(product, None, None,
+                                                  product_fields)
+                product_file = indexes[product].top + "/" + \
+                               subdir_file_path + "/" + hydro_filename
+            if product_file is None:
+                logging.info("No matching %s file for %s", product, base_file)
+                break
+            product_files[product] = product_file
+        if len(product_files) < len(products):
+            continue
+        if data_files is not None and \
+           not data_files.intersection(product_files.values()):
+            continue
+
+        (date, modelrun_str, fcst_hr_str) = fields
+        full_layered_outfile = layered_output_dir + "/" + date + "_" + \
+                               modelrun_str + "_f" + fcst_hr_str + \
+                               "_Analysis-Assimilation.nc"
+        logging.debug("layering %s to %s", " + ".join(product_files.values()),
+                      full_layered_outfile)
+        jobs.append((full_layered_outfile,
+                     [(WRF_Hydro_layering.layer_stack_files,
+                       (product_files, full_layered_outfile, stacks,
+                        optional_products, static_files, mask_cache_dir,
+                        verify_coverage, output_options, tile_rows))]))
+        job_inputs[full_layered_outfile] = list(product_files.values())
+
+    version = WRF_Hydro_manifest.stage_version('layering', 'PYTHON')
+    version += "+stacks(%s)" % ";".join("%s:%s" % (name, ">".join(stack))
+                                        for name, stack in stacks.items())
+    version += output_version(output_options)
+    return (jobs, job_inputs, version)
+
+
+
+def find_layering_files(primary_index, secondary_index):
+    """Given the primary files, indexed by the input catalog,
     retrieve the corresponding secondary file if it exists.  
     Create and return a list of tuples: (primary file, secondary file, 
     layered file). 
 
     Args:
-        primary_files(list):  A list of the primary files
-                              which we are trying to find
+        primary_index(WRF_Hydro_catalog.TreeIndex): The primary
+                              files which we are trying to find
                               a corresponding "match" in
                               the secondary file directory
-        downscaled_secondary_dir(string): The name of the
-                                          directory for the
-                                          secondary data.
+        secondary_index(WRF_Hydro_catalog.TreeIndex): The files
+                              of the directory for the secondary
+                              data, including those which will be
+                              created later.
     Output:
         list_paired_files (list): A list of tuples, where 
                                   the tuple consists of 
@@ -645,88 +2279,693 @@ def find_layering_files(primary_files,downscaled_secondary_dir):
         
  
     """
-    secondary_product = "RAP"
     list_paired_files = []
-    paired_files = ()
-
-    for primary_file in primary_files:
-        match = re.match(r'.*/downscaled/([A-Za-z]{3,4})/([0-9]{8})/i([0-9]{2})/[0-9]{8}_i[0-9]{2}_f([0-9]{3})_[A-Za-z]{3,4}.nc',primary_file)
-        if match:
-            product = match.group(1)
-            date = match.group(2)
-            modelrun_str = match.group(3)
-            fcst_hr_str = match.group(4)
-            # Assemble the corresponding secondary file based on the date, modelrun, 
-            # and forecast hour. 
-            secondary_file = downscaled_secondary_dir +  \
-                             "/" + date + "/i" + modelrun_str + "/" + date +\
-                             "_i"+ modelrun_str + "_f" + fcst_hr_str + "_" +\
-                             secondary_product + ".nc"  
-            layered_filename = date + "_i" + modelrun_str + "_f" + \
-                               fcst_hr_str + "_Analysis-Assimilation.nc"
-               
-        
-            # Determine if this "manufactured" secondary file exists, if so, then 
-            # create a tuple to represent this pair: (primary file, 
-            # secondary file, layered file) then add this tuple of 
-            # files to the list and continue. If not, then continue 
-            # with the next primary file in the primary_files list.
-            if os.path.isfile(secondary_file):
-                paired_files = (primary_file, secondary_file,layered_filename)
-                list_paired_files.append(paired_files)
-                num = len(list_paired_files)
-            else:
-                logging.info("No matching date, or model run or forecast time for\
-                             #secondary file")
+
+    for (primary_file, fields) in primary_index.entries:
+        if fields is None:
+            logging.error('ERROR: filename structure of %s is not what was '
+                          'expected', primary_file)
+            continue
+        (date, modelrun_str, fcst_hr_str) = fields
+        # Look up the corresponding secondary file based on the date,
+        # modelrun, and forecast hour.  If there is one, create a
+        # tuple to represent this pair: (primary file, secondary
+        # file, layered file) then add this tuple of files to the
+        # list and continue. If not, then continue with the next
+        # primary file.
+        secondary_file = secondary_index.lookup(date, modelrun_str, fcst_hr_str)
+        if secondary_file is None:
+            logging.info("No matching date, or model run or forecast time for "
+                         "%s", primary_file)
+            continue
+        layered_filename = date + "_" + modelrun_str + "_f" + \
+                           fcst_hr_str + "_Analysis-Assimilation.nc"
+        list_paired_files.append((primary_file, secondary_file,
+                                  layered_filename))
+
+    return list_paired_files
+
+
+
+def fused_pipeline_data(parser, primary_data, secondary_data,
+                        downscale_shortwave=False, data_files=None):
+    """Creates the layered files of a forcing configuration directly
+    from the raw data with the fused pipeline (WRF_Hydro_pipeline):
+    for each forecast hour present in both the primary and the
+    secondary data, the regridding, downscaling, optional shortwave
+    downscaling and layering are performed in memory by the Python
+    engines, and only the layered file is written.  The regridded
+    and downscaled files are also written if write_intermediates is
+    set in the [pipeline] section of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file containing all the defined
+                                values.
+        primary_data (string):  The name of the primary product
+        secondary_data (string): The name of the secondary product
+        downscale_shortwave (boolean) : 'True' if downscaling of
+                                shortwave radiation (SWDOWN) is
+                                requested.
+        data_files (list): The full paths of raw files (primary or
+                           secondary); if given, only the forecast
+                           hours which include one of these files
+                           are processed.
+    Returns:
+        elapsed_array (List):  A list of the elapsed time for
+                               creating each layered file.
+
+    """
+    (jobs, job_inputs, version) = \
+        fused_pipeline_jobs(parser, primary_data, secondary_data,
+                            downscale_shortwave, data_files)
+
+    # Only the new or changed forecast hours are processed.
+    elapsed_array = []
+    results = run_incremental_jobs(jobs, job_inputs, 'pipeline', version,
+                                   parser, label=(primary_data.upper() + "_" +
+                                                  secondary_data.upper(),
+                                                  "Fused pipeline"))
+    for (output_file, elapsed, return_value, metrics) in results:
+        elapsed_array.append(elapsed)
+
+        if return_value != 0:
+            logging.error('ERROR: The fused pipeline for %s was unsuccessful, \
+                          return value of %s', output_file, return_value)
+
+    return elapsed_array
+
+
+
+def fused_pipeline_jobs(parser, primary_data, secondary_data,
+                        downscale_shortwave=False, data_files=None):
+    """Creates the jobs (see run_jobs) of the fused pipeline, one
+    per forecast hour (see fused_pipeline_data).
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        primary_data (string):  The name of the primary product
+        secondary_data (string): The name of the secondary product
+        downscale_shortwave (boolean) : 'True' if downscaling of
+                                shortwave radiation (SWDOWN) is
+                                requested.
+        data_files (list): If given, only the forecast hours which
+                           include one of these raw files are
+                           processed.
+    Returns:
+        (jobs, job_inputs, version) (tuple):  The jobs, the input
+                            files of each job keyed by output file
+                            and the version of the pipeline stage.
+
+    """
+    import WRF_Hydro_pipeline
+
+    if parser.has_option('layering', 'layering_stacks') and \
+       parser.get('layering', 'layering_stacks').strip():
+        logging.warning("WARNING: the fused pipeline layers the primary and "
+                        "secondary products only, layering_stacks is ignored")
+    layered_output_dir = parser.get('layering', 'output_dir')
+    write_intermediates = parser.has_option('pipeline', 'write_intermediates')\
+                          and parser.getboolean('pipeline', 'write_intermediates')
+    output_options = get_output_options(parser)
+    tile_rows = get_tile_rows(parser, output_options)
+    mkdir_p(layered_output_dir)
+
+    # Index the raw files of both products by date, model run and
+    # forecast hour.
+    stages = []
+    for product in (primary_data.upper(), secondary_data.upper()):
+        stages.append(get_pipeline_stages(parser, product, write_intermediates))
+
+    jobs = []
+    job_inputs = {}
+    for key in sorted(stages[0]):
+        if key not in stages[1]:
+            logging.info("No matching %s file for %s", secondary_data,
+                         stages[0][key]['src_file'])
+            continue
+        if data_files is not None and \
+           stages[0][key]['src_file'] not in data_files and \
+           stages[1][key]['src_file'] not in data_files:
+            continue
+        (date, init_hr, fcst_hr) = key
+        layered_filename = date + "_" + init_hr + "_f" + "%03d" % fcst_hr + \
+                           "_Analysis-Assimilation.nc"
+        full_layered_file = layered_output_dir + "/" + layered_filename
+        logging.debug("fused pipeline: %s + %s to %s", stages[0][key]['src_file'],
+                      stages[1][key]['src_file'], full_layered_file)
+        jobs.append((full_layered_file,
+                     [(WRF_Hydro_pipeline.process_forecast_hour,
+                       (stages[0][key], stages[1][key], full_layered_file,
+                        downscale_shortwave, write_intermediates,
+                        output_options, tile_rows))]))
+        job_inputs[full_layered_file] = []
+        for stage in (stages[0][key], stages[1][key]):
+            job_inputs[full_layered_file] += [stage['src_file'], stage['wgt_file'],
+                                              stage['hgt_file'], stage['geo_file'],
+                                              stage['lapse_file']]
+
+    version = WRF_Hydro_manifest.stage_version('pipeline', 'PYTHON')
+    if downscale_shortwave:
+        version += "+shortwave"
+    if write_intermediates:
+        version += "+intermediates"
+    version += output_version(output_options)
+    return (jobs, job_inputs, version)
+
+
+
+def get_pipeline_stages(parser, product, write_intermediates=False):
+    """Describes the raw files of a product for the fused pipeline,
+    using the values of the [regridding] and [downscaling] sections
+    of the parm/config file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        product (string):  The product name: HRRR, RAP, NAM, GFS
+        write_intermediates (boolean): True if the regridded and
+                                       downscaled files will be
+                                       written, their directories
+                                       are then created.
+    Returns:
+        stages (dict):  The description of each raw file (see
+                        WRF_Hydro_pipeline), keyed by a tuple:
+                        (YYYYMMDD, ihh, forecast hour as an int).
+
+    """
+    weight_cache_dir = None
+    if parser.has_option('regridding', 'weight_cache_dir'):
+        weight_cache_dir = parser.get('regridding', 'weight_cache_dir')
+    grib_index = get_grib_index(parser)
+    terrain_cache_dir = None
+    if parser.has_option('downscaling', 'terrain_cache_dir'):
+        terrain_cache_dir = parser.get('downscaling', 'terrain_cache_dir')
+    static_store = get_static_store(parser)
+    data_dir = parser.get('data_dir', product + '_data')
+    regridded_dir = parser.get('regridding', product + '_output_dir')
+    downscaled_dir = parser.get('downscaling', product + '_downscale_output_dir')
+
+    stages = {}
+    data_index = catalog_index(parser, data_dir,
+                               WRF_Hydro_catalog.name_pattern(product))
+    for (data_file, fields) in data_index.entries:
+        try:
+            (subdir_file_path, hydro_filename) = \
+                create_output_name_and_subdir(product, data_file, data_dir,
+                                              fields)
+        except ValueError as exc:
+            logging.error("ERROR: %s is not processed: %s", data_file, exc)
+            continue
+        key = WRF_Hydro_catalog.fields_key(fields)
+        if write_intermediates:
+            mkdir_p(regridded_dir + "/" + subdir_file_path)
+            mkdir_p(downscaled_dir + "/" + subdir_file_path)
+        stages[key] = {
+            'product': product,
+            'src_file': data_file,
+            'wgt_file': parser.get('regridding', product + '_wgt_bilinear'),
+            'weight_cache_dir': weight_cache_dir,
+            'grib_index': grib_index,
+            'hgt_file': parser.get('downscaling', product + '_hgt_data'),
+            'geo_file': parser.get('downscaling', product + '_geo_data'),
+            'lapse_file': parser.get('downscaling', 'lapse_rate_file'),
+            'terrain_cache_dir': terrain_cache_dir,
+            'static_store': static_store,
+            'regridded_file': regridded_dir + "/" + subdir_file_path + "/" + \
+                              hydro_filename,
+            'downscaled_file': downscaled_dir + "/" + subdir_file_path + "/" + \
+                               hydro_filename,
+            }
+    return stages
+
+
+
+def forcing_graph(parser, products, layering=None, downscale_shortwave=False,
+                  data_files=None):
+    """Creates the task graph (WRF_Hydro_scheduler.TaskGraph) of a
+    forcing configuration: the regridding of each product's files,
+    followed by their downscaling for the products with a
+    downscale_output_dir in the [downscaling] section of the
+    parm/config file, followed by the layering of the primary and
+    secondary products, or of the stacks of products of
+    layering_stacks in the [layering] section (or, if fused is set
+    in the [pipeline] section, the fused pipeline of the layered
+    products).  Each job
+    depends on the jobs that create its input files.  If a cube_dir
+    is defined in the [output] section, the jobs creating the final
+    files of the configuration (layered or, for the products which
+    aren't layered, downscaled or else regridded) append them to
+    their per-cycle cube (see add_cube_cmds).
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        products (list):  The names of the products to process.
+        layering (tuple):  The names of the primary and secondary
+                           products to layer, or None.
+        downscale_shortwave (boolean):  'True' if downscaling of
+                                        shortwave radiation (SWDOWN)
+                                        is requested.
+        data_files (list):  The full paths of the raw files to
+                            process (of any product), by default all
+                            the files of the products' data
+                            directories.
+    Returns:
+        graph (WRF_Hydro_scheduler.TaskGraph):  The task graph.
+    Raises:
+        ValueError:  If one of the products isn't supported.
+
+    """
+    import WRF_Hydro_scheduler
+
+    # Fail before anything is processed if a product can't be.
+    unsupported = [product.upper() for product in products
+                   if product.upper() not in WRF_Hydro_catalog.RAW_PATTERNS]
+    if unsupported:
+        raise ValueError("unsupported products: %s (supported: %s)" %
+                         (", ".join(unsupported),
+                          ", ".join(sorted(WRF_Hydro_catalog.RAW_PATTERNS))))
+
+    fused = layering is not None and parser.has_option('pipeline', 'fused') \
+            and parser.getboolean('pipeline', 'fused')
+    layered_products = [product.upper() for product in layering or ()]
+
+    graph = WRF_Hydro_scheduler.TaskGraph()
+    # The final files of each product (downscaled or, for the products
+    # which aren't downscaled, regridded), which may be layered.
+    final_files = []
+    for product in [product.upper() for product in products]:
+        if fused and product in layered_products:
+            continue
+        product_files = None
+        if data_files is not None:
+            data_dir = os.path.join(parser.get('data_dir', product + '_data'), '')
+            product_files = [f for f in data_files if f.startswith(data_dir)]
+            if not product_files:
                 continue
+
+        (jobs, job_inputs, version, batch) = regrid_jobs(product, parser,
+                                                         product_files)
+        downscaled = parser.has_option('downscaling',
+                                       product + '_downscale_output_dir')
+        if not downscaled and product not in layered_products:
+            (jobs, version) = add_cube_cmds(jobs, version, parser)
+        graph.add_jobs((product, "Regridding"), 'regridding', version, jobs,
+                       job_inputs)
+        if not downscaled:
+            final_files += [job[0] for job in jobs]
+            continue
+
+        # Downscale the regridded files, whether they are created by
+        # the graph or are already up to date.
+        (jobs, job_inputs, version, batch) = \
+            downscale_jobs(product, parser, downscale_shortwave,
+                           [job[0] for job in jobs])
+        if product not in layered_products:
+            (jobs, version) = add_cube_cmds(jobs, version, parser)
+        graph.add_jobs((product, "Downscaling"), 'downscaling', version, jobs,
+                       job_inputs)
+        final_files += [job[0] for job in jobs]
+
+    if layering is not None:
+        label = "_".join(layered_products)
+        if fused:
+            (jobs, job_inputs, version) = \
+                fused_pipeline_jobs(parser, layering[0], layering[1],
+                                    downscale_shortwave, data_files)
+            (jobs, version) = add_cube_cmds(jobs, version, parser)
+            graph.add_jobs((label, "Fused pipeline"), 'pipeline', version, jobs,
+                           job_inputs)
         else:
-            logging.error('ERROR: filename structure is not what was expected')
+            if data_files is not None:
+                data_files = final_files
+            (jobs, job_inputs, version) = \
+                layer_jobs(parser, layering[0], layering[1], data_files,
+                           graph.outputs())
+            (jobs, version) = add_cube_cmds(jobs, version, parser)
+            graph.add_jobs((label, "Layering"), 'layering', version, jobs,
+                           job_inputs)
+    return graph
+
+
+
+def run_forcing_graph(parser, products, layering=None, downscale_shortwave=False,
+                      data_files=None):
+    """Processes the files of a forcing configuration with the
+    dependency-aware scheduler (WRF_Hydro_scheduler): every job of
+    the task graph (see forcing_graph) is run as soon as the jobs
+    creating its input files are done, by the worker processes of
+    the [parallel] section of the parm/config file, so that e.g. the
+    downscaling of a forecast hour starts as soon as its regridding
+    is done.  Only the new or changed files are processed.  The NCL
+    batch mode (ncl_batch_size) isn't used for the jobs of a graph:
+    each NCL job of the forcing scripts processes one file.
+
+    If a run_id is defined in the [distributed] section of the
+    parm/config file, the jobs are shared by all the nodes (hosts)
+    running the same configuration with the same run_id, through
+    lease files in the lease_dir shared by the nodes (see
+    WRF_Hydro_lease).  With local_nodes greater than 1, this host
+    runs that many nodes, as separate processes.
 
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        products (list):  The names of the products to process.
+        layering (tuple):  The names of the primary and secondary
+                           products to layer, or None.
+        downscale_shortwave (boolean):  'True' if downscaling of
+                                        shortwave radiation (SWDOWN)
+                                        is requested.
+        data_files (list):  The full paths of the raw files to
+                            process, by default all the files.
+    Returns:
+        job_metrics (OrderedDict):  The lists of the metrics (see
+                                    run_graph_node) of each job run
+                                    (by the nodes of this host), keyed
+                                    by (product, activity).  A job not
+                                    run because a job it depends on
+                                    failed isn't included.
+    Raises:
+        ValueError:  If one of the products isn't supported.
 
+    """
+    graph = forcing_graph(parser, products, layering, downscale_shortwave,
+                          data_files)
+    run_id = ""
+    if parser.has_option('distributed', 'run_id'):
+        run_id = parser.get('distributed', 'run_id').strip()
+    local_nodes = 1
+    if run_id and parser.has_option('distributed', 'local_nodes'):
+        local_nodes = parser.getint('distributed', 'local_nodes')
+    if local_nodes <= 1:
+        return run_graph_node(graph, parser)
+
+    # Run the nodes in processes of their own, as on separate hosts.
+    logging.info("Running %s nodes for run %s", local_nodes, run_id)
+    node_results = multiprocessing.Queue()
+    nodes = [multiprocessing.Process(target=run_graph_node,
+                                     args=(graph, parser, node_results))
+             for i in range(local_nodes)]
+    for node in nodes:
+        node.start()
+    job_metrics = OrderedDict((task['label'], []) for task in graph.tasks)
+    pending_nodes = len(nodes)
+    while pending_nodes > 0:
+        try:
+            node_job_metrics = node_results.get(timeout=1)
+        except Queue.Empty:
+            # A node which died doesn't report its metrics.
+            if not any(node.is_alive() for node in nodes) and \
+               node_results.empty():
+                logging.error("ERROR: %s nodes failed", pending_nodes)
+                break
+            continue
+        pending_nodes -= 1
+        for label, metrics in node_job_metrics.items():
+            job_metrics[label] += metrics
+    for node in nodes:
+        node.join()
+    return job_metrics
+
+
+
+def run_graph_node(graph, parser, node_results=None):
+    """Runs a task graph (see run_forcing_graph) as one node: with
+    the processed-file manifest and, if a run_id is defined in the
+    [distributed] section of the parm/config file, sharing the tasks
+    with the other nodes of the run.
 
-    return list_paired_files
+    Args:
+        graph (WRF_Hydro_scheduler.TaskGraph):  The task graph.
+        parser (ConfigParser):  The parser to the config/parm file.
+        node_results (multiprocessing.Queue):  If given, the job
+                              metrics are put in this queue instead of
+                              being returned, for a node running in a
+                              process of its own.
+    Returns:
+        job_metrics (OrderedDict):  The lists of the metrics of each
+                                    job run by this node (a dict of
+                                    the WRF_Hydro_metrics.METRIC_FIELDS,
+                                    output_file and return_value),
+                                    keyed by (product, activity).  The
+                                    jobs which failed, were quarantined
+                                    or weren't run because a job they
+                                    depend on failed are also listed in
+                                    the failure report (see
+                                    WRF_Hydro_failures).
 
+    """
+    import WRF_Hydro_failures
+    import WRF_Hydro_lease
+    import WRF_Hydro_scheduler
+
+    def get_distributed_option(option, default):
+        if parser.has_option('distributed', option):
+            return parser.get('distributed', option).strip()
+        return default
+
+    run_id = get_distributed_option('run_id', '')
+    poll_interval = float(get_distributed_option('poll_interval', 10))
+    coordinator = None
+    if run_id:
+        coordinator = WRF_Hydro_lease.LeaseCoordinator(
+            parser.get('distributed', 'lease_dir'), run_id,
+            float(get_distributed_option('heartbeat_interval', 30)),
+            float(get_distributed_option('lease_timeout', 180)))
+        logging.info("Node %s of run %s", coordinator.node, run_id)
+
+    manifest = open_manifest(parser)
+    prefetcher = get_prefetcher(parser)
+    try:
+        results = graph.run(run_job, get_num_workers(parser), manifest,
+                            coordinator, poll_interval,
+                            get_retry_policy(parser),
+                            get_quarantine_hours(parser),
+                            configure_execution(parser), prefetcher)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        if manifest is not None:
+            manifest.close()
+        if coordinator is not None:
+            coordinator.close()
+
+    job_metrics = OrderedDict()
+    failures = []
+    not_created = []
+    for label, label_results in results.items():
+        job_metrics[label] = []
+        for result in label_results:
+            (output_file, elapsed, return_value, metrics) = result
+            if return_value == WRF_Hydro_scheduler.UPSTREAM_FAILED:
+                not_created.append(output_file)
+                continue
+            if return_value != 0:
+                task = graph.tasks[graph.producers[output_file]]
+                failures.append(WRF_Hydro_failures.failure_entry(
+                    label, task['stage'], result, task['inputs'],
+                    metrics.get('quarantined', False)))
+            if return_value == WRF_Hydro_scheduler.QUARANTINED:
+                continue
+            metrics['output_file'] = output_file
+            metrics['return_value'] = return_value
+            job_metrics[label].append(metrics)
+    WRF_Hydro_failures.write_failure_report(
+        failures, not_created, sum(len(r) for r in results.values()))
+    if node_results is not None:
+        node_results.put(job_metrics)
+    return job_metrics
+
+
+
+def watch_data(parser, products, layering=None, downscale_shortwave=False):
+    """Processes the files of a forcing configuration as they arrive
+    in the data directories, instead of all at once: each batch of
+    complete files (see WRF_Hydro_watch) is regridded, downscaled
+    (except MRMS) and, if both products of a forecast hour are
+    available, layered.  If the fused pipeline is enabled in the
+    [pipeline] section of the parm/config file, the layered products
+    are processed with it instead.  The watch ends when no file has
+    arrived for max_idle seconds ([watch] section).
 
-def create_benchmark_summary(product, activity, elapsed_times):
-    
-    """ Create a summary of the min, max, and mean
-        time to perform a processing activity for 
-        each data file. The information is placed 
-        in the log file.
+    Args:
+        parser (ConfigParser):  The parser to the config/parm
+                                file.
+        products (list):  The names of the products to process,
+                          e.g. MRMS, HRRR, RAP.
+        layering (tuple):  The names of the primary and secondary
+                           products to layer, or None.
+        downscale_shortwave (boolean) : 'True' if downscaling of
+                                shortwave radiation (SWDOWN) is
+                                requested.
+    Returns:
+        job_metrics (OrderedDict):  The metrics of the jobs of each
+                                    activity (see run_graph_node),
+                                    keyed by (product, activity), e.g.
+                                    ("HRRR", "Regridding").
+
+    """
+    import WRF_Hydro_watch
+
+    def get_watch_option(option, default):
+        if parser.has_option('watch', option):
+            return parser.get('watch', option).strip()
+        return default
+
+    stable_seconds = float(get_watch_option('stable_seconds', 10))
+    sentinel_suffix = get_watch_option('sentinel_suffix', '')
+    poll_interval = float(get_watch_option('poll_interval', 30))
+    max_idle = float(get_watch_option('max_idle', 3600))
+    use_inotify = get_watch_option('use_inotify', 'True').lower() in \
+                  ('1', 'yes', 'true', 'on')
+
+    products = [product.upper() for product in products]
+    data_dirs = OrderedDict((product, parser.get('data_dir', product + '_data'))
+                            for product in products)
+    for data_dir in data_dirs.values():
+        mkdir_p(data_dir)
+    watcher = WRF_Hydro_watch.FileWatcher(list(data_dirs.values()),
+                                          stable_seconds, sentinel_suffix,
+                                          poll_interval, use_inotify)
+    logging.info("Watching %s", ", ".join(data_dirs.values()))
+
+    job_metrics = OrderedDict()
+
+    try:
+        last_arrival = time.time()
+        while max_idle <= 0 or time.time() - last_arrival < max_idle:
+            new_files = watcher.wait_for_files(poll_interval)
+            if not new_files:
+                continue
+            last_arrival = time.time()
+            logging.info("New files: %s", new_files)
+
+            # Regrid, downscale and layer the new files, each job as
+            # soon as the jobs it depends on are done.
+            new_job_metrics = run_forcing_graph(parser, products, layering,
+                                                downscale_shortwave, new_files)
+            for label, metrics in new_job_metrics.items():
+                job_metrics.setdefault(label, []).extend(metrics)
+        logging.info("No new files for %s seconds, done watching", max_idle)
+    finally:
+        watcher.close()
+
+    return job_metrics
+
+
+
+def forcing_arguments(description, watch=False):
+    """Parses the command line options of a forcing configuration
+    script.
+
+    Args:
+        description (string):  The description of the script.
+        watch (boolean):  True to accept --watch, for the scripts
+                          which can process the files as they arrive.
+    Returns:
+        args (argparse.Namespace):  The options: force, run_id and,
+                                    if accepted, watch.
+
+    """
+    arg_parser = argparse.ArgumentParser(description=description)
+    arg_parser.add_argument('--force', action='store_true',
+                            help='process all the files again, including '
+                                 'those the manifest lists as up to date')
+    arg_parser.add_argument('--run-id',
+                            help='share the files to process with the other '
+                                 'hosts run with the same id (see the '
+                                 '[distributed] section of the parm file)')
+    if watch:
+        arg_parser.add_argument('--watch', action='store_true',
+                                help='process the files as they arrive in the '
+                                     'data directories (see the [watch] '
+                                     'section of the parm file)')
+    return arg_parser.parse_args()
+
+
+
+def read_parm(args, parm_file='wrf_hydro_forcing.parm'):
+    """Reads the parm/config file of a forcing configuration script,
+    with the command line options (see forcing_arguments) which
+    override it.
+
+    Args:
+        args (argparse.Namespace):  The command line options.
+        parm_file (string):  The path of the parm/config file.
+    Returns:
+        parser (ConfigParser):  The parser to the config/parm file.
+
+    """
+    parser = SafeConfigParser()
+    parser.read(parm_file)
+
+    # Rebuild everything if requested, regardless of the
+    # processed-file manifest.
+    if args.force:
+        if not parser.has_section('manifest'):
+            parser.add_section('manifest')
+        parser.set('manifest', 'force', 'True')
+
+    # Share the files with the other hosts of a distributed run.
+    if args.run_id:
+        if not parser.has_section('distributed'):
+            parser.add_section('distributed')
+        parser.set('distributed', 'run_id', args.run_id)
+    return parser
+
+
+
+def create_benchmark(job_metrics, prefix=None):
+    """ Create the benchmarks of a run: for each processing
+        activity of each product, a summary of the elapsed
+        times (see create_benchmark_summary) and of the
+        resource usage of the jobs in the log file, and the
+        per-job metrics and their summaries in the
+        <log file>_metrics.csv and <log file>_metrics.jsonl
+        files next to the log file (see WRF_Hydro_metrics).
 
         Args:
-           product (string):  The name of the product under
-                              consideration.
-           activity (string): The processing activity: 
-                              regridding, downscaling, etc.
-           elapsed_times (ndarray): Numpy ndarray of elapsed 
-                                   times (wall clock time 
-                                   for now) for each of the
-                                   files that were processed.
-       
+           job_metrics (OrderedDict): The lists of the metrics
+                                      of the jobs, keyed by
+                                      (product, activity), as
+                                      returned by run_forcing_graph.
+           prefix (string): The path of the metrics files without
+                            the _metrics suffix, by default that
+                            of the log file.
+
        Output:
-           None:  Generates an entry in the log file, as
-                  an "info" entry, which states the min,
-                  max, and average time in seconds.
-     
+           None:  Generates entries in the log file and appends
+                  to the metrics files.
+
     """
-    if len(elapsed_times) > 0:
-        elapsed_array = np.array(elapsed_times)
-        min_time = np.min(elapsed_array)
-        max_time = np.max(elapsed_array)
-        avg_time = np.mean(elapsed_array)
-        med_time = np.median(elapsed_array) 
+    summaries = WRF_Hydro_metrics.summarize_jobs(job_metrics)
+    for (product, activity), jobs in job_metrics.items():
+        create_benchmark_summary(product, activity,
+                                 [job['wall_time'] for job in jobs])
+        if not jobs:
+            continue
+        summary = summaries[(product, activity)]
+        logging.info("CPU time (sec): p50 %.2f, p90 %.2f, p99 %.2f",
+                     summary['cpu_time']['p50'], summary['cpu_time']['p90'],
+                     summary['cpu_time']['p99'])
+        logging.info("Peak RSS (MB): p50 %.1f, max %.1f",
+                     summary['max_rss']['p50'] / 2.**20,
+                     summary['max_rss']['max'] / 2.**20)
+        logging.info("Read/written (MB per file): %.1f/%.1f, input/output "
+                     "file sizes (MB per file): %.1f/%.1f",
+                     summary['read_bytes']['mean'] / 2.**20,
+                     summary['write_bytes']['mean'] / 2.**20,
+                     summary['input_bytes']['mean'] / 2.**20,
+                     summary['output_bytes']['mean'] / 2.**20)
+
+    try:
+        (csv_file, json_file) = WRF_Hydro_metrics.write_metrics(job_metrics,
+                                                                prefix)
+        logging.info("Metrics written to %s and %s", csv_file, json_file)
+    except (IOError, OSError) as exc:
+        logging.error("ERROR: the metrics could not be written: %s", exc)
+
 
-        logging.info("=========================================")
-        logging.info("SUMMARY for %s %s ", activity,product) 
-        logging.info("=========================================")
-        logging.info("Average elapsed time (sec): %s", avg_time)
-        logging.info("Median elapsed time (sec): %s", med_time)
-        logging.info("Min elapsed time (sec): %s ", min_time)
-        logging.info("Max elapsedtime (sec): %s ", max_time)
-    else:
-        logging.error("ERROR: Nothing was returned....")
-    
 
 #--------------------Define the Workflow -------------------------
 
@@ -0,0 +1,405 @@
+import os
+import hashlib
+import json
+import logging
+import re
+import struct
+import time
+import pygrib
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_grib_index.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Selective reading of GRIB2 files for the Python regridding
+#  engine.  The HRRR, RAP, NAM and GFS files hold hundreds of
+#  messages of which only about eight are regridded; instead of
+#  scanning (and reading) the whole file, the messages are located
+#  with an inventory of the file and only their byte ranges are read
+#  and decoded.  The inventory is, in order of preference:
+#     the wgrib2 inventory (.idx file) published next to the GRIB2
+#     file, if it is consistent with the file's size; its entries
+#     are matched by their wgrib2 names (WGRIB2_PARAMETERS and
+#     levels such as "2 m above ground"),
+#     an inventory built by reading only the headers of the
+#     messages (sections 0 and 4), skipping their data, and cached
+#     as JSON in the grib_index_dir of the [regridding] section of
+#     the wrf_hydro_forcing.parm file, if defined.
+#  The header of each message read is checked against the field it
+#  was read for; if a wgrib2 inventory doesn't list a field or lists it
+#  wrongly, the built inventory is used instead.  Close byte ranges
+#  are read together, with one read.  A ValueError is raised if the
+#  file can't be read this way, the caller then scans the file.
+
+
+# The fields of the wgrib2 inventories: the parameter names of the
+# GRIB2 discipline 0 parameters which are regridded, as
+# (discipline, parameterCategory, parameterNumber), and the level
+# descriptions, as (typeOfFirstFixedSurface, level).
+WGRIB2_PARAMETERS = {
+    'TMP': (0, 0, 0),
+    'SPFH': (0, 1, 0),
+    'PRATE': (0, 1, 7),
+    'APCP': (0, 1, 8),
+    'UGRD': (0, 2, 2),
+    'VGRD': (0, 2, 3),
+    'PRES': (0, 3, 0),
+    'DSWRF': (0, 4, 7),
+    'DLWRF': (0, 5, 3),
+    'ULWRF': (0, 5, 4),
+    }
+WGRIB2_LEVELS = {
+    'surface': (1, 0),
+    'top of atmosphere': (8, 0),
+    'mean sea level': (101, 0),
+    }
+WGRIB2_HEIGHT_LEVEL_RE = r'^([0-9.]+) m above ground$'
+WGRIB2_PERIOD_RE = r'([0-9]+)-([0-9]+) (min|hour|day) (acc|ave|max|min)'
+
+# The offset, in the product definition section (section 4), of
+# the length of the statistical processing period (lengthOfTimeRange)
+# for the templates which have one.
+PERIOD_OFFSETS = {8: 49, 9: 62, 10: 50, 11: 52, 12: 51}
+
+# Byte ranges closer than this are read with one read.
+MAX_READ_GAP = 256 * 1024
+
+# The cached inventories not used for this long are removed.
+INVENTORY_MAX_AGE = 7 * 24 * 3600
+
+# The inventory cache directories already cleaned by this process.
+_cleaned_dirs = set()
+
+
+
+def entry_matches(entry, selector):
+    """Determines if an inventory entry matches a field selector.
+
+    Args:
+        entry (dict): The inventory entry of a message.
+        selector (tuple): (discipline, parameterCategory,
+                          parameterNumber, typeOfFirstFixedSurface,
+                          level), level None matches any level.
+    Returns:
+        True if the message matches.
+
+    """
+    (discipline, category, number, level_type, level) = selector
+    if (entry['discipline'], entry['category'], entry['number'],
+        entry['level_type']) != (discipline, category, number, level_type):
+        return False
+    return level is None or entry['level'] == level
+
+
+
+def message_entry(data):
+    """Returns the field keys of a message from its bytes, to check
+    it against the inventory entry it was read for.
+    """
+    (discipline,) = struct.unpack_from('>B', data, 6)
+    position = 16
+    while position < len(data) - 4:
+        (section_length, section_number) = struct.unpack_from('>IB', data,
+                                                              position)
+        if section_number == 4:
+            entry = product_definition(
+                data[position:position + section_length])
+            entry['discipline'] = discipline
+            return entry
+        position += section_length
+    raise ValueError("GRIB2 message without product definition")
+
+
+
+def read_wgrib2_inventory(filename):
+    """Reads the wgrib2 inventory (<filename>.idx) of a GRIB2 file.
+
+    Returns:
+        entries (list): The inventory entries (offset, length and,
+                        for the known parameters and levels, the
+                        field keys and period) of the messages, or
+                        None if there is no usable .idx file.
+
+    """
+    idx_file = filename + ".idx"
+    try:
+        with open(idx_file) as f:
+            lines = [line.strip().split(':') for line in f if line.strip()]
+        file_size = os.path.getsize(filename)
+    except (IOError, OSError):
+        return None
+
+    try:
+        # Fields of a message holding several (1.1, 1.2, ...) share
+        # its offset and aren't used.
+        offsets = sorted(set(int(fields[1]) for fields in lines))
+        entries = []
+        for fields in lines:
+            if '.' in fields[0]:
+                continue
+            offset = int(fields[1])
+            next_offsets = [o for o in offsets if o > offset]
+            entry = {'offset': offset,
+                     'length': (next_offsets[0] if next_offsets else file_size)
+                               - offset,
+                     'discipline': None, 'category': None, 'number': None,
+                     'level_type': None, 'level': None, 'period': 0}
+            parameter = WGRIB2_PARAMETERS.get(fields[3])
+            level = WGRIB2_LEVELS.get(fields[4])
+            match = re.match(WGRIB2_HEIGHT_LEVEL_RE, fields[4])
+            if match:
+                level = (103, float(match.group(1)))
+            if parameter is not None and level is not None:
+                (entry['discipline'], entry['category'], entry['number']) = \
+                    parameter
+                (entry['level_type'], entry['level']) = level
+            match = re.search(WGRIB2_PERIOD_RE, fields[5])
+            if match:
+                hours = {'min': 1. / 60, 'hour': 1., 'day': 24.}[match.group(3)]
+                entry['period'] = \
+                    (int(match.group(2)) - int(match.group(1))) * hours
+            entries.append(entry)
+    except (IndexError, ValueError):
+        logging.debug("%s is not a wgrib2 inventory", idx_file)
+        return None
+
+    if not entries or offsets[-1] >= file_size:
+        logging.debug("%s doesn't match %s", idx_file, filename)
+        return None
+    return entries
+
+
+
+def product_definition(section):
+    """Returns the field keys and period of a message from its
+    product definition section (section 4).
+    """
+    (template,) = struct.unpack_from('>H', section, 7)
+    (category, number, level_type, scale_factor) = \
+        struct.unpack_from('>BBxxxxxxxxxxxBB', section, 9)
+    (scaled_value,) = struct.unpack_from('>I', section, 24)
+    # Signed values are stored as sign and magnitude, all bits set
+    # for a missing value.
+    if scale_factor == 0xff or scaled_value == 0xffffffff:
+        level = 0
+    else:
+        if scale_factor & 0x80:
+            scale_factor = -(scale_factor & 0x7f)
+        if scaled_value & 0x80000000:
+            scaled_value = -(scaled_value & 0x7fffffff)
+        level = scaled_value / 10. ** scale_factor
+    period = 0
+    if template in PERIOD_OFFSETS and \
+       len(section) >= PERIOD_OFFSETS[template] + 4:
+        (period,) = struct.unpack_from('>I', section, PERIOD_OFFSETS[template])
+    return {'category': category, 'number': number, 'level_type': level_type,
+            'level': level, 'period': period}
+
+
+
+def scan_inventory(filename):
+    """Builds the inventory of a GRIB2 file by reading the headers of
+    its messages only: section 0 (discipline and length) and the
+    product definition section (section 4) of their first field.
+
+    Returns:
+        entries (list): The inventory entries of the messages.
+
+    """
+    entries = []
+    with open(filename, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(16)
+            if len(header) < 16 or header[:4] != b'GRIB':
+                raise ValueError("no GRIB message at byte %d of %s" %
+                                 (offset, filename))
+            (discipline, edition, length) = struct.unpack('>xxxxxxBBQ', header)
+            if edition != 2:
+                raise ValueError("%s is not a GRIB2 file" % filename)
+            entry = {'offset': offset, 'length': length,
+                     'discipline': discipline}
+            position = offset + 16
+            while position < offset + length - 4:
+                f.seek(position)
+                (section_length, section_number) = struct.unpack('>IB',
+                                                                 f.read(5))
+                if section_number == 4:
+                    f.seek(position)
+                    entry.update(product_definition(f.read(section_length)))
+                    break
+                position += section_length
+            if 'category' not in entry:
+                raise ValueError("message at byte %d of %s has no product "
+                                 "definition" % (offset, filename))
+            entries.append(entry)
+            offset += length
+    return entries
+
+
+
+def cached_inventory(filename, index_dir):
+    """Returns the built inventory of a GRIB2 file (see
+    scan_inventory) from the cache directory, building and caching
+    it if needed.  Entries are keyed by the file's path and are valid
+    as long as its size and modification time don't change.
+    """
+    if not index_dir:
+        return scan_inventory(filename)
+
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    cache_file = os.path.join(
+        index_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + ".json")
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if (cached['filename'], cached['size'], cached['mtime']) == \
+           (path, stat.st_size, stat.st_mtime):
+            os.utime(cache_file, None)
+            return cached['messages']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    entries = scan_inventory(filename)
+    try:
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        clean_inventory_cache(index_dir)
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'filename': path, 'size': stat.st_size,
+                       'mtime': stat.st_mtime, 'messages': entries}, f)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as exc:
+        logging.warning("WARNING: the inventory of %s could not be cached: %s",
+                        filename, exc)
+    return entries
+
+
+
+def clean_inventory_cache(index_dir):
+    """Removes the cached inventories which haven't been used for
+    INVENTORY_MAX_AGE seconds, once per process.
+    """
+    if index_dir in _cleaned_dirs:
+        return
+    _cleaned_dirs.add(index_dir)
+    now = time.time()
+    for name in os.listdir(index_dir):
+        cache_file = os.path.join(index_dir, name)
+        try:
+            if now - os.path.getmtime(cache_file) > INVENTORY_MAX_AGE:
+                os.remove(cache_file)
+        except OSError:
+            pass
+
+
+
+def select_messages(entries, selectors):
+    """Selects the message of each field in an inventory: if more
+    than one message matches (e.g. 1 hour and run total
+    accumulations) the one with the shortest statistical processing
+    period, as WRF_Hydro_regrid.read_source_fields does.
+
+    Returns:
+        selected (list): The inventory entry of each selector, None
+                         for those without a matching message.
+
+    """
+    selected = []
+    for selector in selectors:
+        best = None
+        for entry in entries:
+            if entry_matches(entry, selector) and \
+               (best is None or entry['period'] < best['period']):
+                best = entry
+        selected.append(best)
+    return selected
+
+
+
+def read_ranges(filename, entries):
+    """Reads the bytes of the messages of inventory entries, close
+    messages being read together.
+
+    Returns:
+        data (dict): The bytes of each message, keyed by offset.
+
+    """
+    data = {}
+    entries = sorted(set((entry['offset'], entry['length'])
+                         for entry in entries))
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < len(entries):
+            end = start + 1
+            while end < len(entries) and entries[end][0] - \
+                  (entries[end - 1][0] + entries[end - 1][1]) <= MAX_READ_GAP:
+                end += 1
+            first = entries[start][0]
+            f.seek(first)
+            block = f.read(entries[end - 1][0] + entries[end - 1][1] - first)
+            for (offset, length) in entries[start:end]:
+                data[offset] = block[offset - first:offset - first + length]
+            start = end
+    return data
+
+
+
+def read_messages(filename, selectors, index_dir=None):
+    """Reads and decodes the message of each field of a GRIB2 file,
+    reading only the byte ranges of these messages.
+
+    Args:
+        filename (string): The full path to the GRIB2 file.
+        selectors (list): The field selectors, see entry_matches.
+        index_dir (string): The directory where the built inventories
+                            are cached, or None.
+    Returns:
+        messages (list): The decoded message (pygrib.gribmessage) of
+                         each selector, None for the fields that
+                         aren't in the file.
+
+    """
+    inventories = [('wgrib2', lambda: read_wgrib2_inventory(filename)),
+                   ('built', lambda: cached_inventory(filename, index_dir))]
+    for (kind, inventory) in inventories:
+        entries = inventory()
+        if entries is None:
+            continue
+        selected = select_messages(entries, selectors)
+        if kind == 'wgrib2' and None in selected:
+            logging.debug("The wgrib2 inventory of %s doesn't list all "
+                          "the fields", filename)
+            continue
+
+        data = read_ranges(filename, [entry for entry in selected if entry])
+        messages = []
+        for entry, selector in zip(selected, selectors):
+            if entry is None:
+                messages.append(None)
+                continue
+            message = data[entry['offset']]
+            if message[:4] != b'GRIB' or \
+               not entry_matches(message_entry(message), selector):
+                break
+            try:
+                messages.append(pygrib.fromstring(message))
+            except Exception as exc:
+                raise ValueError("the message at byte %d of %s can't be "
+                                 "decoded: %s" % (entry['offset'], filename,
+                                                  exc))
+        else:
+            logging.debug("Read %s messages of %s with its %s inventory",
+                          len(data), filename, kind)
+            return messages
+        logging.debug("The %s inventory of %s doesn't match its messages",
+                      kind, filename)
+    raise ValueError("the inventory of %s doesn't match its messages" %
+                     filename)
@@ -0,0 +1,324 @@
+import os
+import ctypes
+import ctypes.util
+import logging
+import threading
+import time
+from collections import OrderedDict
+from stat import S_ISREG
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_io.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Overlap of the file I/O of the jobs with their computation, as
+#  set in the [io] section of the wrf_hydro_forcing.parm file.
+#
+#  Read-ahead: while the workers run their jobs, the process which
+#  dispatches them warms the page cache with the input files of the
+#  next prefetch_files jobs to run (for the layering, the files of
+#  both products), so the jobs don't wait for their inputs to be
+#  read cold from an automounted or network file system.  The files
+#  are either handed to the kernel's read-ahead with
+#  posix_fadvise(POSIX_FADV_WILLNEED), or read by a background
+#  thread for the file systems which ignore the advice.  The bytes
+#  of each job's inputs warmed ahead of it are its prefetched_bytes
+#  metric.
+#
+#  Write-behind: the NetCDF files of the Python engines are created
+#  in memory and written to the disk by a background thread of the
+#  worker process, under a temporary name renamed when complete,
+#  while the job goes on (e.g. the fused pipeline computing the next
+#  stage after writing an intermediate file).  The files waiting to
+#  be written take at most write_behind_mb MB, a job creating more
+#  waits for the thread.  A job's files are all written before its
+#  next command and before its result is reported, so that the jobs
+#  depending on them only see complete files; the time a job waits
+#  for them is its write_wait metric.
+
+
+# posix_fadvise advice to read a file ahead, on Linux.
+POSIX_FADV_WILLNEED = 3
+
+# Size of the reads of the background prefetch thread.
+READ_SIZE = 1 << 20
+
+
+
+def advise_willneed(filename):
+    """Asks the kernel to read a file into the page cache, in the
+    background.
+
+    Returns:
+        size (int): The size of the file, 0 if it can't be read.
+
+    """
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return 0
+    try:
+        stat = os.fstat(fd)
+        if not S_ISREG(stat.st_mode):
+            return 0
+        size = stat.st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+        else:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6")
+            libc.posix_fadvise(fd, ctypes.c_longlong(0), ctypes.c_longlong(0),
+                               POSIX_FADV_WILLNEED)
+        return size
+    except OSError:
+        return 0
+    finally:
+        os.close(fd)
+
+
+
+def read_through(filename):
+    """Reads a file, discarding its contents, so that it is in the
+    page cache.
+
+    Returns:
+        size (int): The number of bytes read.
+
+    """
+    size = 0
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                size += len(data)
+    except (IOError, OSError):
+        pass
+    return size
+
+
+
+class Prefetcher(object):
+    """Warms the page cache with the input files of the next jobs.
+
+    Args:
+        num_files (int): The number of jobs whose inputs are warmed
+                         ahead of the one being started.
+        mode (string): fadvise to use posix_fadvise, read to read the
+                       files in a background thread.
+
+    """
+
+    def __init__(self, num_files, mode='fadvise'):
+        self.num_files = num_files
+        self.mode = mode
+        # The sizes of the files warmed so far, keyed by path.
+        self.warmed = {}
+        self.lock = threading.Lock()
+        self.queue = None
+        if mode == 'read':
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.read_files)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def prefetch(self, filenames):
+        """Warms the files not warmed yet."""
+        for filename in filenames:
+            with self.lock:
+                if filename in self.warmed:
+                    continue
+                self.warmed[filename] = 0
+            if self.queue is not None:
+                self.queue.put(filename)
+                continue
+            size = advise_willneed(filename)
+            with self.lock:
+                self.warmed[filename] = size
+
+    def read_files(self):
+        """Reads the queued files, until None is queued."""
+        while True:
+            filename = self.queue.get()
+            if filename is None:
+                return
+            size = read_through(filename)
+            with self.lock:
+                self.warmed[filename] = size
+
+    def prefetched_bytes(self, filenames):
+        """Returns the bytes of the files which were warmed."""
+        with self.lock:
+            return sum(self.warmed.get(filename, 0) for filename in filenames)
+
+    def close(self):
+        """Stops the background thread, without waiting for the
+        files queued.
+        """
+        if self.queue is not None:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.queue.put(None)
+
+
+
+class WriteBehind(object):
+    """Writes files in a background thread, holding at most
+    max_bytes of them in memory.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        # The contents of the files waiting to be written, keyed by
+        # path, and the errors of those that couldn't be.
+        self.pending = OrderedDict()
+        self.pending_bytes = 0
+        self.errors = OrderedDict()
+        self.thread = None
+
+    def submit(self, filename, data):
+        """Queues a file to be written, waiting first for room in
+        memory.
+        """
+        self.wait_for(filename)
+        with self.condition:
+            while self.pending and \
+                  self.pending_bytes + len(data) > self.max_bytes:
+                self.condition.wait()
+            self.pending[filename] = data
+            self.pending_bytes += len(data)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_files)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def write_files(self):
+        """Writes the queued files, in order."""
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                (filename, data) = next(iter(self.pending.items()))
+            error = None
+            try:
+                write_file_now(filename, data)
+            except (IOError, OSError) as exc:
+                logging.error("ERROR: %s could not be written: %s",
+                              filename, exc)
+                error = exc
+            with self.condition:
+                del self.pending[filename]
+                self.pending_bytes -= len(data)
+                if error is not None:
+                    self.errors[filename] = error
+                self.condition.notify_all()
+
+    def wait_for(self, filename):
+        """Waits until a file is written, if it is queued."""
+        with self.condition:
+            while filename in self.pending:
+                self.condition.wait()
+
+    def flush(self):
+        """Waits until all the queued files are written.  Raises an
+        IOError if one of them couldn't be written.
+        """
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+            errors = self.errors
+            self.errors = OrderedDict()
+        if errors:
+            (filename, error) = next(iter(errors.items()))
+            raise IOError("%s could not be written: %s" % (filename, error))
+
+
+# The write-behind size (in bytes) of this process, 0 to write the
+# files directly, and its WriteBehind.
+_write_behind_bytes = 0
+_write_behind = None
+
+
+
+def configure(write_behind_mb):
+    """Sets the write-behind size, in MB, of this process."""
+    global _write_behind_bytes
+    _write_behind_bytes = int(write_behind_mb * 1024 * 1024)
+
+
+
+def write_behind_enabled():
+    """Determines if the files of this process are written behind."""
+    return _write_behind_bytes > 0
+
+
+
+def get_write_behind():
+    """Returns the WriteBehind of this process, creating it if
+    needed, e.g. in a worker process forked from a process which
+    had one.
+    """
+    global _write_behind
+    if _write_behind is None or _write_behind.pid != os.getpid():
+        _write_behind = WriteBehind(_write_behind_bytes)
+    return _write_behind
+
+
+
+def write_file_now(filename, data):
+    """Writes the contents of a file under a temporary name which is
+    renamed when complete.
+    """
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_file, filename)
+
+
+
+def write_file(filename, data):
+    """Writes the contents of a file, in the background if
+    write-behind is enabled.
+    """
+    if not write_behind_enabled():
+        write_file_now(filename, data)
+        return
+    get_write_behind().submit(filename, data)
+
+
+
+def wait_for(filename):
+    """Waits until a file written behind by this process, if any, is
+    complete, e.g. before reading it.
+    """
+    if _write_behind is not None and _write_behind.pid == os.getpid():
+        _write_behind.wait_for(filename)
+
+
+
+def flush():
+    """Waits until the files written behind by this process are
+    complete.  Raises an IOError if one couldn't be written.
+
+    Returns:
+        wait (float): The time waited, in seconds.
+
+    """
+    if _write_behind is None or _write_behind.pid != os.getpid():
+        return 0.
+    start = time.time()
+    _write_behind.flush()
+    return time.time() - start
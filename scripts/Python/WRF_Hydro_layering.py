@@ -0,0 +1,600 @@
+import os
+import hashlib
+import logging
+import numpy as np
+from collections import OrderedDict
+from netCDF4 import Dataset
+import WRF_Hydro_netcdf
+import WRF_Hydro_util
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_layering.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Python layering engine, replacing combine.ncl for the Analysis
+#  and Assimilation forcing configuration.  The primary product
+#  (HRRR) is used wherever its temperature, T2D, is defined and
+#  the secondary product (RAP) fills the rest of the domain.  As
+#  in combine.ncl, the downward long wave radiation, LWDOWN, is
+#  always taken from the secondary product.
+#
+#  combine.ncl is run twice per pair of files: once to compute the
+#  index of the missing cells of the primary T2D, saved to index.nc
+#  in the current directory, and once to layer the files.  Here the
+#  index of the missing cells (the primary product's coverage) is
+#  computed once per destination grid, kept in memory and, if a
+#  mask_cache_dir is defined in the [layering] section of the
+#  wrf_hydro_forcing.parm file, saved as a .npy sidecar.  Each pair
+#  is then layered in a single read/write pass, with the missing
+#  cells of all variables filled by indexed assignments, and without
+#  any shared temporary file so that pairs can be layered
+#  concurrently.  The cached index is checked against each file's
+#  T2D: the cells it lists must be missing, and the number of
+#  missing cells must be the same, otherwise the missing cells of
+#  that file are used, so that cells missing from a single primary
+#  file (e.g. an outage) are filled as combine.ncl does.  With
+#  verify_coverage set, the index is compared with the missing cells
+#  of every file, and the differences logged.  With tile_rows set in the [parallel] section,
+#  the files are layered by blocks of rows, each block filled where
+#  its primary T2D is missing.
+#
+#  N-way layering: with layering_stacks defined in the [layering]
+#  section, each variable is layered from its own ordered stack of
+#  products, e.g. RAINRATE from MRMS, then HRRR, then RAP, and T2D
+#  from HRRR, then RAP: each cell is taken from the first product of
+#  the stack which covers it (where the product's coverage variable,
+#  T2D or the MRMS precipitation rate, is defined), the last product
+#  filling the rest.  The coverage of each product is cached per
+#  destination grid as above, and so is the position in each stack
+#  of the product of each cell, so that every variable is filled in
+#  a single pass over the fields of its stack (numpy.choose), without
+#  chaining two-way layering runs.
+
+
+# Variables of the layered files, in the order combine.ncl
+# writes them.
+LAYERED_VARIABLES = ('T2D', 'LWDOWN', 'Q2D', 'U2D', 'V2D', 'PSFC',
+                     'RAINRATE', 'SWDOWN')
+
+# Variables taken entirely from the secondary product.
+SECONDARY_ONLY_VARIABLES = ('LWDOWN',)
+
+# The names of the layered variables in the files of the products
+# which name them differently: the regridded MRMS files hold the
+# precipitation rate as precip_rate.
+PRODUCT_VARIABLES = {
+    'MRMS': {'RAINRATE': 'precip_rate'},
+    }
+
+# The (layered) variable whose defined cells are the coverage of each
+# product in the N-way layering, T2D for the products not listed.
+COVERAGE_VARIABLES = {
+    'MRMS': 'RAINRATE',
+    }
+
+# The index of the missing cells, computed (or read) once per
+# process and destination grid.
+_coverage_cache = {}
+
+# The position in a stack of the product of each cell, computed once
+# per process, stack and coverage of its products.
+_sources_cache = {}
+
+
+
+def missing_index(t2d):
+    """Returns the flat index of the missing (NaN) cells of T2D."""
+    return np.flatnonzero(np.isnan(t2d)).astype(np.int64)
+
+
+
+def coverage_key(static_files, shape, product=None):
+    """Creates the key of a coverage index from the static files
+    which define the primary product on the destination grid (geo,
+    height and weight files) and the shape of the grid.  The key
+    changes whenever one of these files changes.  The product is
+    given for the N-way layering, whose products each have their
+    own coverage.
+    """
+    key = hashlib.sha1(("%s" % (tuple(shape),)).encode('utf-8'))
+    if product is not None:
+        key.update(product.encode('utf-8'))
+    for static_file in static_files:
+        if os.path.isfile(static_file):
+            stat = os.stat(static_file)
+            key.update(("%s:%d:%d" % (os.path.abspath(static_file),
+                                      stat.st_size,
+                                      int(stat.st_mtime))).encode('utf-8'))
+    return key.hexdigest()[:16]
+
+
+
+def load_coverage_index(t2d, static_files, cache_dir=None, verify=False,
+                        product=None):
+    """Returns the index of the cells of the destination grid not
+    covered by the primary product, computing it from T2D the first
+    time.
+
+    Args:
+        t2d (ndarray): The primary T2D of the file being layered.
+        static_files (list): The static files which define the
+                             primary product on the destination grid
+                             (see coverage_key).
+        cache_dir (string): The directory of the .npy sidecars, or
+                            None to keep the index in memory only.
+        verify (boolean): True to compare the cached index with the
+                          missing cells of this T2D, logging a
+                          warning when they differ.
+        product (string): For the N-way layering, the product whose
+                          coverage is returned, t2d being its
+                          coverage variable.
+    Returns:
+        index (ndarray): The flat index of the missing cells of this
+                         T2D: the cached index, unless the cells
+                         missing from T2D differ from it.
+
+    """
+    key = coverage_key(static_files, t2d.shape, product)
+    index = _coverage_cache.get(key)
+    sidecar = os.path.join(cache_dir, "coverage-%s.npy" % key) \
+              if cache_dir else None
+
+    if index is None and sidecar and os.path.isfile(sidecar):
+        index = np.load(sidecar, mmap_mode='r')
+        _coverage_cache[key] = index
+    if index is None:
+        logging.info("Computing the coverage of the %s product",
+                     product or "primary")
+        index = missing_index(t2d)
+        _coverage_cache[key] = index
+        save_coverage_index(index, sidecar)
+        return index
+
+    if verify:
+        current = missing_index(t2d)
+        if not np.array_equal(current, index):
+            logging.warning("WARNING: the missing cells of T2D differ from the "
+                            "cached coverage, using those of T2D")
+            return current
+    elif not np.isnan(np.take(t2d, index)).all():
+        # The grid changed without a change to the static files.
+        logging.warning("WARNING: the cached coverage doesn't match T2D, "
+                        "recomputing it")
+        index = missing_index(t2d)
+        _coverage_cache[key] = index
+        save_coverage_index(index, sidecar)
+    elif np.count_nonzero(np.isnan(t2d)) != len(index):
+        # Cells missing from this file only (e.g. an outage) are
+        # filled too, as combine.ncl does, without changing the
+        # cached coverage.
+        logging.info("T2D has missing cells outside the cached coverage, "
+                     "using those of T2D")
+        return missing_index(t2d)
+    return index
+
+
+
+def save_coverage_index(index, sidecar):
+    """Saves a coverage index to its .npy sidecar (if not None).
+    The sidecar is written under a temporary name and renamed, so
+    concurrent processes never read a partial file.
+    """
+    if not sidecar:
+        return
+    WRF_Hydro_util.mkdir_p(os.path.dirname(sidecar))
+    tmp_sidecar = "%s.tmp.%d" % (sidecar, os.getpid())
+    with open(tmp_sidecar, 'wb') as f:
+        np.save(f, index)
+    os.rename(tmp_sidecar, sidecar)
+
+
+
+def layer_fields(primary, secondary, missing=None):
+    """Layers the fields of two products for the same forecast
+    hour, in memory.
+
+    Args:
+        primary (OrderedDict): (field, attributes) tuples keyed by
+                               variable name, of the primary
+                               product (HRRR).
+        secondary (OrderedDict): The same for the secondary product
+                                 (RAP), on the same grid.
+        missing (ndarray): The flat index of the cells to fill from
+                           the secondary product, by default the
+                           cells where the primary T2D is missing.
+    Returns:
+        layered (OrderedDict): (field, attributes) tuples keyed by
+                               variable name, in the order of
+                               LAYERED_VARIABLES.  The fields of the
+                               primary product are modified in place.
+
+    """
+    if missing is None:
+        missing = missing_index(primary['T2D'][0])
+    logging.debug("Filling %d cells from the secondary product", len(missing))
+
+    layered = OrderedDict()
+    for name in LAYERED_VARIABLES:
+        if name in SECONDARY_ONLY_VARIABLES:
+            layered[name] = secondary[name]
+            continue
+        (field, attributes) = primary[name]
+        np.put(field, missing, np.take(secondary[name][0], missing))
+        layered[name] = (field, attributes)
+    return layered
+
+
+
+def layer_files_tiled(primary_file, secondary_file, out_file,
+                      output_options=None, tile_rows=0):
+    """Layers a pair of downscaled files by blocks of tile_rows rows,
+    each block of both files being read into preallocated buffers,
+    layered and written before the next one is read.  The cells
+    filled from the secondary product are those where the primary
+    T2D of each block is missing, as with verify_coverage: the
+    coverage index isn't used.  The arguments are those of
+    layer_files.
+    """
+    primary_variables = [name for name in LAYERED_VARIABLES
+                         if name not in SECONDARY_ONLY_VARIABLES]
+    with Dataset(primary_file, 'r') as primary, \
+         Dataset(secondary_file, 'r') as secondary:
+        for name in LAYERED_VARIABLES:
+            if name not in secondary.variables or \
+               (name not in SECONDARY_ONLY_VARIABLES and
+                name not in primary.variables):
+                raise ValueError("%s is missing from %s or %s" %
+                                 (name, primary_file, secondary_file))
+        shape = primary.variables['T2D'].shape[-2:]
+        variables = OrderedDict(
+            (name, WRF_Hydro_netcdf.variable_attributes(
+                (secondary if name in SECONDARY_ONLY_VARIABLES
+                 else primary).variables[name]))
+            for name in LAYERED_VARIABLES)
+        buffers = dict((name, np.empty((tile_rows, shape[1]), dtype=np.float32))
+                       for name in LAYERED_VARIABLES + ('secondary',))
+
+        def blocks():
+            for (start, stop) in WRF_Hydro_netcdf.row_blocks(shape[0],
+                                                             tile_rows):
+                block = WRF_Hydro_netcdf.slice_rows(buffers, 0, stop - start)
+                for name in SECONDARY_ONLY_VARIABLES:
+                    WRF_Hydro_netcdf.read_rows(secondary, name, start, stop,
+                                               block[name])
+                for name in primary_variables:
+                    WRF_Hydro_netcdf.read_rows(primary, name, start, stop,
+                                               block[name])
+                missing = missing_index(block['T2D'])
+                if len(missing) > 0:
+                    for name in primary_variables:
+                        WRF_Hydro_netcdf.read_rows(secondary, name, start, stop,
+                                                   block['secondary'])
+                        np.put(block[name], missing,
+                               np.take(block['secondary'], missing))
+                yield (start, stop, block)
+
+        WRF_Hydro_netcdf.write_tiled(out_file, shape, variables, blocks(),
+                                     tile_rows, output_options)
+
+
+
+def layer_files(primary_file, secondary_file, out_file, static_files,
+                cache_dir=None, verify=False, output_options=None,
+                tile_rows=0):
+    """Layers a pair of downscaled files (see layer_fields) and
+    writes the layered file.
+
+    Args:
+        primary_file (string): The full path of the primary file.
+        secondary_file (string): The full path of the secondary file.
+        out_file (string): The full path of the layered file.
+        static_files (list): The static files which define the
+                             primary product on the destination grid.
+        cache_dir (string): The coverage cache directory, or None.
+        verify (boolean): True to check the cached coverage against
+                          each file (see load_coverage_index).
+        output_options (dict): The format and compression of the
+                               layered file, see WRF_Hydro_netcdf.
+        tile_rows (int): If not 0, the files are layered by blocks of
+                         this many rows (see layer_files_tiled).
+    Returns:
+        None
+
+    """
+    if tile_rows > 0:
+        layer_files_tiled(primary_file, secondary_file, out_file,
+                          output_options, tile_rows)
+        return
+
+    primary_variables = [name for name in LAYERED_VARIABLES
+                         if name not in SECONDARY_ONLY_VARIABLES]
+    primary = WRF_Hydro_netcdf.read_fields(primary_file, primary_variables)
+    secondary = WRF_Hydro_netcdf.read_fields(secondary_file, LAYERED_VARIABLES)
+    for name in LAYERED_VARIABLES:
+        if name not in secondary or \
+           (name not in SECONDARY_ONLY_VARIABLES and name not in primary):
+            raise ValueError("%s is missing from %s or %s" %
+                             (name, primary_file, secondary_file))
+
+    missing = load_coverage_index(primary['T2D'][0], static_files, cache_dir,
+                                  verify)
+    WRF_Hydro_netcdf.write_fields(out_file,
+                                  layer_fields(primary, secondary, missing),
+                                  output_options)
+
+
+
+def default_stacks(primary, secondary):
+    """Returns the product stacks (see layer_stack_fields) of the
+    two-way layering: every variable from the primary product, then
+    the secondary one, except LWDOWN, taken from the secondary
+    product only.
+    """
+    return OrderedDict((name, [secondary] if name in SECONDARY_ONLY_VARIABLES
+                              else [primary, secondary])
+                       for name in LAYERED_VARIABLES)
+
+
+
+def product_variable(product, name):
+    """Returns the name of a layered variable in the files of a
+    product.
+    """
+    return PRODUCT_VARIABLES.get(product, {}).get(name, name)
+
+
+
+def coverage_variable(product):
+    """Returns the layered variable which defines the coverage of a
+    product.
+    """
+    return COVERAGE_VARIABLES.get(product, 'T2D')
+
+
+
+def stack_variables(stacks):
+    """Returns the layered variables to read from each product of
+    the stacks: those of the stacks it is in and, if it isn't the
+    last product of one of them, its coverage variable.
+
+    Returns:
+        variables (OrderedDict): The lists of the variable names,
+                                 keyed by product.
+
+    """
+    variables = OrderedDict()
+    for name, stack in stacks.items():
+        for position, product in enumerate(stack):
+            names = variables.setdefault(product, [])
+            if name not in names:
+                names.append(name)
+            if position < len(stack) - 1 and \
+               coverage_variable(product) not in names:
+                names.append(coverage_variable(product))
+    return variables
+
+
+
+def available_stacks(stacks, products):
+    """Removes the products which aren't available from the stacks.
+
+    Raises:
+        ValueError: If none of the products of a stack is available.
+
+    """
+    available = OrderedDict()
+    for name, stack in stacks.items():
+        available[name] = [product for product in stack if product in products]
+        if not available[name]:
+            raise ValueError("none of the products of %s (%s) is available" %
+                             (name, " > ".join(stack)))
+    return available
+
+
+
+def stack_sources(stack, missing, size):
+    """Returns, for each cell of the grid, the position in a stack of
+    the product the cell is taken from: the first product of the
+    stack which covers it, else the last one.
+
+    Args:
+        stack (list): The products, by decreasing priority.
+        missing (dict): The flat index of the cells not covered by
+                        each product (see missing_index), keyed by
+                        product; only those of the products above the
+                        last one are used.
+        size (int): The number of cells of the grid.
+    Returns:
+        sources (ndarray): The int8 positions of the cells, flat.
+
+    """
+    sources = np.empty(size, dtype=np.int8)
+    sources.fill(len(stack) - 1)
+    for position in range(len(stack) - 2, -1, -1):
+        covered = np.ones(size, dtype=bool)
+        covered[missing[stack[position]]] = False
+        sources[covered] = position
+    return sources
+
+
+
+def load_stack_sources(stack, missing, size):
+    """Returns the stack_sources of a stack, computing them only
+    when the coverage of one of its products isn't the one they were
+    computed from (the coverage indexes of load_coverage_index are
+    the same arrays from one file to the next).
+    """
+    key = (tuple(stack), size)
+    indexes = [missing[product] for product in stack[:-1]]
+    cached = _sources_cache.get(key)
+    if cached is not None and len(cached[0]) == len(indexes) and \
+       all(a is b for (a, b) in zip(cached[0], indexes)):
+        return cached[1]
+    sources = stack_sources(stack, missing, size)
+    _sources_cache[key] = (indexes, sources)
+    return sources
+
+
+
+def layer_stack_fields(fields, stacks, missing=None):
+    """Layers the fields of several products for the same forecast
+    hour, in memory, each variable from its own stack of products
+    (N-way layering).  Each variable is filled in a single pass over
+    the fields of its stack.
+
+    Args:
+        fields (dict): The fields of each product, keyed by product:
+                       (field, attributes) tuples keyed by (layered)
+                       variable name, on the same grid.
+        stacks (OrderedDict): The products of each variable, by
+                              decreasing priority, keyed by variable
+                              name in the order the variables are
+                              written.
+        missing (dict): The flat index of the cells not covered by
+                        each product, by default the cells where its
+                        coverage variable is missing.
+    Returns:
+        layered (OrderedDict): (field, attributes) tuples keyed by
+                               variable name, in the order of stacks,
+                               the attributes being those of the
+                               first product of each stack.
+
+    """
+    if missing is None:
+        missing = dict((product, missing_index(
+                            product_fields[coverage_variable(product)][0]))
+                       for product, product_fields in fields.items()
+                       if coverage_variable(product) in product_fields)
+
+    layered = OrderedDict()
+    for name, stack in stacks.items():
+        (field, attributes) = fields[stack[0]][name]
+        if len(stack) > 1:
+            sources = load_stack_sources(stack, missing, field.size)
+            field = np.choose(sources.reshape(field.shape),
+                              [fields[product][name][0] for product in stack])
+        layered[name] = (field, attributes)
+    return layered
+
+
+
+def layer_stack_files_tiled(product_files, out_file, stacks,
+                            output_options=None, tile_rows=0):
+    """Layers the files of several products (see layer_stack_files)
+    by blocks of tile_rows rows, the coverage of each product being
+    that of each block, as in layer_files_tiled.  The arguments are
+    those of layer_stack_files, with only the available products.
+    """
+    variables = stack_variables(stacks)
+    datasets = OrderedDict()
+    try:
+        for product, names in variables.items():
+            datasets[product] = Dataset(product_files[product], 'r')
+            for name in names:
+                if product_variable(product, name) not in \
+                   datasets[product].variables:
+                    raise ValueError("%s is missing from %s" %
+                                     (product_variable(product, name),
+                                      product_files[product]))
+        attributes = OrderedDict(
+            (name, WRF_Hydro_netcdf.variable_attributes(
+                datasets[stack[0]].variables[product_variable(stack[0], name)]))
+            for name, stack in stacks.items())
+        (name, stack) = next(iter(stacks.items()))
+        shape = datasets[stack[0]].variables[
+            product_variable(stack[0], name)].shape[-2:]
+        buffers = OrderedDict(
+            ((product, name), np.empty((tile_rows, shape[1]), dtype=np.float32))
+            for product, names in variables.items() for name in names)
+
+        def blocks():
+            for (start, stop) in WRF_Hydro_netcdf.row_blocks(shape[0],
+                                                             tile_rows):
+                block = dict((product, {}) for product in variables)
+                for (product, name), buffer in buffers.items():
+                    rows = buffer[:stop - start]
+                    WRF_Hydro_netcdf.read_rows(datasets[product],
+                                               product_variable(product, name),
+                                               start, stop, rows)
+                    block[product][name] = (rows, None)
+                layered = layer_stack_fields(block, stacks)
+                yield (start, stop, dict((name, field) for name, (field, unused)
+                                         in layered.items()))
+
+        WRF_Hydro_netcdf.write_tiled(out_file, shape, attributes, blocks(),
+                                     tile_rows, output_options)
+    finally:
+        for nc in datasets.values():
+            nc.close()
+
+
+
+def layer_stack_files(product_files, out_file, stacks, optional_products,
+                      static_files, cache_dir=None, verify=False,
+                      output_options=None, tile_rows=0):
+    """Layers the files of several products for the same forecast
+    hour (see layer_stack_fields) and writes the layered file.
+
+    Args:
+        product_files (OrderedDict): The full path of the file of
+                                     each product, keyed by product.
+        out_file (string): The full path of the layered file.
+        stacks (OrderedDict): The products of each variable, by
+                              decreasing priority.
+        optional_products (list): The products layered only if their
+                                  file exists; they are removed from
+                                  the stacks otherwise.
+        static_files (dict): The static files which define each
+                             product on the destination grid, keyed
+                             by product (see coverage_key).
+        cache_dir (string): The coverage cache directory, or None.
+        verify (boolean): True to check the cached coverage against
+                          each file (see load_coverage_index).
+        output_options (dict): The format and compression of the
+                               layered file, see WRF_Hydro_netcdf.
+        tile_rows (int): If not 0, the files are layered by blocks of
+                         this many rows (see layer_stack_files_tiled).
+    Returns:
+        None
+
+    """
+    available = OrderedDict()
+    for product, filename in product_files.items():
+        if product in optional_products and not os.path.isfile(filename):
+            logging.info("%s is layered without %s, %s doesn't exist",
+                         out_file, product, filename)
+            continue
+        available[product] = filename
+    stacks = available_stacks(stacks, available)
+    if tile_rows > 0:
+        layer_stack_files_tiled(available, out_file, stacks, output_options,
+                                tile_rows)
+        return
+
+    fields = {}
+    for product, names in stack_variables(stacks).items():
+        product_fields = WRF_Hydro_netcdf.read_fields(
+            available[product], [product_variable(product, name)
+                                 for name in names])
+        fields[product] = {}
+        for name in names:
+            if product_variable(product, name) not in product_fields:
+                raise ValueError("%s is missing from %s" %
+                                 (product_variable(product, name),
+                                  available[product]))
+            fields[product][name] = product_fields[product_variable(product,
+                                                                    name)]
+
+    missing = {}
+    for name, stack in stacks.items():
+        for product in stack[:-1]:
+            if product not in missing:
+                missing[product] = load_coverage_index(
+                    fields[product][coverage_variable(product)][0],
+                    static_files.get(product, []), cache_dir, verify, product)
+    WRF_Hydro_netcdf.write_fields(out_file,
+                                  layer_stack_fields(fields, stacks, missing),
+                                  output_options)
@@ -0,0 +1,238 @@
+import os
+import errno
+import hashlib
+import logging
+import socket
+import threading
+import time
+import WRF_Hydro_util
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_lease.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Coordination of several hosts (nodes) processing the same cycle,
+#  through a shared file system only, without any broker.  Every
+#  node builds the same task graph (WRF_Hydro_scheduler) and, before
+#  running a task, claims it by creating its lease file in the run
+#  directory, <lease_dir>/<run_id>, with O_CREAT | O_EXCL so that
+#  only one node succeeds.  Once the task is done the node writes a
+#  .done (or .failed) marker and removes the lease; the other nodes
+#  wait for the marker before running the tasks which depend on it.
+#  A node refreshes the modification time of its leases every
+#  heartbeat_interval seconds.  A lease which hasn't been refreshed
+#  for lease_timeout seconds (its node died or hung) is stale and is
+#  taken over by the next node claiming the task.  The ages of the
+#  leases are measured against the file system's clock (the
+#  modification time of a file each node touches), not the hosts'.
+#  The options are in the [distributed] section of the
+#  wrf_hydro_forcing.parm file.
+#
+#  All the nodes of a run must use the same run_id (e.g. the cycle
+#  date and hour).  Restarting a run with the same run_id resumes it:
+#  the tasks with a .done marker aren't run again.
+
+
+# The states of a task returned by LeaseCoordinator.claim.
+CLAIMED = 'claimed'
+BUSY = 'busy'
+DONE = 'done'
+FAILED = 'failed'
+
+
+
+def node_name():
+    """Returns the name of this node: host name and process id."""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+
+def lease_owner(lease):
+    """Returns the name of the node which holds a lease, None if the
+    lease doesn't exist.
+    """
+    try:
+        with open(lease) as f:
+            return f.read().split(" ")[0]
+    except (IOError, OSError):
+        return None
+
+
+
+class LeaseCoordinator(object):
+    """Claims the tasks of a run for this node.
+
+    Args:
+        lease_dir (string):  The directory of the runs, on the file
+                             system shared by the nodes.
+        run_id (string):  The run shared by the nodes.
+        heartbeat_interval (float):  How often (in seconds) the
+                                     leases are refreshed.
+        lease_timeout (float):  The age (in seconds) after which a
+                                lease is stale.
+
+    """
+
+    def __init__(self, lease_dir, run_id, heartbeat_interval=30.,
+                 lease_timeout=180.):
+        self.run_dir = os.path.join(lease_dir, run_id)
+        WRF_Hydro_util.mkdir_p(self.run_dir)
+        self.node = node_name()
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_timeout = lease_timeout
+        self.clock_file = os.path.join(self.run_dir, ".clock-%s" %
+                                       self.node.replace(":", "-"))
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def task_path(self, task_name):
+        """Returns the path, without extension, of the files of a
+        task in the run directory.
+        """
+        key = hashlib.sha1(task_name.encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self.run_dir, key)
+
+    def now(self):
+        """Returns the current time of the shared file system."""
+        with open(self.clock_file, 'a'):
+            pass
+        os.utime(self.clock_file, None)
+        return os.stat(self.clock_file).st_mtime
+
+    def claim(self, task_name):
+        """Claims a task for this node.
+
+        Args:
+            task_name (string):  The name of the task, its output
+                                 file.
+        Returns:
+            state (string):  CLAIMED if this node must run the task,
+                             DONE or FAILED if it was already run,
+                             BUSY if another node is running it.
+
+        """
+        path = self.task_path(task_name)
+        state = self.marker(path)
+        if state is not None:
+            return state
+
+        lease = path + ".lease"
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            if not self.take_over(lease):
+                return BUSY
+            return self.claim(task_name)
+        with os.fdopen(fd, 'w') as f:
+            f.write("%s %s %s\n" % (self.node, time.time(), task_name))
+
+        # The task may have been completed (and its lease removed)
+        # between the check of its marker and the creation of the
+        # lease.
+        state = self.marker(path)
+        if state is not None:
+            os.remove(lease)
+            return state
+        with self.lock:
+            self.held.add(lease)
+        return CLAIMED
+
+    def marker(self, path):
+        if os.path.exists(path + ".done"):
+            return DONE
+        if os.path.exists(path + ".failed"):
+            return FAILED
+        return None
+
+    def take_over(self, lease):
+        """Removes a stale lease.  The lease is first renamed, which
+        only one of the nodes trying to take it over can do, then
+        checked again: another node may have taken it over and a
+        third one created a fresh lease between the check of its age
+        and the rename, in which case the fresh lease is put back.
+
+        Returns:
+            taken (boolean):  True if the lease was stale and removed.
+
+        """
+        try:
+            stat = os.stat(lease)
+        except OSError:
+            # Released in the meantime.
+            return True
+        age = self.now() - stat.st_mtime
+        if age < self.lease_timeout:
+            return False
+
+        stale_lease = "%s.stale-%s" % (lease, self.node.replace(":", "-"))
+        try:
+            os.rename(lease, stale_lease)
+        except OSError:
+            return True
+        renamed = os.stat(stale_lease)
+        if (renamed.st_ino, renamed.st_mtime) != (stat.st_ino, stat.st_mtime) \
+           and self.now() - renamed.st_mtime < self.lease_timeout:
+            # Not the lease found stale: put it back, unless yet
+            # another lease was created in the meantime.
+            try:
+                os.link(stale_lease, lease)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+                logging.warning("WARNING: the lease of %s was replaced while "
+                                "being put back", lease)
+            os.remove(stale_lease)
+            return False
+        logging.warning("WARNING: taking over the lease of %s from %s, "
+                        "not refreshed for %.0f s", lease,
+                        lease_owner(stale_lease), age)
+        os.remove(stale_lease)
+        return True
+
+    def release(self, task_name, succeeded):
+        """Marks a claimed task as done (or failed) and removes its
+        lease, unless it was taken over by another node.
+        """
+        path = self.task_path(task_name)
+        marker = path + (".done" if succeeded else ".failed")
+        tmp_marker = "%s.tmp-%s" % (marker, self.node.replace(":", "-"))
+        with open(tmp_marker, 'w') as f:
+            f.write("%s %s %s\n" % (self.node, time.time(), task_name))
+        os.rename(tmp_marker, marker)
+
+        lease = path + ".lease"
+        with self.lock:
+            self.held.discard(lease)
+        if lease_owner(lease) != self.node:
+            logging.warning("WARNING: the lease of %s was taken over", task_name)
+            return
+        try:
+            os.remove(lease)
+        except OSError:
+            logging.warning("WARNING: the lease of %s was taken over", task_name)
+
+    def heartbeat(self):
+        """Refreshes the leases held by this node until close."""
+        while not self.stopped.wait(self.heartbeat_interval):
+            with self.lock:
+                leases = list(self.held)
+            for lease in leases:
+                try:
+                    os.utime(lease, None)
+                except OSError:
+                    logging.warning("WARNING: the lease %s was lost", lease)
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat_thread.join()
+        if os.path.exists(self.clock_file):
+            os.remove(self.clock_file)
@@ -0,0 +1,239 @@
+import os
+import hashlib
+import json
+import sqlite3
+import time
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_manifest.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Manifest of the files processed by the WRF-Hydro forcing engine,
+#  so that a re-run of a cycle (e.g. after a partial failure) only
+#  processes new or changed input files.  The manifest is a SQLite
+#  database, defined by manifest_file in the [manifest] section of
+#  the wrf_hydro_forcing.parm file, which records for each output
+#  file the stage that produced it (regridding, downscaling, etc.),
+#  the version of that stage and the size, modification time and
+#  checksum of each of its input files (data, weights, static files
+#  and scripts).  An output file is up to date if it exists and
+#  neither its inputs nor the stage version have changed; an input
+#  whose modification time changed but whose checksum did not (e.g.
+#  a file copied again) doesn't cause the output to be recreated.
+#  The manifest is only accessed by the main process, never by the
+#  workers running the jobs.
+#
+#  The manifest also records the jobs quarantined after failing all
+#  their retries (see WRF_Hydro_failures), with their inputs: such a
+#  job isn't run again until one of its inputs or the stage version
+#  changes, the quarantine expires, or the job is forced.
+
+
+# Version of each processing stage.  Increase a stage's version when
+# a change to the code alters its output, so that the files created
+# by the previous version are processed again.
+STAGE_VERSIONS = {
+    'regridding': 2,
+    'downscaling': 1,
+    'shortwave': 1,
+    'layering': 1,
+    'pipeline': 1,
+    }
+
+# Seconds to wait for another process (e.g. another forcing
+# configuration) to release the database.
+LOCK_TIMEOUT = 60.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    stage TEXT NOT NULL,
+    output_file TEXT NOT NULL,
+    stage_version TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    processed_at REAL NOT NULL,
+    PRIMARY KEY (stage, output_file));
+CREATE TABLE IF NOT EXISTS quarantine (
+    stage TEXT NOT NULL,
+    output_file TEXT NOT NULL,
+    stage_version TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    error TEXT NOT NULL,
+    quarantined_at REAL NOT NULL,
+    PRIMARY KEY (stage, output_file));
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    checksum TEXT NOT NULL);
+"""
+
+
+
+def stage_version(stage, engine):
+    """Creates the version string of a stage run by an engine,
+    e.g. NCL-1.
+    """
+    return "%s-%d" % (engine, STAGE_VERSIONS[stage])
+
+
+
+def file_checksum(filename):
+    """Computes the SHA-1 checksum of a file's content.
+
+    Args:
+        filename (string): The full path to the file.
+    Returns:
+        checksum (string): The hex digest.
+
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+
+class Manifest(object):
+    """The processed-file manifest, a SQLite database.
+
+    Args:
+        db_file (string): The full path to the database, which is
+                          created if it doesn't exist.
+        force (boolean): True to consider every output out of date,
+                         for a full rebuild.  The outputs are still
+                         recorded.
+
+    """
+
+    def __init__(self, db_file, force=False):
+        db_dir = os.path.dirname(db_file)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db_file = db_file
+        self.force = force
+        self.connection = sqlite3.connect(db_file, timeout=LOCK_TIMEOUT)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def fingerprint(self, filename):
+        """Returns the [path, size, mtime, checksum] of an input
+        file.  The checksum of a file whose size and modification
+        time haven't changed is taken from the database instead of
+        reading the file again.
+        """
+        stat = os.stat(filename)
+        row = self.connection.execute(
+            "SELECT checksum FROM checksums WHERE path=? AND size=? AND mtime=?",
+            (filename, stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            return [filename, stat.st_size, stat.st_mtime, row[0]]
+
+        checksum = file_checksum(filename)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)",
+                (filename, stat.st_size, stat.st_mtime, checksum))
+        return [filename, stat.st_size, stat.st_mtime, checksum]
+
+    def is_current(self, stage, output_file, input_files, version):
+        """Determines if an output file is up to date.
+
+        Args:
+            stage (string): The processing stage, a key of
+                            STAGE_VERSIONS.
+            output_file (string): The full path of the output file.
+            input_files (list): The full paths of the files the
+                                output is created from.  Files which
+                                don't exist are ignored.
+            version (string): The version of the stage, see
+                              stage_version.
+        Returns:
+            current (boolean): True if the output file exists and was
+                               recorded with the same stage version
+                               and unchanged inputs.
+
+        """
+        if self.force or not os.path.isfile(output_file):
+            return False
+        row = self.connection.execute(
+            "SELECT stage_version, inputs FROM outputs "
+            "WHERE stage=? AND output_file=?", (stage, output_file)).fetchone()
+        if row is None or row[0] != version:
+            return False
+
+        return self.inputs_unchanged(json.loads(row[1]), input_files)
+
+    def inputs_unchanged(self, recorded, input_files):
+        """Determines if the input files of an output are those
+        recorded (see fingerprint), unchanged.
+        """
+        input_files = [f for f in input_files if os.path.isfile(f)]
+        if [entry[0] for entry in recorded] != input_files:
+            return False
+        for (filename, size, mtime, checksum) in recorded:
+            stat = os.stat(filename)
+            if stat.st_size != size:
+                return False
+            if stat.st_mtime != mtime and \
+               self.fingerprint(filename)[3] != checksum:
+                return False
+        return True
+
+    def record(self, stage, output_file, input_files, version):
+        """Records that an output file was successfully created,
+        lifting its quarantine if any.  The arguments are those of
+        is_current.
+        """
+        inputs = [self.fingerprint(f) for f in input_files if os.path.isfile(f)]
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)",
+                (stage, output_file, version, json.dumps(inputs), time.time()))
+            self.connection.execute(
+                "DELETE FROM quarantine WHERE stage=? AND output_file=?",
+                (stage, output_file))
+
+    def quarantine(self, stage, output_file, input_files, version, error):
+        """Quarantines a job which failed all its retries, with its
+        current inputs.  The arguments are those of is_current, and
+        the error of the last attempt.
+        """
+        inputs = [self.fingerprint(f) for f in input_files if os.path.isfile(f)]
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?, ?, ?)",
+                (stage, output_file, version, json.dumps(inputs), error,
+                 time.time()))
+
+    def is_quarantined(self, stage, output_file, input_files, version,
+                       max_age):
+        """Determines if a job is quarantined.
+
+        Args:
+            stage, output_file, input_files, version: See is_current.
+            max_age (float): The duration (in seconds) of a
+                             quarantine.
+        Returns:
+            error (string): The error which caused the quarantine if
+                            the job was quarantined less than max_age
+                            seconds ago with the same stage version
+                            and inputs, otherwise None.
+
+        """
+        if self.force:
+            return None
+        row = self.connection.execute(
+            "SELECT stage_version, inputs, error, quarantined_at "
+            "FROM quarantine WHERE stage=? AND output_file=?",
+            (stage, output_file)).fetchone()
+        if row is None or row[0] != version or \
+           time.time() - row[3] > max_age or \
+           not self.inputs_unchanged(json.loads(row[1]), input_files):
+            return None
+        return row[2]
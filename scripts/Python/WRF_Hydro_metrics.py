@@ -0,0 +1,260 @@
+import os
+import csv
+import errno
+import json
+import logging
+import resource
+import sys
+import time
+import numpy as np
+from collections import OrderedDict
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_metrics.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Per-job performance instrumentation of the forcing engine.  For
+#  every job (see WRF_Hydro_forcing.run_job) the wall clock time,
+#  the CPU time (user + system) of the job's processes, their peak
+#  resident set size, the bytes they read from and wrote to the
+#  storage, the sizes of the job's input and output files, the bytes
+#  of its input files read ahead of it and the time it waited for
+#  its output files to be written behind (see WRF_Hydro_io) are
+#  recorded.  The resource usage of the commands (NCL) is that of
+#  their processes, as returned by wait4 (see WRF_Hydro_execution);
+#  the usage of the jobs run in-process by Python functions is the
+#  difference of the worker process' getrusage, and of that of the
+#  commands they run, before and after the job (its peak resident
+#  set size is that of the worker process so far).  The jobs'
+#  metrics are summarized per product and activity (count, mean,
+#  min, max, 50th, 90th and 99th percentiles) in the log file and
+#  appended, as CSV (one row per job) and JSON lines (one summary
+#  per run), to files next to the log file, for capacity planning
+#  and regression tracking.
+
+
+# The metrics of a job, in the order of the CSV columns.
+METRIC_FIELDS = ('wall_time', 'cpu_time', 'max_rss', 'read_bytes',
+                 'write_bytes', 'input_bytes', 'output_bytes',
+                 'prefetched_bytes', 'write_wait')
+
+# The percentiles of the summaries.
+PERCENTILES = (50, 90, 99)
+
+# The columns of the CSV file.
+CSV_FIELDS = ('run_start', 'product', 'activity', 'output_file',
+              'return_value') + METRIC_FIELDS
+
+# ru_maxrss is in kilobytes on Linux, in bytes on Mac OS X.
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# ru_inblock and ru_oublock count 512-byte blocks.
+_BLOCK_SIZE = 512
+
+
+
+def file_size(path):
+    """Returns the size in bytes of a file, 0 if it doesn't exist."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+
+class JobUsage(object):
+    """Accumulates the resource usage of the commands of a job."""
+
+    def __init__(self):
+        self.cpu_time = 0.
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.write_wait = 0.
+
+    def add(self, usage, before=None):
+        """Adds a resource usage (as returned by wait4 or getrusage),
+        or its difference with a previous one.
+        """
+        if before is None:
+            before = resource.struct_rusage((0,) * 16)
+        self.cpu_time += (usage.ru_utime - before.ru_utime) + \
+                         (usage.ru_stime - before.ru_stime)
+        self.max_rss = max(self.max_rss, usage.ru_maxrss * _MAXRSS_UNIT)
+        self.read_bytes += (usage.ru_inblock - before.ru_inblock) * _BLOCK_SIZE
+        self.write_bytes += (usage.ru_oublock - before.ru_oublock) * _BLOCK_SIZE
+
+    def call(self, function, args):
+        """Calls a function in this process and adds the difference
+        of the resource usage of the process and of the commands it
+        ran.
+        """
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            return function(*args)
+        finally:
+            self.add(resource.getrusage(resource.RUSAGE_SELF), before)
+            self.add(resource.getrusage(resource.RUSAGE_CHILDREN),
+                     before_children)
+
+    def metrics(self, wall_time, output_file=None):
+        """Returns the metrics of the job (see METRIC_FIELDS), the
+        input_bytes and prefetched_bytes being set by the caller,
+        which knows the job's input files.
+        """
+        return {'wall_time': wall_time,
+                'cpu_time': self.cpu_time,
+                'max_rss': self.max_rss,
+                'read_bytes': self.read_bytes,
+                'write_bytes': self.write_bytes,
+                'input_bytes': 0,
+                'output_bytes': file_size(output_file) if output_file else 0,
+                'prefetched_bytes': 0,
+                'write_wait': self.write_wait}
+
+
+
+def wait4(pid):
+    """Waits for a child process, retrying if interrupted by a
+    signal.
+
+    Returns:
+        (status, usage) (tuple):  The wait status and the resource
+                                  usage of the process.
+
+    """
+    while True:
+        try:
+            (pid, status, usage) = os.wait4(pid, 0)
+            return (status, usage)
+        except OSError as exc:
+            if exc.errno != errno.EINTR:
+                raise
+
+
+
+def empty_metrics(wall_time=0.):
+    """Returns the metrics of a job which was not run, or whose usage
+    is unknown.
+    """
+    return JobUsage().metrics(wall_time)
+
+
+
+def summarize(values):
+    """Summarizes the values of a metric.
+
+    Returns:
+        summary (OrderedDict):  The count, mean, min, max and
+                                percentiles (p50, p90, p99) of the
+                                values, or the count only if there
+                                are none.
+
+    """
+    summary = OrderedDict([('count', len(values))])
+    if len(values) > 0:
+        array = np.array(values, dtype=np.float64)
+        summary['mean'] = float(np.mean(array))
+        summary['min'] = float(np.min(array))
+        summary['max'] = float(np.max(array))
+        for (percentile, value) in zip(PERCENTILES,
+                                       np.percentile(array, PERCENTILES)):
+            summary['p%d' % percentile] = float(value)
+    return summary
+
+
+
+def summarize_jobs(job_metrics):
+    """Summarizes each metric of the jobs of each product and
+    activity.
+
+    Args:
+        job_metrics (OrderedDict):  The lists of the metrics of the
+                                    jobs, keyed by (product, activity).
+    Returns:
+        summaries (OrderedDict):  The summaries (see summarize) of
+                                  each metric, keyed by (product,
+                                  activity) and metric.
+
+    """
+    summaries = OrderedDict()
+    for label, jobs in job_metrics.items():
+        summaries[label] = OrderedDict(
+            (field, summarize([job[field] for job in jobs]))
+            for field in METRIC_FIELDS)
+    return summaries
+
+
+
+def log_file_prefix():
+    """Returns the path, without extension, of the log file of the
+    root logger, or of a file named after the running script in the
+    current directory if the log is not written to a file.
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return os.path.splitext(handler.baseFilename)[0]
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] or "wrf_hydro"
+
+
+
+def write_metrics(job_metrics, prefix=None, run_start=None):
+    """Appends the metrics of a run to <prefix>_metrics.csv, one row
+    per job, and its summaries to <prefix>_metrics.jsonl, one JSON
+    object per run.
+
+    Args:
+        job_metrics (OrderedDict):  The lists of the metrics of the
+                                    jobs (with their output_file and
+                                    return_value), keyed by (product,
+                                    activity).
+        prefix (string):  The path of the files, without the
+                          _metrics suffix, by default that of the log
+                          file.
+        run_start (float):  The start time of the run, by default
+                            now.
+    Returns:
+        (csv_file, json_file) (tuple):  The paths of the files.
+
+    """
+    if prefix is None:
+        prefix = log_file_prefix()
+    if run_start is None:
+        run_start = time.time()
+    run_start = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(run_start))
+    csv_file = prefix + "_metrics.csv"
+    json_file = prefix + "_metrics.jsonl"
+
+    new_csv_file = not os.path.isfile(csv_file)
+    if not new_csv_file:
+        # A file with other columns, written by an earlier version,
+        # is set aside.
+        with open(csv_file) as f:
+            header = next(csv.reader(f), None)
+        if header is not None and tuple(header) != CSV_FIELDS:
+            os.rename(csv_file, csv_file + ".old")
+            new_csv_file = True
+    with open(csv_file, 'a') as f:
+        writer = csv.writer(f)
+        if new_csv_file:
+            writer.writerow(CSV_FIELDS)
+        for (product, activity), jobs in job_metrics.items():
+            for job in jobs:
+                writer.writerow([run_start, product, activity,
+                                 job.get('output_file', ''),
+                                 job.get('return_value', '')] +
+                                [job[field] for field in METRIC_FIELDS])
+
+    summaries = [OrderedDict([('product', product),
+                              ('activity', activity),
+                              ('metrics', summary)])
+                 for (product, activity), summary in
+                 summarize_jobs(job_metrics).items()]
+    with open(json_file, 'a') as f:
+        f.write(json.dumps(OrderedDict([('run_start', run_start),
+                                        ('summaries', summaries)])) + "\n")
+    return (csv_file, json_file)
@@ -0,0 +1,422 @@
+import os
+import numpy as np
+import WRF_Hydro_io
+from collections import OrderedDict
+from netCDF4 import Dataset
+try:
+    from netCDF4 import __has_nc_create_mem__ as _HAS_CREATE_MEM
+except ImportError:
+    _HAS_CREATE_MEM = False
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_netcdf.py
+# -----------------------------------------------------
+
+#  Overview:
+#  NetCDF reading and writing shared by the Python engines
+#  (regridding, downscaling, etc.) of the WRF-Hydro forcing
+#  engine.  Fields are handled as 2D float32 arrays with NaN
+#  for missing values, and written with the NCL default
+#  _FillValue so the files match those created by NCL.
+#
+#  The files are written according to the output options of the
+#  [output] section of the wrf_hydro_forcing.parm file (see
+#  WRF_Hydro_forcing.get_output_options): by default uncompressed
+#  NetCDF3 files as NCL creates them, otherwise NetCDF4 (HDF5) files
+#  whose fields may be compressed with zlib (after the shuffle
+#  filter), chunked, and for the variables where the loss of
+#  precision is acceptable, quantized to a number of significant
+#  digits or packed as 16-bit integers (scale_factor, add_offset).
+#  The files created by the NCL scripts are rewritten with the same
+#  options by repack_file.
+#
+#  With tile_rows set in the [parallel] section, the engines read,
+#  process and write the fields by blocks of rows (see row_blocks,
+#  read_rows and write_tiled) instead of whole, so that the memory
+#  they need depends on the width of the grid and not on its size.
+#  The NetCDF4 fields written by blocks are chunked one block per
+#  chunk by default, and can't be packed as 16-bit integers, whose
+#  scale depends on the whole field.
+#
+#  With write_behind_mb set in the [io] section, the files written
+#  whole are created in memory and written to the disk in the
+#  background (see WRF_Hydro_io), if the netCDF library can create
+#  files in memory.  The files written by blocks of rows are written
+#  directly, so that their memory stays bounded.
+
+
+# Default _FillValue NCL uses for float variables.
+FILL_VALUE = 9.96921e+36
+
+# _FillValue of the variables packed as 16-bit integers, the packed
+# values range from -32767 to 32767.
+INT16_FILL_VALUE = -32768
+INT16_MAX = 32767
+
+# The output options when there is no [output] section: the format
+# and options of the files created by NCL.
+DEFAULT_OUTPUT_OPTIONS = {
+    'format': 'NETCDF3_64BIT',
+    'complevel': 0,
+    'shuffle': True,
+    'chunk_shape': None,
+    'least_significant_digit': {},
+    'pack_int16': (),
+    }
+
+# Attributes which are handled by the netCDF library and
+# must not be copied from one file to another.
+_RESERVED_ATTRIBUTES = ('_FillValue', 'missing_value', 'scale_factor',
+                        'add_offset')
+
+
+
+def read_field(nc, name):
+    """Reads a variable from an open NetCDF file as a float32
+    array, with NaN for the missing values.  Leading dimensions
+    of size 1 (e.g. Time) are removed.
+
+    Args:
+        nc (netCDF4.Dataset): The open NetCDF file.
+        name (string): The variable name.
+    Returns:
+        field (ndarray): The float32 values.
+
+    """
+    values = nc.variables[name][:]
+    field = np.ma.filled(np.ma.asarray(values, dtype=np.float32), np.nan)
+    while field.ndim > 2 and field.shape[0] == 1:
+        field = field[0]
+    return field
+
+
+
+def variable_attributes(var):
+    """Returns the attributes of a variable, except those handled by
+    the netCDF library (_FillValue, scale_factor, etc.).
+    """
+    return OrderedDict((attribute, var.getncattr(attribute))
+                       for attribute in var.ncattrs()
+                       if attribute not in _RESERVED_ATTRIBUTES)
+
+
+
+def read_fields(filename, names):
+    """Reads variables and their attributes from a NetCDF file.
+
+    Args:
+        filename (string): The full path to the NetCDF file.
+        names (list): The names of the variables to read.
+    Returns:
+        fields (OrderedDict): (field, attributes) tuples keyed by
+                              variable name, for the variables
+                              present in the file.
+
+    """
+    fields = OrderedDict()
+    WRF_Hydro_io.wait_for(filename)
+    with Dataset(filename, 'r') as nc:
+        for name in names:
+            if name not in nc.variables:
+                continue
+            fields[name] = (read_field(nc, name),
+                            variable_attributes(nc.variables[name]))
+    return fields
+
+
+
+def output_options(options=None):
+    """Returns the output options, completed with the defaults."""
+    completed = dict(DEFAULT_OUTPUT_OPTIONS)
+    completed.update(options or {})
+    return completed
+
+
+
+def options_version(options=None):
+    """Returns a string identifying the output options, to be added
+    to the version of a stage (see WRF_Hydro_manifest) so that its
+    files are created again when the options change, or an empty
+    string for the default options.
+    """
+    options = output_options(options)
+    if options == DEFAULT_OUTPUT_OPTIONS:
+        return ""
+    version = options['format']
+    if options['format'].startswith('NETCDF4'):
+        version += "-z%d%s" % (options['complevel'],
+                               "s" if options['shuffle'] else "")
+        if options['chunk_shape']:
+            version += "-c%dx%d" % tuple(options['chunk_shape'])
+    if options['least_significant_digit']:
+        version += "-lsd:" + ",".join(
+            "%s%d" % item
+            for item in sorted(options['least_significant_digit'].items()))
+    if options['pack_int16']:
+        version += "-i16:" + ",".join(sorted(options['pack_int16']))
+    return version
+
+
+
+def int16_packing(field):
+    """Computes the scale_factor and add_offset packing a field as
+    16-bit integers over its range.
+
+    Returns:
+        (scale_factor, add_offset) (tuple):  float32 values.
+
+    """
+    valid = field[~np.isnan(field)]
+    if valid.size == 0:
+        return (np.float32(1.), np.float32(0.))
+    (low, high) = (float(valid.min()), float(valid.max()))
+    scale_factor = (high - low) / (2. * INT16_MAX) if high > low else 1.
+    return (np.float32(scale_factor), np.float32((high + low) / 2.))
+
+
+
+def create_variable(nc, name, dimensions, field, options=None):
+    """Creates a float variable of an output file according to the
+    output options: its compression and chunking (NetCDF4 only)
+    and its lossy packing, if requested for this variable.
+
+    Args:
+        nc (netCDF4.Dataset): The output file, open for writing.
+        name (string): The variable name.
+        dimensions (tuple): The names of the variable's dimensions.
+        field (ndarray): The values to be written (NaN for missing
+                         values), used to pack them as 16-bit integers,
+                         or None if the variable isn't packed.
+        options (dict): The output options, see output_options.
+    Returns:
+        var (netCDF4.Variable): The variable, values are written to
+                                it unpacked.
+
+    """
+    options = output_options(options)
+    kwargs = {}
+    if options['format'].startswith('NETCDF4'):
+        if options['complevel'] > 0:
+            kwargs['zlib'] = True
+            kwargs['complevel'] = options['complevel']
+            kwargs['shuffle'] = options['shuffle']
+        if len(dimensions) >= 2:
+            # A field is read whole by WRF-Hydro: by default it is a
+            # single chunk.
+            shape = tuple(len(nc.dimensions[dimension])
+                          for dimension in dimensions[-2:])
+            chunk_shape = options['chunk_shape'] or shape
+            kwargs['chunksizes'] = (1,) * (len(dimensions) - 2) + \
+                tuple(min(chunk, size) for (chunk, size) in zip(chunk_shape,
+                                                                 shape))
+    if name in options['least_significant_digit']:
+        kwargs['least_significant_digit'] = \
+            options['least_significant_digit'][name]
+
+    if name in options['pack_int16']:
+        var = nc.createVariable(name, 'i2', dimensions,
+                                fill_value=INT16_FILL_VALUE, **kwargs)
+        (var.scale_factor, var.add_offset) = int16_packing(field)
+    else:
+        var = nc.createVariable(name, 'f4', dimensions, fill_value=FILL_VALUE,
+                                **kwargs)
+    return var
+
+
+
+def masked_field(field):
+    """Returns a field with its NaN values masked, and set to 0 under
+    the mask so that they can be packed into integers.
+    """
+    invalid = ~np.isfinite(field)
+    return np.ma.masked_array(np.where(invalid, 0., field).astype(field.dtype),
+                              mask=invalid)
+
+
+
+def row_blocks(num_rows, tile_rows):
+    """Returns the (start, stop) rows of the blocks of at most
+    tile_rows rows of a grid, all the rows if tile_rows is 0.
+    """
+    if tile_rows <= 0:
+        return [(0, num_rows)]
+    return [(start, min(start + tile_rows, num_rows))
+            for start in range(0, num_rows, tile_rows)]
+
+
+
+def slice_rows(fields, start, stop):
+    """Returns views of the rows start:stop of 2D fields, keyed as
+    the fields.
+    """
+    return dict((name, field[start:stop]) for name, field in fields.items())
+
+
+
+def read_rows(nc, name, start, stop, out):
+    """Reads the rows start:stop of a variable from an open NetCDF
+    file into a float32 buffer, with NaN for the missing values.
+    Leading dimensions of size 1 (e.g. Time) are skipped.
+
+    Args:
+        nc (netCDF4.Dataset): The open NetCDF file.
+        name (string): The variable name.
+        start, stop (int): The rows to read.
+        out (ndarray): The float32 buffer, of shape (stop - start,
+                       number of columns).
+    Returns:
+        out (ndarray): The buffer.
+
+    """
+    var = nc.variables[name]
+    index = (0,) * (var.ndim - 2) + (slice(start, stop), slice(None))
+    out[...] = np.ma.filled(np.ma.asarray(var[index], dtype=np.float32),
+                            np.nan)
+    return out
+
+
+
+def write_tiled(out_file, shape, variables, blocks, tile_rows, options=None):
+    """Writes 2D fields to a NetCDF file by blocks of rows, as they
+    are computed, under a temporary name which is renamed when
+    complete (see write_fields).
+
+    Args:
+        out_file (string): The full path of the output file.
+        shape (tuple): The (south_north, west_east) shape of the
+                       fields.
+        variables (OrderedDict): The attributes of each variable,
+                                 keyed by variable name, in the order
+                                 they are written.
+        blocks (iterable): (start, stop, fields) tuples: the rows of
+                           a block and its fields, keyed by variable
+                           name. NaN values are written as missing.
+        tile_rows (int): The number of rows of the blocks, the
+                         default chunk size of NetCDF4 files.
+        options (dict): The output options (see output_options), by
+                        default uncompressed NetCDF3.
+    Returns:
+        None
+
+    """
+    options = output_options(options)
+    packed = [name for name in variables if name in options['pack_int16']]
+    if packed:
+        raise ValueError("%s can't be packed as 16-bit integers when written "
+                         "by blocks of rows" % ", ".join(packed))
+    if options['chunk_shape'] is None:
+        options['chunk_shape'] = (tile_rows, shape[1])
+
+    tmp_file = out_file + ".tmp"
+    with Dataset(tmp_file, 'w', format=options['format']) as nc:
+        nc.createDimension('south_north', shape[0])
+        nc.createDimension('west_east', shape[1])
+        for name, attributes in variables.items():
+            var = create_variable(nc, name, ('south_north', 'west_east'), None,
+                                  options)
+            for attribute, value in attributes.items():
+                var.setncattr(attribute, value)
+        for (start, stop, fields) in blocks:
+            for name in variables:
+                nc.variables[name][start:stop, :] = masked_field(fields[name])
+    os.rename(tmp_file, out_file)
+
+
+
+def write_fields(out_file, fields, options=None):
+    """Writes 2D fields to a NetCDF file.  The file is first written
+    under a temporary name and renamed when complete, so other
+    processes never see a partially written file.
+
+    Args:
+        out_file (string): The full path of the output file.
+        fields (OrderedDict): (field, attributes) tuples keyed by
+                              variable name. NaN values are written
+                              as missing.
+        options (dict): The output options (see output_options), by
+                        default uncompressed NetCDF3.
+    Returns:
+        None
+
+    """
+    def fill(nc):
+        dims_created = False
+        for name, (field, attributes) in fields.items():
+            if not dims_created:
+                nc.createDimension('south_north', field.shape[0])
+                nc.createDimension('west_east', field.shape[1])
+                dims_created = True
+            var = create_variable(nc, name, ('south_north', 'west_east'),
+                                  field, options)
+            for attribute, value in attributes.items():
+                var.setncattr(attribute, value)
+            var[:] = masked_field(field)
+
+    file_format = output_options(options)['format']
+    if WRF_Hydro_io.write_behind_enabled() and _HAS_CREATE_MEM:
+        # The file grows as needed, a larger initial size would
+        # pad the NetCDF3 files.
+        nc = Dataset(out_file, 'w', format=file_format, memory=1)
+        try:
+            fill(nc)
+        finally:
+            data = nc.close()
+        WRF_Hydro_io.write_file(out_file, data)
+        return
+
+    tmp_file = out_file + ".tmp"
+    with Dataset(tmp_file, 'w', format=file_format) as nc:
+        fill(nc)
+    os.rename(tmp_file, out_file)
+
+
+
+def repack_file(filename, options=None):
+    """Rewrites a NetCDF file, e.g. created by an NCL script, with
+    the output options.  Its single precision (f4) variables of two
+    or more dimensions are compressed and packed as requested, the
+    other variables (including the double precision ones, which
+    would lose precision) and all the attributes are copied as they
+    are.
+
+    Args:
+        filename (string): The full path of the file, replaced by
+                           the rewritten file.
+        options (dict): The output options, see output_options.
+    Returns:
+        None
+
+    """
+    tmp_file = filename + ".tmp"
+    with Dataset(filename, 'r') as src, \
+         Dataset(tmp_file, 'w', format=output_options(options)['format']) as dst:
+        dst.setncatts(dict((attribute, src.getncattr(attribute))
+                           for attribute in src.ncattrs()))
+        for name, dimension in src.dimensions.items():
+            dst.createDimension(name, None if dimension.isunlimited()
+                                      else len(dimension))
+        for name, var in src.variables.items():
+            attributes = dict((attribute, var.getncattr(attribute))
+                              for attribute in var.ncattrs()
+                              if attribute not in _RESERVED_ATTRIBUTES)
+            if var.dtype == np.float32 and len(var.dimensions) >= 2:
+                field = np.ma.filled(np.ma.asarray(var[:], dtype=np.float32),
+                                     np.nan)
+                out_var = create_variable(dst, name, var.dimensions, field,
+                                          options)
+                out_var.setncatts(attributes)
+                out_var[:] = masked_field(field)
+            else:
+                var.set_auto_maskandscale(False)
+                fill_value = getattr(var, '_FillValue', None)
+                out_var = dst.createVariable(name, var.dtype, var.dimensions,
+                                             fill_value=fill_value)
+                out_var.set_auto_maskandscale(False)
+                for attribute in ('missing_value', 'scale_factor', 'add_offset'):
+                    if attribute in var.ncattrs():
+                        attributes[attribute] = var.getncattr(attribute)
+                out_var.setncatts(attributes)
+                out_var[:] = var[:]
+    os.rename(tmp_file, filename)
@@ -0,0 +1,243 @@
+import logging
+import itertools
+import numpy as np
+from collections import OrderedDict
+import WRF_Hydro_regrid
+import WRF_Hydro_downscale
+import WRF_Hydro_layering
+import WRF_Hydro_shortwave
+from WRF_Hydro_netcdf import row_blocks, slice_rows, write_fields, write_tiled
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_pipeline.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Fused pipeline of the WRF-Hydro forcing engine.  Instead of
+#  writing a regridded, a downscaled and a layered file for each
+#  forecast hour, with each step reading back the file written by
+#  the previous one, the fields of a forecast hour are regridded,
+#  downscaled, adjusted for the terrain (SWDOWN, if requested) and
+#  layered in memory by the Python engines, and only the final
+#  product is written.  The regridded and downscaled files can still
+#  be written, for debugging, with the write_intermediates option in
+#  the [pipeline] section of the wrf_hydro_forcing.parm file.
+#
+#  Each product of a forecast hour is described by a dictionary
+#  (see WRF_Hydro_forcing.fused_pipeline_data) with the keys:
+#     'product'             HRRR, RAP, etc.
+#     'src_file'            the GRIB2 file to regrid
+#     'wgt_file'            the ESMF weight file
+#     'weight_cache_dir'    the weight cache directory, or None
+#     'grib_index'          the GRIB2 inventory cache directory, or
+#                           None to scan the whole GRIB2 file (see
+#                           WRF_Hydro_regrid.read_source_fields)
+#     'hgt_file', 'geo_file', 'lapse_file'
+#                           the static downscaling files
+#     'terrain_cache_dir'   the terrain geometry cache directory
+#     'static_store'        the node-wide static field store, or None
+#                           (see WRF_Hydro_static_store)
+#     'regridded_file', 'downscaled_file'
+#                           where the intermediate files are
+#                           written, if requested.
+#
+#  With tile_rows set in the [parallel] section (and no intermediate
+#  files), the source fields of both products are read and stacked
+#  once, then each block of tile_rows rows of the destination grid is
+#  regridded, downscaled, layered and written before the next one, so
+#  that only a block of the destination fields is in memory at a time.
+
+
+
+def process_product(stage, valid_time, downscale_shortwave=False,
+                    write_intermediates=False, output_options=None):
+    """Regrids and downscales the data of one product for a
+    forecast hour, in memory.
+
+    Args:
+        stage (dict): The description of the product's data, see
+                      the overview above.
+        valid_time (datetime): The valid time of the forecast hour,
+                               used to adjust SWDOWN.
+        downscale_shortwave (boolean): True to also downscale SWDOWN.
+        write_intermediates (boolean): True to also write the
+                                       regridded and downscaled files.
+        output_options (dict): The format and compression of the
+                               files, see WRF_Hydro_netcdf.
+    Returns:
+        fields (OrderedDict): The downscaled (field, attributes)
+                              tuples, keyed by variable name.
+
+    """
+    logging.debug("Regridding %s", stage['src_file'])
+    fields = WRF_Hydro_regrid.regrid_fields(stage['product'],
+                                            [stage['src_file']],
+                                            stage['wgt_file'],
+                                            stage['weight_cache_dir'],
+                                            stage['grib_index'])[0]
+    if write_intermediates:
+        write_fields(stage['regridded_file'], fields, output_options)
+
+    WRF_Hydro_downscale.downscale_in_memory(fields, stage['hgt_file'],
+                                            stage['geo_file'],
+                                            stage['lapse_file'],
+                                            downscale_shortwave,
+                                            stage['terrain_cache_dir'],
+                                            valid_time, stage['static_store'])
+    if write_intermediates:
+        write_fields(stage['downscaled_file'], fields, output_options)
+    return fields
+
+
+
+def load_product(stage, downscale_shortwave=False, tile_rows=0):
+    """Reads the data of one product needed to process a forecast
+    hour by blocks of rows: its weights, its stacked source fields,
+    its static downscaling fields and, if requested, its terrain
+    geometry.
+
+    Args:
+        stage (dict): The description of the product's data, see
+                      the overview above.
+        downscale_shortwave (boolean): True to also downscale SWDOWN.
+        tile_rows (int): The number of rows of the blocks.
+    Returns:
+        data (dict): The data of the product, for product_rows.
+
+    """
+    product = stage['product'].upper()
+    weights = WRF_Hydro_regrid.load_weights(stage['wgt_file'],
+                                            stage['weight_cache_dir'])
+    logging.debug("Reading %s", stage['src_file'])
+    src_fields = [(name, field) for name, field in
+                  WRF_Hydro_regrid.read_source_fields(
+                      product, stage['src_file'], stage['grib_index']).items()
+                  if field is not None]
+    data = {'product': product,
+            'weights': weights,
+            'names': [name for (name, field) in src_fields],
+            'stacked': weights.stack([field for (name, field) in src_fields]),
+            'static': WRF_Hydro_downscale.load_static_fields(
+                stage['hgt_file'], stage['geo_file'], stage['lapse_file'],
+                stage['static_store']),
+            'scratch': (np.empty((tile_rows, weights.dst_shape[1]),
+                                 dtype=np.float32),
+                        np.empty((tile_rows, weights.dst_shape[1]),
+                                 dtype=np.float32)),
+            'geometry': None}
+    if downscale_shortwave:
+        data['geometry'] = WRF_Hydro_shortwave.load_terrain_geometry(
+            stage['geo_file'], stage['terrain_cache_dir'],
+            stage['static_store'])
+    return data
+
+
+
+def product_rows(data, start, stop, valid_time):
+    """Regrids and downscales a block of rows of one product, see
+    load_product.
+
+    Returns:
+        fields (OrderedDict): The downscaled (field, attributes)
+                              tuples of the rows start:stop, keyed by
+                              variable name.
+
+    """
+    fields = WRF_Hydro_regrid.regrid_rows(data['product'], data['weights'],
+                                          data['names'], data['stacked'],
+                                          start, stop)
+    for name in ('T2D', 'Q2D', 'PSFC'):
+        if name not in fields:
+            raise ValueError("%s is missing from the fields to downscale" % name)
+    scratch = tuple(buffer[:stop - start] for buffer in data['scratch'])
+    WRF_Hydro_downscale.downscale_fields(
+        dict((name, field) for name, (field, attributes) in fields.items()),
+        slice_rows(data['static'], start, stop), scratch)
+    if data['geometry'] is not None and 'SWDOWN' in fields:
+        WRF_Hydro_shortwave.adjust_shortwave(
+            fields['SWDOWN'][0], slice_rows(data['geometry'], start, stop),
+            valid_time)
+    return fields
+
+
+
+def process_forecast_hour_tiled(primary, secondary, layered_file,
+                                downscale_shortwave=False,
+                                output_options=None, tile_rows=0):
+    """Creates the layered file of a forecast hour by blocks of
+    tile_rows rows of the destination grid, see the overview above.
+    The arguments are those of process_forecast_hour.
+    """
+    valid_time = WRF_Hydro_shortwave.valid_time_from_filename(layered_file)
+    primary_data = load_product(primary, downscale_shortwave, tile_rows)
+    secondary_data = load_product(secondary, downscale_shortwave, tile_rows)
+    shape = primary_data['weights'].dst_shape
+    if secondary_data['weights'].dst_shape != shape:
+        raise ValueError("the destination grids of %s and %s differ" %
+                         (primary['product'], secondary['product']))
+
+    def layered_rows():
+        for (start, stop) in row_blocks(shape[0], tile_rows):
+            yield (start, stop, WRF_Hydro_layering.layer_fields(
+                product_rows(primary_data, start, stop, valid_time),
+                product_rows(secondary_data, start, stop, valid_time)))
+
+    # The attributes of the layered variables are those of the first
+    # block, which must be known before the file is created.
+    blocks = layered_rows()
+    (start, stop, first) = next(blocks)
+    variables = OrderedDict((name, attributes)
+                            for name, (field, attributes) in first.items())
+    write_tiled(layered_file, shape, variables,
+                ((start, stop, dict((name, field) for name, (field, attributes)
+                                    in layered.items()))
+                 for (start, stop, layered) in
+                 itertools.chain([(start, stop, first)], blocks)),
+                tile_rows, output_options)
+
+
+
+def process_forecast_hour(primary, secondary, layered_file,
+                          downscale_shortwave=False,
+                          write_intermediates=False, output_options=None,
+                          tile_rows=0):
+    """Creates the layered file of a forecast hour from the raw
+    data of the primary and secondary products.  This is run by
+    the job runner's worker processes, so it must remain a
+    module-level function.
+
+    Args:
+        primary (dict): The description of the primary product's
+                        data (HRRR).
+        secondary (dict): The description of the secondary
+                          product's data (RAP).
+        layered_file (string): The full path of the layered file,
+                               named YYYYMMDD_iHH_fNNN_<config>.nc
+        downscale_shortwave (boolean): True to also downscale SWDOWN.
+        write_intermediates (boolean): True to also write the
+                                       regridded and downscaled files.
+        output_options (dict): The format and compression of the
+                               files, see WRF_Hydro_netcdf.
+        tile_rows (int): If not 0, and no intermediate file is
+                         written, the forecast hour is processed by
+                         blocks of this many rows.
+    Returns:
+        None
+
+    """
+    if tile_rows > 0 and not write_intermediates:
+        process_forecast_hour_tiled(primary, secondary, layered_file,
+                                    downscale_shortwave, output_options,
+                                    tile_rows)
+        return
+
+    valid_time = WRF_Hydro_shortwave.valid_time_from_filename(layered_file)
+    primary_fields = process_product(primary, valid_time, downscale_shortwave,
+                                     write_intermediates, output_options)
+    secondary_fields = process_product(secondary, valid_time,
+                                       downscale_shortwave,
+                                       write_intermediates, output_options)
+    layered = WRF_Hydro_layering.layer_fields(primary_fields, secondary_fields)
+    write_fields(layered_file, layered, output_options)
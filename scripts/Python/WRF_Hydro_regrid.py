@@ -0,0 +1,627 @@
+import logging
+import numbers
+import numpy as np
+import scipy.sparse
+import pygrib
+from collections import OrderedDict
+from netCDF4 import Dataset
+from WRF_Hydro_netcdf import read_fields, row_blocks, write_fields, write_tiled
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_regrid.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Python regridding engine for the WRF-Hydro forcing engine.
+#  This is an alternative to the *-2-WRF_Hydro_ESMF_regrid.ncl
+#  scripts, selected with the regridding_engine option in the
+#  [regridding] section of the wrf_hydro_forcing.parm file.
+#  The ESMF weight file (row, col, S) is read once into a sparse
+#  CSR matrix and applied to all the fields of a file as a single
+#  sparse matrix multiplication.  The forcing jobs regrid one file
+#  each, so that the files of a cycle are downscaled as soon as
+#  they are regridded (see WRF_Hydro_scheduler); regrid_files can
+#  still stack the fields of several files into one multiplication
+#  for callers which have them all.  The regridded files contain
+#  the same variables as those created by the NCL scripts,
+#  including the lat and lon of the destination grid for GFS.
+#  With grib_index set in the [regridding] section, only the
+#  messages of the regridded fields are read from the GRIB2 files,
+#  located with an inventory of each file (see
+#  WRF_Hydro_grib_index).
+
+
+# The fields to regrid for each product, these mirror the
+# variables used by the corresponding NCL regridding script.
+# Each entry is a tuple:
+#    (output variable, GRIB2 selector, scale factor, default, attributes)
+# where the GRIB2 selector is a tuple:
+#    (discipline, parameterCategory, parameterNumber,
+#     typeOfFirstFixedSurface, level)
+# and a level of None matches any level.  If more than one message
+# matches (e.g. 1 hour and run total accumulations) the message with
+# the shortest statistical processing period is used.  When no
+# message matches, a field of the default value is written or, for a
+# default of None, the variable is omitted from the output if it is
+# one of the OPTIONAL_FIELDS of the product, and the file fails
+# otherwise.
+_HRRR_RAP_FIELDS = [
+    ('T2D', (0, 0, 0, 103, 2), 1.0, None, {'units': 'K'}),
+    ('Q2D', (0, 1, 0, 103, 2), 1.0, None, {'units': 'kg kg-1'}),
+    ('U2D', (0, 2, 2, 103, 10), 1.0, None, {'units': 'm s-1'}),
+    ('V2D', (0, 2, 3, 103, 10), 1.0, None, {'units': 'm s-1'}),
+    ('PSFC', (0, 3, 0, 1, None), 1.0, None, {'units': 'Pa'}),
+    ('RAINRATE', (0, 1, 8, 1, None), 1.0 / 3600.0, None,
+     {'description': 'RAINRATE', 'units': 'mm s^-1'}),
+    ('SWDOWN', (0, 4, 7, 1, None), 1.0, None, {'units': 'W m-2'}),
+    # LWDOWN is taken from the (nominal top of atmosphere) ULWRF, as
+    # in the NCL scripts.
+    ('LWDOWN', (0, 5, 4, 8, None), 1.0, None, {'units': 'W m-2'}),
+    ]
+
+_NAM_GFS_FIELDS = [
+    ('T2D', (0, 0, 0, 103, 2), 1.0, None, {'units': 'K'}),
+    ('Q2D', (0, 1, 0, 103, 2), 1.0, None, {'units': 'kg kg-1'}),
+    ('U2D', (0, 2, 2, 103, 10), 1.0, None, {'units': 'm s-1'}),
+    ('V2D', (0, 2, 3, 103, 10), 1.0, None, {'units': 'm s-1'}),
+    ('PSFC', (0, 3, 0, 1, None), 1.0, None, {'units': 'Pa'}),
+    # The NAM and GFS scripts write a RAINRATE of 0 when there is
+    # no PRATE, e.g. in the analysis (f000).
+    ('RAINRATE', (0, 1, 7, 1, None), 1.0, 0.0,
+     {'description': 'RAINRATE', 'units': 'mm s^-1'}),
+    ('SWDOWN', (0, 4, 7, 1, None), 1.0, None, {'units': 'W m-2'}),
+    ('LWDOWN', (0, 5, 3, 1, None), 1.0, None, {'units': 'W m-2'}),
+    ]
+
+REGRID_FIELDS = {
+    'HRRR': _HRRR_RAP_FIELDS,
+    'RAP': _HRRR_RAP_FIELDS,
+    'NAM': _NAM_GFS_FIELDS,
+    'GFS': _NAM_GFS_FIELDS,
+    # MRMS radar-gauge corrected QPE (local table 209).
+    'MRMS': [
+        ('precip_rate', (209, 6, 9, 102, None), 1.0 / 3600.0, None,
+         {'description': 'RAINRATE', 'units': 'mm s^-1'}),
+        ],
+    }
+
+# The variables without a default which may be missing from a file
+# and are then omitted from the output: the accumulations and
+# averages, which the analysis (f000) doesn't have.  A file missing
+# any other variable isn't regridded, as the NCL scripts report it
+# (WRF_HYDRO_FILE_FAILED) or fail reading it, so that incomplete
+# forcing files are never written.
+OPTIONAL_FIELDS = {
+    'HRRR': ('RAINRATE',),
+    'RAP': ('RAINRATE',),
+    'NAM': ('SWDOWN', 'LWDOWN'),
+    'GFS': ('SWDOWN', 'LWDOWN'),
+    'MRMS': (),
+    }
+
+# The variables of the destination grid written ahead of the fields,
+# as the NCL script of the product does: (output variable, variable
+# of the destination grid file).
+COORDINATE_VARIABLES = {
+    'GFS': (('lat', 'XLAT_M'), ('lon', 'XLONG_M')),
+    }
+
+# Weights are read once per process and kept for later files.
+_weights_cache = {}
+
+# The coordinates are read once per process and destination grid.
+_coordinates_cache = {}
+
+
+
+class RegridWeights(object):
+    """ESMF regridding weights stored as a sparse CSR matrix
+    of shape (destination cells, source cells).
+
+    Attributes:
+        matrix (scipy.sparse.csr_matrix): The weights.
+        src_shape (tuple): The (south_north, west_east) shape
+                           of the source grid.
+        dst_shape (tuple): The (south_north, west_east) shape
+                           of the destination grid.
+        unmapped (ndarray): Boolean array, True for the
+                            destination cells that don't
+                            receive any weight.
+
+    """
+
+    def __init__(self, matrix, src_shape, dst_shape):
+        self.matrix = matrix
+        self.src_shape = tuple(src_shape)
+        self.dst_shape = tuple(dst_shape)
+        self.unmapped = np.diff(matrix.indptr) == 0
+
+
+    def apply(self, src_fields):
+        """Regrids a list of source fields with one sparse
+        matrix multiplication.
+
+        Args:
+            src_fields (list): A list of 2D arrays on the source
+                               grid, with NaN for missing values.
+        Returns:
+            dst_fields (list): A list of float32 2D arrays on the
+                               destination grid.  A destination
+                               cell is NaN if it doesn't receive
+                               any weight or if any of the source
+                               cells it is computed from is missing.
+
+        """
+        (stacked, missing) = self.stack(src_fields)
+        return self.apply_rows(stacked, missing, 0, self.dst_shape[0])
+
+
+    def stack(self, src_fields):
+        """Stacks source fields into the columns of one array, to
+        be regridded by apply_rows.
+
+        Args:
+            src_fields (list): A list of 2D arrays on the source
+                               grid, with NaN for missing values.
+        Returns:
+            (stacked, missing) (tuple):  The float32 array of the
+                               fields, of shape (source cells, fields),
+                               with 0 for the missing values, and a
+                               float32 array of the same shape, 1 for
+                               the missing values, or None if no value
+                               is missing.
+
+        """
+        num_src = self.matrix.shape[1]
+        stacked = np.empty((num_src, len(src_fields)), dtype=np.float32)
+        for column, src_field in enumerate(src_fields):
+            if src_field.size != num_src:
+                raise ValueError("source field of shape %s doesn't match the "
+                                 "weights source grid %s" %
+                                 (src_field.shape, self.src_shape))
+            stacked[:, column] = src_field.ravel()
+
+        missing = np.isnan(stacked)
+        if not missing.any():
+            return (stacked, None)
+        stacked[missing] = 0.0
+        return (stacked, missing.astype(np.float32))
+
+
+    def apply_rows(self, stacked, missing, start, stop):
+        """Regrids stacked source fields (see stack) on a block of
+        rows of the destination grid, using only the weights of
+        these rows.
+
+        Args:
+            stacked, missing (ndarray): The stacked source fields.
+            start, stop (int): The rows of the destination grid.
+        Returns:
+            dst_fields (list): A list of float32 2D arrays of shape
+                               (stop - start, west_east), see apply.
+
+        """
+        num_cols = self.dst_shape[1]
+        (first, last) = (start * num_cols, stop * num_cols)
+        matrix = self.matrix
+        if (first, last) != (0, matrix.shape[0]):
+            matrix = matrix[first:last]
+
+        regridded = matrix.dot(stacked)
+
+        if missing is not None:
+            touched = matrix.dot(missing)
+            regridded[touched > 0.0] = np.nan
+        regridded[self.unmapped[first:last], :] = np.nan
+
+        return [np.ascontiguousarray(regridded[:, column]).reshape(
+                    (stop - start, num_cols))
+                for column in range(stacked.shape[1])]
+
+
+
+def read_weights(wgt_file):
+    """Reads an ESMF weight file (as created by ESMF_regrid_gen_weights)
+    into a RegridWeights object.
+
+    Args:
+        wgt_file (string): The full path to the ESMF weight file.
+    Returns:
+        weights (RegridWeights): The weights as a CSR matrix.
+
+    """
+    with Dataset(wgt_file, 'r') as nc:
+        num_src = len(nc.dimensions['n_a'])
+        num_dst = len(nc.dimensions['n_b'])
+        # ESMF stores the grid dimensions in Fortran order and
+        # 1-based row/column indices.
+        src_shape = tuple(nc.variables['src_grid_dims'][:].tolist()[::-1])
+        dst_shape = tuple(nc.variables['dst_grid_dims'][:].tolist()[::-1])
+        rows = np.asarray(nc.variables['row'][:], dtype=np.int32) - 1
+        cols = np.asarray(nc.variables['col'][:], dtype=np.int32) - 1
+        vals = np.asarray(nc.variables['S'][:], dtype=np.float32)
+
+    matrix = scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                     shape=(num_dst, num_src))
+    return RegridWeights(matrix, src_shape, dst_shape)
+
+
+
+def load_weights(wgt_file, cache_dir=None):
+    """Returns the weights for a weight file, reading the file
+    only the first time it is requested by this process.  If a
+    weight cache directory is given, the weights are memory-mapped
+    from their compiled form in the cache (see the
+    WRF_Hydro_weight_cache module) instead.
+
+    Args:
+        wgt_file (string): The full path to the ESMF weight file.
+        cache_dir (string): The weight cache directory, or None
+                            to read the weight file directly.
+    Returns:
+        weights (RegridWeights): The weights as a CSR matrix.
+
+    """
+    if wgt_file not in _weights_cache:
+        if cache_dir:
+            import WRF_Hydro_weight_cache
+            _weights_cache[wgt_file] = \
+                WRF_Hydro_weight_cache.load_cached_weights(wgt_file, cache_dir)
+        else:
+            logging.info("Reading regridding weights %s", wgt_file)
+            _weights_cache[wgt_file] = read_weights(wgt_file)
+    return _weights_cache[wgt_file]
+
+
+
+def read_source_fields(product, filename, grib_index=None):
+    """Reads the fields which are regridded for a product from
+    a GRIB2 file, scanning the file only once, or reading only the
+    messages of these fields if an inventory of the file is used
+    (see WRF_Hydro_grib_index).
+
+    Args:
+        product (string): The product name: HRRR, RAP, NAM, GFS, MRMS
+        filename (string): The full path to the GRIB2 file.
+        grib_index (string): None to scan the whole file, otherwise
+                             the messages are located with an
+                             inventory, the built inventories being
+                             cached in this directory (not cached if
+                             empty).
+    Returns:
+        fields (OrderedDict): The float32 source fields (NaN where
+                              missing) keyed by output variable
+                              name, None for the variables that
+                              weren't found in the file.
+    Raises:
+        ValueError: If a variable which isn't optional (see
+                    OPTIONAL_FIELDS) and has no default isn't found
+                    in the file.
+
+    """
+    field_specs = REGRID_FIELDS[product.upper()]
+    found = dict((spec[0], None) for spec in field_specs)
+
+    if grib_index is not None:
+        import WRF_Hydro_grib_index
+        try:
+            messages = WRF_Hydro_grib_index.read_messages(
+                filename, [spec[1] for spec in field_specs], grib_index or None)
+            for spec, grb in zip(field_specs, messages):
+                if grb is not None:
+                    found[spec[0]] = (0, grb.values)
+        except (IOError, OSError, ValueError) as exc:
+            logging.warning("WARNING: scanning the whole of %s, its messages "
+                            "can't be located: %s", filename, exc)
+            grib_index = None
+
+    if grib_index is None:
+        grbs = pygrib.open(filename)
+        try:
+            for grb in grbs:
+                for spec in field_specs:
+                    if not grib_message_matches(grb, spec[1]):
+                        continue
+                    period = grb.lengthOfTimeRange \
+                             if grb.has_key('lengthOfTimeRange') else 0
+                    if found[spec[0]] is None or period < found[spec[0]][0]:
+                        found[spec[0]] = (period, grb.values)
+        finally:
+            grbs.close()
+
+    missing = [(name, selector) for (name, selector, scale, default,
+                                     attributes) in field_specs
+               if found[name] is None and default is None and
+               name not in OPTIONAL_FIELDS[product.upper()]]
+    if missing:
+        raise ValueError("%s has no GRIB2 message for %s" %
+                         (filename, ", ".join("%s %s" % (name, selector)
+                                              for (name, selector) in missing)))
+
+    fields = OrderedDict()
+    for (name, selector, scale, default, attributes) in field_specs:
+        if found[name] is None:
+            fields[name] = None
+            continue
+        values = found[name][1]
+        field = np.ma.filled(np.ma.asarray(values, dtype=np.float32), np.nan)
+        if scale != 1.0:
+            field *= scale
+        fields[name] = field
+    return fields
+
+
+
+def grib_message_matches(grb, selector):
+    """Determines if a GRIB2 message matches a field selector.
+
+    Args:
+        grb (pygrib.gribmessage): The GRIB2 message.
+        selector (tuple): (discipline, parameterCategory,
+                          parameterNumber, typeOfFirstFixedSurface,
+                          level), level None matches any level.
+    Returns:
+        True if the message matches.
+
+    """
+    (discipline, category, number, level_type, level) = selector
+    if grb.discipline != discipline or \
+       grb.parameterCategory != category or \
+       grb.parameterNumber != number:
+        return False
+    message_level_type = grb.typeOfFirstFixedSurface
+    if not isinstance(message_level_type, numbers.Integral):
+        # Some pygrib and ecCodes versions return the abbreviation of
+        # the code table entry (e.g. sfc for both 1 and 103): the code
+        # is read from the message itself.
+        import WRF_Hydro_grib_index
+        message_level_type = \
+            WRF_Hydro_grib_index.message_entry(grb.tostring())['level_type']
+    if message_level_type != level_type:
+        return False
+    return level is None or grb.level == level
+
+
+
+def read_coordinates(product, dst_grid_name):
+    """Returns the coordinates of the destination grid written in
+    the regridded files of a product (see COORDINATE_VARIABLES),
+    reading them the first time they are requested by this process.
+
+    Args:
+        product (string): The product name: HRRR, RAP, NAM, GFS, MRMS
+        dst_grid_name (string): The destination grid (geo) file.
+    Returns:
+        coordinates (OrderedDict): (field, attributes) tuples keyed by
+                                   output variable name, empty for
+                                   the products without coordinates.
+    Raises:
+        ValueError: If the destination grid file isn't given or
+                    doesn't have the coordinates.
+
+    """
+    variables = COORDINATE_VARIABLES.get(product.upper(), ())
+    if not variables:
+        return OrderedDict()
+    key = (product.upper(), dst_grid_name)
+    if key not in _coordinates_cache:
+        if not dst_grid_name:
+            raise ValueError("the destination grid file is needed to write "
+                             "the coordinates of %s" % product)
+        grid_fields = read_fields(dst_grid_name,
+                                  [grid_name for (name, grid_name) in variables])
+        missing = [grid_name for (name, grid_name) in variables
+                   if grid_name not in grid_fields]
+        if missing:
+            raise ValueError("%s has no %s" % (dst_grid_name,
+                                                ", ".join(missing)))
+        _coordinates_cache[key] = OrderedDict(
+            (name, grid_fields[grid_name]) for (name, grid_name) in variables)
+    return _coordinates_cache[key]
+
+
+
+def regrid_fields(product, src_files, wgt_file, cache_dir=None,
+                  grib_index=None):
+    """Regrids one or more GRIB2 files of a product in memory.  The
+    fields of all the files are stacked and regridded with a single
+    sparse matrix multiplication.
+
+    Args:
+        product (string): The product name: HRRR, RAP, NAM, GFS, MRMS
+        src_files (list): The full paths of the GRIB2 files.
+        wgt_file (string): The full path to the ESMF weight file.
+        cache_dir (string): The weight cache directory, or None.
+        grib_index (string): None to scan the whole GRIB2 files,
+                             otherwise the inventory cache directory,
+                             see read_source_fields.
+    Returns:
+        regridded (list): For each file, an OrderedDict of
+                          (field, attributes) tuples keyed by
+                          variable name, ready to be written with
+                          WRF_Hydro_netcdf.write_fields.
+
+    """
+    product = product.upper()
+    weights = load_weights(wgt_file, cache_dir)
+    field_specs = REGRID_FIELDS[product]
+
+    # Collect the fields to regrid, remembering which file and
+    # variable each one belongs to.
+    src_fields = []
+    field_keys = []
+    file_fields = []
+    for src_file in src_files:
+        logging.debug("Reading %s", src_file)
+        fields = read_source_fields(product, src_file, grib_index)
+        for name, field in fields.items():
+            if field is not None:
+                src_fields.append(field)
+                field_keys.append((len(file_fields), name))
+        file_fields.append(fields)
+
+    if src_fields:
+        dst_fields = weights.apply(src_fields)
+        for (file_index, name), dst_field in zip(field_keys, dst_fields):
+            file_fields[file_index][name] = dst_field
+
+    regridded = []
+    for fields in file_fields:
+        output = OrderedDict()
+        for (name, selector, scale, default, attributes) in field_specs:
+            if fields[name] is not None:
+                output[name] = (fields[name], dict(attributes))
+            elif default is not None:
+                output[name] = (np.full(weights.dst_shape, default,
+                                        dtype=np.float32), dict(attributes))
+        regridded.append(output)
+    return regridded
+
+
+
+def regrid_rows(product, weights, names, stacked, start, stop):
+    """Regrids the stacked source fields of a file (see
+    RegridWeights.stack) on a block of rows of the destination grid.
+
+    Args:
+        product (string): The product name: HRRR, RAP, NAM, GFS, MRMS
+        weights (RegridWeights): The weights.
+        names (list): The variable names of the stacked fields.
+        stacked (tuple): The (stacked, missing) source fields.
+        start, stop (int): The rows of the destination grid.
+    Returns:
+        fields (OrderedDict): (field, attributes) tuples keyed by
+                              variable name, as regrid_fields returns
+                              for whole fields.
+
+    """
+    regridded = dict(zip(names, weights.apply_rows(stacked[0], stacked[1],
+                                                   start, stop)))
+    fields = OrderedDict()
+    for (name, selector, scale, default, attributes) in REGRID_FIELDS[product]:
+        if name in regridded:
+            fields[name] = (regridded[name], dict(attributes))
+        elif default is not None:
+            fields[name] = (np.full((stop - start, weights.dst_shape[1]),
+                                    default, dtype=np.float32),
+                            dict(attributes))
+    return fields
+
+
+
+def regrid_file_tiled(product, src_file, out_file, wgt_file, cache_dir=None,
+                      output_options=None, grib_index=None, tile_rows=0,
+                      dst_grid_name=None):
+    """Regrids a GRIB2 file and writes the regridded fields by blocks
+    of tile_rows rows of the destination grid, so that only a block
+    of each regridded field is in memory at a time.  The arguments
+    are those of regrid_file.
+    """
+    product = product.upper()
+    weights = load_weights(wgt_file, cache_dir)
+    logging.debug("Reading %s", src_file)
+    src_fields = [(name, field) for name, field in
+                  read_source_fields(product, src_file, grib_index).items()
+                  if field is not None]
+    names = [name for (name, field) in src_fields]
+    stacked = weights.stack([field for (name, field) in src_fields])
+    del src_fields
+    coordinates = read_coordinates(product, dst_grid_name)
+
+    variables = OrderedDict(
+        (name, dict(attributes))
+        for name, (field, attributes) in coordinates.items())
+    variables.update(
+        (name, dict(attributes))
+        for (name, selector, scale, default, attributes) in REGRID_FIELDS[product]
+        if name in names or default is not None)
+
+    def blocks():
+        for (start, stop) in row_blocks(weights.dst_shape[0], tile_rows):
+            fields = regrid_rows(product, weights, names, stacked, start, stop)
+            block = dict((name, field[start:stop]) for name, (field, attributes)
+                         in coordinates.items())
+            block.update((name, field) for name, (field, attributes)
+                         in fields.items())
+            yield (start, stop, block)
+
+    write_tiled(out_file, weights.dst_shape, variables, blocks(), tile_rows,
+                output_options)
+
+
+
+def regrid_files(product, src_files, out_files, wgt_file, cache_dir=None,
+                 output_options=None, grib_index=None, tile_rows=0,
+                 dst_grid_name=None):
+    """Regrids one or more GRIB2 files of a product (see regrid_fields)
+    and writes each file's fields to its output file.
+
+    Args:
+        product (string): The product name: HRRR, RAP, NAM, GFS, MRMS
+        src_files (list): The full paths of the GRIB2 files.
+        out_files (list): The full paths of the corresponding
+                          regridded (NetCDF) files.
+        wgt_file (string): The full path to the ESMF weight file.
+        cache_dir (string): The weight cache directory, or None.
+        output_options (dict): The format and compression of the
+                               output files, see WRF_Hydro_netcdf.
+        grib_index (string): None to scan the whole GRIB2 files,
+                             otherwise the inventory cache directory,
+                             see read_source_fields.
+        tile_rows (int): If not 0, each file is regridded and
+                         written by blocks of this many rows (see
+                         regrid_file_tiled).
+        dst_grid_name (string): The destination grid (geo) file, the
+                                coordinates of which are written
+                                ahead of the fields for the products
+                                of COORDINATE_VARIABLES.
+    Returns:
+        None
+
+    """
+    if tile_rows > 0:
+        for src_file, out_file in zip(src_files, out_files):
+            regrid_file_tiled(product, src_file, out_file, wgt_file, cache_dir,
+                              output_options, grib_index, tile_rows,
+                              dst_grid_name)
+        return
+
+    coordinates = read_coordinates(product, dst_grid_name)
+    regridded = regrid_fields(product, src_files, wgt_file, cache_dir,
+                              grib_index)
+    for fields, out_file in zip(regridded, out_files):
+        output = OrderedDict(coordinates)
+        output.update(fields)
+        write_fields(out_file, output, output_options)
+
+
+
+def regrid_file(product, src_file, out_file, wgt_file, cache_dir=None,
+                output_options=None, grib_index=None, tile_rows=0,
+                dst_grid_name=None):
+    """Regrids a single GRIB2 file, see regrid_files.
+
+    Args:
+        product (string): The product name: HRRR, RAP, NAM, GFS, MRMS
+        src_file (string): The full path of the GRIB2 file.
+        out_file (string): The full path of the regridded file.
+        wgt_file (string): The full path to the ESMF weight file.
+        cache_dir (string): The weight cache directory, or None.
+        output_options (dict): The format and compression of the
+                               output file, see WRF_Hydro_netcdf.
+        grib_index (string): None to scan the whole GRIB2 file,
+                             otherwise the inventory cache directory,
+                             see read_source_fields.
+        tile_rows (int): If not 0, the file is regridded and written
+                         by blocks of this many rows.
+        dst_grid_name (string): The destination grid (geo) file, see
+                                regrid_files.
+    Returns:
+        None
+
+    """
+    regrid_files(product, [src_file], [out_file], wgt_file, cache_dir,
+                 output_options, grib_index, tile_rows, dst_grid_name)
+
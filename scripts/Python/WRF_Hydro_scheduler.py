@@ -0,0 +1,386 @@
+import heapq
+import logging
+import multiprocessing
+import time
+import WRF_Hydro_lease
+import WRF_Hydro_metrics
+from collections import OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_scheduler.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Dependency-aware scheduler of the per-file jobs of a forcing
+#  configuration.  Instead of running each stage (regridding,
+#  downscaling, layering) over all the files before starting the
+#  next one, the jobs of all the stages form a task graph: a job
+#  depends on the jobs that create its input files, e.g.
+#     regrid(HRRR, f) -> downscale(HRRR, f) -> layer(f)
+#                     downscale(RAP, f) ----^
+#  and is run as soon as those are done, so the downscaling of the
+#  first forecast hour doesn't wait for the regridding of the last
+#  one.  The ready jobs are run concurrently by a pool of worker
+#  processes, shared by all the products and stages (the
+#  num_workers of the [parallel] section of the wrf_hydro_forcing.parm
+#  file); the jobs furthest down the graph are run first, so that
+#  each forecast hour is completed as early as possible.  The jobs
+#  which depend on a failed job are not run; a failed job is run
+#  again after a delay, and quarantined if it still fails, as set in
+#  the [failures] section (see WRF_Hydro_failures).  The tasks of a graph
+#  can also be shared by several nodes (hosts, or processes of the
+#  same host), each running the same graph, through the lease files
+#  of WRF_Hydro_lease on a shared file system: a node only runs the
+#  tasks it claims and waits for the others' tasks to be done.
+
+
+# Return value of the jobs not run because a job they depend on
+# failed.
+UPSTREAM_FAILED = -1
+
+# Return value of the jobs not run because they are quarantined.
+QUARANTINED = -2
+
+
+
+class TaskGraph(object):
+    """A graph of per-file jobs (see WRF_Hydro_forcing.run_jobs),
+    connected through their input and output files.
+    """
+
+    def __init__(self):
+        # Each task is a dict: label, stage, version, job, inputs,
+        # dependencies (task ids) and depth.
+        self.tasks = []
+        # The id of the last task writing each output file.
+        self.producers = {}
+
+    def add_jobs(self, label, stage, version, jobs, job_inputs):
+        """Adds the jobs of a stage to the graph.  A job depends on
+        the jobs already in the graph which write one of its input
+        files, or the same output file.
+
+        Args:
+            label (tuple):  The label of the jobs' results, e.g.
+                            (product, activity).
+            stage (string):  The processing stage, for the manifest.
+            version (string):  The version of the stage.
+            jobs (list):  The jobs: (output file, list of commands).
+            job_inputs (dict):  The input files of each job, keyed
+                                by output file.
+
+        """
+        for job in jobs:
+            output_file = job[0]
+            inputs = job_inputs[output_file]
+            dependencies = set(self.producers[f] for f in inputs
+                               if f in self.producers)
+            if output_file in self.producers:
+                dependencies.add(self.producers[output_file])
+            depth = max([self.tasks[d]['depth'] + 1 for d in dependencies] +
+                        [0])
+            self.producers[output_file] = len(self.tasks)
+            self.tasks.append({'label': label,
+                               'stage': stage,
+                               'version': version,
+                               'job': job,
+                               'inputs': inputs,
+                               'dependencies': dependencies,
+                               'depth': depth})
+
+    def outputs(self):
+        """Returns the set of the output files of the graph."""
+        return set(self.producers)
+
+    def run(self, run_job, num_workers=1, manifest=None, coordinator=None,
+            poll_interval=10., retry=None, quarantine_hours=0.,
+            worker_init=None, prefetcher=None):
+        """Runs the tasks of the graph, each as soon as the tasks it
+        depends on are done.
+
+        Args:
+            run_job (function):  The module-level function running
+                                 a job and returning its result:
+                                 (output file, elapsed time, return
+                                 value, metrics).
+            num_workers (int):  The number of worker processes, the
+                                tasks are run in this process if 1.
+            manifest (WRF_Hydro_manifest.Manifest):  If given, the
+                                tasks whose output is up to date
+                                when they are ready are skipped and
+                                the successful ones are recorded.
+            coordinator (WRF_Hydro_lease.LeaseCoordinator):  If
+                                given, the tasks are shared with the
+                                other nodes of the run: only the tasks
+                                claimed by this node are run.
+            poll_interval (float):  How often (in seconds) the tasks
+                                    run by other nodes are checked.
+            retry (WRF_Hydro_failures.RetryPolicy):  If given, the
+                                failed tasks are run again after a
+                                delay, while the other tasks go on.
+            quarantine_hours (float):  If not 0, and with a manifest,
+                                the tasks which failed all their
+                                retries are quarantined for this
+                                many hours, and the quarantined
+                                tasks are not run.
+            worker_init (tuple):  If given, the (initializer,
+                                initargs) of the pool of worker
+                                processes.
+            prefetcher (WRF_Hydro_io.Prefetcher):  If given, the
+                                input files of the next ready tasks
+                                are read ahead as tasks are started.
+        Returns:
+            results (OrderedDict):  The results of the tasks run,
+                                    lists of (output file, elapsed
+                                    time in seconds, return value,
+                                    metrics) keyed by label, in task
+                                    order.  The input_bytes of the
+                                    metrics are the total size of the
+                                    task's input files, their
+                                    prefetched_bytes that of those read
+                                    ahead, their attempts the number of
+                                    times the task was run.
+
+        """
+        dependents = [[] for task in self.tasks]
+        waiting = []
+        for task_id, task in enumerate(self.tasks):
+            waiting.append(len(task['dependencies']))
+            for dependency in task['dependencies']:
+                dependents[dependency].append(task_id)
+
+        ready = []
+        def push(task_id):
+            heapq.heappush(ready, (-self.tasks[task_id]['depth'], task_id))
+        for task_id in range(len(self.tasks)):
+            if waiting[task_id] == 0:
+                push(task_id)
+
+        results = [None] * len(self.tasks)
+        # The tasks run by other nodes.
+        remote = []
+        # The failed tasks to run again: (time, task id) heap.
+        attempts = [0] * len(self.tasks)
+        delayed = []
+        def complete(task_id, result):
+            task = self.tasks[task_id]
+            if result is not None:
+                attempts[task_id] += 1
+                result[3]['attempts'] = attempts[task_id]
+                result[3]['input_bytes'] = sum(
+                    WRF_Hydro_metrics.file_size(f) for f in task['inputs'])
+                if prefetcher is not None:
+                    result[3]['prefetched_bytes'] = \
+                        prefetcher.prefetched_bytes(task['inputs'])
+            if result is not None and result[2] != 0 and retry is not None \
+               and retry.should_retry(attempts[task_id]):
+                # The task keeps its lease until it is run again.
+                delay = retry.delay(attempts[task_id])
+                logging.warning("WARNING: %s %s failed for %s, return value "
+                                "of %s, retrying in %.0f s", task['label'][0],
+                                task['stage'], result[0], result[2], delay)
+                heapq.heappush(delayed, (time.time() + delay, task_id))
+                return
+            results[task_id] = result
+            if result is not None and coordinator is not None:
+                coordinator.release(task['job'][0], result[2] == 0)
+            succeeded = result is None or result[2] == 0
+            if result is not None and result[2] != 0:
+                logging.error("ERROR: %s %s failed for %s, return value of %s",
+                              task['label'][0], task['stage'], result[0],
+                              result[2])
+                if manifest is not None and quarantine_hours > 0:
+                    manifest.quarantine(task['stage'], result[0],
+                                        task['inputs'], task['version'],
+                                        result[3].get('error', ""))
+                    result[3]['quarantined'] = True
+            elif result is not None and manifest is not None:
+                manifest.record(task['stage'], result[0], task['inputs'],
+                                task['version'])
+            for dependent in dependents[task_id]:
+                if not succeeded:
+                    fail(dependent)
+                    continue
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    push(dependent)
+        def fail(task_id, reason="a file it depends on is missing"):
+            if results[task_id] is not None:
+                return
+            output_file = self.tasks[task_id]['job'][0]
+            logging.error("ERROR: %s is not created, %s", output_file, reason)
+            results[task_id] = (output_file, 0., UPSTREAM_FAILED,
+                                WRF_Hydro_metrics.empty_metrics())
+            for dependent in dependents[task_id]:
+                fail(dependent)
+        def quarantined(task_id, error):
+            output_file = self.tasks[task_id]['job'][0]
+            logging.error("ERROR: %s is not created, it is quarantined (%s)",
+                          output_file, error)
+            metrics = WRF_Hydro_metrics.empty_metrics()
+            metrics.update({'attempts': 0, 'quarantined': True,
+                            'error': "quarantined: %s" % error})
+            results[task_id] = (output_file, 0., QUARANTINED, metrics)
+            for dependent in dependents[task_id]:
+                fail(dependent)
+
+        def next_task():
+            """Pops the next task to run, a failed task due to be
+            run again or a ready task, completing those which are up
+            to date or done by other nodes.
+            """
+            if delayed and delayed[0][0] <= time.time():
+                return heapq.heappop(delayed)[1]
+            while ready:
+                (depth, task_id) = heapq.heappop(ready)
+                if results[task_id] is not None:
+                    continue
+                task = self.tasks[task_id]
+                if manifest is not None and \
+                   manifest.is_current(task['stage'], task['job'][0],
+                                       task['inputs'], task['version']):
+                    logging.debug("%s is up to date", task['job'][0])
+                    complete(task_id, None)
+                    continue
+                if manifest is not None and quarantine_hours > 0:
+                    error = manifest.is_quarantined(
+                        task['stage'], task['job'][0], task['inputs'],
+                        task['version'], quarantine_hours * 3600.)
+                    if error is not None:
+                        quarantined(task_id, error)
+                        continue
+                if coordinator is not None and not claim(task_id):
+                    continue
+                return task_id
+            return None
+
+        def claim(task_id):
+            """Claims a task for this node, returns True if this node
+            must run it.
+            """
+            state = coordinator.claim(self.tasks[task_id]['job'][0])
+            if state == WRF_Hydro_lease.DONE:
+                complete(task_id, None)
+            elif state == WRF_Hydro_lease.FAILED:
+                fail(task_id, "it failed on another node")
+            elif state == WRF_Hydro_lease.BUSY:
+                remote.append(task_id)
+            return state == WRF_Hydro_lease.CLAIMED
+
+        def prefetch():
+            """Reads ahead the inputs of the next ready tasks.  They
+            are at the top of the ready heap: the n smallest items of
+            a heap are among its first 2**n - 1.
+            """
+            if prefetcher is None:
+                return
+            for (depth, task_id) in heapq.nsmallest(
+                    prefetcher.num_files,
+                    ready[:(1 << prefetcher.num_files) - 1]):
+                if results[task_id] is None:
+                    prefetcher.prefetch(self.tasks[task_id]['inputs'])
+
+        def wait_for_remote(timeout):
+            """Waits up to timeout seconds, or until a failed task is
+            due to be run again, then makes the tasks run by other
+            nodes ready again: those that are done (or whose lease is
+            stale) are completed (or claimed) when popped.
+            """
+            if delayed:
+                timeout = min(timeout, delayed[0][0] - time.time())
+            time.sleep(max(timeout, 0.))
+            while remote:
+                push(remote.pop())
+
+        start = time.time()
+        if num_workers > 1:
+            done = queue.Queue()
+            pool = multiprocessing.Pool(num_workers,
+                                        *(worker_init or (None, ())))
+            try:
+                running = 0
+                last_poll = time.time()
+                while True:
+                    while running < num_workers:
+                        task_id = next_task()
+                        if task_id is None:
+                            break
+                        pool.apply_async(run_task,
+                                         (run_job, task_id,
+                                          self.tasks[task_id]['job']),
+                                         callback=done.put)
+                        running += 1
+                    prefetch()
+                    if running == 0:
+                        if not remote and not delayed:
+                            break
+                        wait_for_remote(last_poll + poll_interval - time.time())
+                        last_poll = time.time()
+                        continue
+                    try:
+                        timeout = poll_interval if remote else None
+                        if delayed:
+                            timeout = max(min(timeout or poll_interval,
+                                              delayed[0][0] - time.time()), 0.)
+                        if timeout is not None:
+                            (task_id, result) = done.get(timeout=timeout)
+                        else:
+                            (task_id, result) = done.get()
+                    except queue.Empty:
+                        wait_for_remote(0)
+                        last_poll = time.time()
+                        continue
+                    running -= 1
+                    complete(task_id, result)
+                    if remote and time.time() - last_poll >= poll_interval:
+                        wait_for_remote(0)
+                        last_poll = time.time()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            while True:
+                task_id = next_task()
+                if task_id is None:
+                    if not remote and not delayed:
+                        break
+                    wait_for_remote(poll_interval)
+                    continue
+                prefetch()
+                complete(*run_task(run_job, task_id, self.tasks[task_id]['job']))
+        logging.info("Ran the task graph of %s tasks in %.1f s", len(self.tasks),
+                     time.time() - start)
+
+        labelled_results = OrderedDict()
+        for task, result in zip(self.tasks, results):
+            labelled_results.setdefault(task['label'], [])
+            if result is not None:
+                labelled_results[task['label']].append(result)
+        return labelled_results
+
+
+
+def run_task(run_job, task_id, job):
+    """Runs the job of a task.  This is invoked by the worker
+    processes, so it must remain a module-level function.
+
+    Returns:
+        (task_id, result) (tuple):  The task id and the result of
+                                    the job, a failure if the job
+                                    raised an exception.
+
+    """
+    start = time.time()
+    try:
+        return (task_id, run_job(job))
+    except Exception:
+        logging.exception("ERROR: the job of %s failed", job[0])
+        elapsed = time.time() - start
+        return (task_id, (job[0], elapsed, 1,
+                          WRF_Hydro_metrics.empty_metrics(elapsed)))
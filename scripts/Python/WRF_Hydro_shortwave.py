@@ -0,0 +1,299 @@
+import os
+import hashlib
+import logging
+import math
+import re
+import datetime
+import numpy as np
+from netCDF4 import Dataset
+import WRF_Hydro_netcdf
+import WRF_Hydro_util
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_shortwave.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Python version of the topographic adjustment of the shortwave
+#  radiation, SWDOWN, performed by topo_adj.ncl and topo_adj.f90
+#  (topo_adjf90.so).  The terrain geometry (slope and slope azimuth,
+#  cal_slope in topo_adj.f90) never changes for a destination grid,
+#  so it is computed once and saved as a .npz sidecar in the
+#  terrain_cache_dir defined in the [downscaling] section of the
+#  wrf_hydro_forcing.parm file.  Only the solar geometry (radconst,
+#  calc_coszen) and the per-cell correction (TOPO_RAD_ADJ_DRVR) are
+#  computed for each file, as array operations.  As in topo_adj.ncl
+#  there is no shadowing and no diffuse fraction.  With a
+#  static_store_dir, the geometry is also shared by the processes of
+#  a host (see WRF_Hydro_static_store).
+
+
+DEGRAD = math.pi / 180.
+DPD = 360. / 365.
+
+# Maximum correction factor, from TOPO_RAD_ADJ.
+MAX_CORRECTION = 1.3
+
+# The terrain geometry is computed (or read) once per process
+# and geo file.
+_geometry_cache = {}
+
+
+
+def cal_slope(hgt, dx, dy, cosa, sina):
+    """Computes the slope and slope azimuth, rotated to the lat-lon
+    grid, of the terrain (cal_slope in topo_adj.f90).
+
+    Args:
+        hgt (ndarray): Terrain height (m), (south_north, west_east).
+        dx, dy (float): Grid spacing (m).
+        cosa, sina (ndarray): Cosine and sine of the rotation angle
+                              of the grid (COSALPHA, SINALPHA).
+    Returns:
+        (slope, slp_azi) (tuple): float32 arrays, in radians.
+
+    """
+    hgt = hgt.astype(np.float64)
+    # Centered differences, one-sided at the edges of the grid.
+    hx = np.empty_like(hgt)
+    hy = np.empty_like(hgt)
+    hx[:, 1:-1] = (hgt[:, 2:] - hgt[:, :-2]) / (2. * dx)
+    hx[:, 0] = (hgt[:, 1] - hgt[:, 0]) / dx
+    hx[:, -1] = (hgt[:, -1] - hgt[:, -2]) / dx
+    hy[1:-1, :] = (hgt[2:, :] - hgt[:-2, :]) / (2. * dy)
+    hy[0, :] = (hgt[1, :] - hgt[0, :]) / dy
+    hy[-1, :] = (hgt[-1, :] - hgt[-2, :]) / dy
+
+    slope = np.arctan(np.sqrt(hx * hx + hy * hy))
+    slp_azi = np.arctan2(hx, hy) + math.pi
+    rotation = np.arcsin(sina)
+    slp_azi -= np.where(cosa >= 0, rotation, math.pi - rotation)
+
+    flat = slope < 1.e-4
+    slope[flat] = 0.
+    slp_azi[flat] = 0.
+    return (slope.astype(np.float32), slp_azi.astype(np.float32))
+
+
+
+def geometry_file(geo_file, cache_dir):
+    """Returns the name of the terrain geometry sidecar of a
+    geo file, which changes whenever the geo file changes.
+    """
+    stat = os.stat(geo_file)
+    key = hashlib.sha1(("%s:%d:%d" % (os.path.abspath(geo_file), stat.st_size,
+                                      int(stat.st_mtime))).encode('utf-8'))
+    name = os.path.splitext(os.path.basename(geo_file))[0]
+    return os.path.join(cache_dir, "%s-terrain-%s.npz" %
+                                   (name, key.hexdigest()[:16]))
+
+
+
+def load_terrain_geometry(geo_file, cache_dir=None, store_dir=None):
+    """Returns the static terrain geometry of a destination grid,
+    reading it from the sidecar in the cache directory or computing
+    it (and saving the sidecar) the first time.
+
+    Args:
+        geo_file (string): The geo file of the destination grid.
+        cache_dir (string): The directory of the sidecars, or None
+                            to compute the geometry in memory only.
+        store_dir (string): The node-wide static field store (see
+                            WRF_Hydro_static_store), or None to
+                            keep the geometry in this process only.
+    Returns:
+        geometry (dict): float32 arrays:
+                         'slope'     slope (radians)
+                         'is_flat'   True where there is no slope
+                         'sin_lat', 'cos_lat'  of the latitude
+                         'sin_lon', 'cos_lon'  of the longitude
+                         'p1', 'p2', 'p3'  the slope terms of the
+                                           cosine of the zenith angle
+                                           over sloping terrain.
+
+    """
+    if geo_file not in _geometry_cache:
+        if store_dir:
+            import WRF_Hydro_static_store
+            _geometry_cache[geo_file] = WRF_Hydro_static_store.load_fields(
+                store_dir, 'terrain', [geo_file],
+                lambda: compute_terrain_geometry(geo_file, cache_dir))
+        else:
+            _geometry_cache[geo_file] = compute_terrain_geometry(geo_file,
+                                                                 cache_dir)
+    return _geometry_cache[geo_file]
+
+
+
+def compute_terrain_geometry(geo_file, cache_dir=None):
+    """Reads or computes the terrain geometry of a destination grid,
+    see load_terrain_geometry.
+    """
+    with Dataset(geo_file, 'r') as nc:
+        xlat = WRF_Hydro_netcdf.read_field(nc, 'XLAT_M')
+        xlong = WRF_Hydro_netcdf.read_field(nc, 'XLONG_M')
+        sidecar = geometry_file(geo_file, cache_dir) if cache_dir else None
+        if sidecar and os.path.isfile(sidecar):
+            with np.load(sidecar) as terrain:
+                slope = terrain['slope']
+                slp_azi = terrain['slp_azi']
+        else:
+            logging.info("Computing the terrain geometry of %s", geo_file)
+            (slope, slp_azi) = cal_slope(WRF_Hydro_netcdf.read_field(nc, 'HGT_M'),
+                                         float(nc.getncattr('DX')),
+                                         float(nc.getncattr('DY')),
+                                         WRF_Hydro_netcdf.read_field(nc, 'COSALPHA'),
+                                         WRF_Hydro_netcdf.read_field(nc, 'SINALPHA'))
+            if sidecar:
+                WRF_Hydro_util.mkdir_p(cache_dir)
+                tmp_sidecar = "%s.tmp.%d" % (sidecar, os.getpid())
+                with open(tmp_sidecar, 'wb') as f:
+                    np.savez(f, slope=slope, slp_azi=slp_azi)
+                os.rename(tmp_sidecar, sidecar)
+
+    # Expand the cosine of the zenith angle over sloping terrain
+    # (TOPO_RAD_ADJ) into terms which only depend on the grid:
+    #   csza_slp = (cos(h)*p1 - sin(h)*p2)*cos(decl) + p3*sin(decl)
+    lat = xlat.astype(np.float64) * DEGRAD
+    lon = xlong.astype(np.float64) * DEGRAD
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    sin_slope = np.sin(slope)
+    cos_slope = np.cos(slope)
+    a = np.cos(slp_azi) * sin_slope
+    b = np.sin(slp_azi) * sin_slope
+    return {
+        'slope': slope,
+        'is_flat': slope == 0.,
+        'sin_lat': sin_lat.astype(np.float32),
+        'cos_lat': cos_lat.astype(np.float32),
+        'sin_lon': np.sin(lon).astype(np.float32),
+        'cos_lon': np.cos(lon).astype(np.float32),
+        'p1': (cos_lat * cos_slope - sin_lat * a).astype(np.float32),
+        'p2': b.astype(np.float32),
+        'p3': (cos_lat * a + sin_lat * cos_slope).astype(np.float32),
+        }
+
+
+
+def solar_declination(julian):
+    """Computes the solar declination (radians) for a day of
+    the year (radconst in topo_adj.f90).
+    """
+    if julian >= 80.:
+        sxlong = DPD * (julian - 80.)
+    else:
+        sxlong = DPD * (julian + 285.)
+    return math.asin(math.sin(23.5 * DEGRAD) * math.sin(sxlong * DEGRAD))
+
+
+
+def hour_angle_offset(julian, xtime, gmt=0.):
+    """Computes the part of the hour angle (radians) which doesn't
+    depend on the longitude, including the equation of time
+    correction (calc_coszen in topo_adj.f90).
+
+    Args:
+        julian (float): The day of the year.
+        xtime (float): Minutes since 00 UTC.
+        gmt (float): The hour of the start of the day.
+    Returns:
+        offset (float): The hour angle is offset + longitude.
+
+    """
+    da = 2. * math.pi * (julian - 1.) / 365.
+    eot = (0.000075 + 0.001868 * math.cos(da) - 0.032077 * math.sin(da)
+           - 0.014615 * math.cos(2. * da) - 0.04089 * math.sin(2. * da)) * 229.18
+    xt24 = math.fmod(xtime, 1440.) + eot
+    return 15. * (gmt + xt24 / 60. - 12.) * DEGRAD
+
+
+
+def valid_time_from_filename(filename):
+    """Determines the valid time of a file from its name:
+    YYYYMMDD_iHH_fNNN_<product>.nc
+
+    Args:
+        filename (string): The file name (with or without path).
+    Returns:
+        valid_time (datetime): The init time plus the forecast hour.
+
+    """
+    match = re.match(r'.*([0-9]{8})_i([0-9]{2})_f([0-9]{2,4})',
+                     os.path.basename(filename))
+    if not match:
+        raise ValueError("can't determine the valid time of %s" % filename)
+    init_time = datetime.datetime.strptime(match.group(1) + match.group(2),
+                                           "%Y%m%d%H")
+    return init_time + datetime.timedelta(hours=int(match.group(3)))
+
+
+
+def adjust_shortwave(swdown, geometry, valid_time):
+    """Performs the topographic adjustment of the shortwave
+    radiation, in place (TOPO_RAD_ADJ_DRVR in topo_adj.f90).
+
+    Args:
+        swdown (ndarray): float32 SWDOWN (W m-2).
+        geometry (dict): The terrain geometry from
+                         load_terrain_geometry.
+        valid_time (datetime): The valid time of SWDOWN.
+    Returns:
+        None:  swdown is modified in place.
+
+    """
+    julian = float(valid_time.timetuple().tm_yday)
+    xtime = valid_time.hour * 60. + valid_time.minute
+    declin = solar_declination(julian)
+    offset = hour_angle_offset(julian, xtime)
+    sin_decl = np.float32(math.sin(declin))
+    cos_decl = np.float32(math.cos(declin))
+
+    # cos and sin of the hour angle, offset + longitude.
+    cos_h = geometry['cos_lon'] * np.float32(math.cos(offset))
+    cos_h -= geometry['sin_lon'] * np.float32(math.sin(offset))
+    sin_h = geometry['sin_lon'] * np.float32(math.cos(offset))
+    sin_h += geometry['cos_lon'] * np.float32(math.sin(offset))
+
+    coszen = geometry['cos_lat'] * cos_decl
+    coszen *= cos_h
+    coszen += geometry['sin_lat'] * sin_decl
+
+    csza_slp = cos_h
+    csza_slp *= geometry['p1']
+    sin_h *= geometry['p2']
+    csza_slp -= sin_h
+    csza_slp *= cos_decl
+    csza_slp += geometry['p3'] * sin_decl
+    csza_slp[csza_slp <= 1.e-4] = 0.
+
+    # Only daytime, sloping cells with the sun above the horizon
+    # are adjusted.
+    adjust = (swdown > 1.e-3) & (coszen > 1.e-4) & ~geometry['is_flat']
+    corr_fac = csza_slp[adjust] / coszen[adjust]
+    np.minimum(corr_fac, np.float32(MAX_CORRECTION), out=corr_fac)
+    swdown[adjust] *= corr_fac
+
+
+
+def adjust_shortwave_file(filename, geo_file, cache_dir=None, store_dir=None):
+    """Performs the topographic adjustment of the shortwave radiation
+    of a downscaled file, overwriting only its SWDOWN variable.
+
+    Args:
+        filename (string): The full path of the downscaled file.
+        geo_file (string): The geo file of the destination grid.
+        cache_dir (string): The terrain geometry cache directory.
+        store_dir (string): The node-wide static field store, or None.
+    Returns:
+        None
+
+    """
+    geometry = load_terrain_geometry(geo_file, cache_dir, store_dir)
+    with Dataset(filename, 'r+') as nc:
+        swdown = WRF_Hydro_netcdf.read_field(nc, 'SWDOWN')
+        adjust_shortwave(swdown, geometry, valid_time_from_filename(filename))
+        var = nc.variables['SWDOWN']
+        var[:] = np.ma.masked_invalid(swdown).reshape(var.shape)
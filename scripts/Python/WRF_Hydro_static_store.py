@@ -0,0 +1,217 @@
+import os
+import atexit
+import fcntl
+import hashlib
+import json
+import logging
+import shutil
+import numpy as np
+import WRF_Hydro_util
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_static_store.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Node-wide store of the static fields of the Python downscaling
+#  and shortwave engines (the height difference, lapse rate and
+#  pressure adjustments of load_static_fields and the terrain
+#  geometry of load_terrain_geometry).  Each set of static fields is
+#  computed once per host and saved as .npy files in the
+#  static_store_dir of the [downscaling] section of the
+#  wrf_hydro_forcing.parm file, normally in /dev/shm, the POSIX
+#  shared memory file system.  Every process then memory-maps the
+#  fields read-only, so the worker processes of a host share a single
+#  copy of each field instead of each reading the static files and
+#  keeping its own.
+#
+#  An entry is keyed by the kind of fields and the identity (path,
+#  device, inode, size and modification time) of the files they are
+#  computed from, so an entry is never used once one of its files has
+#  changed.  Each process using an entry holds a reference to it, a
+#  file named after its pid in the entry's refs directory, released
+#  when the process exits (the references of processes which exited
+#  without releasing them, e.g. pool workers, are ignored).  Entries whose files have changed or
+#  disappeared are removed once no live process references them.
+
+
+META_FILE = "meta.json"
+REFS_DIR = "refs"
+
+# The entries referenced by this process.
+_references = set()
+
+
+
+def file_identity(filename):
+    """Returns the identity of a file: its absolute path, device,
+    inode, size and modification time, or only its path if it
+    doesn't exist.
+    """
+    filename = os.path.abspath(filename)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return [filename]
+    return [filename, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime]
+
+
+
+def entry_dir(store_dir, kind, files):
+    """Returns the directory of the entry of a kind of static fields
+    computed from a list of files.
+    """
+    key = hashlib.sha1(json.dumps([kind] + [file_identity(filename)
+                                            for filename in files]
+                                  ).encode('utf-8'))
+    return os.path.join(store_dir, "%s-%s" % (kind, key.hexdigest()[:24]))
+
+
+
+def load_fields(store_dir, kind, files, compute):
+    """Returns the static fields of an entry of the store, computing
+    and saving them first if the entry doesn't exist.  If the store
+    can't be written (e.g. /dev/shm is full), the fields are
+    computed in this process' memory.
+
+    Args:
+        store_dir (string): The store directory.
+        kind (string): The kind of static fields, e.g. downscale.
+        files (list): The files the fields are computed from.
+        compute (function): Computes the fields, returned as a dict
+                            of arrays keyed by name.
+    Returns:
+        fields (dict): The read-only, memory-mapped arrays.
+
+    """
+    entry = entry_dir(store_dir, kind, files)
+    try:
+        if not os.path.isfile(os.path.join(entry, META_FILE)):
+            # Only one process computes an entry, the others wait
+            # for it and then map it.
+            WRF_Hydro_util.mkdir_p(store_dir)
+            with open(entry + ".lock", 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    if not os.path.isfile(os.path.join(entry, META_FILE)):
+                        evict_stale_entries(store_dir)
+                        save_entry(entry, kind, files, compute())
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        add_reference(entry)
+        return open_entry(entry)
+    except (IOError, OSError) as exc:
+        logging.warning("WARNING: can't use the static field store %s (%s), "
+                        "keeping the %s fields in memory", store_dir, exc, kind)
+        return compute()
+
+
+
+def save_entry(entry, kind, files, fields):
+    """Writes the fields of an entry to a temporary directory which
+    is renamed when complete.
+    """
+    logging.info("Saving the %s static fields to %s", kind, entry)
+    tmp_entry = "%s.tmp.%d" % (entry, os.getpid())
+    WRF_Hydro_util.mkdir_p(os.path.join(tmp_entry, REFS_DIR))
+    try:
+        for name, field in fields.items():
+            np.save(os.path.join(tmp_entry, name + ".npy"), np.asarray(field))
+        with open(os.path.join(tmp_entry, META_FILE), 'w') as f:
+            json.dump({'kind': kind,
+                       'files': [file_identity(filename) for filename in files],
+                       'names': sorted(fields)}, f)
+        os.rename(tmp_entry, entry)
+    except (IOError, OSError):
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        raise
+
+
+
+def open_entry(entry):
+    """Memory-maps the fields of an entry read-only."""
+    with open(os.path.join(entry, META_FILE)) as f:
+        meta = json.load(f)
+    return dict((name, np.load(os.path.join(entry, name + ".npy"),
+                               mmap_mode='r'))
+                for name in meta['names'])
+
+
+
+def add_reference(entry):
+    """Records that this process uses an entry, until it exits."""
+    if entry in _references:
+        return
+    open(os.path.join(entry, REFS_DIR, str(os.getpid())), 'w').close()
+    if not _references:
+        atexit.register(release_references)
+    _references.add(entry)
+
+
+
+def release_references():
+    """Releases the references of this process to the entries."""
+    for entry in _references:
+        try:
+            os.remove(os.path.join(entry, REFS_DIR, str(os.getpid())))
+        except OSError:
+            pass
+    _references.clear()
+
+
+
+def live_references(entry):
+    """Returns the number of live processes referencing an entry,
+    removing the references of the processes which have exited.
+    """
+    refs_dir = os.path.join(entry, REFS_DIR)
+    count = 0
+    for name in os.listdir(refs_dir):
+        if WRF_Hydro_util.process_exists(int(name)):
+            count += 1
+        else:
+            try:
+                os.remove(os.path.join(refs_dir, name))
+            except OSError:
+                pass
+    return count
+
+
+
+def evict_stale_entries(store_dir):
+    """Removes the unreferenced entries whose files have changed or
+    no longer exist, along with any temporary directories left by an
+    interrupted save.
+
+    Args:
+        store_dir (string): The store directory.
+    Returns:
+        None
+
+    """
+    for name in os.listdir(store_dir):
+        entry = os.path.join(store_dir, name)
+        if not os.path.isdir(entry):
+            continue
+        if ".tmp." in name:
+            if not WRF_Hydro_util.process_exists(int(name.rsplit(".", 1)[1])):
+                shutil.rmtree(entry, ignore_errors=True)
+            continue
+        try:
+            with open(os.path.join(entry, META_FILE)) as f:
+                meta = json.load(f)
+            stale = [file_identity(filename[0]) for filename in meta['files']] \
+                    != meta['files']
+            if stale and live_references(entry) > 0:
+                continue
+        except (IOError, OSError, ValueError, KeyError):
+            stale = True
+        if stale:
+            logging.info("Removing stale static field entry %s", entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            try:
+                os.remove(entry + ".lock")
+            except OSError:
+                pass
@@ -0,0 +1,44 @@
+import os
+import errno
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_util.py
+# -----------------------------------------------------
+
+#  Overview:
+#  File system and process helpers shared by the forcing modules.
+#  This module has no dependencies on the other WRF_Hydro modules,
+#  so that the numeric kernels and the caches run by the worker
+#  processes can use it without importing the orchestration.
+
+
+
+def mkdir_p(dir):
+    """Provides mkdir -p functionality.
+
+       Args:
+          dir (string):  Full directory path to be created if it
+                         doesn't exist.
+       Returns:
+          None:  Creates nested subdirs if they don't already
+                 exist.
+
+    """
+    try:
+        os.makedirs(dir)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(dir):
+            pass
+        else: raise
+
+
+
+def process_exists(pid):
+    """Determines if a process exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
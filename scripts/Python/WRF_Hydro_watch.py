@@ -0,0 +1,270 @@
+import os
+import ctypes
+import ctypes.util
+import errno
+import logging
+import select
+import struct
+import time
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_watch.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Watches the data directories of the WRF-Hydro forcing engine for
+#  new files, so that each forecast hour can be processed as soon as
+#  it arrives instead of after the whole cycle has landed.  A file is
+#  reported once it is complete:
+#     - when its sentinel file (e.g. <file>.done) exists, if a
+#       sentinel_suffix is defined in the [watch] section of the
+#       wrf_hydro_forcing.parm file,
+#     - otherwise when its size and modification time haven't
+#       changed for stable_seconds.
+#  On Linux, inotify (through ctypes, there is no extra dependency)
+#  wakes the watcher up as soon as a file is written.  inotify doesn't
+#  see files written by other hosts on a network file system, so the
+#  directories are also rescanned every poll_interval seconds; where
+#  inotify isn't available only this polling is used.
+
+
+# inotify event masks, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+
+class Inotify(object):
+    """Minimal ctypes interface to the Linux inotify API, watching
+    directory trees for written, created and moved-in files.
+
+    Raises:
+        OSError: if inotify isn't available.
+
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.directories = {}
+
+    def add_tree(self, top):
+        """Watches a directory and all its subdirectories."""
+        for root, directories, files in os.walk(top):
+            self.add_directory(root)
+
+    def add_directory(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd,
+                                         directory.encode('utf-8'),
+                                         WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            logging.warning("WARNING: can't watch %s: %s", directory,
+                            os.strerror(error))
+        else:
+            self.directories[wd] = directory
+
+    def read_events(self, timeout):
+        """Waits for events for at most timeout seconds.
+
+        Returns:
+            (paths, overflow) (tuple): The paths of the files with an
+                                       event, and True if events were
+                                       lost (a rescan is needed).
+
+        """
+        paths = set()
+        overflow = False
+        (readable, writable, exceptional) = select.select([self.fd], [], [],
+                                                          timeout)
+        if not readable:
+            return (paths, overflow)
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return (paths, overflow)
+            raise
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            (wd, mask, cookie, length) = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode('utf-8')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if wd not in self.directories or not name:
+                continue
+            path = os.path.join(self.directories[wd], name)
+            if mask & IN_ISDIR:
+                # Files may have landed before the watch was added.
+                self.add_tree(path)
+                for root, directories, files in os.walk(path):
+                    paths.update(os.path.join(root, f) for f in files)
+            else:
+                paths.add(path)
+        return (paths, overflow)
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class FileWatcher(object):
+    """Reports the complete files of one or more directory trees,
+    each file once (or again if it is later replaced).  The files
+    already present when the watcher starts are reported too.
+
+    Args:
+        directories (list): The directories to watch.
+        stable_seconds (float): How long a file's size and
+                                modification time must not change
+                                for it to be considered complete.
+        sentinel_suffix (string): If not empty, a file is instead
+                                  complete when the file with this
+                                  suffix appended to its name exists.
+        poll_interval (float): The directories are rescanned every
+                               poll_interval seconds.
+        use_inotify (boolean): False to only poll.
+
+    """
+
+    def __init__(self, directories, stable_seconds=10., sentinel_suffix=None,
+                 poll_interval=30., use_inotify=True):
+        self.directories = list(directories)
+        self.stable_seconds = stable_seconds
+        self.sentinel_suffix = sentinel_suffix or None
+        self.poll_interval = poll_interval
+        # The files not yet complete: path -> (size, mtime, time
+        # the size and mtime were first seen).
+        self.candidates = {}
+        # The files already reported: path -> (size, mtime).
+        self.reported = {}
+        self.last_scan = 0.
+
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+                for directory in self.directories:
+                    self.inotify.add_tree(directory)
+            except OSError as exc:
+                logging.info("inotify is not available (%s), polling %s",
+                             exc, self.directories)
+                self.inotify = None
+
+    def ignored(self, path):
+        """Determines if a file is ignored: hidden and temporary
+        files, and the sentinel files themselves.
+        """
+        name = os.path.basename(path)
+        return name.startswith('.') or name.endswith('.tmp') or \
+               (self.sentinel_suffix is not None and
+                name.endswith(self.sentinel_suffix))
+
+    def scan(self):
+        """Adds the new and changed files of the directories to the
+        candidates.
+        """
+        for directory in self.directories:
+            for root, directories, files in os.walk(directory):
+                for name in files:
+                    self.add_candidate(os.path.join(root, name))
+        self.last_scan = time.time()
+
+    def add_candidate(self, path):
+        if self.sentinel_suffix is not None and \
+           path.endswith(self.sentinel_suffix):
+            path = path[:-len(self.sentinel_suffix)]
+        if self.ignored(path) or path in self.candidates:
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        if self.reported.get(path) != (stat.st_size, stat.st_mtime):
+            self.candidates[path] = (stat.st_size, stat.st_mtime, time.time())
+
+    def complete_files(self):
+        """Removes the complete files from the candidates.
+
+        Returns:
+            complete (list): The complete files, sorted.
+
+        """
+        now = time.time()
+        complete = []
+        for path, (size, mtime, since) in list(self.candidates.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed or renamed before it was complete.
+                del self.candidates[path]
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.candidates[path] = (stat.st_size, stat.st_mtime, now)
+                continue
+            if self.sentinel_suffix is not None:
+                done = os.path.exists(path + self.sentinel_suffix)
+            else:
+                done = now - since >= self.stable_seconds
+            if done:
+                del self.candidates[path]
+                self.reported[path] = (size, mtime)
+                complete.append(path)
+        return sorted(complete)
+
+    def wait_for_files(self, timeout):
+        """Waits up to timeout seconds for files to be complete.
+
+        Returns:
+            complete (list): The complete files, possibly empty.
+
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            if now - self.last_scan >= self.poll_interval:
+                self.scan()
+            complete = self.complete_files()
+            if complete or now >= deadline:
+                return complete
+
+            # Sleep until the next event, the next stability check
+            # of a candidate, the next scan or the deadline.
+            wait = min(deadline, self.last_scan + self.poll_interval) - now
+            if self.candidates:
+                wait = min(wait, max(self.stable_seconds / 4., 0.1))
+            wait = max(wait, 0.)
+            if self.inotify is not None:
+                (paths, overflow) = self.inotify.read_events(wait)
+                if overflow:
+                    self.last_scan = 0.
+                for path in paths:
+                    self.add_candidate(path)
+            else:
+                time.sleep(wait)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
@@ -0,0 +1,225 @@
+import os
+import fcntl
+import hashlib
+import json
+import logging
+import shutil
+import socket
+import numpy as np
+import scipy.sparse
+import WRF_Hydro_regrid
+import WRF_Hydro_util
+
+
+
+# -----------------------------------------------------
+#             WRF_Hydro_weight_cache.py
+# -----------------------------------------------------
+
+#  Overview:
+#  On-disk cache of compiled ESMF regridding weights.  Each weight
+#  file is converted once into a compact binary CSR form (int32
+#  indices, float32 values) stored as .npy files in the cache
+#  directory defined by weight_cache_dir in the [regridding] section
+#  of the wrf_hydro_forcing.parm file.  Later runs, and the workers
+#  of a parallel run, memory-map these files instead of reparsing the
+#  weight file, so workers on the same host share the pages through
+#  the OS page cache.  An entry is keyed by the weight file's path,
+#  size, modification time and a hash of its first and last blocks;
+#  entries whose weight file has changed or disappeared are removed.
+
+
+# Bytes hashed at each end of the weight file to build the cache key.
+KEY_HASH_BYTES = 1024 * 1024
+
+META_FILE = "meta.json"
+ARRAY_NAMES = ("indptr", "indices", "data")
+
+
+
+def cache_key(wgt_file):
+    """Creates the cache key of a weight file from its path, size,
+    modification time and a hash of its first and last blocks.
+
+    Args:
+        wgt_file (string): The full path to the ESMF weight file.
+    Returns:
+        key (string): The cache key, a hex digest.
+
+    """
+    wgt_file = os.path.abspath(wgt_file)
+    stat = os.stat(wgt_file)
+    key_hash = hashlib.sha1()
+    key_hash.update(("%s:%d:%d" % (wgt_file, stat.st_size,
+                                   int(stat.st_mtime))).encode('utf-8'))
+    with open(wgt_file, 'rb') as f:
+        key_hash.update(f.read(KEY_HASH_BYTES))
+        if stat.st_size > 2 * KEY_HASH_BYTES:
+            f.seek(-KEY_HASH_BYTES, os.SEEK_END)
+            key_hash.update(f.read(KEY_HASH_BYTES))
+    return key_hash.hexdigest()
+
+
+
+def file_hash(filename):
+    """Computes the SHA-1 hash of a file's content.
+
+    Args:
+        filename (string): The full path to the file.
+    Returns:
+        digest (string): The hex digest.
+
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+
+def entry_dir(cache_dir, wgt_file, key):
+    """Returns the directory holding the cache entry of a
+    weight file.
+    """
+    name = os.path.splitext(os.path.basename(wgt_file))[0]
+    return os.path.join(cache_dir, name + "-" + key)
+
+
+
+def load_cached_weights(wgt_file, cache_dir):
+    """Returns the weights of a weight file from the cache,
+    compiling the weight file into the cache first if there
+    isn't a valid entry for it.  The CSR arrays are memory-mapped
+    read-only.
+
+    Args:
+        wgt_file (string): The full path to the ESMF weight file.
+        cache_dir (string): The weight cache directory.
+    Returns:
+        weights (WRF_Hydro_regrid.RegridWeights): The weights.
+
+    """
+    key = cache_key(wgt_file)
+    entry = entry_dir(cache_dir, wgt_file, key)
+
+    if not os.path.isfile(os.path.join(entry, META_FILE)):
+        # Only one process compiles an entry, the others wait for
+        # it to finish and then use it.
+        WRF_Hydro_util.mkdir_p(cache_dir)
+        with open(entry + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.isfile(os.path.join(entry, META_FILE)):
+                    evict_stale_entries(cache_dir)
+                    compile_weights(wgt_file, entry)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        try:
+            os.remove(entry + ".lock")
+        except OSError:
+            pass
+
+    return open_entry(entry)
+
+
+
+def compile_weights(wgt_file, entry):
+    """Converts an ESMF weight file into a cache entry.  The entry
+    is written to a temporary directory which is renamed when
+    complete.
+
+    Args:
+        wgt_file (string): The full path to the ESMF weight file.
+        entry (string): The cache entry directory to create.
+    Returns:
+        None
+
+    """
+    logging.info("Compiling regridding weights %s into %s", wgt_file, entry)
+    stat = os.stat(wgt_file)
+    weights = WRF_Hydro_regrid.read_weights(wgt_file)
+    matrix = weights.matrix
+    matrix.sum_duplicates()
+
+    index_type = np.int32 if matrix.nnz < np.iinfo(np.int32).max else np.int64
+    arrays = {'indptr': matrix.indptr.astype(index_type),
+              'indices': matrix.indices.astype(np.int32),
+              'data': matrix.data.astype(np.float32)}
+    meta = {'source': os.path.abspath(wgt_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha1': file_hash(wgt_file),
+            'shape': list(matrix.shape),
+            'src_shape': list(weights.src_shape),
+            'dst_shape': list(weights.dst_shape)}
+
+    tmp_entry = entry + ".tmp.%s.%d" % (socket.gethostname(), os.getpid())
+    WRF_Hydro_util.mkdir_p(tmp_entry)
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(tmp_entry, name + ".npy"), arrays[name])
+    with open(os.path.join(tmp_entry, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Another host compiled the same entry in the meantime.
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+
+def open_entry(entry):
+    """Memory-maps the arrays of a cache entry.
+
+    Args:
+        entry (string): The cache entry directory.
+    Returns:
+        weights (WRF_Hydro_regrid.RegridWeights): The weights.
+
+    """
+    with open(os.path.join(entry, META_FILE)) as f:
+        meta = json.load(f)
+    arrays = dict((name, np.load(os.path.join(entry, name + ".npy"),
+                                 mmap_mode='r'))
+                  for name in ARRAY_NAMES)
+    matrix = scipy.sparse.csr_matrix((arrays['data'], arrays['indices'],
+                                      arrays['indptr']),
+                                     shape=tuple(meta['shape']), copy=False)
+    return WRF_Hydro_regrid.RegridWeights(matrix, meta['src_shape'],
+                                          meta['dst_shape'])
+
+
+
+def evict_stale_entries(cache_dir):
+    """Removes the cache entries whose weight file has changed
+    (different size or modification time) or no longer exists,
+    along with any temporary directories left by an interrupted
+    compilation.
+
+    Args:
+        cache_dir (string): The weight cache directory.
+    Returns:
+        None
+
+    """
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if not os.path.isdir(entry):
+            continue
+        if ".tmp." in name:
+            (host, pid) = name.split(".tmp.", 1)[1].rsplit(".", 1)
+            if host == socket.gethostname() and not WRF_Hydro_util.process_exists(int(pid)):
+                shutil.rmtree(entry, ignore_errors=True)
+            continue
+        try:
+            with open(os.path.join(entry, META_FILE)) as f:
+                meta = json.load(f)
+            stat = os.stat(meta['source'])
+            stale = stat.st_size != meta['size'] or \
+                    stat.st_mtime != meta['mtime']
+        except (IOError, OSError, ValueError, KeyError):
+            stale = True
+        if stale:
+            logging.info("Removing stale weight cache entry %s", entry)
+            shutil.rmtree(entry, ignore_errors=True)
+
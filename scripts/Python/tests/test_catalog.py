@@ -0,0 +1,163 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_catalog
+
+
+
+# -----------------------------------------------------
+#             test_catalog.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the catalog of the input files of WRF_Hydro_catalog:
+#  the parsing of the file names and the incremental scan of a
+#  small tree of downscaled files, persisted as JSON.
+
+
+
+class NameTest(unittest.TestCase):
+
+    def test_parse_name(self):
+        hrrr = WRF_Hydro_catalog.name_pattern('hrrr')
+        self.assertEqual(WRF_Hydro_catalog.parse_name(
+                             hrrr, "/data/20150723_i23_f010_HRRR.grb2"),
+                         ("20150723", "i23", "010"))
+        self.assertTrue(WRF_Hydro_catalog.parse_name(hrrr, "README") is None)
+
+        mrms = WRF_Hydro_catalog.name_pattern('MRMS')
+        self.assertEqual(WRF_Hydro_catalog.parse_name(
+                             mrms, "GaugeCorr_QPE_00.00_20150723_230000.grib2"),
+                         ("20150723", "i23", "000"))
+
+        processed = WRF_Hydro_catalog.name_pattern('GFS', processed=True)
+        self.assertEqual(WRF_Hydro_catalog.parse_name(
+                             processed, "20150723_i00_f120_GFS.nc"),
+                         ("20150723", "i00", "120"))
+        self.assertTrue(WRF_Hydro_catalog.parse_name(
+            processed, "20150723_i00_f120_GFS.nc.tmp") is None)
+
+        self.assertRaises(ValueError, WRF_Hydro_catalog.name_pattern, 'ECMWF')
+
+    def test_valid_fields(self):
+        self.assertEqual(WRF_Hydro_catalog.valid_fields(
+                             ("20150731", "i22", "003")),
+                         ("20150801", "i01", "000"))
+
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmp_dir, "downscaled")
+        self.catalog_file = os.path.join(self.tmp_dir, "catalog",
+                                         "catalog.json")
+        self.pattern = WRF_Hydro_catalog.name_pattern('HRRR', processed=True)
+        for (date, init_hr, fcst_hrs) in (("20150723", "i22", (1, 2)),
+                                          ("20150723", "i23", (1,))):
+            for fcst_hr in fcst_hrs:
+                self.write(date, init_hr, "%s_%s_f%03d_HRRR.nc" %
+                                          (date, init_hr, fcst_hr))
+        self.write("20150723", "i23", ".hidden")
+        self.write("20150723", "i23", "20150723_i23_f002_HRRR.nc.tmp")
+        self.listed = []
+        self.list_directory = WRF_Hydro_catalog.list_directory
+
+    def tearDown(self):
+        WRF_Hydro_catalog.list_directory = self.list_directory
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, date, init_hr, name):
+        directory = os.path.join(self.top, date, init_hr)
+        modified = [directory]
+        path = directory
+        while not os.path.isdir(path):
+            path = os.path.dirname(path)
+            modified.append(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(os.path.join(directory, name), 'w').close()
+        # The modified directories are older than the slack of the
+        # scans.
+        past = time.time() - 60
+        for path in modified:
+            os.utime(path, (past, past))
+
+    def scan(self):
+        """Scans the tree with a new catalog loaded from the catalog
+        file, recording the directories listed.
+        """
+        def list_directory(path):
+            self.listed.append(os.path.relpath(path, self.top))
+            return self.list_directory(path)
+        WRF_Hydro_catalog.list_directory = list_directory
+        del self.listed[:]
+        catalog = WRF_Hydro_catalog.Catalog(self.catalog_file)
+        index = catalog.scan(self.top, self.pattern)
+        catalog.save()
+        return index
+
+    def test_scan(self):
+        index = self.scan()
+        self.assertEqual(sorted(self.listed),
+                         ['.', '20150723', '20150723/i22', '20150723/i23'])
+        self.assertEqual([os.path.relpath(path, self.top)
+                          for path in index.files()],
+                         ['20150723/i22/20150723_i22_f001_HRRR.nc',
+                          '20150723/i22/20150723_i22_f002_HRRR.nc',
+                          '20150723/i23/20150723_i23_f001_HRRR.nc'])
+        self.assertEqual(index.lookup("20150723", "i22", "002"),
+                         os.path.join(self.top, "20150723", "i22",
+                                      "20150723_i22_f002_HRRR.nc"))
+        self.assertTrue(index.lookup("20150723", "i23", 2) is None)
+        self.assertTrue(os.path.isfile(self.catalog_file))
+
+    def test_incremental_scan(self):
+        self.scan()
+        index = self.scan()
+        self.assertEqual(self.listed, [])
+        self.assertEqual(len(index.files()), 3)
+
+        # Only the directory whose files changed is listed again.
+        self.write("20150723", "i23", "20150723_i23_f002_HRRR.nc")
+        index = self.scan()
+        self.assertEqual(self.listed, ['20150723/i23'])
+        self.assertTrue(index.lookup("20150723", "i23", 2) is not None)
+
+        shutil.rmtree(os.path.join(self.top, "20150723", "i22"))
+        index = self.scan()
+        self.assertEqual(self.listed, ['20150723'])
+        self.assertEqual(len(index.files()), 2)
+
+    def test_recent_directory(self):
+        os.utime(os.path.join(self.top, "20150723", "i22"), None)
+        self.scan()
+        # A directory modified just before the scan is listed again.
+        self.scan()
+        self.assertEqual(self.listed, ['20150723/i22'])
+
+    def test_unreadable_catalog_file(self):
+        os.makedirs(os.path.dirname(self.catalog_file))
+        with open(self.catalog_file, 'w') as f:
+            f.write("{")
+        self.assertEqual(len(self.scan().files()), 3)
+        self.assertEqual(len(self.listed), 4)
+
+    def test_add(self):
+        index = self.scan()
+        planned = os.path.join(self.top, "20150724", "i00",
+                               "20150724_i00_f001_HRRR.nc")
+        index.add([planned, os.path.join(self.tmp_dir, "other",
+                                         "20150724_i00_f002_HRRR.nc")])
+        self.assertEqual(index.lookup("20150724", "i00", 1), planned)
+        self.assertEqual(len(index.files()), 4)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+from collections import OrderedDict
+from netCDF4 import Dataset
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_cube
+import WRF_Hydro_netcdf
+
+
+
+# -----------------------------------------------------
+#             test_cube.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the per-cycle forcing cubes of WRF_Hydro_cube, built
+#  from synthetic 3x4 forecast hour files appended out of order.
+
+
+
+class CubeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cube_dir = os.path.join(self.tmp_dir, "cubes")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def hour_file(self, forecast_hour, value, shape=(3, 4)):
+        """Writes the forecast hour file of the 2015070112 HRRR cycle
+        whose T2D is value everywhere.
+        """
+        hour_file = os.path.join(self.tmp_dir, "20150701_i12_f%03d_HRRR.nc" %
+                                 forecast_hour)
+        t2d = np.full(shape, value, dtype=np.float32)
+        t2d[0, 0] = np.nan
+        WRF_Hydro_netcdf.write_fields(hour_file, OrderedDict(
+            [('T2D', (t2d, {'units': 'K'})),
+             ('U2D', (t2d / 100., {}))]))
+        return hour_file
+
+    def test_cube_file_name(self):
+        self.assertEqual(WRF_Hydro_cube.cube_file_name(
+                             "/cubes", "/data/20150701_i12_f003_HRRR.nc"),
+                         ("/cubes/20150701/i12/20150701_i12_HRRR.nc", 3))
+        self.assertRaises(ValueError, WRF_Hydro_cube.cube_file_name,
+                          "/cubes", "/data/HRRR.nc")
+
+    def test_append(self):
+        for forecast_hour in (3, 1, 2):
+            cube_file = WRF_Hydro_cube.append_file(
+                self.cube_dir, self.hour_file(forecast_hour, forecast_hour))
+        self.assertEqual(cube_file, os.path.join(
+            self.cube_dir, "20150701", "i12", "20150701_i12_HRRR.nc"))
+
+        index = WRF_Hydro_cube.read_index(cube_file)
+        self.assertEqual(index['cycle'], "20150701_i12")
+        self.assertEqual(index['variables'], ['T2D', 'U2D'])
+        self.assertEqual(index['chunk_shape'], [1, 3, 4])
+        self.assertEqual(dict(index['forecast_hours']),
+                         {'3': 0, '1': 1, '2': 2})
+
+        with Dataset(cube_file) as nc:
+            self.assertEqual(nc.data_model, 'NETCDF4_CLASSIC')
+            self.assertEqual(list(nc.variables[WRF_Hydro_cube.TIME][:]),
+                             [3, 1, 2])
+            self.assertEqual(nc.variables['T2D'].chunking(), [1, 3, 4])
+            self.assertEqual(nc.variables[WRF_Hydro_cube.TIME].units,
+                             "hours since 2015-07-01 12:00:00")
+
+        fields = WRF_Hydro_cube.read_hour(cube_file, 1)
+        (t2d, attributes) = fields['T2D']
+        self.assertEqual(attributes['units'], 'K')
+        self.assertTrue(np.isnan(t2d[0, 0]))
+        np.testing.assert_array_equal(t2d[1:], 1.)
+        self.assertEqual(list(WRF_Hydro_cube.read_hour(cube_file, 2, ['U2D'])),
+                         ['U2D'])
+        self.assertRaises(KeyError, WRF_Hydro_cube.read_hour, cube_file, 4)
+
+    def test_replace_hour(self):
+        WRF_Hydro_cube.append_file(self.cube_dir, self.hour_file(1, 1.))
+        WRF_Hydro_cube.append_file(self.cube_dir, self.hour_file(2, 2.))
+        cube_file = WRF_Hydro_cube.append_file(self.cube_dir,
+                                               self.hour_file(1, 10.))
+        with Dataset(cube_file) as nc:
+            self.assertEqual(len(nc.dimensions[WRF_Hydro_cube.TIME]), 2)
+        (t2d, _) = WRF_Hydro_cube.read_hour(cube_file, 1)['T2D']
+        np.testing.assert_array_equal(t2d[1:], 10.)
+
+    def test_packed_options(self):
+        options = {'format': 'NETCDF4', 'complevel': 2, 'pack_int16': ('T2D',)}
+        cube_file = WRF_Hydro_cube.append_file(self.cube_dir,
+                                               self.hour_file(1, 1.), options)
+        with Dataset(cube_file) as nc:
+            self.assertEqual(nc.data_model, 'NETCDF4')
+            self.assertEqual(nc.variables['T2D'].dtype, np.float32)
+            self.assertTrue(nc.variables['T2D'].filters()['zlib'])
+
+    def test_grid_mismatch(self):
+        WRF_Hydro_cube.append_file(self.cube_dir, self.hour_file(1, 1.))
+        self.assertRaises(ValueError, WRF_Hydro_cube.append_file,
+                          self.cube_dir, self.hour_file(2, 1., shape=(4, 4)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_downscale
+
+
+
+# -----------------------------------------------------
+#             test_downscale.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the height correction of WRF_Hydro_downscale against
+#  the relhum and mixhum_ptrh formulas of NCL, computed in double
+#  precision, on synthetic fields.
+
+
+
+def saturation_vapor_pressure(t2d):
+    """The saturation vapor pressure (hPa) of mixhum_ptrh."""
+    return 6.11 * np.exp(17.269 * (t2d - 273.15) / (t2d - 35.86))
+
+
+
+def reference_downscale(t2d, q2d, psfc, dhgt, lapse):
+    """Downscales T2D, Q2D and PSFC as All_WRF_Hydro_downscale.ncl."""
+    w2d = q2d / (1. - q2d)
+    es = saturation_vapor_pressure(t2d)
+    rh = np.clip(100. * w2d * (psfc / 100. - es) / (0.622 * es), 0.0001, 100.)
+    t2d = t2d + dhgt * lapse / 1000.
+    psfc = psfc + dhgt * psfc / 287.05 / t2d * 9.8
+    es = saturation_vapor_pressure(t2d)
+    qw = rh / 100. * 0.622 * es / (psfc / 100. - 0.378 * es)
+    return (t2d, qw / (1. + qw), psfc)
+
+
+
+def make_static(dhgt, lapse):
+    """Returns the static fields of load_static_fields."""
+    dhgt = dhgt.astype(np.float32)
+    return {
+        'dhgt': dhgt,
+        't_adjust': (dhgt * np.float32(lapse / 1000.)).astype(np.float32),
+        'p_factor': (dhgt * np.float32(9.8 / 287.05)).astype(np.float32),
+        }
+
+
+
+class DownscaleFieldsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.t2d = np.array([[263.15, 278.15], [293.15, 303.15]])
+        self.q2d = np.array([[0.001, 0.004], [0.01, 0.02]])
+        self.psfc = np.array([[70000., 85000.], [95000., 101325.]])
+        self.dhgt = np.array([[-500., -100.], [0., 800.]])
+
+    def downscale(self, dhgt, lapse=6.49):
+        fields = {'T2D': self.t2d.astype(np.float32),
+                  'Q2D': self.q2d.astype(np.float32),
+                  'PSFC': self.psfc.astype(np.float32)}
+        WRF_Hydro_downscale.downscale_fields(fields, make_static(dhgt, lapse))
+        return fields
+
+    def test_formulas(self):
+        fields = self.downscale(self.dhgt)
+        (t2d, q2d, psfc) = reference_downscale(self.t2d, self.q2d, self.psfc,
+                                               self.dhgt, 6.49)
+        np.testing.assert_allclose(fields['T2D'], t2d, rtol=1e-6)
+        np.testing.assert_allclose(fields['PSFC'], psfc, rtol=1e-6)
+        np.testing.assert_allclose(fields['Q2D'], q2d, rtol=1e-4)
+        for name in ('T2D', 'Q2D', 'PSFC'):
+            self.assertEqual(fields[name].dtype, np.float32)
+
+    def test_no_height_difference(self):
+        # relhum and mixhum_ptrh aren't exact inverses, Q2D changes
+        # slightly even without a height difference.
+        dhgt = np.zeros_like(self.dhgt)
+        fields = self.downscale(dhgt)
+        np.testing.assert_array_equal(fields['T2D'],
+                                      self.t2d.astype(np.float32))
+        np.testing.assert_array_equal(fields['PSFC'],
+                                      self.psfc.astype(np.float32))
+        (t2d, q2d, psfc) = reference_downscale(self.t2d, self.q2d, self.psfc,
+                                               dhgt, 6.49)
+        np.testing.assert_allclose(fields['Q2D'], q2d, rtol=1e-4)
+
+    def test_supersaturated(self):
+        # The relative humidity is capped at 100%: the humidity is
+        # that of saturation at the new temperature and pressure.
+        self.q2d[:] = 0.05
+        fields = self.downscale(self.dhgt)
+        es = saturation_vapor_pressure(fields['T2D'].astype(np.float64))
+        qw = 0.622 * es / (fields['PSFC'] / 100. - 0.378 * es)
+        np.testing.assert_allclose(fields['Q2D'], qw / (1. + qw), rtol=1e-4)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
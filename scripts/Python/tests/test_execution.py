@@ -0,0 +1,132 @@
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_execution
+
+
+
+# -----------------------------------------------------
+#             test_execution.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the execution backend of the external commands,
+#  WRF_Hydro_execution: exit status, output and job log files,
+#  timeout, memory cap and nice level, with shell and Python
+#  commands standing for NCL.
+
+
+
+class ExecuteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.tmp_dir, "out",
+                                        "20150701_i12_f001_HRRR.nc")
+
+    def tearDown(self):
+        WRF_Hydro_execution.configure(WRF_Hydro_execution.ExecutionLimits())
+        shutil.rmtree(self.tmp_dir)
+
+    def execute(self, command, **limits):
+        WRF_Hydro_execution.configure(
+            WRF_Hydro_execution.ExecutionLimits(**limits))
+        lines = []
+        (status, usage, timed_out) = WRF_Hydro_execution.execute(
+            ['/bin/sh', '-c', command], self.output_file, lines.append)
+        return (status, lines, timed_out)
+
+    def test_status(self):
+        (status, lines, timed_out) = self.execute("echo done; exit 3")
+        self.assertEqual(os.WEXITSTATUS(status), 3)
+        self.assertEqual(lines, ["done\n"])
+        self.assertFalse(timed_out)
+        (status, lines, timed_out) = self.execute("echo error >&2")
+        self.assertEqual((status, lines), (0, ["error\n"]))
+
+    def test_job_log(self):
+        log_dir = os.path.join(self.tmp_dir, "logs")
+        for run in range(2):
+            self.execute("echo run %d" % run, log_dir=log_dir)
+        log_file = WRF_Hydro_execution.job_log_file(self.output_file, log_dir)
+        self.assertEqual(log_file, os.path.join(
+            log_dir, "20150701_i12_f001_HRRR.nc.log"))
+        with open(log_file) as f:
+            log = f.read().splitlines()
+        self.assertEqual(len(log), 4)
+        self.assertTrue(log[0].startswith("# ") and
+                        log[0].endswith("/bin/sh -c echo run 0"))
+        self.assertEqual((log[1], log[3]), ("run 0", "run 1"))
+
+    def test_timeout(self):
+        start = time.time()
+        # The processes started by the command are terminated too.
+        (status, lines, timed_out) = self.execute(
+            "sleep 30 & echo started; wait", timeout=.5)
+        self.assertTrue(timed_out)
+        self.assertTrue(os.WIFSIGNALED(status))
+        self.assertEqual(os.WTERMSIG(status), signal.SIGTERM)
+        self.assertEqual(lines, ["started\n"])
+        self.assertTrue(time.time() - start < 10.)
+
+    def test_memory_limit(self):
+        allocate = "%s -c 'bytearray(1024 * 1024 * 1024)'" % sys.executable
+        (status, lines, timed_out) = self.execute(allocate,
+                                                  memory_limit_mb=256)
+        self.assertNotEqual(status, 0)
+        (status, lines, timed_out) = self.execute(allocate)
+        self.assertEqual(status, 0)
+
+    def test_nice(self):
+        nice = max(os.nice(0), 5)
+        (status, lines, timed_out) = self.execute("nice", nice=nice)
+        self.assertEqual(lines, ["%d\n" % nice])
+
+
+
+class ScratchDirTest(unittest.TestCase):
+
+    def test_run_in_scratch_dir(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cwd_file = os.path.join(tmp_dir, "cwd")
+            WRF_Hydro_execution.run_in_scratch_dir(
+                [['/bin/sh', '-c', 'touch index.nc'],
+                 ['/bin/sh', '-c', 'test -f index.nc && pwd > %s' % cwd_file]],
+                os.path.join(tmp_dir, "out.nc"))
+            with open(cwd_file) as f:
+                scratch_dir = f.read().strip()
+            self.assertNotEqual(scratch_dir, os.getcwd())
+            self.assertFalse(os.path.exists(scratch_dir))
+
+            self.assertRaises(RuntimeError,
+                              WRF_Hydro_execution.run_in_scratch_dir,
+                              [['/bin/sh', '-c', 'exit 1']],
+                              os.path.join(tmp_dir, "out.nc"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+
+class CpuSlotsTest(unittest.TestCase):
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(WRF_Hydro_execution.parse_cpu_list("0-3,8,10-11\n"),
+                         [0, 1, 2, 3, 8, 10, 11])
+
+    def test_cpu_slots(self):
+        allowed = WRF_Hydro_execution.allowed_cpus()
+        slots = WRF_Hydro_execution.cpu_slots(1)
+        self.assertEqual(sorted(cpu for slot in slots for cpu in slot), allowed)
+        for slot in WRF_Hydro_execution.cpu_slots(len(allowed) + 1):
+            self.assertTrue(set(slot) <= set(allowed))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import json
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_failures
+import WRF_Hydro_metrics
+import WRF_Hydro_scheduler
+try:
+    import WRF_Hydro_forcing
+except ImportError:
+    # The forcing engine itself needs Python 2 (ConfigParser).
+    WRF_Hydro_forcing = None
+
+
+
+# -----------------------------------------------------
+#             test_failures.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the retries, quarantine and failure report of the failed
+#  jobs (WRF_Hydro_failures), and of their handling by the jobs run
+#  by WRF_Hydro_forcing, whose commands are simulated by write_output.
+
+
+
+def write_output(output_file, failures):
+    """Writes an output file, after failing the given number of
+    times (counted in <output_file>.attempts), or always if failures
+    is negative.
+    """
+    attempts_file = output_file + ".attempts"
+    attempts = 0
+    if os.path.exists(attempts_file):
+        with open(attempts_file) as f:
+            attempts = int(f.read())
+    with open(attempts_file, 'w') as f:
+        f.write(str(attempts + 1))
+    if failures < 0 or attempts < failures:
+        raise IOError("%s is not ready" % output_file)
+    with open(output_file, 'w') as f:
+        f.write("output")
+
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_retries(self):
+        retry = WRF_Hydro_failures.RetryPolicy(max_retries=2)
+        self.assertEqual([retry.should_retry(attempts)
+                          for attempts in (1, 2, 3)], [True, True, False])
+        self.assertFalse(WRF_Hydro_failures.RetryPolicy().should_retry(1))
+
+    def test_delay(self):
+        retry = WRF_Hydro_failures.RetryPolicy(max_retries=5, retry_delay=30.,
+                                               max_retry_delay=100.)
+        self.assertEqual([retry.delay(attempts) for attempts in (1, 2, 3, 4)],
+                         [30., 60., 100., 100.])
+
+
+
+class FailureReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_command_error(self):
+        self.assertEqual(WRF_Hydro_failures.command_error(
+                             ['ncl', 'script.ncl'], 3 << 8),
+                         "ncl exited with 3")
+        self.assertEqual(WRF_Hydro_failures.command_error(
+                             "ncl script.ncl", signal.SIGKILL),
+                         "ncl killed by signal %d" % signal.SIGKILL)
+
+    def test_failure_entry(self):
+        entry = WRF_Hydro_failures.failure_entry(
+            ('HRRR', 'Regrid'), 'regridding',
+            ("out.nc", 1., 1, {'attempts': 3, 'error': "ncl exited with 1"}),
+            ("in.grb2",), quarantined=True)
+        self.assertEqual(list(entry.items()),
+                         [('product', 'HRRR'), ('activity', 'Regrid'),
+                          ('stage', 'regridding'), ('output_file', "out.nc"),
+                          ('return_value', 1), ('attempts', 3),
+                          ('error', "ncl exited with 1"), ('quarantined', True),
+                          ('inputs', ["in.grb2"])])
+        self.assertEqual(WRF_Hydro_failures.failure_entry(
+            ('HRRR', 'Regrid'), 'regridding', ("out.nc", 1., 2, {}),
+            ())['error'], "return value of 2")
+
+    def test_write_failure_report(self):
+        prefix = os.path.join(self.tmp_dir, "forcing")
+        self.assertTrue(WRF_Hydro_failures.write_failure_report(
+            [], prefix=prefix) is None)
+        self.assertFalse(os.path.exists(prefix + "_failures.jsonl"))
+
+        entry = WRF_Hydro_failures.failure_entry(
+            ('HRRR', 'Regrid'), 'regridding', ("out.nc", 1., 1, {}), ())
+        for run in range(2):
+            report_file = WRF_Hydro_failures.write_failure_report(
+                [entry], ["downscaled.nc"], num_jobs=4, prefix=prefix)
+        self.assertEqual(report_file, prefix + "_failures.jsonl")
+        with open(report_file) as f:
+            runs = [json.loads(line) for line in f]
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(runs[0]['num_jobs'], 4)
+        self.assertEqual(runs[0]['failures'][0]['output_file'], "out.nc")
+        self.assertEqual(runs[0]['not_created'], ["downscaled.nc"])
+
+
+
+@unittest.skipIf(WRF_Hydro_forcing is None, "WRF_Hydro_forcing needs Python 2")
+class IncrementalJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # The failure report is written next to the script by default.
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.parser = WRF_Hydro_forcing.SafeConfigParser()
+        for (section, options) in (
+                ('parallel', {'num_workers': '1'}),
+                ('manifest', {'manifest_file': os.path.join(self.tmp_dir,
+                                                            "manifest.sqlite")}),
+                ('failures', {'max_retries': '1', 'retry_delay': '0',
+                              'quarantine_hours': '1'})):
+            self.parser.add_section(section)
+            for option, value in options.items():
+                self.parser.set(section, option, value)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def run_jobs(self):
+        jobs = []
+        job_inputs = {}
+        for (name, failures) in (("ok.nc", 0), ("transient.nc", 1),
+                                 ("broken.nc", -1)):
+            output_file = os.path.join(self.tmp_dir, name)
+            jobs.append((output_file, [(write_output, (output_file, failures))]))
+            job_inputs[output_file] = []
+        results = WRF_Hydro_forcing.run_incremental_jobs(
+            jobs, job_inputs, 'regridding', "Python-1", self.parser,
+            label=('HRRR', 'Regrid'))
+        return dict((os.path.basename(result[0]),
+                     (result[2], result[3]['attempts'])) for result in results)
+
+    def read_report(self):
+        with open(WRF_Hydro_metrics.log_file_prefix() +
+                  "_failures.jsonl") as f:
+            return [json.loads(line) for line in f]
+
+    def test_retry_and_quarantine(self):
+        self.assertEqual(self.run_jobs(), {'ok.nc': (0, 1),
+                                           'transient.nc': (0, 2),
+                                           'broken.nc': (1, 2)})
+        (run,) = self.read_report()
+        (failure,) = run['failures']
+        self.assertEqual((failure['output_file'], failure['attempts'],
+                          failure['quarantined']),
+                         (os.path.join(self.tmp_dir, "broken.nc"), 2, True))
+        self.assertTrue(failure['error'].startswith("write_output: "))
+
+        # The created files are up to date, the broken job is
+        # quarantined and not run again.
+        self.assertEqual(self.run_jobs(), {})
+        (_, run) = self.read_report()
+        (failure,) = run['failures']
+        self.assertEqual(failure['return_value'],
+                         WRF_Hydro_scheduler.QUARANTINED)
+        self.assertEqual(failure['attempts'], 0)
+        with open(os.path.join(self.tmp_dir, "broken.nc.attempts")) as f:
+            self.assertEqual(f.read(), "2")
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_grib_index
+
+
+
+# -----------------------------------------------------
+#             test_grib_index.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the selective reading of GRIB2 files of
+#  WRF_Hydro_grib_index, on a synthetic file of four 3x4 messages
+#  with and without a wgrib2 inventory.
+
+
+
+def grib2_message(discipline, category, number, level_type, level, values,
+                  period=None):
+    """Encodes a GRIB2 message of a 6 hour forecast on a regular
+    lat-lon grid, with simple packing: an instantaneous field, or if
+    a period (hours) is given an accumulation (template 4.8) over the
+    period ending at the forecast hour.  The level is in whole units.
+    """
+    (ny, nx) = values.shape
+    section1 = struct.pack('>IBHHBBBHBBBBBBB', 21, 1, 7, 0, 2, 1, 1, 2015, 9,
+                           29, 18, 0, 0, 0, 1)
+    section3 = struct.pack('>IBBIBBH', 72, 3, 0, nx * ny, 0, 0, 0) + \
+        struct.pack('>BBIBIBIIIIIiiBiiIIB', 6, 0, 0, 0, 0, 0, 0, nx, ny, 0,
+                    0xffffffff, 20000000, 230000000, 48,
+                    20000000 + ny * 1000, 230000000 + nx * 1000, 1000, 1000,
+                    64)
+    start = 6 if period is None else 6 - period
+    product = struct.pack('>BBBBBHBBIBBIBBI', category, number, 2, 0, 0, 0, 0,
+                          1, start, level_type, 0, level, 255, 0, 0)
+    if period is None:
+        section4 = struct.pack('>IBHH', 34, 4, 0, 0) + product
+    else:
+        section4 = struct.pack('>IBHH', 58, 4, 0, 8) + product + \
+            struct.pack('>HBBBBBBIBBBIBI', 2015, 9, 30, 0, 0, 0, 1, 0, 1, 2,
+                        1, period, 1, 0)
+    # 16-bit values with a binary scale factor of -8.
+    reference = float(values.min())
+    packed = np.round((values - reference) * 2. ** 8).astype('>u2').tobytes()
+    section5 = struct.pack('>IBIHfHHBB', 21, 5, nx * ny, 0, reference, 0x8008,
+                           0, 16, 0)
+    section6 = struct.pack('>IBB', 6, 6, 255)
+    section7 = struct.pack('>IB', 5 + len(packed), 7) + packed
+    body = section1 + section3 + section4 + section5 + section6 + section7 + \
+        b'7777'
+    return b'GRIB' + struct.pack('>HBBQ', 0, discipline, 2, 16 + len(body)) + \
+        body
+
+
+
+# The messages of the test file: wgrib2 inventory name, level and
+# period, and the selector and arguments of the message.
+MESSAGES = [
+    ('TMP', '2 m above ground', '6 hour fcst', (0, 0, 0, 103, 2.0), None),
+    ('APCP', 'surface', '0-6 hour acc fcst', (0, 1, 8, 1, 0.0), 6),
+    ('APCP', 'surface', '5-6 hour acc fcst', (0, 1, 8, 1, 0.0), 1),
+    ('UGRD', '10 m above ground', '6 hour fcst', (0, 2, 2, 103, 10.0), None),
+    ]
+
+
+
+class GribIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "hrrr.grib2")
+        self.values = []
+        self.offsets = []
+        with open(self.filename, 'wb') as f:
+            for i, (_, _, _, selector, period) in enumerate(MESSAGES):
+                values = np.arange(12.).reshape(3, 4) + 100. * i
+                self.values.append(values)
+                self.offsets.append(f.tell())
+                (discipline, category, number, level_type, level) = selector
+                f.write(grib2_message(discipline, category, number, level_type,
+                                      int(level), values, period))
+        self.selectors = [MESSAGES[i][3] for i in (3, 0, 1)] + \
+                         [(0, 4, 7, 1, 0.0)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_idx(self, offsets):
+        with open(self.filename + ".idx", 'w') as f:
+            for i, (name, level, period, _, _) in enumerate(MESSAGES):
+                f.write("%d:%d:d=2015092918:%s:%s:%s:\n" %
+                        (i + 1, offsets[i], name, level, period))
+
+    def check_messages(self, messages):
+        (ugrd, tmp, apcp, dswrf) = messages
+        np.testing.assert_allclose(ugrd.values, self.values[3], atol=.01)
+        np.testing.assert_allclose(tmp.values, self.values[0], atol=.01)
+        # The 1 hour accumulation, not the 6 hour one.
+        np.testing.assert_allclose(apcp.values, self.values[2], atol=.01)
+        self.assertTrue(dswrf is None)
+
+    def test_scan_inventory(self):
+        entries = WRF_Hydro_grib_index.scan_inventory(self.filename)
+        self.assertEqual([entry['offset'] for entry in entries], self.offsets)
+        self.assertEqual(entries[-1]['offset'] + entries[-1]['length'],
+                         os.path.getsize(self.filename))
+        self.assertEqual([(entry['discipline'], entry['category'],
+                           entry['number'], entry['level_type'], entry['level'])
+                          for entry in entries],
+                         [message[3] for message in MESSAGES])
+        self.assertEqual([entry['period'] for entry in entries], [0, 6, 1, 0])
+
+        (ugrd, missing) = WRF_Hydro_grib_index.select_messages(
+            entries, [MESSAGES[3][3], (0, 4, 7, 1, 0.0)])
+        self.assertEqual(ugrd['offset'], self.offsets[3])
+        self.assertTrue(missing is None)
+
+    def test_wgrib2_inventory(self):
+        self.write_idx(self.offsets)
+        entries = WRF_Hydro_grib_index.read_wgrib2_inventory(self.filename)
+        self.assertEqual(entries, WRF_Hydro_grib_index.scan_inventory(
+            self.filename))
+
+        # An inventory of another (larger) file isn't used.
+        self.write_idx(self.offsets[:-1] + [os.path.getsize(self.filename)])
+        self.assertTrue(
+            WRF_Hydro_grib_index.read_wgrib2_inventory(self.filename) is None)
+
+    def test_message_entry(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offsets[1])
+            data = f.read(self.offsets[2] - self.offsets[1])
+        entry = WRF_Hydro_grib_index.message_entry(data)
+        self.assertTrue(WRF_Hydro_grib_index.entry_matches(entry, MESSAGES[1][3]))
+        self.assertEqual(entry['period'], 6)
+
+    def test_read_ranges(self):
+        entries = WRF_Hydro_grib_index.scan_inventory(self.filename)
+        data = WRF_Hydro_grib_index.read_ranges(self.filename,
+                                                [entries[3], entries[0]])
+        with open(self.filename, 'rb') as f:
+            content = f.read()
+        self.assertEqual(sorted(data), [self.offsets[0], self.offsets[3]])
+        for entry in (entries[0], entries[3]):
+            self.assertEqual(data[entry['offset']],
+                             content[entry['offset']:entry['offset'] +
+                                     entry['length']])
+
+    def test_read_messages(self):
+        self.check_messages(WRF_Hydro_grib_index.read_messages(
+            self.filename, self.selectors))
+
+    def test_read_messages_wgrib2(self):
+        self.write_idx(self.offsets)
+        self.check_messages(WRF_Hydro_grib_index.read_messages(
+            self.filename, self.selectors))
+
+        # An inventory listing the messages wrongly is not used.
+        self.write_idx([self.offsets[i] for i in (3, 1, 2, 0)])
+        self.check_messages(WRF_Hydro_grib_index.read_messages(
+            self.filename, self.selectors))
+
+    def test_cached_inventory(self):
+        index_dir = os.path.join(self.tmp_dir, "index")
+        entries = WRF_Hydro_grib_index.cached_inventory(self.filename,
+                                                        index_dir)
+        (cache_file,) = os.listdir(index_dir)
+        self.assertEqual(WRF_Hydro_grib_index.cached_inventory(self.filename,
+                                                               index_dir),
+                         entries)
+        self.check_messages(WRF_Hydro_grib_index.read_messages(
+            self.filename, self.selectors, index_dir))
+        self.assertEqual(os.listdir(index_dir), [cache_file])
+
+    def test_not_grib2(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a GRIB2 file')
+        self.assertRaises(ValueError, WRF_Hydro_grib_index.read_messages,
+                          self.filename, self.selectors)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+from collections import OrderedDict
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_layering
+
+
+
+# -----------------------------------------------------
+#             test_layering.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the layering of WRF_Hydro_layering on a synthetic 3x4
+#  grid: the cells not covered by the primary product are filled
+#  from the secondary product, using the cached coverage index.
+
+
+
+def make_fields(value, missing=()):
+    """Returns the fields of a product, all set to value except the
+    missing (NaN) cells, given by their flat index.
+    """
+    fields = OrderedDict()
+    for name in WRF_Hydro_layering.LAYERED_VARIABLES:
+        field = np.full((3, 4), value, dtype=np.float32)
+        field.flat[list(missing)] = np.nan
+        fields[name] = (field, {'units': name})
+    return fields
+
+
+
+class LayerFieldsTest(unittest.TestCase):
+
+    def test_fill(self):
+        primary = make_fields(1., missing=(0, 5, 11))
+        secondary = make_fields(2.)
+        layered = WRF_Hydro_layering.layer_fields(primary, secondary)
+        self.assertEqual(list(layered), list(WRF_Hydro_layering.LAYERED_VARIABLES))
+        for name, (field, attributes) in layered.items():
+            self.assertEqual(attributes, {'units': name})
+            self.assertFalse(np.isnan(field).any())
+            if name in WRF_Hydro_layering.SECONDARY_ONLY_VARIABLES:
+                np.testing.assert_array_equal(field, 2.)
+                continue
+            np.testing.assert_array_equal(field.flat[[0, 5, 11]], 2.)
+            self.assertEqual(np.count_nonzero(field == 1.), 9)
+
+    def test_fill_given_cells(self):
+        primary = make_fields(1., missing=(0,))
+        secondary = make_fields(2.)
+        layered = WRF_Hydro_layering.layer_fields(primary, secondary,
+                                                  np.array([0, 1]))
+        np.testing.assert_array_equal(layered['T2D'][0].flat[:3], [2., 2., 1.])
+
+
+
+class CoverageIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.static_file = os.path.join(self.tmp_dir, "geo.nc")
+        with open(self.static_file, 'w') as f:
+            f.write("geo")
+        self.cache_dir = os.path.join(self.tmp_dir, "coverage")
+        WRF_Hydro_layering._coverage_cache.clear()
+
+    def tearDown(self):
+        WRF_Hydro_layering._coverage_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def load(self, missing):
+        t2d = make_fields(1., missing)['T2D'][0]
+        return list(WRF_Hydro_layering.load_coverage_index(
+            t2d, [self.static_file], self.cache_dir))
+
+    def test_cached(self):
+        self.assertEqual(self.load((1, 2)), [1, 2])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # Read from the sidecar by another process.
+        WRF_Hydro_layering._coverage_cache.clear()
+        self.assertEqual(self.load((1, 2)), [1, 2])
+
+    def test_missing_outside_coverage(self):
+        self.load((1, 2))
+        # An outage of this file only is filled, the cache is kept.
+        self.assertEqual(self.load((1, 2, 7)), [1, 2, 7])
+        self.assertEqual(self.load((1, 2)), [1, 2])
+
+    def test_coverage_changed(self):
+        self.load((1, 2))
+        # Cached cells present in T2D: the coverage is recomputed.
+        self.assertEqual(self.load((3,)), [3])
+        WRF_Hydro_layering._coverage_cache.clear()
+        self.assertEqual(self.load((3, 4)), [3, 4])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
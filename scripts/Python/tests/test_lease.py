@@ -0,0 +1,89 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_lease
+
+
+
+# -----------------------------------------------------
+#             test_lease.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the claim, take-over and release of the task leases of
+#  WRF_Hydro_lease, the nodes being simulated by coordinators of
+#  the same run in one process.
+
+
+
+class LeaseCoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lease_dir = tempfile.mkdtemp()
+        self.coordinators = []
+
+    def tearDown(self):
+        for coordinator in self.coordinators:
+            coordinator.close()
+        shutil.rmtree(self.lease_dir)
+
+    def coordinator(self, node, lease_timeout=180.):
+        coordinator = WRF_Hydro_lease.LeaseCoordinator(
+            self.lease_dir, "run", heartbeat_interval=3600.,
+            lease_timeout=lease_timeout)
+        coordinator.node = node
+        self.coordinators.append(coordinator)
+        return coordinator
+
+    def lease(self, coordinator, task_name):
+        return coordinator.task_path(task_name) + ".lease"
+
+    def test_claim_and_release(self):
+        (node1, node2) = (self.coordinator("n1"), self.coordinator("n2"))
+        self.assertEqual(node1.claim("a.nc"), WRF_Hydro_lease.CLAIMED)
+        self.assertEqual(WRF_Hydro_lease.lease_owner(self.lease(node1, "a.nc")),
+                         "n1")
+        self.assertEqual(node2.claim("a.nc"), WRF_Hydro_lease.BUSY)
+        self.assertEqual(node2.claim("b.nc"), WRF_Hydro_lease.CLAIMED)
+
+        node1.release("a.nc", True)
+        node2.release("b.nc", False)
+        self.assertFalse(os.path.exists(self.lease(node1, "a.nc")))
+        self.assertEqual(node2.claim("a.nc"), WRF_Hydro_lease.DONE)
+        self.assertEqual(node1.claim("b.nc"), WRF_Hydro_lease.FAILED)
+
+    def test_take_over(self):
+        (node1, node2) = (self.coordinator("n1"),
+                          self.coordinator("n2", lease_timeout=60.))
+        self.assertEqual(node1.claim("a.nc"), WRF_Hydro_lease.CLAIMED)
+        lease = self.lease(node1, "a.nc")
+        # The lease of n1 is not refreshed any more.
+        stale = time.time() - 120.
+        os.utime(lease, (stale, stale))
+        self.assertEqual(node2.claim("a.nc"), WRF_Hydro_lease.CLAIMED)
+        self.assertEqual(WRF_Hydro_lease.lease_owner(lease), "n2")
+        self.assertFalse([name for name in os.listdir(node1.run_dir)
+                          if ".stale-" in name])
+
+        # n1 doesn't remove the lease of n2 when it ends.
+        node1.release("a.nc", True)
+        self.assertEqual(WRF_Hydro_lease.lease_owner(lease), "n2")
+        node2.release("a.nc", True)
+        self.assertFalse(os.path.exists(lease))
+
+    def test_fresh_lease_not_taken_over(self):
+        (node1, node2) = (self.coordinator("n1"),
+                          self.coordinator("n2", lease_timeout=60.))
+        node1.claim("a.nc")
+        self.assertFalse(node2.take_over(self.lease(node1, "a.nc")))
+        self.assertEqual(WRF_Hydro_lease.lease_owner(self.lease(node1, "a.nc")),
+                         "n1")
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_manifest
+
+
+
+# -----------------------------------------------------
+#             test_manifest.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the processed-file manifest and of the quarantine of
+#  WRF_Hydro_manifest, with small input and output files in a
+#  temporary directory.
+
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, "db", "manifest.sqlite")
+        self.manifest = WRF_Hydro_manifest.Manifest(self.db_file)
+        self.inputs = [self.write("input.grb2", "data"),
+                       self.write("weights.nc", "weights")]
+        self.output = self.write("output.nc", "output")
+        self.version = WRF_Hydro_manifest.stage_version('regridding', 'Python')
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content, mtime=None):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def is_current(self, input_files=None, version=None):
+        return self.manifest.is_current('regridding', self.output,
+                                        input_files or self.inputs,
+                                        version or self.version)
+
+    def test_stage_version(self):
+        self.assertEqual(self.version, "Python-%d" %
+                         WRF_Hydro_manifest.STAGE_VERSIONS['regridding'])
+
+    def test_record(self):
+        self.assertFalse(self.is_current())
+        self.manifest.record('regridding', self.output, self.inputs,
+                             self.version)
+        self.assertTrue(self.is_current())
+        self.assertFalse(self.manifest.is_current('downscaling', self.output,
+                                                  self.inputs, self.version))
+
+        # The manifest persists across runs.
+        self.manifest.close()
+        self.manifest = WRF_Hydro_manifest.Manifest(self.db_file)
+        self.assertTrue(self.is_current())
+
+    def test_missing_output(self):
+        self.manifest.record('regridding', self.output, self.inputs,
+                             self.version)
+        os.remove(self.output)
+        self.assertFalse(self.is_current())
+
+    def test_changed_inputs(self):
+        self.manifest.record('regridding', self.output, self.inputs,
+                             self.version)
+        self.assertFalse(self.is_current(version="NCL-1"))
+        self.assertFalse(self.is_current(input_files=self.inputs[:1]))
+
+        self.write("weights.nc", "weights2")
+        self.assertFalse(self.is_current())
+
+    def test_touched_input(self):
+        self.manifest.record('regridding', self.output, self.inputs,
+                             self.version)
+        # Only the modification time changed, the checksum didn't.
+        self.write("input.grb2", "data", mtime=1.e9)
+        self.assertTrue(self.is_current())
+
+        self.write("input.grb2", "DATA", mtime=1.1e9)
+        self.assertFalse(self.is_current())
+
+    def test_force(self):
+        self.manifest.record('regridding', self.output, self.inputs,
+                             self.version)
+        forced = WRF_Hydro_manifest.Manifest(self.db_file, force=True)
+        try:
+            self.assertFalse(forced.is_current('regridding', self.output,
+                                               self.inputs, self.version))
+        finally:
+            forced.close()
+
+    def test_quarantine(self):
+        args = ('regridding', self.output, self.inputs, self.version)
+        self.assertEqual(self.manifest.is_quarantined(*args, max_age=3600.),
+                         None)
+        self.manifest.quarantine(*(args + ("exit status 1",)))
+        self.assertEqual(self.manifest.is_quarantined(*args, max_age=3600.),
+                         "exit status 1")
+        # The quarantine expires, or ends when an input changes.
+        self.assertEqual(self.manifest.is_quarantined(*args, max_age=-1.),
+                         None)
+        self.assertEqual(self.manifest.is_quarantined(
+            'regridding', self.output, self.inputs[:1], self.version,
+            max_age=3600.), None)
+
+        self.manifest.record(*args)
+        self.assertEqual(self.manifest.is_quarantined(*args, max_age=3600.),
+                         None)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
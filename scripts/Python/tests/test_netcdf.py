@@ -0,0 +1,192 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+from collections import OrderedDict
+from netCDF4 import Dataset
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_netcdf
+
+
+
+# -----------------------------------------------------
+#             test_netcdf.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the NetCDF writing of WRF_Hydro_netcdf with the output
+#  options: NetCDF3 as NCL, compressed NetCDF4, quantized or packed
+#  fields, writing by blocks of rows and repacking of NCL files.
+
+
+
+COMPRESSED = {'format': 'NETCDF4', 'complevel': 4}
+
+
+
+class WriteFieldsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.out_file = os.path.join(self.tmp_dir, "out.nc")
+        self.field = np.linspace(200., 300., 20, dtype=np.float32).reshape(4, 5)
+        self.field[1, 2] = np.nan
+        self.fields = OrderedDict([('T2D', (self.field, {'units': 'K'})),
+                                   ('Q2D', (self.field / 1000., {}))])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, name='T2D'):
+        with Dataset(self.out_file) as nc:
+            return WRF_Hydro_netcdf.read_field(nc, name)
+
+    def test_default(self):
+        WRF_Hydro_netcdf.write_fields(self.out_file, self.fields)
+        self.assertFalse(os.path.exists(self.out_file + ".tmp"))
+        with Dataset(self.out_file) as nc:
+            self.assertEqual(nc.data_model, 'NETCDF3_64BIT_OFFSET')
+            var = nc.variables['T2D']
+            self.assertEqual(var.dtype, np.float32)
+            self.assertEqual(var.dimensions, ('south_north', 'west_east'))
+            self.assertEqual(var.units, 'K')
+            self.assertEqual(var._FillValue,
+                             np.float32(WRF_Hydro_netcdf.FILL_VALUE))
+        np.testing.assert_array_equal(self.read(), self.field)
+        self.assertEqual(list(WRF_Hydro_netcdf.read_fields(
+            self.out_file, ['Q2D', 'U2D', 'T2D'])), ['Q2D', 'T2D'])
+
+    def test_compressed(self):
+        WRF_Hydro_netcdf.write_fields(self.out_file, self.fields, COMPRESSED)
+        with Dataset(self.out_file) as nc:
+            self.assertEqual(nc.data_model, 'NETCDF4')
+            var = nc.variables['T2D']
+            self.assertTrue(var.filters()['zlib'])
+            self.assertTrue(var.filters()['shuffle'])
+            self.assertEqual(var.chunking(), [4, 5])
+        np.testing.assert_array_equal(self.read(), self.field)
+
+    def test_least_significant_digit(self):
+        options = dict(COMPRESSED, least_significant_digit={'T2D': 1})
+        WRF_Hydro_netcdf.write_fields(self.out_file, self.fields, options)
+        np.testing.assert_allclose(self.read(), self.field, atol=.1)
+        self.assertFalse((self.read() == self.field).all())
+        np.testing.assert_array_equal(self.read('Q2D'), self.field / 1000.)
+
+    def test_pack_int16(self):
+        options = dict(COMPRESSED, pack_int16=('T2D',))
+        WRF_Hydro_netcdf.write_fields(self.out_file, self.fields, options)
+        with Dataset(self.out_file) as nc:
+            var = nc.variables['T2D']
+            self.assertEqual(var.dtype, np.int16)
+            scale_factor = float(var.scale_factor)
+        self.assertAlmostEqual(scale_factor, 100. / 65534., places=6)
+        packed = self.read()
+        self.assertTrue(np.isnan(packed[1, 2]))
+        np.testing.assert_allclose(packed, self.field, atol=scale_factor)
+
+    def test_int16_packing(self):
+        (scale_factor, add_offset) = WRF_Hydro_netcdf.int16_packing(
+            np.array([[np.nan, 10.], [20., 30.]]))
+        self.assertAlmostEqual(add_offset, 20.)
+        self.assertAlmostEqual(scale_factor * WRF_Hydro_netcdf.INT16_MAX, 10.,
+                               places=4)
+        self.assertEqual(WRF_Hydro_netcdf.int16_packing(np.full((2, 2), 5.)),
+                         (1., 5.))
+
+    def test_options_version(self):
+        self.assertEqual(WRF_Hydro_netcdf.options_version(), "")
+        self.assertEqual(WRF_Hydro_netcdf.options_version(
+            dict(COMPRESSED, pack_int16=('T2D',), chunk_shape=(2, 5))),
+            "NETCDF4-z4s-c2x5-i16:T2D")
+
+
+
+class WriteTiledTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.field = np.arange(35, dtype=np.float32).reshape(7, 5)
+        self.variables = OrderedDict([('T2D', {'units': 'K'})])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def blocks(self, tile_rows):
+        return [(start, stop, {'T2D': self.field[start:stop]})
+                for (start, stop) in WRF_Hydro_netcdf.row_blocks(7, tile_rows)]
+
+    def test_row_blocks(self):
+        self.assertEqual(WRF_Hydro_netcdf.row_blocks(7, 3),
+                         [(0, 3), (3, 6), (6, 7)])
+        self.assertEqual(WRF_Hydro_netcdf.row_blocks(7, 0), [(0, 7)])
+
+    def test_write_tiled(self):
+        out_file = os.path.join(self.tmp_dir, "tiled.nc")
+        WRF_Hydro_netcdf.write_tiled(out_file, (7, 5), self.variables,
+                                     self.blocks(3), 3, COMPRESSED)
+        with Dataset(out_file) as nc:
+            self.assertEqual(nc.variables['T2D'].chunking(), [3, 5])
+            self.assertEqual(nc.variables['T2D'].units, 'K')
+            buffer = np.empty((2, 5), dtype=np.float32)
+            WRF_Hydro_netcdf.read_rows(nc, 'T2D', 3, 5, buffer)
+            np.testing.assert_array_equal(buffer, self.field[3:5])
+            np.testing.assert_array_equal(
+                WRF_Hydro_netcdf.read_field(nc, 'T2D'), self.field)
+
+    def test_packed_variable(self):
+        self.assertRaises(ValueError, WRF_Hydro_netcdf.write_tiled,
+                          os.path.join(self.tmp_dir, "tiled.nc"), (7, 5),
+                          self.variables, self.blocks(3), 3,
+                          dict(COMPRESSED, pack_int16=('T2D',)))
+
+
+
+class RepackFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "ncl.nc")
+        self.field = np.linspace(0., 1., 12, dtype=np.float32).reshape(1, 3, 4)
+        with Dataset(self.filename, 'w', format='NETCDF3_64BIT') as nc:
+            nc.setncattr('source', 'NCL')
+            nc.createDimension('Time', None)
+            nc.createDimension('south_north', 3)
+            nc.createDimension('west_east', 4)
+            dimensions = ('Time', 'south_north', 'west_east')
+            nc.createVariable('T2D', 'f4', dimensions)[:] = self.field
+            nc.createVariable('XLAT', 'f8', dimensions[1:])[:] = self.field[0]
+            nc.createVariable('levels', 'f4', ('west_east',))[:] = self.field[0, 0]
+            nc.variables['T2D'].setncattr('units', 'K')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_repack(self):
+        WRF_Hydro_netcdf.repack_file(self.filename,
+                                     dict(COMPRESSED, pack_int16=('T2D',)))
+        with Dataset(self.filename) as nc:
+            self.assertEqual(nc.data_model, 'NETCDF4')
+            self.assertEqual(nc.source, 'NCL')
+            self.assertTrue(nc.dimensions['Time'].isunlimited())
+            t2d = nc.variables['T2D']
+            self.assertEqual(t2d.dtype, np.int16)
+            self.assertEqual(t2d.units, 'K')
+            self.assertTrue(t2d.filters()['zlib'])
+            np.testing.assert_allclose(t2d[:], self.field,
+                                       atol=float(t2d.scale_factor))
+            # The double precision and 1D variables are copied as is.
+            for (name, dtype, values) in (('XLAT', np.float64, self.field[0]),
+                                          ('levels', np.float32,
+                                           self.field[0, 0])):
+                var = nc.variables[name]
+                self.assertEqual(var.dtype, dtype)
+                self.assertFalse(var.filters()['zlib'])
+                np.testing.assert_array_equal(var[:], values)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse
+from netCDF4 import Dataset
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_regrid
+
+
+
+# -----------------------------------------------------
+#             test_regrid.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the sparse (CSR) regridding of WRF_Hydro_regrid on a
+#  synthetic 2x2 source grid and 2x3 destination grid, and of the
+#  coordinates written in the regridded files.
+
+
+
+def make_weights():
+    """Returns the RegridWeights of the test grids: the first
+    destination row averages pairs of source cells, the second one
+    copies a source cell, averages all of them and has an unmapped
+    cell.
+    """
+    rows = [0, 0, 1, 1, 2, 2, 3, 4, 4, 4, 4]
+    cols = [0, 1, 1, 2, 2, 3, 3, 0, 1, 2, 3]
+    weights = [.5, .5, .5, .5, .5, .5, 1., .25, .25, .25, .25]
+    matrix = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(6, 4),
+                                     dtype=np.float32)
+    return WRF_Hydro_regrid.RegridWeights(matrix, (2, 2), (2, 3))
+
+
+
+class RegridWeightsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.weights = make_weights()
+        self.src = np.array([[1., 2.], [3., 4.]], dtype=np.float32)
+
+    def test_apply(self):
+        (dst,) = self.weights.apply([self.src])
+        self.assertEqual(dst.dtype, np.float32)
+        self.assertEqual(dst.shape, (2, 3))
+        np.testing.assert_allclose(dst[0], [1.5, 2.5, 3.5])
+        np.testing.assert_allclose(dst[1, :2], [4., 2.5])
+        self.assertTrue(np.isnan(dst[1, 2]))
+
+    def test_apply_several_fields(self):
+        (dst, dst2) = self.weights.apply([self.src, 2 * self.src])
+        np.testing.assert_allclose(dst2, 2 * dst)
+
+    def test_missing_source_cell(self):
+        src = self.src.copy()
+        src[0, 1] = np.nan
+        (dst,) = self.weights.apply([src])
+        # Only the cells computed from the missing one are missing.
+        np.testing.assert_array_equal(np.isnan(dst),
+                                      [[True, True, False],
+                                       [False, True, True]])
+        np.testing.assert_allclose(dst[0, 2], 3.5)
+        np.testing.assert_allclose(dst[1, 0], 4.)
+
+    def test_apply_rows(self):
+        (stacked, missing) = self.weights.stack([self.src])
+        self.assertIsNone(missing)
+        (full,) = self.weights.apply([self.src])
+        (row,) = self.weights.apply_rows(stacked, missing, 1, 2)
+        np.testing.assert_array_equal(row, full[1:2])
+
+    def test_shape_mismatch(self):
+        self.assertRaises(ValueError, self.weights.apply,
+                          [np.zeros((3, 3), dtype=np.float32)])
+
+
+
+
+class CoordinatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.geo_file = os.path.join(self.tmp_dir, "geo_dst.nc")
+        with Dataset(self.geo_file, 'w') as nc:
+            nc.createDimension('Time', 1)
+            nc.createDimension('south_north', 2)
+            nc.createDimension('west_east', 3)
+            for (name, offset) in (('XLAT_M', 40.), ('XLONG_M', -105.)):
+                var = nc.createVariable(name, 'f4',
+                                        ('Time', 'south_north', 'west_east'))
+                var[:] = offset + np.arange(6).reshape((1, 2, 3))
+                var.units = 'degrees'
+
+    def tearDown(self):
+        WRF_Hydro_regrid._coordinates_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_gfs(self):
+        coordinates = WRF_Hydro_regrid.read_coordinates('GFS', self.geo_file)
+        self.assertEqual(list(coordinates), ['lat', 'lon'])
+        (lat, attributes) = coordinates['lat']
+        np.testing.assert_array_equal(lat, 40. + np.arange(6).reshape((2, 3)))
+        self.assertEqual(attributes['units'], 'degrees')
+        np.testing.assert_array_equal(coordinates['lon'][0][0],
+                                      [-105., -104., -103.])
+
+    def test_other_products(self):
+        for product in ('HRRR', 'RAP', 'NAM', 'MRMS'):
+            self.assertEqual(
+                WRF_Hydro_regrid.read_coordinates(product, None), {})
+
+    def test_missing_grid_file(self):
+        self.assertRaises(ValueError, WRF_Hydro_regrid.read_coordinates,
+                          'GFS', None)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_failures
+import WRF_Hydro_manifest
+import WRF_Hydro_metrics
+import WRF_Hydro_scheduler
+
+
+
+# -----------------------------------------------------
+#             test_scheduler.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the task graph of WRF_Hydro_scheduler, the jobs being
+#  simulated by fake_job: the regridding of two products, their
+#  downscaling and the layering of the downscaled files.
+
+
+
+def fake_job(job):
+    """Runs a test job: (output file, [action, input files]).  The
+    job fails if one of its inputs is missing, or if its action is
+    'fail', or 'fail_once' and it is run for the first time; it
+    writes its output file, from the content of its inputs, otherwise.
+    """
+    (output_file, (action, input_files)) = job
+    marker = output_file + ".failed"
+    failed = action == 'fail' or \
+             (action == 'fail_once' and not os.path.exists(marker)) or \
+             not all(os.path.exists(f) for f in input_files)
+    if failed:
+        open(marker, 'w').close()
+    else:
+        with open(output_file, 'w') as f:
+            for input_file in input_files:
+                with open(input_file) as data:
+                    f.write(data.read())
+            f.write(os.path.basename(output_file))
+    return (output_file, 0., 1 if failed else 0,
+            WRF_Hydro_metrics.empty_metrics())
+
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = None
+
+    def tearDown(self):
+        if self.manifest is not None:
+            self.manifest.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def graph(self, actions={}):
+        """Builds the graph:
+            regrid(HRRR) -> downscale(HRRR) -> layer
+            regrid(RAP)  -> downscale(RAP) ----^
+        """
+        graph = WRF_Hydro_scheduler.TaskGraph()
+        for product in ('HRRR', 'RAP'):
+            stages = (('regridding', 'Regrid', self.path(product + ".grb2"),
+                       self.path(product + "_regridded.nc")),
+                      ('downscaling', 'Downscale',
+                       self.path(product + "_regridded.nc"),
+                       self.path(product + "_downscaled.nc")))
+            for (stage, activity, input_file, output_file) in stages:
+                action = actions.get(os.path.basename(output_file), 'run')
+                graph.add_jobs((product, activity), stage, "Python-1",
+                               [(output_file, (action, [input_file]))],
+                               {output_file: [input_file]})
+        inputs = [self.path("HRRR_downscaled.nc"), self.path("RAP_downscaled.nc")]
+        output_file = self.path("layered.nc")
+        graph.add_jobs(('HRRR', 'Layer'), 'layering', "Python-1",
+                       [(output_file, ('run', inputs))], {output_file: inputs})
+        for product in ('HRRR', 'RAP'):
+            if not os.path.exists(self.path(product + ".grb2")):
+                open(self.path(product + ".grb2"), 'w').close()
+        return graph
+
+    def return_values(self, results):
+        return dict((os.path.basename(result[0]), result[2])
+                    for label_results in results.values()
+                    for result in label_results)
+
+    def test_dependencies(self):
+        graph = self.graph()
+        self.assertEqual([task['depth'] for task in graph.tasks],
+                         [0, 1, 0, 1, 2])
+        self.assertEqual(graph.tasks[4]['dependencies'], set([1, 3]))
+        self.assertEqual(len(graph.outputs()), 5)
+
+        for num_workers in (1, 2):
+            results = graph.run(fake_job, num_workers=num_workers)
+            self.assertEqual(list(results.keys()),
+                             [('HRRR', 'Regrid'), ('HRRR', 'Downscale'),
+                              ('RAP', 'Regrid'), ('RAP', 'Downscale'),
+                              ('HRRR', 'Layer')])
+            self.assertEqual(set(self.return_values(results).values()), set([0]))
+            self.assertTrue(os.path.isfile(self.path("layered.nc")))
+            os.remove(self.path("layered.nc"))
+
+    def test_upstream_failure(self):
+        results = self.graph({'RAP_regridded.nc': 'fail'}).run(fake_job)
+        self.assertEqual(self.return_values(results),
+                         {'HRRR_regridded.nc': 0,
+                          'HRRR_downscaled.nc': 0,
+                          'RAP_regridded.nc': 1,
+                          'RAP_downscaled.nc': WRF_Hydro_scheduler.UPSTREAM_FAILED,
+                          'layered.nc': WRF_Hydro_scheduler.UPSTREAM_FAILED})
+        self.assertFalse(os.path.exists(self.path("layered.nc")))
+
+    def test_retry(self):
+        retry = WRF_Hydro_failures.RetryPolicy(max_retries=1, retry_delay=0.)
+        for num_workers in (1, 2):
+            results = self.graph({'RAP_regridded.nc': 'fail_once'}).run(
+                fake_job, num_workers=num_workers, retry=retry)
+            self.assertEqual(set(self.return_values(results).values()), set([0]))
+            (rap_regrid,) = results[('RAP', 'Regrid')]
+            self.assertEqual(rap_regrid[3]['attempts'], 2)
+            self.assertEqual(results[('HRRR', 'Regrid')][0][3]['attempts'], 1)
+            os.remove(self.path("RAP_regridded.nc.failed"))
+
+    def test_manifest(self):
+        self.manifest = WRF_Hydro_manifest.Manifest(self.path("manifest.sqlite"))
+        results = self.graph().run(fake_job, manifest=self.manifest)
+        self.assertEqual(len(self.return_values(results)), 5)
+
+        # The up to date tasks are skipped, and only the task of a
+        # changed input and those whose inputs it changes are run
+        # again.
+        results = self.graph().run(fake_job, manifest=self.manifest)
+        self.assertEqual(self.return_values(results), {})
+        with open(self.path("RAP.grb2"), 'w') as f:
+            f.write("new data")
+        results = self.graph().run(fake_job, manifest=self.manifest)
+        self.assertEqual(sorted(self.return_values(results)),
+                         ['RAP_downscaled.nc', 'RAP_regridded.nc', 'layered.nc'])
+
+    def test_quarantine(self):
+        self.manifest = WRF_Hydro_manifest.Manifest(self.path("manifest.sqlite"))
+        actions = {'RAP_regridded.nc': 'fail'}
+        results = self.graph(actions).run(fake_job, manifest=self.manifest,
+                                          quarantine_hours=1.)
+        (rap_regrid,) = results[('RAP', 'Regrid')]
+        self.assertTrue(rap_regrid[3]['quarantined'])
+
+        results = self.graph(actions).run(fake_job, manifest=self.manifest,
+                                          quarantine_hours=1.)
+        self.assertEqual(self.return_values(results),
+                         {'RAP_regridded.nc': WRF_Hydro_scheduler.QUARANTINED,
+                          'RAP_downscaled.nc': WRF_Hydro_scheduler.UPSTREAM_FAILED,
+                          'layered.nc': WRF_Hydro_scheduler.UPSTREAM_FAILED})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import datetime
+import math
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+from netCDF4 import Dataset
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_shortwave
+
+
+
+# -----------------------------------------------------
+#             test_shortwave.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the topographic adjustment of the shortwave radiation
+#  of WRF_Hydro_shortwave on synthetic 4x3 grids at 40N 0E, flat or
+#  sloping to the north or to the south.
+
+
+
+def write_geo_file(geo_file, hgt):
+    """Writes a geo file at 40N 0E, not rotated, with 1 km spacing
+    and the given terrain height.
+    """
+    with Dataset(geo_file, 'w') as nc:
+        nc.createDimension('Time', 1)
+        nc.createDimension('south_north', hgt.shape[0])
+        nc.createDimension('west_east', hgt.shape[1])
+        nc.setncattr('DX', 1000.)
+        nc.setncattr('DY', 1000.)
+        dimensions = ('Time', 'south_north', 'west_east')
+        for (name, value) in (('XLAT_M', 40.), ('XLONG_M', 0.),
+                              ('COSALPHA', 1.), ('SINALPHA', 0.), ('HGT_M', hgt)):
+            nc.createVariable(name, 'f4', dimensions)[:] = \
+                np.broadcast_to(value, hgt.shape)
+
+
+
+class SlopeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ones = np.ones((4, 3))
+
+    def test_flat(self):
+        (slope, slp_azi) = WRF_Hydro_shortwave.cal_slope(
+            np.full((4, 3), 250.), 1000., 1000., self.ones, 0 * self.ones)
+        self.assertEqual(slope.dtype, np.float32)
+        self.assertFalse(slope.any())
+        self.assertFalse(slp_azi.any())
+
+    def test_tilted(self):
+        hgt = 100. * np.arange(3.) * self.ones
+        (slope, slp_azi) = WRF_Hydro_shortwave.cal_slope(
+            hgt, 1000., 1000., self.ones, 0 * self.ones)
+        np.testing.assert_allclose(slope, math.atan(.1), rtol=1.e-6)
+        np.testing.assert_allclose(slp_azi, 1.5 * math.pi, rtol=1.e-6)
+
+        # The azimuth is rotated to the lat-lon grid.
+        angle = .1
+        (_, rotated) = WRF_Hydro_shortwave.cal_slope(
+            hgt, 1000., 1000., math.cos(angle) * self.ones,
+            math.sin(angle) * self.ones)
+        np.testing.assert_allclose(rotated, slp_azi - angle, rtol=1.e-6)
+
+
+
+class SolarGeometryTest(unittest.TestCase):
+
+    def test_solar_declination(self):
+        self.assertAlmostEqual(WRF_Hydro_shortwave.solar_declination(80.), 0.)
+        self.assertAlmostEqual(WRF_Hydro_shortwave.solar_declination(172.),
+                               23.5 * WRF_Hydro_shortwave.DEGRAD, places=3)
+        self.assertAlmostEqual(WRF_Hydro_shortwave.solar_declination(355.),
+                               -23.5 * WRF_Hydro_shortwave.DEGRAD, places=2)
+
+    def test_valid_time_from_filename(self):
+        self.assertEqual(WRF_Hydro_shortwave.valid_time_from_filename(
+                             "/data/20150630_i22_f003_HRRR.nc"),
+                         datetime.datetime(2015, 7, 1, 1))
+        self.assertRaises(ValueError,
+                          WRF_Hydro_shortwave.valid_time_from_filename,
+                          "HRRR.nc")
+
+
+
+class AdjustShortwaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rows = np.arange(4.)[:, None] * np.ones((1, 3))
+        self.noon = datetime.datetime(2015, 6, 21, 12)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        WRF_Hydro_shortwave._geometry_cache.clear()
+
+    def adjusted(self, hgt, valid_time, cache_dir=None):
+        geo_file = os.path.join(self.tmp_dir, "geo.nc")
+        write_geo_file(geo_file, hgt)
+        geometry = WRF_Hydro_shortwave.compute_terrain_geometry(geo_file,
+                                                                cache_dir)
+        swdown = np.full(hgt.shape, 500., dtype=np.float32)
+        WRF_Hydro_shortwave.adjust_shortwave(swdown, geometry, valid_time)
+        return swdown
+
+    def test_flat_terrain(self):
+        swdown = self.adjusted(np.zeros((4, 3)), self.noon)
+        np.testing.assert_array_equal(swdown, 500.)
+
+    def test_sloping_terrain(self):
+        # The terrain rises to the north, so it faces the sun.
+        facing = self.adjusted(100. * self.rows, self.noon)
+        self.assertTrue((facing > 500.).all())
+        self.assertTrue((facing <= 500. * WRF_Hydro_shortwave.MAX_CORRECTION).all())
+        away = self.adjusted(-100. * self.rows, self.noon)
+        self.assertTrue((away < 500.).all())
+
+    def test_night(self):
+        swdown = self.adjusted(100. * self.rows, datetime.datetime(2015, 6, 21))
+        np.testing.assert_array_equal(swdown, 500.)
+
+    def test_geometry_sidecar(self):
+        cache_dir = os.path.join(self.tmp_dir, "terrain")
+        swdown = self.adjusted(100. * self.rows, self.noon, cache_dir)
+        (sidecar,) = os.listdir(cache_dir)
+        self.assertTrue(sidecar.startswith("geo-terrain-"))
+        # The slope is read back from the sidecar.
+        geometry = WRF_Hydro_shortwave.load_terrain_geometry(
+            os.path.join(self.tmp_dir, "geo.nc"), cache_dir)
+        self.assertEqual(os.listdir(cache_dir), [sidecar])
+        cached = np.full((4, 3), 500., dtype=np.float32)
+        WRF_Hydro_shortwave.adjust_shortwave(cached, geometry, self.noon)
+        np.testing.assert_array_equal(cached, swdown)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
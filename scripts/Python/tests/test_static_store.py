@@ -0,0 +1,117 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_static_store
+
+
+
+# -----------------------------------------------------
+#             test_static_store.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the node-wide static field store of
+#  WRF_Hydro_static_store, its entries being computed from a small
+#  static file by a counting builder.
+
+
+
+# A pid above the largest pid of Linux, of no process.
+DEAD_PID = 2 ** 22 + 1
+
+
+
+class StaticStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, "store")
+        self.static_file = os.path.join(self.tmp_dir, "geo.nc")
+        self.write_static_file("1")
+        self.computed = 0
+
+    def tearDown(self):
+        WRF_Hydro_static_store.release_references()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_static_file(self, content, mtime=None):
+        with open(self.static_file, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.static_file, (mtime, mtime))
+
+    def compute(self):
+        self.computed += 1
+        return {'hgt': np.arange(6, dtype=np.float32).reshape(2, 3) *
+                       self.computed,
+                'is_flat': np.zeros((2, 3), dtype=bool)}
+
+    def load(self, store_dir=None):
+        return WRF_Hydro_static_store.load_fields(
+            store_dir or self.store_dir, 'downscale', [self.static_file],
+            self.compute)
+
+    def entries(self):
+        return sorted(name for name in os.listdir(self.store_dir)
+                      if os.path.isdir(os.path.join(self.store_dir, name)))
+
+    def test_load_fields(self):
+        fields = self.load()
+        self.assertEqual(sorted(fields), ['hgt', 'is_flat'])
+        self.assertEqual(fields['hgt'].dtype, np.float32)
+        self.assertFalse(fields['hgt'].flags.writeable)
+        np.testing.assert_array_equal(fields['hgt'][1], [3., 4., 5.])
+
+        (entry,) = self.entries()
+        self.assertTrue(entry.startswith("downscale-"))
+        self.assertEqual(os.listdir(os.path.join(
+            self.store_dir, entry, WRF_Hydro_static_store.REFS_DIR)),
+            [str(os.getpid())])
+
+        # The entry is reused, not computed again.
+        np.testing.assert_array_equal(self.load()['hgt'], fields['hgt'])
+        self.assertEqual(self.computed, 1)
+
+    def test_changed_file(self):
+        self.load()
+        (old_entry,) = self.entries()
+        self.write_static_file("2", mtime=time.time() + 10)
+        np.testing.assert_array_equal(self.load()['hgt'][1], [6., 8., 10.])
+        # The old entry is still referenced by this process.
+        self.assertEqual(len(self.entries()), 2)
+
+        WRF_Hydro_static_store.release_references()
+        WRF_Hydro_static_store.evict_stale_entries(self.store_dir)
+        (new_entry,) = self.entries()
+        self.assertNotEqual(new_entry, old_entry)
+
+    def test_dead_references(self):
+        self.load()
+        (entry,) = self.entries()
+        WRF_Hydro_static_store.release_references()
+        refs_dir = os.path.join(self.store_dir, entry,
+                                WRF_Hydro_static_store.REFS_DIR)
+        open(os.path.join(refs_dir, str(DEAD_PID)), 'w').close()
+        os.mkdir(os.path.join(self.store_dir, "%s.tmp.%d" % (entry, DEAD_PID)))
+
+        self.assertEqual(WRF_Hydro_static_store.live_references(
+            os.path.join(self.store_dir, entry)), 0)
+        os.remove(self.static_file)
+        WRF_Hydro_static_store.evict_stale_entries(self.store_dir)
+        self.assertEqual(self.entries(), [])
+
+    def test_unusable_store(self):
+        store_dir = os.path.join(self.static_file, "store")
+        fields = self.load(store_dir)
+        self.assertTrue(fields['hgt'].flags.writeable)
+        self.assertEqual(self.computed, 1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import numpy as np
+from netCDF4 import Dataset
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import WRF_Hydro_weight_cache
+
+
+
+# -----------------------------------------------------
+#             test_weight_cache.py
+# -----------------------------------------------------
+
+#  Overview:
+#  Tests of the compiled weight cache of WRF_Hydro_weight_cache on
+#  a synthetic ESMF weight file from a 2x2 source grid to a 1x3
+#  destination grid.
+
+
+
+def write_weight_file(wgt_file, scale=1.):
+    """Writes an ESMF weight file (1-based row/col, grid dimensions
+    in Fortran order) whose weights are multiplied by scale.
+    """
+    rows = [1, 1, 2, 3, 3, 3, 3]
+    cols = [1, 2, 3, 1, 2, 3, 4]
+    weights = [.5, .5, 1., .25, .25, .25, .25]
+    with Dataset(wgt_file, 'w') as nc:
+        nc.createDimension('n_a', 4)
+        nc.createDimension('n_b', 3)
+        nc.createDimension('n_s', len(rows))
+        nc.createDimension('src_grid_rank', 2)
+        nc.createDimension('dst_grid_rank', 2)
+        nc.createVariable('src_grid_dims', 'i4', ('src_grid_rank',))[:] = [2, 2]
+        nc.createVariable('dst_grid_dims', 'i4', ('dst_grid_rank',))[:] = [3, 1]
+        nc.createVariable('row', 'i4', ('n_s',))[:] = rows
+        nc.createVariable('col', 'i4', ('n_s',))[:] = cols
+        nc.createVariable('S', 'f8', ('n_s',))[:] = np.multiply(weights, scale)
+
+
+
+class WeightCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.wgt_file = os.path.join(self.tmp_dir, "weights.nc")
+        write_weight_file(self.wgt_file)
+        self.src = np.array([[1., 2.], [3., 4.]], dtype=np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def entries(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_compile_and_load(self):
+        weights = WRF_Hydro_weight_cache.load_cached_weights(self.wgt_file,
+                                                             self.cache_dir)
+        self.assertEqual(weights.src_shape, (2, 2))
+        self.assertEqual(weights.dst_shape, (1, 3))
+        self.assertEqual(weights.matrix.indices.dtype, np.int32)
+        self.assertEqual(weights.matrix.data.dtype, np.float32)
+        (dst,) = weights.apply([self.src])
+        np.testing.assert_allclose(dst, [[1.5, 3., 2.5]])
+
+        (entry,) = self.entries()
+        self.assertTrue(entry.startswith("weights-"))
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.cache_dir, entry, WRF_Hydro_weight_cache.META_FILE)))
+
+    def test_cache_hit(self):
+        WRF_Hydro_weight_cache.load_cached_weights(self.wgt_file, self.cache_dir)
+        (entry,) = self.entries()
+        # The weight file isn't read again while its entry is valid.
+        compile_weights = WRF_Hydro_weight_cache.compile_weights
+        WRF_Hydro_weight_cache.compile_weights = None
+        try:
+            weights = WRF_Hydro_weight_cache.load_cached_weights(
+                self.wgt_file, self.cache_dir)
+        finally:
+            WRF_Hydro_weight_cache.compile_weights = compile_weights
+        self.assertEqual(self.entries(), [entry])
+        self.assertEqual(weights.dst_shape, (1, 3))
+
+    def test_changed_weight_file(self):
+        WRF_Hydro_weight_cache.load_cached_weights(self.wgt_file, self.cache_dir)
+        (old_entry,) = self.entries()
+
+        write_weight_file(self.wgt_file, scale=2.)
+        mtime = time.time() + 10
+        os.utime(self.wgt_file, (mtime, mtime))
+        weights = WRF_Hydro_weight_cache.load_cached_weights(self.wgt_file,
+                                                             self.cache_dir)
+        (dst,) = weights.apply([self.src])
+        np.testing.assert_allclose(dst, [[3., 6., 5.]])
+        # The stale entry was evicted when the new one was compiled.
+        (new_entry,) = self.entries()
+        self.assertNotEqual(new_entry, old_entry)
+
+    def test_evict_stale_entries(self):
+        WRF_Hydro_weight_cache.load_cached_weights(self.wgt_file, self.cache_dir)
+        dead_tmp = os.path.join(self.cache_dir, "weights-0.tmp.%s.%d" % (
+            WRF_Hydro_weight_cache.socket.gethostname(), 2 ** 22 + 1))
+        os.mkdir(dead_tmp)
+
+        WRF_Hydro_weight_cache.evict_stale_entries(self.cache_dir)
+        self.assertEqual(len(self.entries()), 1)
+
+        os.remove(self.wgt_file)
+        WRF_Hydro_weight_cache.evict_stale_entries(self.cache_dir)
+        self.assertEqual(self.entries(), [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()